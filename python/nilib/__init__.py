@@ -41,8 +41,10 @@ Lightweight NI NDO cache server:
  - niserver.py -       the guts of the server
  - niserver.conf -     main configuration file - specifies locations for logs, cache
  - niserver_log.conf - configuration file for Python logging system for server
- - niserver_stop.py -  command line utility to stop the server (only from the
-                       same host as it was started on)
+ - niserver_stop.py -  command line utility to stop the server or start and
+                       stop its sampling profiler (only from the same host
+                       as it was started on)
+ - nisampler.py -      sampling profiler for the server's handler threads
 
 Support modules:
 - ni.py -              library of ni: and nih: URL processing and digest
@@ -0,0 +1,776 @@
+#!/usr/bin/python
+"""
+@package nilib
+@file cache_listing.py
+@brief Shared memory listing of the NDOs in a NetInf cache
+@version Copyright (C) 2012 Trinity College Dublin and Folly Consulting Ltd
+      This is an adjunct to the NI URI library developed as
+      part of the SAIL project. (http://sail-project.eu)
+
+      Specification(s) - note, versions may change
+          - http://tools.ietf.org/html/draft-farrell-decade-ni-10
+          - http://tools.ietf.org/html/draft-hallambaker-decade-ni-params-03
+          - http://tools.ietf.org/html/draft-kutscher-icnrg-netinf-proto-00
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+       - http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+===============================================================================#
+
+@details
+Listing the cache used to mean reading the metadata directory (or the Redis
+sets) for every digest algorithm and checking for each content file on
+every request.  SharedCacheListing instead keeps the listing in one
+posix_ipc shared memory segment per storage root, shared by all the server
+processes using the cache (there may be several under mod_wsgi).
+
+The segment holds a header followed by a log of entry records, one line per
+record:
+
+    <hash alg> <digest> <content exists: 0 or 1> <timestamp>
+
+The timestamp is the time (in seconds since the epoch) at which the entry
+was added to the cache or its content arrived.  When the log is built by
+scanning the cache the modification time of the metadata is used.
+
+The cache modules call add_entry after each successful cache_put; a record
+is only appended if the entry is new or its content flag has changed, so
+the log stays about the size of the cache.  Each process keeps a decoded
+copy of the log and only decodes the records added since it last looked,
+so when nothing has changed a listing costs a comparison of the header with
+the one seen last time.
+
+Each process also keeps the digests for each algorithm in a sorted list
+(case insensitive order, as the cache listing pages have always been
+displayed) updated as records are decoded.  iter_entries walks this index
+from any starting digest in batches, taking the instance lock only while a
+batch is copied, so that pages of a listing can be generated (see
+nilisting.py) without copying or sorting the whole listing.
+StaticCacheListing provides the same interface over a dictionary returned
+by cache_list for use if the shared memory listing is not available.
+
+The header records:
+- a magic string,
+- the generation, incremented whenever the log is rewritten from scratch
+  (readers then start decoding again from the beginning),
+- the number of bytes of the log in use,
+- the capacity of the log (the segment is grown when it fills up and
+  readers remap it when the capacity changes),
+- a table of the process ids attached to the segment (one entry for each
+  SharedCacheListing instance).
+
+The first process to attach (or the first after all the processes attached
+have gone away without cleaning up) rebuilds the log by scanning the cache.
+The last process to close the listing (closing is also registered with
+atexit) removes the segment and its semaphore.  All updates of the segment
+are made holding the posix_ipc semaphore with the same name.
+"""
+import os
+import time
+import mmap
+import bisect
+import struct
+import atexit
+import hashlib
+import threading
+import posix_ipc as pipc
+
+#===============================================================================#
+# List of classes/global functions in file
+__all__ = ['SharedCacheListing', 'StaticCacheListing', 'listing_name_for',
+           'sort_key']
+
+#===============================================================================#
+##@var SHM_PREFIX
+# Start of the posix_ipc names for listing segments
+SHM_PREFIX = "/netinf_list_"
+
+##@var MAGIC
+# Identifies a listing segment (and its format version)
+MAGIC = "NIL2"
+
+##@var HDR_FMT
+# struct format for header: magic, generation, bytes used, capacity
+HDR_FMT = "!4sIII"
+
+##@var MAX_PROCS
+# Size of the table of attached process ids
+MAX_PROCS = 64
+
+##@var PID_FMT
+# struct format for table of attached process ids
+PID_FMT = "!%dI" % MAX_PROCS
+
+##@var PID_OFFSET
+# Offset of table of attached process ids in segment
+PID_OFFSET = struct.calcsize(HDR_FMT)
+
+##@var DATA_OFFSET
+# Offset of start of log of entry records in segment
+DATA_OFFSET = PID_OFFSET + struct.calcsize(PID_FMT)
+
+##@var INITIAL_CAPACITY
+# Initial size of log area in bytes (grown by doubling as needed)
+INITIAL_CAPACITY = 1 << 20
+
+##@var BATCH_SIZE
+# Number of entries copied from the index at a time by iter_entries
+BATCH_SIZE = 256
+
+#===============================================================================#
+def listing_name_for(storage_root):
+    """
+    @brief Derive the posix_ipc name for the listing of a cache
+    @param storage_root string pathname for root of cache tree
+    @return string name for shared memory segment and semaphore
+    """
+    return SHM_PREFIX + \
+           hashlib.sha1(os.path.abspath(storage_root)).hexdigest()[:16]
+
+#===============================================================================#
+def sort_key(dgst):
+    """
+    @brief Key used to order the digests in a listing
+    @param dgst string digest
+    @return 2-tuple (lower case digest, digest)
+    """
+    return (dgst.lower(), dgst)
+
+#===============================================================================#
+class _OrderedListing(object):
+    """
+    @brief Decoded cache listing with a sorted index for each algorithm
+
+    Subclasses fill in the entries with _note and override _refresh if the
+    entries can change.
+    """
+    ##@var lock
+    # object Lock instance serializing access to this instance by threads
+
+    ##@var entries
+    # dictionary indexed by hash algorithm of dictionaries mapping digest to
+    # 2-tuple (content exists flag, timestamp)
+
+    ##@var order
+    # dictionary indexed by hash algorithm of sorted lists of sort_key values
+    # for the digests in entries
+
+    ##@var lists
+    # dictionary indexed by hash algorithm of listing arrays built from
+    # entries (rebuilt when entries for algorithm change)
+
+    #--------------------------------------------------------------------------#
+    def __init__(self):
+        """
+        @brief Constructor
+        """
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.order = {}
+        self.lists = {}
+        return
+
+    #--------------------------------------------------------------------------#
+    def _clear(self):
+        """
+        @brief Forget all entries - hold lock
+        @return (none)
+        """
+        self.entries = {}
+        self.order = {}
+        self.lists = {}
+        return
+
+    #--------------------------------------------------------------------------#
+    def _note(self, recs):
+        """
+        @brief Add or update entries - hold lock
+        @param recs iterable of 4-tuples (alg, digest, content exists, timestamp)
+        @return (none)
+
+        New digests are inserted in the sorted index, or appended and the
+        index resorted if there are a lot of them (e.g., when starting up).
+        """
+        added = {}
+        for (alg, dgst, ce, ts) in recs:
+            ents = self.entries.setdefault(alg, {})
+            if dgst not in ents:
+                added.setdefault(alg, []).append(sort_key(dgst))
+            ents[dgst] = (ce, ts)
+            self.lists.pop(alg, None)
+        for (alg, keys) in added.iteritems():
+            order = self.order.setdefault(alg, [])
+            if len(keys) > 16 + (len(order) / 8):
+                order.extend(keys)
+                order.sort()
+            else:
+                for k in keys:
+                    bisect.insort(order, k)
+        return
+
+    #--------------------------------------------------------------------------#
+    def _refresh(self):
+        """
+        @brief Bring the entries up to date - hold lock
+        @return boolean True if the listing is available
+        """
+        return True
+
+    #--------------------------------------------------------------------------#
+    def get_listing(self, alg_list):
+        """
+        @brief Get the listing of the cache for some hash algorithms
+        @param alg_list list of strings of digest algorithm names
+        @return dictionary indexed by hash algorithm of lists of
+                {"dgst":, "ce":, "ts":} objects (as cache_list) or None if
+                the listing is not available
+
+        The lists are shared between calls until the entries change and
+        must not be modified by the caller.
+        """
+        with self.lock:
+            if not self._refresh():
+                return None
+            rslt = {}
+            for alg in alg_list:
+                l = self.lists.get(alg)
+                if l is None:
+                    l = [ { "dgst": dgst, "ce": ce, "ts": ts } for
+                          (dgst, (ce, ts)) in
+                          self.entries.get(alg, {}).iteritems() ]
+                    self.lists[alg] = l
+                rslt[alg] = l
+        return rslt
+
+    #--------------------------------------------------------------------------#
+    def _batch(self, alg, after):
+        """
+        @brief Copy the next batch of entries from the index
+        @param alg string hash algorithm name
+        @param after 2-tuple sort_key of digest to start after or None
+        @return list of 4-tuples (sort key, digest, content exists, timestamp)
+                or None if the listing is not available
+        """
+        with self.lock:
+            if not self._refresh():
+                return None
+            order = self.order.get(alg, [])
+            i = 0 if after is None else bisect.bisect_right(order, after)
+            ents = self.entries[alg] if order else {}
+            return [ (k, k[1]) + ents[k[1]] for k in order[i:i + BATCH_SIZE] ]
+
+    #--------------------------------------------------------------------------#
+    def iter_entries(self, alg, after=None, content=None,
+                     since=None, until=None):
+        """
+        @brief Generate the entries for an algorithm in digest order
+        @param alg string hash algorithm name
+        @param after string digest to start after or None to start at the
+                     beginning
+        @param content boolean True (False) to generate only entries with
+                       (without) content, or None for all entries
+        @param since float only entries with timestamps >= since (if not None)
+        @param until float only entries with timestamps < until (if not None)
+        @return (yields) 3-tuples (digest, content exists, timestamp)
+
+        Entries added while the generator is running are included if they
+        come after the end of the batch that was last copied from the index.
+        """
+        after = None if after is None else sort_key(after)
+        while True:
+            batch = self._batch(alg, after)
+            if not batch:
+                return
+            for (after, dgst, ce, ts) in batch:
+                if (content is not None) and (ce != content):
+                    continue
+                if (since is not None) and (ts < since):
+                    continue
+                if (until is not None) and (ts >= until):
+                    continue
+                yield (dgst, ce, ts)
+
+#===============================================================================#
+class StaticCacheListing(_OrderedListing):
+    """
+    @brief Fixed listing made from the result of cache_list
+    """
+    #--------------------------------------------------------------------------#
+    def __init__(self, listing):
+        """
+        @brief Constructor
+        @param listing dictionary as returned by cache_list
+        """
+        _OrderedListing.__init__(self)
+        self._note((alg, e["dgst"], e["ce"], e.get("ts", 0))
+                   for (alg, ents) in listing.iteritems() for e in ents)
+        return
+
+#===============================================================================#
+class SharedCacheListing(_OrderedListing):
+    """
+    @brief Listing of cache entries kept in shared memory and updated
+           incrementally by cache_put
+
+    Create an instance, then call attach with the scan function of the
+    cache (used to build the log when no other process has done so) and
+    give it to the cache with set_listing.
+    """
+    ##@var logger
+    # object logger instance to output messages
+
+    ##@var shm_name
+    # string posix_ipc name of shared memory segment and semaphore
+
+    ##@var shm
+    # object posix_ipc SharedMemory instance (fd kept open for remapping)
+
+    ##@var sem
+    # object posix_ipc Semaphore instance serializing updates of segment
+
+    ##@var map
+    # object mmap instance mapping segment (None when closed)
+
+    ##@var pid
+    # integer process id recorded in segment for this instance
+
+    ##@var slot
+    # integer index of entry for this instance in attached table (or None)
+
+    ##@var seen
+    # 2-tuple (generation, bytes used) of log decoded into entries
+
+    #--------------------------------------------------------------------------#
+    def __init__(self, storage_root, logger):
+        """
+        @brief Constructor
+        @param storage_root string pathname for root of cache tree
+        @param logger object logger instance to output messages
+        """
+        _OrderedListing.__init__(self)
+        self.logger = logger
+        self.shm_name = listing_name_for(storage_root)
+        self.shm = None
+        self.sem = None
+        self.map = None
+        self.pid = None
+        self.slot = None
+        self.seen = (None, 0)
+        return
+
+    #--------------------------------------------------------------------------#
+    def attach(self, scan):
+        """
+        @brief Open (creating if necessary) the shared memory segment
+        @param scan callable taking no arguments returning dictionary indexed
+                    by hash algorithm of lists of {"dgst":, "ce":, "ts":}
+                    objects (as cache_list) built by scanning the cache
+        @return boolean True if the segment is in use
+
+        The log is rebuilt using scan if the segment is new or if none of
+        the processes recorded in it are still running.
+        """
+        try:
+            self.sem = pipc.Semaphore(self.shm_name, flags=pipc.O_CREAT,
+                                      mode=0600, initial_value=1)
+        except Exception, e:
+            self.logger.error("Unable to open cache listing semaphore %s: %s" %
+                              (self.shm_name, str(e)))
+            return False
+        self.sem.acquire()
+        try:
+            created = False
+            try:
+                self.shm = pipc.SharedMemory(self.shm_name, flags=pipc.O_CREX,
+                                             mode=0600,
+                                             size=DATA_OFFSET + INITIAL_CAPACITY)
+                created = True
+            except pipc.ExistentialError:
+                self.shm = pipc.SharedMemory(self.shm_name)
+            self.map = mmap.mmap(self.shm.fd, self.shm.size)
+            (magic, gen, used, capacity) = struct.unpack_from(HDR_FMT,
+                                                              self.map, 0)
+            if created or (magic != MAGIC) or \
+               (DATA_OFFSET + capacity > self.shm.size):
+                struct.pack_into(HDR_FMT, self.map, 0, MAGIC, 0, 0,
+                                 self.shm.size - DATA_OFFSET)
+                struct.pack_into(PID_FMT, self.map, PID_OFFSET,
+                                 *([0] * MAX_PROCS))
+                rebuild = True
+            else:
+                rebuild = len(self._live_pids()) == 0
+            self._register_pid()
+            if rebuild:
+                self._rebuild(scan())
+        except Exception, e:
+            self.logger.error("Unable to set up cache listing %s: %s" %
+                              (self.shm_name, str(e)))
+            self.sem.release()
+            self.close()
+            return False
+        self.sem.release()
+        atexit.register(self.close)
+        return True
+
+    #--------------------------------------------------------------------------#
+    def _live_pids(self):
+        """
+        @brief Remove dead processes from the attached table - hold sem
+        @return list of process ids still running
+        """
+        pids = list(struct.unpack_from(PID_FMT, self.map, PID_OFFSET))
+        live = []
+        for i in xrange(MAX_PROCS):
+            if pids[i] == 0:
+                continue
+            try:
+                os.kill(pids[i], 0)
+                live.append(pids[i])
+            except OSError, e:
+                if e.errno == 3:        # ESRCH
+                    pids[i] = 0
+                else:
+                    live.append(pids[i])
+        struct.pack_into(PID_FMT, self.map, PID_OFFSET, *pids)
+        return live
+
+    #--------------------------------------------------------------------------#
+    def _register_pid(self):
+        """
+        @brief Record this instance in the attached table - hold sem
+        @return (none)
+
+        Also called if the process has forked since the instance was
+        attached so that the child process is recorded.
+        """
+        self.pid = os.getpid()
+        pids = list(struct.unpack_from(PID_FMT, self.map, PID_OFFSET))
+        if 0 not in pids:
+            self._live_pids()
+            pids = list(struct.unpack_from(PID_FMT, self.map, PID_OFFSET))
+        if 0 in pids:
+            self.slot = pids.index(0)
+            pids[self.slot] = self.pid
+            struct.pack_into(PID_FMT, self.map, PID_OFFSET, *pids)
+        else:
+            self.slot = None
+            self.logger.warn("Cache listing process table full")
+        return
+
+    #--------------------------------------------------------------------------#
+    def _ensure_capacity(self, needed):
+        """
+        @brief Grow the segment so the log can hold needed bytes - hold sem
+        @param needed integer number of bytes required in log
+        @return (none)
+        """
+        (magic, gen, used, capacity) = struct.unpack_from(HDR_FMT, self.map, 0)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        os.ftruncate(self.shm.fd, DATA_OFFSET + capacity)
+        self._remap(DATA_OFFSET + capacity)
+        struct.pack_into(HDR_FMT, self.map, 0, magic, gen, used, capacity)
+        return
+
+    #--------------------------------------------------------------------------#
+    def _remap(self, size):
+        """
+        @brief Map the segment again after it has been grown
+        @param size integer new size of segment
+        @return (none)
+        """
+        self.map.close()
+        self.map = mmap.mmap(self.shm.fd, size)
+        return
+
+    #--------------------------------------------------------------------------#
+    def _rebuild(self, listing):
+        """
+        @brief Rewrite the log from a complete listing - hold sem
+        @param listing dictionary as returned by cache_list
+        @return (none)
+        """
+        recs = []
+        for (alg, entries) in listing.iteritems():
+            for e in entries:
+                recs.append("%s %s %d %d\n" % (alg, e["dgst"],
+                                                1 if e["ce"] else 0,
+                                                e.get("ts", 0)))
+        log = "".join(recs)
+        self._ensure_capacity(len(log))
+        (magic, gen, used, capacity) = struct.unpack_from(HDR_FMT, self.map, 0)
+        self.map[DATA_OFFSET:DATA_OFFSET + len(log)] = log
+        struct.pack_into(HDR_FMT, self.map, 0, MAGIC, (gen + 1) & 0xffffffff,
+                         len(log), capacity)
+        return
+
+    #--------------------------------------------------------------------------#
+    def _sync(self):
+        """
+        @brief Bring the decoded copy of the log up to date - hold lock
+        @return (none)
+
+        The header is read first without the semaphore; if it matches what
+        was last decoded there is nothing more to do.  Otherwise the new
+        records are read holding the semaphore.
+        """
+        (magic, gen, used, capacity) = struct.unpack_from(HDR_FMT, self.map, 0)
+        if ((gen, used) == self.seen) and (self.pid == os.getpid()):
+            return
+        self.sem.acquire()
+        try:
+            if self.pid != os.getpid():
+                self._register_pid()
+            (magic, gen, used, capacity) = struct.unpack_from(HDR_FMT,
+                                                              self.map, 0)
+            if DATA_OFFSET + capacity > len(self.map):
+                self._remap(DATA_OFFSET + capacity)
+            if gen != self.seen[0]:
+                self._clear()
+                start = 0
+            else:
+                start = self.seen[1]
+            log = self.map[DATA_OFFSET + start:DATA_OFFSET + used]
+        finally:
+            self.sem.release()
+        recs = []
+        for rec in log.splitlines():
+            (alg, dgst, ce, ts) = rec.split(" ")
+            recs.append((alg, dgst, ce == "1", int(ts)))
+        self._note(recs)
+        self.seen = (gen, used)
+        return
+
+    #--------------------------------------------------------------------------#
+    def _refresh(self):
+        """
+        @brief Bring the decoded copy of the log up to date - hold lock
+        @return boolean True if the listing is available
+        """
+        if self.map is None:
+            return False
+        try:
+            self._sync()
+        except Exception, e:
+            self.logger.error("Unable to read cache listing: %s" % str(e))
+            return False
+        return True
+
+    #--------------------------------------------------------------------------#
+    def add_entry(self, alg, dgst, content_exists, ts=None):
+        """
+        @brief Record a new or updated cache entry
+        @param alg string hash algorithm name for entry
+        @param dgst string digest for entry
+        @param content_exists boolean True if content file is present
+        @param ts float time entry changed (default now)
+        @return (none)
+        """
+        with self.lock:
+            if self.map is None:
+                return
+            try:
+                self._sync()
+                old = self.entries.get(alg, {}).get(dgst)
+                if (old is not None) and (old[0] == content_exists):
+                    return
+                if ts is None:
+                    ts = time.time()
+                rec = "%s %s %d %d\n" % (alg, dgst, 1 if content_exists else 0,
+                                         ts)
+                self.sem.acquire()
+                try:
+                    (magic, gen, used, capacity) = \
+                        struct.unpack_from(HDR_FMT, self.map, 0)
+                    self._ensure_capacity(used + len(rec))
+                    (magic, gen, used, capacity) = \
+                        struct.unpack_from(HDR_FMT, self.map, 0)
+                    self.map[DATA_OFFSET + used:
+                             DATA_OFFSET + used + len(rec)] = rec
+                    struct.pack_into(HDR_FMT, self.map, 0, magic, gen,
+                                     used + len(rec), capacity)
+                finally:
+                    self.sem.release()
+            except Exception, e:
+                self.logger.error("Unable to update cache listing: %s" % str(e))
+        return
+
+    #--------------------------------------------------------------------------#
+    def close(self):
+        """
+        @brief Detach from the segment, removing it if no other process is
+               using it
+        @return (none)
+        """
+        with self.lock:
+            if self.sem is None:
+                return
+            unlink = False
+            if self.map is not None:
+                self.sem.acquire()
+                try:
+                    pids = list(struct.unpack_from(PID_FMT, self.map,
+                                                   PID_OFFSET))
+                    if (self.slot is not None) and \
+                       (self.pid == os.getpid()) and \
+                       (pids[self.slot] == self.pid):
+                        pids[self.slot] = 0
+                        struct.pack_into(PID_FMT, self.map, PID_OFFSET, *pids)
+                    self.slot = None
+                    unlink = len(self._live_pids()) == 0
+                    if unlink:
+                        try:
+                            self.shm.unlink()
+                        except pipc.ExistentialError:
+                            unlink = False
+                finally:
+                    self.sem.release()
+                self.map.close()
+                self.map = None
+            if self.shm is not None:
+                self.shm.close_fd()
+                self.shm = None
+            if unlink:
+                try:
+                    self.sem.unlink()
+                except pipc.ExistentialError:
+                    pass
+            self.sem.close()
+            self.sem = None
+        return
+
+#==============================================================================#
+if __name__ == "__main__":
+    import shutil
+    import logging
+    import tempfile
+    logging.basicConfig()
+    logger = logging.getLogger("test")
+
+    errs = 0
+    root = tempfile.mkdtemp()
+    scans = [0]
+    def scan():
+        scans[0] += 1
+        return { "sha-256": [ { "dgst": "aaa", "ce": True, "ts": 100 },
+                              { "dgst": "bbb", "ce": False, "ts": 200 } ] }
+    def as_dict(listing, alg):
+        return dict((e["dgst"], e["ce"]) for e in listing[alg])
+
+    l1 = SharedCacheListing(root, logger)
+    if not l1.attach(scan) or scans[0] != 1:
+        print "First attach did not build listing"
+        errs += 1
+    l2 = SharedCacheListing(root, logger)
+    if not l2.attach(scan) or scans[0] != 1:
+        print "Second attach rebuilt listing"
+        errs += 1
+    ls = l2.get_listing(["sha-256", "sha-256-32"])
+    if (as_dict(ls, "sha-256") != { "aaa": True, "bbb": False }) or \
+       (ls["sha-256-32"] != []):
+        print "Wrong initial listing: %s" % ls
+        errs += 1
+    if l2.get_listing(["sha-256"])["sha-256"] is not ls["sha-256"]:
+        print "Unchanged listing was rebuilt"
+        errs += 1
+
+    # Updates in one instance are seen by the other
+    l1.add_entry("sha-256", "bbb", True)
+    l1.add_entry("sha-256", "ccc", False)
+    l1._sync()
+    l1.add_entry("sha-256", "ccc", False)
+    if struct.unpack_from(HDR_FMT, l1.map, 0)[2] != l1.seen[1]:
+        print "Duplicate entry appended to log"
+        errs += 1
+    ls = l2.get_listing(["sha-256"])
+    if as_dict(ls, "sha-256") != { "aaa": True, "bbb": True, "ccc": False }:
+        print "Update not seen: %s" % ls
+        errs += 1
+
+    # Ordered iteration with filters, starting point and concurrent insertion
+    l1.add_entry("sha-256", "AAB", True, 300)
+    l1.add_entry("sha-256", "Aab", False, 400)
+    want = ["aaa", "AAB", "Aab", "bbb", "ccc"]
+    got = [d for (d, ce, ts) in l2.iter_entries("sha-256")]
+    if got != want:
+        print "Wrong order: %s" % got
+        errs += 1
+    got = [d for (d, ce, ts) in l2.iter_entries("sha-256", after="AAB")]
+    if got != want[2:]:
+        print "Wrong entries after AAB: %s" % got
+        errs += 1
+    got = [d for (d, ce, ts) in l2.iter_entries("sha-256", content=False,
+                                                 since=200, until=500)]
+    if got != ["Aab"]:
+        print "Wrong filtered entries: %s" % got
+        errs += 1
+    BATCH_SIZE = 2
+    it = l2.iter_entries("sha-256")
+    first = it.next()
+    l1.add_entry("sha-256", "abc", True)
+    l1.add_entry("sha-256", "a", True)
+    got = [first[0]] + [d for (d, ce, ts) in it]
+    if got != ["aaa", "AAB", "Aab", "abc", "bbb", "ccc"]:
+        print "Wrong entries with concurrent insertion: %s" % got
+        errs += 1
+    BATCH_SIZE = 256
+    if list(l2.iter_entries("sha-256-32")) != []:
+        print "Entries for empty algorithm"
+        errs += 1
+    st = StaticCacheListing(l2.get_listing(["sha-256"]))
+    if [d for (d, ce, ts) in st.iter_entries("sha-256", after="abc")] != \
+       ["bbb", "ccc"]:
+        print "Wrong entries from static listing"
+        errs += 1
+
+    # Growing the segment
+    for i in xrange(INITIAL_CAPACITY / 20):
+        l1.add_entry("sha-512", "d%020d" % i, (i % 2) == 0)
+    ls = l2.get_listing(["sha-512"])
+    if len(ls["sha-512"]) != INITIAL_CAPACITY / 20:
+        print "Wrong number of entries after growth: %d" % len(ls["sha-512"])
+        errs += 1
+    if len(l2.map) <= DATA_OFFSET + INITIAL_CAPACITY:
+        print "Reader did not remap grown segment"
+        errs += 1
+
+    # Another process adds an entry and goes away
+    pid = os.fork()
+    if pid == 0:
+        l3 = SharedCacheListing(root, logger)
+        l3.attach(scan)
+        l3.add_entry("sha-256", "child", True)
+        l3.close()
+        os._exit(0)
+    os.waitpid(pid, 0)
+    if as_dict(l1.get_listing(["sha-256"]), "sha-256").get("child") != True:
+        print "Entry added by child process not seen"
+        errs += 1
+
+    # Last one out removes the segment
+    l2.close()
+    if not os.path.exists("/dev/shm" + l1.shm_name):
+        print "Segment removed while still in use"
+        errs += 1
+    l1.close()
+    l1.close()
+    if os.path.exists("/dev/shm" + l1.shm_name):
+        print "Segment not removed by last process"
+        errs += 1
+    if l1.get_listing(["sha-256"]) is not None:
+        print "Closed listing still returned entries"
+        errs += 1
+
+    shutil.rmtree(root)
+    print "Tests completed with %d errors" % errs
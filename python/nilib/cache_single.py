@@ -83,8 +83,6 @@ import os
 import sys
 import time
 import json
-import mmap
-import posix_ipc as pipc
 import tempfile
 import threading
 
@@ -92,6 +90,7 @@ import threading
 
 from ni import NIname, UnvalidatedNIname, EmptyParams
 from metadata import NetInfMetaData
+from cache_listing import SharedCacheListing
 
 #==============================================================================#
 __all__ = ['SingleNetInfCache']
@@ -177,6 +176,13 @@ class SingleNetInfCache:
     ##@var logerror
     # callable Convenience function for logging error messages
 
+    ##@var search_index
+    # NDOSearchIndex instance updated by cache_put or None
+
+    ##@var listing
+    # SharedCacheListing instance updated by cache_put and used by
+    # cache_list or None
+
     ##@var memcache
     # dictionary containing in memory sub-cache
 
@@ -210,6 +216,12 @@ class SingleNetInfCache:
         # Set up empty in memory cache
         self.memcache = {}
 
+        # Local search index - set by set_search_index later
+        self.search_index = None
+
+        # Shared memory listing - set by set_listing (or cache_list_mem) later
+        self.listing = None
+
         # Lock for cache access
         self.cache_lock = threading.Lock()
 
@@ -304,6 +316,27 @@ class SingleNetInfCache:
         """
         return self.temp_path
     
+    #--------------------------------------------------------------------------#
+    def set_search_index(self, search_index):
+        """
+        @brief Record search index to be updated when entries are put in cache
+        @param search_index object NDOSearchIndex instance or None
+        @return (none)
+        """
+        self.search_index = search_index
+        return
+
+    #--------------------------------------------------------------------------#
+    def set_listing(self, listing):
+        """
+        @brief Record shared memory listing to be updated when entries are
+               put in cache and used to answer cache_list
+        @param listing object SharedCacheListing instance (attached) or None
+        @return (none)
+        """
+        self.listing = listing
+        return
+
     #--------------------------------------------------------------------------#
     def check_cache_dirs(self):
         """
@@ -402,6 +435,9 @@ class SingleNetInfCache:
                            Either the content file name or None if not stored,
                            boolean - True if this was a new entry
                            boolean - True if content_file was a duplicate)
+                The metadata and content file name are the same as a
+                subsequent cache_get would return, so the caller can use
+                them directly to build a response.
         @throw UnvalidatedNIname if ni_name is not validated
         @throw EmptyParams if ni_name doesn't have a digest set
         @throw InconsistentParams if both metadata and content_file are None or
@@ -559,9 +595,25 @@ class SingleNetInfCache:
                     os.remove(cfn)
                 raise sys.exc_info()[0](err_str + str(e))
 
-            self._make_sub_cache_entry(ni_digest, ni_hash_alg, metadata,
+            # Keep the merged metadata so that cache_get and cache_put agree
+            self._make_sub_cache_entry(ni_digest, ni_hash_alg, old_metadata,
                                        cfn, content_exists)
             # End of with self.cache_write_lock
+        # Keep local search index up to date with the merged metadata
+        # ... and the shared listing.  The entry is already in the cache so
+        # a failure here is logged rather than failing the put.
+        if self.search_index is not None:
+            try:
+                self.search_index.index_ndo(old_metadata)
+            except Exception, e:
+                self.logerror("put_cache: search index update failed for %s: %s" %
+                              (ni_url, str(e)))
+        if self.listing is not None:
+            try:
+                self.listing.add_entry(ni_hash_alg, ni_digest, content_exists)
+            except Exception, e:
+                self.logerror("put_cache: listing update failed for %s: %s" %
+                              (ni_url, str(e)))
         return (old_metadata, cfn if content_exists else None,
                 new_entry, ignore_duplicate)
 
@@ -655,13 +707,18 @@ class SingleNetInfCache:
 
         Read the metadata directory entries for selected algorithm names
         Build a dictionary with an entry for each selected algorithm name
-        Value for each is an array of objects with two entries:
+        Value for each is an array of objects with three entries:
         - "dgst": digest (ni format)
         - "ce":   boolean indicating if content file exists
+        - "ts":   modification time of metadata file (seconds since epoch)
 
         Return dictionary constructed if alg_list contains known algorithms
         Return None if anything goes wrong and log infomational message.
 
+        If a shared memory listing has been set up (see set_listing) the
+        entries are taken from that instead.  The arrays are then shared
+        with later calls and must not be modified.
+
         Note that we don't use the lock here.  At present cache entries are
         never explicitly deleted so the worst that can happen is that the
         listing is shy of a (very) few last microsedond entries
@@ -675,6 +732,10 @@ class SingleNetInfCache:
                     self.loginfo("cache_list: Unknown algorithm name requested %s" %
                                  alg)
                     return None
+        if self.listing is not None:
+            rslt = self.listing.get_listing(alg_list)
+            if rslt is not None:
+                return rslt
         rslt = {}
         for alg in alg_list:
             mfd = "%s%s%s" % (self.storage_root, self.META_DIR, alg)
@@ -686,7 +747,8 @@ class SingleNetInfCache:
             try:
                 for dgst in os.listdir(mfd):
                     ce = os.path.isfile("%s/%s" % (cfd, dgst))
-                    entries.append( { "dgst": dgst, "ce": ce })
+                    ts = int(os.path.getmtime("%s/%s" % (mfd, dgst)))
+                    entries.append( { "dgst": dgst, "ce": ce, "ts": ts })
             except Exception, e:
                 self.logerror("cache_list: error while listing for alg %s: %s" %
                               (alg, str(e)))
@@ -698,46 +760,35 @@ class SingleNetInfCache:
     #--------------------------------------------------------------------------#
     def cache_list_mem(self, alg_list = None):
         """
-        @brief Construct a JSON encoded structure listing current cache contents
-               and save it in a shared memory block.
+        @brief Make sure the listing of the cache contents is available in
+               shared memory
         @param alg_list list of strings of digest algorithm names or None (= all)
-        @return string name of pozix_ipc shared memory segment with data or None
+        @return string name of posix_ipc shared memory segment with data or None
 
         Check if alg_list contains valid names - or get all from NIname.
         Return None if no valid names
 
-        Read the metadata directory entries for selected algorithm names
-        Build a JSON object with an entry for each selected algorithm name
-        Value for each is an array of objects with two entries:
-        - "dgst": digest (ni format)
-        - "ce":   boolean indicating if content file exists
+        If no shared memory listing has been set up yet, create one, building
+        it from the cache if this is the first process using it.  The same
+        segment is used for all calls and all processes using the cache and
+        is updated by cache_put.  It lists all the algorithms: see
+        cache_listing.py for the format (SharedCacheListing.get_listing
+        decodes it).  The segment is removed when the last process using
+        it exits.
 
-        JSON encode and place in a posix_ipc shared memory block
         Return name of memory block if all goes well
         Return None if anything goes wrong and log infomational message.
         """
-        # Create a dictionary with the information
-        list_dict = self.cache_list(alg_list)
-        if list_dict is None:
-            return None
-        
-        # JSON encode results
-        js = json.dumps(list_dict)
-        try:
-            blk = pipc.SharedMemory(None, flags=pipc.O_CREX,
-                                    mode=0600, size=len(js))
-            f = mmap.mmap(blk.fd, blk.size)
-            f.write(js)
-            f.close
-            blk.close_fd()
-        except Exception, e:
-            self.logerror("cache_list: Problem while writing to shared memory block: %s" %
-                          str(e))
-            return None
+        if self.listing is None:
+            listing = SharedCacheListing(self.storage_root, self.logger)
+            if not listing.attach(self.cache_list):
+                return None
+            self.set_listing(listing)
 
-        # Ought to clean this block up periodically -
-        # will go when process ends for now
-        return blk.name
+        # Check the algorithm names
+        if self.cache_list(alg_list) is None:
+            return None
+        return self.listing.shm_name
         
     #--------------------------------------------------------------------------#
     def cache_mktemp(self):
@@ -903,18 +954,29 @@ if __name__ == "__main__":
     except Exception, e:
         print "Fault: valid cache_update caused exception: %s" % str(e)
 
+    # A failing search index must not make a put fail
+    class BrokenIndex:
+        def index_ndo(self, metadata):
+            raise IOError("index unavailable")
+    cache_inst.set_search_index(BrokenIndex())
+    try:
+        m, f, n, i = cache_inst.cache_put(ni_name, md, None)
+        print "cache_put: put succeeded although search index failed"
+    except Exception, e:
+        print "Fault: search index failure made cache_put fail: %s" % str(e)
+    cache_inst.set_search_index(None)
+
     ln = cache_inst.cache_list_mem(None)
     print( "posix_ipc 'file name': %s" % ln)
+    if cache_inst.cache_list_mem(None) != ln:
+        print "Fault: cache_list_mem did not reuse shared memory block"
 
-    p = pipc.SharedMemory(ln)
-    
-    f = mmap.mmap(p.fd, p.size)
-    # Unfortunately old versions of mmap require a length argument to read
-    # so you can't just give the (not so) file-like mmap object to json.load()
-    b = f.read(p.size)
-    j = json.loads(b)
+    reader = SharedCacheListing(storage_root, logger)
+    reader.attach(None)
+    j = reader.get_listing(NIname.get_all_algs())
     print json.dumps(j, sort_keys=True, indent=4)
-    f.close()
+    reader.close()
+    cache_inst.listing.close()
     
     
     
@@ -0,0 +1,273 @@
+#!/usr/bin/python
+"""
+@package nilib
+@file ctype_detect.py
+@brief Shared content type detection using libmagic.
+@version Copyright (C) 2012 Trinity College Dublin and Folly Consulting Ltd
+      This is an adjunct to the NI URI library developed as
+      part of the SAIL project. (http://sail-project.eu)
+
+      Specification(s) - note, versions may change
+          - http://tools.ietf.org/html/draft-farrell-decade-ni-10
+          - http://tools.ietf.org/html/draft-hallambaker-decade-ni-params-03
+          - http://tools.ietf.org/html/draft-kutscher-icnrg-netinf-proto-00
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+       - http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+================================================================================
+
+@details
+When a publisher does not say what type of content it is sending, the
+server and the publishing clients guess the MIME type with libmagic.
+Calling magic.from_file or making a new magic.Magic instance for each file
+loads and compiles the magic database every time, and from_file reads the
+start of the file back from disk even when it has just been written.
+
+ContentTypeDetector keeps one libmagic handle, made (and the magic module
+imported) when it is first needed, and guesses types from the first
+SNIFF_LEN octets of the content.
+libmagic handles must not be used by two threads at once, so calls are
+serialized with a lock; the calls only examine a short buffer so this
+costs little.
+
+A TypeSniffer collects the start of the content as it passes through a
+copy loop (in the same way as the digest is calculated) so the type can be
+found when the copy is finished without reopening the file:
+
+@code
+    sniffer = ctype_detector.sniffer()
+    while True:
+        buf = g.read(16 * 1024)
+        if not buf:
+            break
+        f.write(buf)
+        sniffer.update(buf)
+    ctype = sniffer.content_type()
+@endcode
+
+The module instance ctype_detector is shared by all users in a process.
+If libmagic cannot be loaded or fails, None is returned and callers use
+their default content type.
+"""
+
+#==============================================================================#
+#=== Standard modules for Python 2.[567].x distributions ===
+import os
+import threading
+
+#=== Modules needing special downloading
+# magic is imported when the handle is made - see from_buffer
+
+#==============================================================================#
+# List of classes/global functions in file
+__all__ = ['ContentTypeDetector', 'TypeSniffer', 'ctype_detector',
+           'SNIFF_LEN']
+
+#==============================================================================#
+##@var SNIFF_LEN
+# Number of octets from the start of the content used to guess the type
+SNIFF_LEN = 64 * 1024
+
+#==============================================================================#
+class TypeSniffer:
+    """
+    @brief Collect the start of some content and guess its type
+
+    Used by one thread at a time.
+    """
+
+    #--------------------------------------------------------------------------#
+    def __init__(self, detector):
+        """
+        @brief Constructor
+        @param detector ContentTypeDetector instance to guess the type
+        """
+        self.detector = detector
+        self.bufs = []
+        self.remaining = detector.sniff_len
+        return
+
+    #--------------------------------------------------------------------------#
+    def update(self, buf):
+        """
+        @brief Add the next piece of the content
+        @param buf string next octets of content
+        @return (none)
+
+        Only the first SNIFF_LEN octets are kept - the rest are ignored.
+        """
+        if self.remaining > 0:
+            buf = buf[:self.remaining]
+            self.bufs.append(buf)
+            self.remaining -= len(buf)
+        return
+
+    #--------------------------------------------------------------------------#
+    def content_type(self):
+        """
+        @brief Guess the type of the content seen so far
+        @return string MIME type or None if it could not be determined
+        """
+        return self.detector.from_buffer("".join(self.bufs))
+
+#==============================================================================#
+class ContentTypeDetector:
+    """
+    @brief Guess MIME types with a shared libmagic handle
+
+    Thread safe.
+    """
+
+    #--------------------------------------------------------------------------#
+    def __init__(self, sniff_len=SNIFF_LEN):
+        """
+        @brief Constructor
+        @param sniff_len integer number of octets examined to guess the type
+        """
+        self.sniff_len = sniff_len
+        self.magic = None
+        self.lock = threading.Lock()
+        return
+
+    #--------------------------------------------------------------------------#
+    def sniffer(self):
+        """
+        @brief Make a TypeSniffer to find the type of content being copied
+        @return TypeSniffer instance using this detector
+        """
+        return TypeSniffer(self)
+
+    #--------------------------------------------------------------------------#
+    def from_buffer(self, buf):
+        """
+        @brief Guess the type of some content from its first octets
+        @param buf string start of the content (only first sniff_len used)
+        @return string MIME type or None if it could not be determined
+        """
+        with self.lock:
+            try:
+                if self.magic is None:
+                    import magic
+                    self.magic = magic.Magic(mime=True)
+                ctype = self.magic.from_buffer(buf[:self.sniff_len])
+            except Exception:
+                return None
+        if not ctype:
+            return None
+        return ctype
+
+    #--------------------------------------------------------------------------#
+    def from_fileobj(self, f):
+        """
+        @brief Guess the type of the content of an open file
+        @param f file object open for reading (and seekable)
+        @return string MIME type or None if it could not be determined
+
+        The file is left positioned where it was on entry so it can then
+        be read (or sent) from the same place.
+        """
+        pos = f.tell()
+        try:
+            buf = f.read(self.sniff_len)
+        finally:
+            f.seek(pos, os.SEEK_SET)
+        return self.from_buffer(buf)
+
+    #--------------------------------------------------------------------------#
+    def from_file(self, file_name):
+        """
+        @brief Guess the type of the content of a file
+        @param file_name string path name of file
+        @return string MIME type or None if it could not be determined
+        """
+        try:
+            f = open(file_name, "rb")
+        except IOError:
+            return None
+        try:
+            buf = f.read(self.sniff_len)
+        except IOError:
+            buf = None
+        f.close()
+        if buf is None:
+            return None
+        return self.from_buffer(buf)
+
+#==============================================================================#
+# === GLOBAL VARIABLES ===
+
+##@var ctype_detector
+# ContentTypeDetector instance shared by all users in this process
+ctype_detector = ContentTypeDetector()
+
+#==============================================================================#
+if __name__ == "__main__":
+    import tempfile
+    errs = 0
+
+    html = "<html>\n<head><title>Test</title></head>\n<body>Hi</body>\n</html>\n"
+    if ctype_detector.from_buffer(html) != "text/html":
+        print "HTML not recognized: %s" % ctype_detector.from_buffer(html)
+        errs += 1
+
+    # Sniffer only keeps the first sniff_len octets
+    detector = ContentTypeDetector(sniff_len=100)
+    sniffer = detector.sniffer()
+    sniffer.update("%PDF-1.4\n")
+    for i in range(10):
+        sniffer.update("x" * 50)
+    if sum(len(b) for b in sniffer.bufs) != 100:
+        print "Sniffer kept wrong amount of content"
+        errs += 1
+    if sniffer.content_type() != "application/pdf":
+        print "PDF not recognized: %s" % sniffer.content_type()
+        errs += 1
+
+    # Files and open file objects (examined from the current position)
+    (fd, name) = tempfile.mkstemp()
+    os.write(fd, "%PDF-1.4\n" + "x" * 50)
+    os.close(fd)
+    try:
+        if ctype_detector.from_file(name) != "application/pdf":
+            print "PDF file not recognized"
+            errs += 1
+        f = open(name, "rb")
+        f.read(9)
+        if ctype_detector.from_fileobj(f) != "text/plain":
+            print "Text after PDF header gave %s" % ctype_detector.from_fileobj(f)
+            errs += 1
+        if f.tell() != 9:
+            print "File position not restored"
+            errs += 1
+        f.close()
+    finally:
+        os.remove(name)
+    if ctype_detector.from_file(name) is not None:
+        print "Missing file gave a type"
+        errs += 1
+
+    # Many threads sharing the handle
+    results = []
+    def worker():
+        for i in range(200):
+            results.append(ctype_detector.from_buffer(html))
+    threads = [threading.Thread(target=worker) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if results != ["text/html"] * 800:
+        print "Inconsistent results from concurrent use"
+        errs += 1
+
+    print "Tests completed with %d errors" % errs
@@ -55,40 +55,76 @@ This version has been modified in two ways from version 0.8.1 on the web site:
   parameter is written to the network rather than when the form is constructed.
   This allows values to be dependent on things (such as digests) that are
   calculated as the form is uploaded.
+
+multipart_encode_vectored is an alternative to multipart_encode that copies
+the encoded form into large fixed size blocks (so the transport sends a few
+large writes rather than many small ones) and can optionally use HTTP
+chunked transfer encoding so that generated values need not have a length
+known in advance.
 """
 
 #==============================================================================#
 # List of classes/global functions in file
 __all__ = ['gen_boundary', 'encode_and_quote', 'ParamDigester', 'MultipartParam',
         'encode_string', 'encode_file_header', 'get_body_size', 'get_headers',
-        'multipart_yielder', 'multipart_encode']
+        'multipart_yielder', 'multipart_encode', 'multipart_vector_yielder',
+        'multipart_encode_vectored']
 
 #==============================================================================#
-try:
-    import uuid
-    def gen_boundary():
-        """
-        @brief Generates a random string to use as the boundary for a message
-        @return random boundary string
-        """
-        return uuid.uuid4().hex
-except ImportError:
-    import random, sha
-    def gen_boundary():
-        """
-        @brief Generates a random string to use as the boundary for a message
-        @return random boundary string
-        """
+# uuid, urllib, mimetypes and email.header are imported when first used.
+# ni.py imports this module so every client and the server load it, but
+# these modules (with the socket, ssl and ctypes modules they pull in) are
+# only needed when a form is actually encoded.
+import hashlib
+import re, os
+
+#==============================================================================#
+def gen_boundary():
+    """
+    @brief Generates a random string to use as the boundary for a message
+    @return random boundary string
+    """
+    try:
+        import uuid
+    except ImportError:
+        import random, sha
         bits = random.getrandbits(160)
         return sha.new(str(bits)).hexdigest()
+    return uuid.uuid4().hex
 
-import hashlib
-import urllib, re, os, mimetypes
-try:
-    from email.header import Header
-except ImportError:
-    # Python 2.4
-    from email.Header import Header
+#------------------------------------------------------------------------------#
+def _quote_plus(s):
+    """
+    @brief Quote string for use in a form as urllib.quote_plus
+    @param s string to be quoted
+    @return quoted string
+    """
+    import urllib
+    return urllib.quote_plus(s)
+
+#------------------------------------------------------------------------------#
+def _make_header(name):
+    """
+    @brief Encode a parameter name as an RFC 2047 header value if needed
+    @param name string or unicode parameter name
+    @return encoded string
+    """
+    try:
+        from email.header import Header
+    except ImportError:
+        # Python 2.4
+        from email.Header import Header
+    return Header(name).encode()
+
+#------------------------------------------------------------------------------#
+def _guess_type(filename):
+    """
+    @brief Guess the Content-Type of a file from its name
+    @param filename string file name
+    @return string MIME type or None if not known
+    """
+    import mimetypes
+    return mimetypes.guess_type(filename)[0]
 
 #==============================================================================#
 def encode_and_quote(data):
@@ -103,7 +139,7 @@ def encode_and_quote(data):
 
     if isinstance(data, unicode):
         data = data.encode("utf-8")
-    return urllib.quote_plus(data)
+    return _quote_plus(data)
 
 #------------------------------------------------------------------------------#
 def _strify(s):
@@ -248,7 +284,8 @@ class MultipartParam(object):
     # callable is called with the dictionary as a parameter.  Because the
     # serialization process precalculates the length of the set of parameters,
     # the dictionary must also contain a (fixed value) length field that will
-    # be the length of the value.
+    # be the length of the value, unless the form is sent using chunked
+    # transfer encoding (see multipart_encode_vectored).
 
     ##@var filename
     # string If ``filename`` is set, it is what to say that this parameter's
@@ -296,7 +333,7 @@ class MultipartParam(object):
         @param cb callable called after each value chunk is yielded by iterator
         @param digester object instance of class derieved from ParamDigester
         """
-        self.name = Header(name).encode()
+        self.name = _make_header(name)
         if value is None:
             self.value = None
         elif type(value) == dict:
@@ -304,8 +341,6 @@ class MultipartParam(object):
                 raise AttributeError("Value dictionary must have 'generator' key")
             if not callable(value["generator"]):
                 raise AttributeError("Value dictionary 'generator' entry must be callable.")
-            if "length" not in value:
-                raise AttributeError("Value dictionary must have 'length' key")
             self.value = value
         else:
             self.value = _strify(value)
@@ -383,7 +418,7 @@ class MultipartParam(object):
         """
 
         return cls(paramname, filename=os.path.basename(filename),
-                filetype=mimetypes.guess_type(filename)[0],
+                filetype=_guess_type(filename),
                 filesize=os.path.getsize(filename),
                 fileobj=open(filename, "rb"))
 
@@ -422,7 +457,7 @@ class MultipartParam(object):
                 # Looks like a file object
                 filename = getattr(value, 'name', None)
                 if filename is not None:
-                    filetype = mimetypes.guess_type(filename)[0]
+                    filetype = _guess_type(filename)
                 else:
                     filetype = None
 
@@ -481,20 +516,38 @@ class MultipartParam(object):
             if self.digester is not None:
                 self.digester.update_digest(value)
                 self.digester.finalize_digest()
-        elif type(self.value) == dict:
-            if len(self.value) == 2:
+        else:
+            value = self.encode_value(boundary)
+
+        if re.search("^--%s$" % re.escape(boundary), value, re.M):
+            raise ValueError("boundary found in encoded string")
+
+        return "%s%s\r\n" % (self.encode_hdr(boundary), value)
+
+    #--------------------------------------------------------------------------#
+    def encode_value(self, boundary):
+        """
+        @brief Returns the value of a non-file parameter
+        @param boundary string MIME boundary to be used
+        @return string parameter value (generated if value is a dictionary)
+        @throw ValueError if the boundary occurs in the value
+
+        Generated values are produced at the time this is called.
+        """
+        if type(self.value) == dict:
+            if set(self.value.keys()) <= set(["generator", "length"]):
                 # Just the "generator" and "length" entries - send no parameter
-                value = self.value["generator"]()
+                value = _strify(self.value["generator"]())
             else:
                 # Send the dictionary as a parameter
-                value = self.value["generator"](self.value)
+                value = _strify(self.value["generator"](self.value))
         else:
             value = self.value
 
         if re.search("^--%s$" % re.escape(boundary), value, re.M):
             raise ValueError("boundary found in encoded string")
 
-        return "%s%s\r\n" % (self.encode_hdr(boundary), value)
+        return value
 
     #--------------------------------------------------------------------------#
     def iter_encode(self, boundary, blocksize=4096):
@@ -568,10 +621,15 @@ class MultipartParam(object):
                with the given boundary.
         @param boundary string boundary to be used
         @return integer length of encoded parameter.
+        @throw ValueError if the parameter has a generated value without
+                          a length
         """
         if self.filesize is not None:
             valuesize = self.filesize
         elif type(self.value) == dict:
+            if "length" not in self.value:
+                raise ValueError("Value dictionary for %s has no 'length' key" %
+                                 self.name)
             valuesize = self.value["length"]
         else:
             valuesize = len(self.value)
@@ -659,7 +717,7 @@ def get_headers(params, boundary):
     @return dictionary with headers
     """
     headers = {}
-    boundary = urllib.quote_plus(boundary)
+    boundary = _quote_plus(boundary)
     headers['Content-Type'] = "multipart/form-data; boundary=%s" % boundary
     headers['Content-Length'] = str(get_body_size(params, boundary))
     return headers
@@ -777,6 +835,248 @@ class multipart_yielder:
         for param in self.params:
             param.reset()
 
+#==============================================================================#
+##@var VECTOR_BLOCK_SIZE
+# Default size of blocks delivered by multipart_vector_yielder
+VECTOR_BLOCK_SIZE = 256 * 1024
+
+#==============================================================================#
+class multipart_vector_yielder:
+    """
+    @brief Class that acts as an iterator to deliver the encoded parameters
+           of a set of form parameters in large fixed size blocks.
+
+    An alternative to multipart_yielder that is more efficient for large
+    files.  The parameter headers are encoded once when the instance is
+    created.  The encoded form is assembled in a preallocated buffer of
+    blocksize octets: file parameters are read directly into the buffer
+    (using readinto if the file object has it) and the digester and the
+    boundary check work on the buffer in place.  Every block delivered is
+    exactly blocksize octets long apart from the last one.
+
+    Generated (dictionary) values are produced when they are reached, so
+    they can depend on the digest of a file parameter earlier in the form.
+
+    If chunked is True the blocks are framed for HTTP chunked transfer
+    encoding (including the terminating zero length chunk) and the total
+    size need not be known - generated values do not need a 'length'.
+    """
+    #--------------------------------------------------------------------------#
+    # INSTANCE VARIABLES
+
+    ##@var params
+    # list of instances of MultipartParam
+
+    ##@var boundary
+    # string MIME boundary to use
+
+    ##@var cb
+    # callable which will be called from next with three arguments
+    # (param, current, total) as for multipart_yielder.  total is None
+    # in chunked mode.
+
+    ##@var blocksize
+    # integer size of blocks delivered
+
+    ##@var chunked
+    # boolean True if blocks are framed for chunked transfer encoding
+
+    ##@var hdrs
+    # list of strings encoded headers for each of params
+
+    ##@var p
+    # instance of MultipartParam currently being encoded
+
+    ##@var current
+    # integer number of octets of the encoded form delivered so far
+    # (excluding chunk framing)
+
+    ##@var total
+    # integer size of body of complete set of encoded params (None if chunked)
+
+    ##@var gen
+    # generator producing the blocks (None until iteration starts)
+
+    #--------------------------------------------------------------------------#
+    def __init__(self, params, boundary, cb, blocksize=VECTOR_BLOCK_SIZE,
+                 chunked=False):
+        """
+        @brief Constructor - record parameters, encode headers and work out
+               the body size.
+        @param params list of instances of MultipartParam
+        @param boundary string MIME boundary to use
+        @param cb callable which will be called after each block is made
+        @param blocksize integer size of blocks delivered
+        @param chunked boolean True to use chunked transfer encoding
+        @throw ValueError if not chunked and the size of a generated value
+                          is not known
+        """
+        self.params = params
+        self.boundary = boundary
+        self.cb = cb
+        self.blocksize = blocksize
+        self.chunked = chunked
+
+        self.hdrs = [p.encode_hdr(boundary) for p in params]
+        self.p = None
+        self.current = 0
+        self.gen = None
+        if chunked:
+            self.total = None
+        else:
+            # Allow for CRLF after each value and trailing '--CRLF'
+            self.total = len(boundary) + 6
+            for (p, hdr) in zip(params, self.hdrs):
+                if p.filesize is not None:
+                    valuesize = p.filesize
+                elif type(p.value) == dict:
+                    if "length" not in p.value:
+                        raise ValueError("Value dictionary for %s has no "
+                                         "'length' key" % p.name)
+                    valuesize = p.value["length"]
+                else:
+                    valuesize = len(p.value)
+                self.total += len(hdr) + 2 + valuesize
+
+    #--------------------------------------------------------------------------#
+    def __iter__(self):
+        """
+        @brief The class instance is itself an iterator (has next method)
+        @return self
+        """
+        return self
+
+    #--------------------------------------------------------------------------#
+    def next(self):
+        """
+        @brief Deliver the next block of the multipart/form-data representation
+        @return string next block
+        """
+        if self.gen is None:
+            self.gen = self._generate()
+        return self.gen.next()
+
+    #--------------------------------------------------------------------------#
+    def reset(self):
+        """
+        @brief Rewind the parameters and restart the encoding
+        """
+        self.gen = None
+        self.p = None
+        self.current = 0
+        for param in self.params:
+            param.reset()
+
+    #--------------------------------------------------------------------------#
+    #=== Private methods ===
+    #--------------------------------------------------------------------------#
+    def _generate(self):
+        """
+        @brief Generator function assembling the encoded form into blocks
+        @return generator of strings
+        """
+        self._buf = bytearray(self.blocksize)
+        self._view = memoryview(self._buf)
+        self._pos = 0
+        for (p, hdr) in zip(self.params, self.hdrs):
+            self.p = p
+            for block in self._put(hdr):
+                yield block
+            if p.fileobj is None:
+                value = p.encode_value(self.boundary)
+            else:
+                for block in self._put_file(p):
+                    yield block
+                value = ""
+            for block in self._put(value + "\r\n"):
+                yield block
+        self.p = None
+        for block in self._put("--%s--\r\n" % self.boundary):
+            yield block
+        if self._pos > 0:
+            yield self._block()
+        if self.chunked:
+            yield "0\r\n\r\n"
+
+    #--------------------------------------------------------------------------#
+    def _block(self):
+        """
+        @brief Make a block from the buffer contents and empty the buffer
+        @return string block (with chunk framing if chunked)
+        """
+        n = self._pos
+        self._pos = 0
+        self.current += n
+        if self.cb:
+            self.cb(self.p, self.current, self.total)
+        if self.chunked:
+            return "%x\r\n%s\r\n" % (n, self._view[:n].tobytes())
+        return self._view[:n].tobytes()
+
+    #--------------------------------------------------------------------------#
+    def _put(self, s):
+        """
+        @brief Copy a string into the buffer
+        @param s string to be copied
+        @return generator of blocks filled in the process
+        """
+        bs = self.blocksize
+        spos = 0
+        slen = len(s)
+        while spos < slen:
+            n = min(bs - self._pos, slen - spos)
+            self._view[self._pos:self._pos + n] = buffer(s, spos, n)
+            self._pos += n
+            spos += n
+            if self._pos == bs:
+                yield self._block()
+
+    #--------------------------------------------------------------------------#
+    def _put_file(self, p):
+        """
+        @brief Read the file of a parameter into the buffer
+        @param p MultipartParam instance with fileobj
+        @return generator of blocks filled in the process
+        @throw ValueError if the boundary string occurs in the file data
+
+        Feeds the digester (if any) and finalizes it at the end of the file.
+        The check for the boundary uses the tail of the previous data read
+        to catch a boundary spanning two reads.
+        """
+        bs = self.blocksize
+        encoded_boundary = "--%s" % encode_and_quote(self.boundary)
+        boundary_exp = re.compile("^%s$" % re.escape(encoded_boundary), re.M)
+        keep = len(encoded_boundary) + 2
+        use_readinto = hasattr(p.fileobj, "readinto")
+        tail = ""
+        while True:
+            pos = self._pos
+            if use_readinto:
+                n = p.fileobj.readinto(self._view[pos:])
+            else:
+                data = p.fileobj.read(bs - pos)
+                n = len(data)
+                self._view[pos:pos + n] = data
+            if not n:
+                break
+            # The literal search is much quicker than the regular expression
+            # and nearly always fails
+            if (((self._buf.find(encoded_boundary, pos, pos + n) >= 0) and
+                 boundary_exp.search(self._buf, pos, pos + n)) or
+                boundary_exp.search(tail + self._view[pos:pos + min(n, keep)].tobytes())):
+                raise ValueError("boundary found in file data")
+            if p.digester is not None:
+                p.digester.update_digest(buffer(self._buf, pos, n))
+            if n >= keep:
+                tail = self._view[pos + n - keep:pos + n].tobytes()
+            else:
+                tail = (tail + self._view[pos:pos + n].tobytes())[-keep:]
+            self._pos += n
+            if self._pos == bs:
+                yield self._block()
+        if p.digester is not None:
+            p.digester.finalize_digest()
+
 #==============================================================================#
 def multipart_encode(params, boundary=None, cb=None):
     """
@@ -827,13 +1127,50 @@ def multipart_encode(params, boundary=None, cb=None):
     if boundary is None:
         boundary = gen_boundary()
     else:
-        boundary = urllib.quote_plus(boundary)
+        boundary = _quote_plus(boundary)
 
     headers = get_headers(params, boundary)
     params = MultipartParam.from_params(params)
 
     return multipart_yielder(params, boundary, cb), headers
 
+#==============================================================================#
+def multipart_encode_vectored(params, boundary=None, cb=None,
+                              blocksize=VECTOR_BLOCK_SIZE, chunked=False):
+    """
+    @brief Encode ``params`` as multipart/form-data delivered in large blocks.
+
+    @param params as for multipart_encode
+    @param boundary string as for multipart_encode
+    @param cb callable as for multipart_encode (total is None if chunked)
+    @param blocksize integer size of blocks yielded
+    @param chunked boolean If True the blocks are framed for HTTP chunked
+                           transfer encoding and the headers contain
+                           'Transfer-Encoding: chunked' rather than
+                           Content-Length.  Generated values need not
+                           then have a 'length'.
+
+    @return a tuple of `datagen`, `headers` as for multipart_encode, where
+            `datagen` is a multipart_vector_yielder.
+
+    The server must accept chunked request bodies if chunked is used
+    (niserver does).
+    """
+    if boundary is None:
+        boundary = gen_boundary()
+    else:
+        boundary = _quote_plus(boundary)
+
+    params = MultipartParam.from_params(params)
+    datagen = multipart_vector_yielder(params, boundary, cb, blocksize, chunked)
+    headers = { 'Content-Type': "multipart/form-data; boundary=%s" % boundary }
+    if chunked:
+        headers['Transfer-Encoding'] = "chunked"
+    else:
+        headers['Content-Length'] = str(datagen.total)
+
+    return datagen, headers
+
 #==============================================================================#
 # ==== Test Code ====
 if __name__ == "__main__":
@@ -883,4 +1220,65 @@ if __name__ == "__main__":
     print s
     assert "-PZJemkhZSYuYuDZgZJHKd5cTCbVE0xWDyMvAC0mfu0=" in s
 
+    # Vectored encoding must give the same body whatever the block size
+    big = "".join([chr(i % 251) for i in range(100000)])
+    for bs in (7, 4096, 1 << 20):
+        for use_file in (True, False):
+            f = open(__file__, "rb") if use_file else StringIO(big)
+            fp = MultipartParam("data", fileobj=f, filename="x")
+            ref_datagen, ref_headers = multipart_encode([fp, ("key", "value1")],
+                                                        boundary="xyzzy")
+            ref = "".join(ref_datagen)
+            fp.reset()
+            datagen, headers = multipart_encode_vectored([fp, ("key", "value1")],
+                                                         boundary="xyzzy",
+                                                         blocksize=bs)
+            blocks = list(datagen)
+            assert "".join(blocks) == ref
+            assert headers == ref_headers
+            assert max([len(b) for b in blocks]) <= bs
+            assert min([len(b) for b in blocks[:-1]] + [bs]) == bs
+            f.close()
+
+    # Boundary in file data must be detected, including across blocks
+    for bs in (5, 8, 4096):
+        f = StringIO("abc\n--xyzzy\ndef")
+        fp = MultipartParam("data", fileobj=f, filename="x")
+        datagen, headers = multipart_encode_vectored([fp], boundary="xyzzy",
+                                                     blocksize=bs)
+        try:
+            "".join(datagen)
+            assert False
+        except ValueError:
+            pass
+
+    # Chunked encoding of a generated value without a length
+    f = StringIO(s)
+    dg = ParamDigester()
+    dg.set_algorithm("sha-256", hashlib.sha256)
+    digest_parm = MultipartParam("digest", fileobj=f, filename="str", digester=dg)
+    tc = { "generator": lambda: base64.urlsafe_b64encode(digest_parm.get_digest()) }
+    datagen, headers = multipart_encode_vectored([digest_parm, ("uri", tc)],
+                                                 blocksize=100, chunked=True)
+    assert headers["Transfer-Encoding"] == "chunked"
+    assert "Content-Length" not in headers
+    body = "".join(datagen)
+    decoded = ""
+    while True:
+        (size, body) = body.split("\r\n", 1)
+        size = int(size, 16)
+        decoded += body[:size]
+        assert body[size:size + 2] == "\r\n"
+        body = body[size + 2:]
+        if size == 0:
+            break
+    assert body == ""
+    assert base64.urlsafe_b64encode(hashlib.sha256(s).digest()) in decoded
+    try:
+        multipart_encode_vectored([("uri", tc)])
+        assert False
+    except ValueError:
+        pass
+    print "Vectored encoding tests passed"
+
 
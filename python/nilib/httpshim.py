@@ -124,17 +124,203 @@ Version   Date       Author         Notes
 #=== Standard modules for Python 2.[567].x distributions ===
 import threading
 import time
-import shutil
 from BaseHTTPServer import BaseHTTPRequestHandler
 
 #=== Local package modules ===
 
 from netinf_ver import NETINF_VER, NISERVER_VER
+from nitiming import new_timer, PHASE_SEND
+import nimetrics
 
 #==============================================================================#
 # List of classes/global functions in file
 __all__ = ['directHTTPRequestShim']
 
+#==============================================================================#
+##@var SEND_BLK_SIZE
+# Size of blocks copied from files to the response body stream
+SEND_BLK_SIZE = 16384
+
+##@var KEEPALIVE_TIMEOUT
+# Time (seconds) without activity on a connection after which the handler
+# thread closes it
+KEEPALIVE_TIMEOUT = 60
+
+#==============================================================================#
+class _ChunkedReader:
+    """
+    @brief File-like wrapper decoding a request body sent with HTTP chunked
+           transfer encoding.
+
+    Provides the read and readline methods used by cgi.FieldStorage.  Reads
+    return '' once the terminating zero length chunk (and any trailers) has
+    been consumed, leaving the underlying file positioned at the next request.
+    """
+    #--------------------------------------------------------------------------#
+    def __init__(self, fp):
+        """
+        @brief Constructor
+        @param fp file-like object (rfile) positioned at start of body
+        """
+        self.fp = fp
+        self.remaining = 0
+        self.eof = False
+        return
+
+    #--------------------------------------------------------------------------#
+    def _next_chunk(self):
+        """
+        @brief Read the size line of the next chunk (and the trailers after
+               the last chunk)
+        @return boolean True if there is more data
+        @throw ValueError if the chunk size line is malformed
+        """
+        if self.eof:
+            return False
+        line = self.fp.readline(1024)
+        try:
+            size = int(line.split(";", 1)[0].strip(), 16)
+        except ValueError:
+            raise ValueError("Bad chunk size line in request body")
+        if size == 0:
+            # Skip any trailers up to the blank line ending the body
+            while True:
+                line = self.fp.readline(65536)
+                if line in ("\r\n", "\n", ""):
+                    break
+            self.eof = True
+            return False
+        self.remaining = size
+        return True
+
+    #--------------------------------------------------------------------------#
+    def _consumed(self, n):
+        """
+        @brief Account for data taken from the current chunk
+        @param n integer number of octets taken
+        """
+        self.remaining -= n
+        if self.remaining == 0:
+            # Discard CRLF after chunk data
+            self.fp.readline(3)
+        return
+
+    #--------------------------------------------------------------------------#
+    def read(self, size=-1):
+        """
+        @brief Read decoded data
+        @param size integer maximum number of octets or -1 for all
+        @return string data ('' at end of body)
+        """
+        parts = []
+        while (size < 0) or (size > 0):
+            if (self.remaining == 0) and not self._next_chunk():
+                break
+            n = self.remaining if size < 0 else min(size, self.remaining)
+            data = self.fp.read(n)
+            if not data:
+                self.eof = True
+                break
+            parts.append(data)
+            self._consumed(len(data))
+            if size > 0:
+                size -= len(data)
+        return "".join(parts)
+
+    #--------------------------------------------------------------------------#
+    def readline(self, size=-1):
+        """
+        @brief Read decoded data up to and including the next newline
+        @param size integer maximum number of octets or -1 for no limit
+        @return string data ('' at end of body)
+        """
+        parts = []
+        while (size < 0) or (size > 0):
+            if (self.remaining == 0) and not self._next_chunk():
+                break
+            n = self.remaining if size < 0 else min(size, self.remaining)
+            data = self.fp.readline(n)
+            if not data:
+                self.eof = True
+                break
+            parts.append(data)
+            self._consumed(len(data))
+            if size > 0:
+                size -= len(data)
+            if data.endswith("\n"):
+                break
+        return "".join(parts)
+
+    #--------------------------------------------------------------------------#
+    def drain(self):
+        """
+        @brief Discard any unread data up to the end of the body
+        """
+        while self.read(65536):
+            pass
+        return
+
+#==============================================================================#
+class _LengthReader:
+    """
+    @brief File-like wrapper limiting reads to a request body with a
+           Content-Length.
+
+    Provides the read and readline methods used by cgi.FieldStorage, so
+    that the body cannot be read beyond its end and any part not read by
+    the handler can be discarded before the next request on a persistent
+    connection.
+    """
+    #--------------------------------------------------------------------------#
+    def __init__(self, fp, length):
+        """
+        @brief Constructor
+        @param fp file-like object (rfile) positioned at start of body
+        @param length integer length of body
+        """
+        self.fp = fp
+        self.remaining = length
+        return
+
+    #--------------------------------------------------------------------------#
+    def read(self, size=-1):
+        """
+        @brief Read body data
+        @param size integer maximum number of octets or -1 for all
+        @return string data ('' at end of body)
+        """
+        if (size < 0) or (size > self.remaining):
+            size = self.remaining
+        if size == 0:
+            return ""
+        data = self.fp.read(size)
+        self.remaining = self.remaining - len(data) if data else 0
+        return data
+
+    #--------------------------------------------------------------------------#
+    def readline(self, size=-1):
+        """
+        @brief Read body data up to and including the next newline
+        @param size integer maximum number of octets or -1 for no limit
+        @return string data ('' at end of body)
+        """
+        if (size < 0) or (size > self.remaining):
+            size = self.remaining
+        if size == 0:
+            return ""
+        data = self.fp.readline(size)
+        self.remaining = self.remaining - len(data) if data else 0
+        return data
+
+    #--------------------------------------------------------------------------#
+    def drain(self):
+        """
+        @brief Discard any unread data up to the end of the body
+        """
+        while self.read(65536):
+            pass
+        return
+
 #==============================================================================#
 class directHTTPRequestShim(BaseHTTPRequestHandler):
     """
@@ -146,9 +332,24 @@ class directHTTPRequestShim(BaseHTTPRequestHandler):
     writing parts of the response body so that the BaseHTTPRequestHandler
     wfile attribute is not used directly by NIHTTPREquestHandler since there
     is no way to emulate that in the WSGI interface.
-    
+
+    Responses are sent as HTTP/1.1 so that clients asking for it (HTTP/1.1
+    clients and HTTP/1.0 clients sending 'Connection: keep-alive') can send
+    several requests on one connection.  This only works if the client can
+    find the end of the response body, so end_headers adds
+    'Connection: close' to any response sent without a Content-Length.
     """
     
+    #--------------------------------------------------------------------------#
+    # CLASS VARIABLES
+    ##@var protocol_version
+    # HTTP version sent in responses - allows persistent connections
+    protocol_version = "HTTP/1.1"
+
+    ##@var timeout
+    # Socket timeout so that idle persistent connections are closed
+    timeout = KEEPALIVE_TIMEOUT
+
     #--------------------------------------------------------------------------#
     # INSTANCE VARIABLES
 
@@ -179,6 +380,21 @@ class directHTTPRequestShim(BaseHTTPRequestHandler):
     ##@var nrs_redis
     # object instance of Redis database interface (or None if provide_nrs False)
 
+    ##@var nrs_cache
+    # object NRSLookupCache instance shared by all handlers (or None)
+
+    ##@var search_index
+    # object NDOSearchIndex instance shared by all handlers
+
+    ##@var search_fallback
+    # boolean True if searches not satisfied locally use the external engine
+
+    ##@var search_cache
+    # object SearchResultCache instance shared by all handlers
+
+    ##@var qrcode_cache
+    # object QRCodeCache instance shared by all handlers
+
     ##@var unique_id 
     # integer random number used to uniquely identify files generated for this
     # request
@@ -186,6 +402,16 @@ class directHTTPRequestShim(BaseHTTPRequestHandler):
     ##@var cache
     # object instance of NetInfCache interface to cache storage
 
+    ##@var phase_stats
+    # object PhaseStats instance shared by all handlers (or None if phase
+    # timing is disabled)
+
+    ##@var timer
+    # object RequestTimer for the current request (or NULL_TIMER)
+
+    ##@var metrics
+    # object MetricsExporter shared by all handlers
+
     # === BaseHTTPRequestHandler derived variables ===
     ##@var server_name
     # string FQDN of server hosting this program
@@ -296,19 +522,27 @@ class directHTTPRequestShim(BaseHTTPRequestHandler):
         self.server_name = self.server.server_name
         self.server_port = self.server.server_port
         self.nrs_redis = self.server.nrs_redis
+        self.nrs_cache = self.server.nrs_cache
         self.cache = self.server.cache
+        self.search_index = self.server.search_index
+        self.search_fallback = self.server.search_fallback
+        self.search_cache = self.server.search_cache
+        self.qrcode_cache = self.server.qrcode_cache
         if hasattr(self.server, "router"):
             self.router = self.server.router
+        self.fwd_neg_cache = self.server.fwd_neg_cache
         if hasattr(self.server, "request_aggregation"):
             self.request_aggregation = self.server.request_aggregation
-            self.requestlist = self.server.requestlist
-            self.requestlock = self.server.requestlock
+            self.coalescer = self.server.coalescer
+        self.phase_stats = self.server.phase_stats
+        self.metrics = self.server.metrics
 
         # For logging
         self.stime = time.time()
         self.msgid = "dunno"
         self.req_size = -1
         self.command = "DUMMY"
+        self.timer = new_timer(None)
             
         self.loginfo("new_handler")
 
@@ -331,6 +565,128 @@ class directHTTPRequestShim(BaseHTTPRequestHandler):
         self.server.remove_thread(self)
         return
 
+    #--------------------------------------------------------------------------#
+    def handle_one_request(self):
+        """
+        @brief Wrapper round superclass handle_one_request() function
+               dealing with chunked request bodies and phase timing.
+        @return (none)
+
+        parse_request substitutes a decoder for rfile if the request body
+        is chunked, or a reader limited to the body if it has a
+        Content-Length and the connection is persistent.  Afterwards any of
+        the body not read by the handler is discarded and the real rfile
+        restored ready for the next request on the connection.
+
+        Each request gets a fresh timer (see nitiming.py).  If phase timing
+        is enabled the phase times are logged and added to the server
+        histograms when the request has been handled.
+
+        The request counters in nimetrics.py are updated unless the
+        connection was closed without sending a request.
+        """
+        self.timer = new_timer(self.phase_stats)
+        stime = time.time()
+        nimetrics.REQUESTS_IN_PROGRESS.inc()
+        try:
+            BaseHTTPRequestHandler.handle_one_request(self)
+        finally:
+            nimetrics.REQUESTS_IN_PROGRESS.dec()
+        if self.raw_requestline:
+            method = nimetrics.method_label(self)
+            nimetrics.REQUESTS.inc(labels=(method,))
+            nimetrics.REQUEST_SECONDS.observe(time.time() - stime,
+                                              labels=(method,))
+            self.metrics.request_done()
+        if self.timer.enabled() and self.timer.spans:
+            self.phase_stats.record(self.timer)
+            self.loginfo("phases,req,%s,path,%s,msgid,%s,%s" %
+                         (self.command, self.path, self.msgid,
+                          self.timer.log_fields()))
+        if isinstance(self.rfile, (_ChunkedReader, _LengthReader)):
+            try:
+                self.rfile.drain()
+            except Exception, e:
+                self.logwarn("Unable to read rest of request body: %s" %
+                             str(e))
+                self.close_connection = 1
+            self.rfile = self.rfile.fp
+        return
+
+    #--------------------------------------------------------------------------#
+    def send_response(self, code, message=None):
+        """
+        @brief Wrapper round superclass send_response() noting the start of
+               a new set of response headers
+        @param code integer HTTP response code
+        @param message string reason phrase or None for the default
+        @return (none)
+        """
+        self.resp_has_length = False
+        BaseHTTPRequestHandler.send_response(self, code, message)
+        return
+
+    #--------------------------------------------------------------------------#
+    def send_header(self, keyword, value):
+        """
+        @brief Wrapper round superclass send_header() recording if the
+               response has a Content-Length header
+        @param keyword string header name
+        @param value string header value
+        @return (none)
+        """
+        if keyword.lower() == "content-length":
+            self.resp_has_length = True
+        BaseHTTPRequestHandler.send_header(self, keyword, value)
+        return
+
+    #--------------------------------------------------------------------------#
+    def end_headers(self):
+        """
+        @brief Wrapper round superclass end_headers() making sure the
+               connection is only kept open if the client can tell where
+               the response ends
+        @return (none)
+
+        If the connection would be kept open but the response has no
+        Content-Length (e.g., a streamed response) 'Connection: close' is
+        sent.  HTTP/1.0 clients are told explicitly that the connection is
+        being kept open.
+        """
+        if not self.close_connection:
+            if not getattr(self, "resp_has_length", False):
+                self.send_header("Connection", "close")
+            elif self.request_version == "HTTP/1.0":
+                self.send_header("Connection", "keep-alive")
+        BaseHTTPRequestHandler.end_headers(self)
+        return
+
+    #--------------------------------------------------------------------------#
+    def parse_request(self):
+        """
+        @brief Wrapper round superclass parse_request() function
+               substituting a decoder for rfile if the request body is
+               sent with chunked transfer encoding, or a reader limited to
+               the body if there is a Content-Length and the connection
+               is to be kept open.
+        @return boolean True if request was parsed successfully
+        """
+        if not BaseHTTPRequestHandler.parse_request(self):
+            return False
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            self.rfile = _ChunkedReader(self.rfile)
+        elif (not self.close_connection) and \
+             (self.headers.get("Content-Length") is not None):
+            try:
+                length = int(self.headers["Content-Length"])
+            except ValueError:
+                length = -1
+            if length < 0:
+                self.send_error(400, "Bad Content-Length header")
+                return False
+            self.rfile = _LengthReader(self.rfile, length)
+        return True
+
     #--------------------------------------------------------------------------#
     def log_message(self, format, *args):
         """
@@ -372,8 +728,16 @@ class directHTTPRequestShim(BaseHTTPRequestHandler):
         The only reason for overriding this would be to change
         the block size or perhaps to replace newlines by CRLF
         """
-        shutil.copyfileobj(source, self.wfile)
+        sent = 0
+        with self.timer.span(PHASE_SEND):
+            while True:
+                buf = source.read(SEND_BLK_SIZE)
+                if not buf:
+                    break
+                self.wfile.write(buf)
+                sent += len(buf)
         source.close()
+        nimetrics.RESPONSE_BYTES.inc(sent)
         return
 
     #--------------------------------------------------------------------------#
@@ -385,6 +749,8 @@ class directHTTPRequestShim(BaseHTTPRequestHandler):
 
         @return void
         """
-        self.wfile.write(buf)
+        with self.timer.span(PHASE_SEND):
+            self.wfile.write(buf)
+        nimetrics.RESPONSE_BYTES.inc(len(buf))
         return
 
@@ -97,14 +97,17 @@ import base64
 import hashlib
 import array
 import re
+import os
+import mmap
+import threading
+from collections import OrderedDict
 from exceptions import *
 import ni_urlparse
 from encode import ParamDigester
-from stdnum import luhn
 
 #==============================================================================#
-__all__ = ['NIname', 'NI', 'NIdigester', 'NIproc', 'NI_SCHEME', 'NIH_SCHEME',
-           'ni_errs', 'ni_errs_txt']
+__all__ = ['NIname', 'NI', 'NIdigester', 'NIDigestEngine', 'NIproc',
+           'NI_SCHEME', 'NIH_SCHEME', 'ni_errs', 'ni_errs_txt']
 #==============================================================================#
 # Debug function for usae during testing
 def debug(string):
@@ -115,6 +118,21 @@ def debug(string):
     #print string
     return
 
+#==============================================================================#
+# Luhn-mod-16 check digit for nih names
+def nih_check_digit(hex_dgst):
+    """
+    @brief Calculate the check digit for a base16 (hex) encoded digest
+    @param hex_dgst string lower case hex digits (in)
+    @return string single check digit from the nih alphabet
+
+    The stdnum luhn module is imported on first use because loading stdnum
+    pulls in pydoc and inspect and takes longer than loading the rest of
+    this module, which every client imports whether or not it uses nih.
+    """
+    from stdnum import luhn
+    return luhn.calc_check_digit(hex_dgst, NIname.get_nih_alphabet())
+
 #==============================================================================#
 # Support class
 class _Enum(set):
@@ -218,11 +236,72 @@ ni_errs_txt = { ni_errs.niSUCCESS:      "Successful",
 from ni_exception import UnvalidatedNIname, EmptyParams, NonEmptyNetlocOrQuery
 
 #==============================================================================#
-class NIname:
+# Support class
+class _ValidatedNameCache:
+    """
+    @brief Bounded least recently used cache of validated ni/nih names
+
+    Keyed by the tuple of URL components plus the has_params flag used
+    for validation.  The value is the (alg_name, hash_alg_info) pair
+    found during validation.  Only successful validations are remembered
+    so the error codes are always generated by the full checks.
+
+    Thread safe - names are validated in the server handler threads.
+    """
+    def __init__(self, max_entries):
+        """
+        @brief Constructor
+        @param max_entries integer maximum number of names remembered
+        """
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        return
+
+    def get(self, key):
+        """
+        @brief Look up a name, marking it most recently used
+        @param key tuple URL components and has_params flag
+        @return (alg_name, hash_alg_info) tuple or None
+        """
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.entries[key] = value
+            return value
+
+    def put(self, key, value):
+        """
+        @brief Remember a validated name, dropping the least recently used
+               name if full
+        @param key tuple URL components and has_params flag
+        @param value tuple (alg_name, hash_alg_info)
+        @return (none)
+        """
+        with self.lock:
+            if key in self.entries:
+                del self.entries[key]
+            elif len(self.entries) >= self.max_entries:
+                self.entries.popitem(last=False)
+            self.entries[key] = value
+        return
+
+    def clear(self):
+        """
+        @brief Forget all names
+        @return (none)
+        """
+        with self.lock:
+            self.entries.clear()
+        return
+
+#==============================================================================#
+class NIname(object):
     """
     @brief Encapsulation for an ni: name
 
-    Uses ni_urlparse to dismantle URL
+    Uses a precompiled matcher for the usual forms of URL and falls back
+    to ni_urlparse to dismantle anything else
 
     Note that constructor does not validate URL - user must call
     validate_ni_url before attempting to retrieve hash algorithm info
@@ -280,8 +359,34 @@ class NIname:
     # Mapping from suite numbers to hash algs
     suite_index = None
     
+    #--------------------------------------------------------------------------#
+    ##@var url_re
+    # Precompiled matcher for the usual forms of ni and nih URLs, i.e.,
+    # ni://<authority>/<alg>;<digest>?<query> and nih:[/]<alg>;<digest>
+    # (the ;<digest> and ?<query> parts being optional).  Groups are
+    # scheme, netloc, path, params and query with the same values as
+    # ni_urlparse.urlparse would give.  Anything else (upper case schemes,
+    # fragments, multi-level paths, etc) is left to ni_urlparse.
+    url_re = re.compile(r"(nih?):(?://([^/?#]*))?(/?[^/?#;]*)"
+                        r"(?:;([^/?#]*))?(?:\?([^#]*))?\Z")
+
+    ##@var VALIDATED_CACHE_SIZE
+    # Maximum number of validated names remembered in validated_cache
+    VALIDATED_CACHE_SIZE = 1024
+
+    ##@var validated_cache
+    # Shared LRU cache of successfully validated names
+    validated_cache = _ValidatedNameCache(VALIDATED_CACHE_SIZE)
+    
     #--------------------------------------------------------------------------#
     #=== Instance Variables ===
+    # Fixed set of slots rather than a per-instance dictionary to keep
+    # instances small - they are created for every request and held in
+    # forwarding tables and DTN request queues.
+    __slots__ = ( "alg_name", "url", "validated", "scheme", "netloc", "path",
+                  "dir_part", "file_part", "hash_alg_info", "params", "query",
+                  "fragment" )
+
     ##@var alg_name
     # string the algorithm name identifier for this URI
     
@@ -297,6 +402,15 @@ class NIname:
     ##@var netloc
     # string the netloc part of the URI (FQDN, port, etc)
     
+    ##@var path
+    # string the path part of the URI (dir_part/file_part)
+    
+    ##@var dir_part
+    # string the path up to the last / (must be empty)
+    
+    ##@var file_part
+    # string the path after the last / (the algorithm name or suite number)
+    
     ##@var hash_alg_info
     # tuple value from hash_algs corresponding to alg_name
     
@@ -306,6 +420,9 @@ class NIname:
     ##@var query
     # string the query string part of the URI
     
+    ##@var fragment
+    # string the fragment part of the URI (must be empty)
+    
     #--------------------------------------------------------------------------#
     #=== Class Methods ===
     #--------------------------------------------------------------------------#
@@ -451,8 +568,20 @@ class NIname:
         @return (void)
         """
         self.url = url
-        (self.scheme, self.netloc, self.path, self.params,
-         self.query, self.fragment) = ni_urlparse.urlparse(url)
+        m = NIname.url_re.match(url)
+        if m is not None:
+            (self.scheme, self.netloc, self.path, self.params,
+             self.query) = m.group(1, 2, 3, 4, 5)
+            if self.netloc is None:
+                self.netloc = ""
+            if self.params is None:
+                self.params = ""
+            if self.query is None:
+                self.query = ""
+            self.fragment = ""
+        else:
+            (self.scheme, self.netloc, self.path, self.params,
+             self.query, self.fragment) = ni_urlparse.urlparse(url)
         (self.dir_part, sep, self.file_part) = self.path.rpartition("/")
         self.validated = False
         return
@@ -468,7 +597,7 @@ class NIname:
         or the index number of the suite.
         @return appropriate tuple from hash_algs or None if no match
         """
-        if self.file_part in NIname.hash_algs.keys():
+        if self.file_part in NIname.hash_algs:
             self.alg_name = self.file_part
             return NIname.hash_algs[self.file_part]
         elif (self.scheme == NIH_SCHEME):
@@ -512,8 +641,7 @@ class NIname:
         b64_dgst = self.params + ("", "", "==", "=")[l%4]
         bin_dgst = base64.urlsafe_b64decode(b64_dgst)
         hex_dgst = base64.b16encode(bin_dgst).lower()
-        check_digit = luhn.calc_check_digit(hex_dgst,
-                                            NIname.get_nih_alphabet())
+        check_digit = nih_check_digit(hex_dgst)
         return ";".join([hex_dgst, check_digit])
         
     #--------------------------------------------------------------------------#
@@ -644,7 +772,17 @@ class NIname:
         Check query is empty for nih scheme only.
 
         Check fragment is empty (neither ni or nih scheme really allows fragments
+
+        Names that have previously passed these checks are found in
+        validated_cache and not checked again.
         """
+        cache_key = (self.scheme, self.netloc, self.path, self.params,
+                     self.query, self.fragment, has_params)
+        cached = NIname.validated_cache.get(cache_key)
+        if cached is not None:
+            (self.alg_name, self.hash_alg_info) = cached
+            self.validated = True
+            return ni_errs.niSUCCESS
 
         if not ((self.scheme == NI_SCHEME) or (self.scheme == NIH_SCHEME)):
             debug("validate_ni_url: Scheme is not 'ni' or 'nih' in %s" % self.url)
@@ -720,13 +858,13 @@ class NIname:
                               (pl, (tl2 + 2)))
                         return ni_errs.niBADPARAMS
                     elif (m.group(2) != None) and (pl == (tl2 + 2)):
-                        check_digit = luhn.calc_check_digit(m.group(1),
-                                                            NIname.get_nih_alphabet())
+                        check_digit = nih_check_digit(m.group(1))
                         if check_digit != m.group(2)[1]:
                             debug("validate_ni_url: nih URL has bad check digit (%s vs %s)" %
                                   (check_digit, m.group(2)[1]))
                             return ni_errs.niBADPARAMS
                     
+        NIname.validated_cache.put(cache_key, (self.alg_name, self.hash_alg_info))
         self.validated = True
         return ni_errs.niSUCCESS    
 
@@ -1097,6 +1235,184 @@ class NIdigester(ParamDigester):
         return "Digest algorithm: %s; Value: %s" % (str(self.algorithm),
                                                     str(self.digest))
 
+#==============================================================================#
+class NIDigestEngine:
+    """
+    @brief Generate digests for several algorithm suites in one pass over data
+
+    The suites in NIname.hash_algs are grouped by their hash function so that
+    each distinct hash function is run only once over the data - all the
+    sha-256 truncations share a single SHA-256 computation.  A suite with a
+    different hash function added to hash_algs in future gets its own hash
+    object automatically.
+
+    Data can be fed in with 'update' (e.g., while it is being written
+    elsewhere - see nifeedparser.DigestFile) or a whole file or stream can
+    be processed with 'hash_file' or 'hash_stream'.  Files are mapped into
+    memory if possible, otherwise read in large blocks.
+
+    After all the data has been supplied, 'get_digest' returns the truncated
+    binary digest for a suite and 'get_digests' those for all the suites.
+    'get_hash_digest' gives the untruncated output of a hash function.
+    """
+    #--------------------------------------------------------------------------#
+    #=== Class constants ===
+    #--------------------------------------------------------------------------#
+    ##@var BLK_SIZE
+    # Size of blocks in which files or streams are fed to the hash functions
+    BLK_SIZE = 1024 * 1024
+
+    #--------------------------------------------------------------------------#
+    #=== Instance variables ===
+    ##@var alg_names
+    # list of strings names of suites (keys of NIname.hash_algs) handled
+
+    ##@var hashers
+    # dictionary hash function constructor -> hash object instance
+
+    ##@var results
+    # dictionary hash function constructor -> untruncated binary digest
+    #            (None until finalized)
+
+    #--------------------------------------------------------------------------#
+    def __init__(self, alg_names=None, hash_functions=()):
+        """
+        @brief Constructor - set up one hash object per distinct hash function
+        @param alg_names list of strings suite names from NIname.hash_algs
+                         or None for all known suites
+        @param hash_functions list of additional hash function constructors
+                              (e.g., hashlib.sha256) whose untruncated
+                              output is wanted
+        @throw ValueError if an algorithm name is not known
+        """
+        if alg_names is None:
+            alg_names = NIname.get_all_algs()
+        self.alg_names = list(alg_names)
+        self.hashers = {}
+        for alg in self.alg_names:
+            try:
+                hf = NIname.hash_algs[alg][NIname.AF]
+            except KeyError:
+                raise ValueError("Unknown digest algorithm: %s" % alg)
+            if hf not in self.hashers:
+                self.hashers[hf] = hf()
+        for hf in hash_functions:
+            if hf not in self.hashers:
+                self.hashers[hf] = hf()
+        self.results = None
+        return
+
+    #--------------------------------------------------------------------------#
+    def update(self, data):
+        """
+        @brief Feed data to all the hash functions
+        @param data string or buffer with next chunk of data
+        @return (none)
+        """
+        for h in self.hashers.itervalues():
+            h.update(data)
+        return
+
+    #--------------------------------------------------------------------------#
+    def hash_stream(self, fileobj, blk_size=BLK_SIZE):
+        """
+        @brief Feed all the (remaining) data from a file-like object
+        @param fileobj object with read method
+        @param blk_size integer size of reads
+        @return integer number of octets processed
+        @throw IOError if reading fails
+        """
+        total = 0
+        while True:
+            buf = fileobj.read(blk_size)
+            if len(buf) == 0:
+                break
+            self.update(buf)
+            total += len(buf)
+        return total
+
+    #--------------------------------------------------------------------------#
+    def hash_file(self, file_name):
+        """
+        @brief Feed the whole contents of a file
+        @param file_name string pathname of file
+        @return integer number of octets processed
+        @throw IOError or OSError if the file can't be opened or read
+
+        The file is mapped into memory and fed in blocks without copying
+        if possible.  Empty files and files that can't be mapped (e.g.,
+        pipes) are read normally.
+        """
+        f = open(file_name, "rb")
+        try:
+            size = os.fstat(f.fileno()).st_size
+            mm = None
+            if size > 0:
+                try:
+                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except (mmap.error, EnvironmentError, ValueError):
+                    mm = None
+            if mm is None:
+                return self.hash_stream(f)
+            try:
+                for offset in xrange(0, size, self.BLK_SIZE):
+                    self.update(buffer(mm, offset, self.BLK_SIZE))
+            finally:
+                mm.close()
+            return size
+        finally:
+            f.close()
+
+    #--------------------------------------------------------------------------#
+    def finalize(self):
+        """
+        @brief Finish the digests - no more data can be added afterwards
+        @return (none)
+        """
+        if self.results is None:
+            self.results = {}
+            for hf, h in self.hashers.iteritems():
+                self.results[hf] = h.digest()
+        return
+
+    #--------------------------------------------------------------------------#
+    def get_hash_digest(self, hash_function):
+        """
+        @brief Get the untruncated binary digest from a hash function
+        @param hash_function hash function constructor given to constructor
+                             or used by one of the suites
+        @return string binary digest
+        """
+        self.finalize()
+        return self.results[hash_function]
+
+    #--------------------------------------------------------------------------#
+    def get_digest(self, alg_name):
+        """
+        @brief Get the binary digest for a suite, truncated as required
+        @param alg_name string suite name (must have been given to constructor)
+        @return string binary digest or None if the hash function output
+                does not have the expected length
+        """
+        info = NIname.hash_algs[alg_name]
+        dgst = self.get_hash_digest(info[NIname.AF])
+        if len(dgst) != info[NIname.HL]:
+            debug("Hash algorithm returned unexpected length (Exp: %d; Actual: %d)" %
+                  (info[NIname.HL], len(dgst)))
+            return None
+        return dgst[:info[NIname.TL]]
+
+    #--------------------------------------------------------------------------#
+    def get_digests(self):
+        """
+        @brief Get the truncated binary digests for all suites
+        @return dictionary suite name -> binary digest (None if hash failed)
+        """
+        rslt = {}
+        for alg in self.alg_names:
+            rslt[alg] = self.get_digest(alg)
+        return rslt
+
 #==============================================================================#
 class NI:
     """
@@ -1143,48 +1459,44 @@ class NI:
         niBADFILE if canot open/read file, 
         niHASHFAIL if the hash digest seems to be the wrong length or
         niSUCCESS if all goes well.
-        Processes file in chunks to avoid needing enormous buffer.
+        Uses NIDigestEngine to process the file.
         """
-
-        # Digest output
-        dgst = None
-
-        ret = ni_errs.niSUCCESS
-        
-        # Check ni_url has been validated and if so get hash digest class
+        # Check ni_url has been validated
         if not ni_url.url_validated():
-            return (dgst, ni_errs.niBADALG)
-        h = ni_url.get_hash_function()()
+            return (None, ni_errs.niBADALG)
+        (dgsts, ret) = self.digest_file_multi([ni_url.get_alg_name()], file_name)
+        if dgsts is None:
+            return (None, ret)
+        dgst = dgsts[ni_url.get_alg_name()]
+        if dgst is None:
+            return (None, ni_errs.niHASHFAIL)
+        return (dgst, ni_errs.niSUCCESS)
 
-        # Open the file
+    #--------------------------------------------------------------------------#
+    def digest_file_multi(self, alg_names, file_name):
+        """
+        @brief Make digests for several algorithm suites with one pass over a file
+        @param alg_names list of suite names from NIname.hash_algs or None for all (in)
+        @param file_name of file to be hashed (in)
+        @return tuple (dictionary suite name -> truncated binary digest (None
+                       for any suite where the hash had the wrong length) or
+                       None if failed, result code)
+        Returns result code
+        niBADALG if any of the algorithm names is not known
+        niBADFILE if canot open/read file, or
+        niSUCCESS if the file was hashed.
+        """
         try:
-            f = open(file_name, "rb")
-        except Exception, e :
-            debug("Cannot open file: Error: %s" % str(e))
-            return (dgst, ni_errs.niBADFILE)
-
+            engine = NIDigestEngine(alg_names)
+        except ValueError, e:
+            debug(str(e))
+            return (None, ni_errs.niBADALG)
         try:
-            l = f.read(1024)
-        except Exception, e :
-            debug("Cannot read file: Error: %s" %str(e))
-            return (dgst, ni_errs.niBADFILE)
-        while (len(l) > 0):
-            h.update(l)
-            try:
-                l = f.read(1024)
-            except Exception, e :
-                debug("Cannot read file: Error: %s" %str(e))
-                return (dgst, ni_errs.niBADFILE)
-
-        f.close()
-
-        dgst = h.digest()
-        
-        if len(dgst) != ni_url.get_digest_length():
-            debug("Hash algorithm returned unexpected length (Exp: %d; Actual: %d)" % (self.hash_algs[alg_name][HL], len(dgst)))
-            return (dgst, ni_errs.niHASHFAIL)
-
-        return (dgst[:ni_url.get_truncated_length()], ni_errs.niSUCCESS)
+            engine.hash_file(file_name)
+        except Exception, e:
+            debug("Cannot read file: Error: %s" % str(e))
+            return (None, ni_errs.niBADFILE)
+        return (engine.get_digests(), ni_errs.niSUCCESS)
 
     #--------------------------------------------------------------------------#
     #=== Public routines ===
@@ -1225,7 +1537,7 @@ class NI:
         """
         dgst = base64.b16encode(bin_digest).lower()
         debug("base16 encoded digest: %s" % dgst)
-        check_digit = luhn.calc_check_digit(dgst, NIname.get_nih_alphabet())
+        check_digit = nih_check_digit(dgst)
         debug("check digit: %s" % check_digit)
         dgst = dgst + ";" + check_digit        
         return dgst 
@@ -1279,6 +1591,53 @@ class NI:
         # Validation *should be* a formality
         return ni_url.validate_ni_url(has_params=True)
         
+    #--------------------------------------------------------------------------#
+    def makenifs(self, ni_urls, file_name):
+        """
+        @brief make several ni or nih scheme URIs for a named file in one pass
+        @param ni_urls list of NIname object URI templates (in/out)
+        @param file_name is a file name - string (in)
+        @return list of result codes from ni_errs enumeration, one per template
+
+        As makenif but the file is read only once whatever the number of
+        templates and hash algorithms selected.  Templates that fail
+        validation are left unchanged and the file is not read if none
+        is valid.
+        """
+        rslts = []
+        algs = set()
+        for ni_url in ni_urls:
+            rv = ni_errs.niSUCCESS
+            if not ni_url.url_validated():
+                rv = ni_url.validate_ni_url(has_params=False)
+            rslts.append(rv)
+            if rv == ni_errs.niSUCCESS:
+                algs.add(ni_url.get_alg_name())
+        if len(algs) == 0:
+            return rslts
+
+        # Construct the binary digests of the file
+        (bin_dgsts, ret) = self.digest_file_multi(list(algs), file_name)
+
+        for i in range(len(ni_urls)):
+            if rslts[i] != ni_errs.niSUCCESS:
+                continue
+            if bin_dgsts is None:
+                rslts[i] = ret
+                continue
+            ni_url = ni_urls[i]
+            bin_dgst = bin_dgsts[ni_url.get_alg_name()]
+            if bin_dgst is None:
+                rslts[i] = ni_errs.niHASHFAIL
+                continue
+            if ni_url.get_scheme() == NI_SCHEME:
+                dgst = self.make_b64_urldigest(bin_dgst)
+            else:
+                dgst = self.make_human_digest(bin_dgst)
+            ni_url.set_params(dgst)
+            rslts[i] = ni_url.validate_ni_url(has_params=True)
+        return rslts
+
     #--------------------------------------------------------------------------#
     def checknif(self, ni_url, file_name):
         """
@@ -2296,6 +2655,33 @@ if __name__ == "__main__":
             
         print "\nError count: %d" % err_cnt
         
+        print "\nChecking fast URL parser against ni_urlparse"
+        print   "============================================\n"
+        for u in [ "ni:///sha-256;abc", "ni://tcd.ie/sha-256-32;abcdef?c=text%2Fplain",
+                   "nih:sha-256-32;982a6f4a;1", "nih:/6;982a6f4a", "nih:6",
+                   "ni://a;b?q", "ni://x", "ni:sha-256", "ni://h/sha-256;a?b?c",
+                   "NI:///sha-256;abc", "ni:///sha-256;abc#frag", "ni:////sha-256;a",
+                   "ni://h/d/sha-256;a", "ni://[::1]/sha-256;a", "nix:///sha-256;a" ]:
+            n = NIname(u)
+            fast = (n.scheme, n.netloc, n.path, n.params, n.query, n.fragment)
+            if fast != tuple(ni_urlparse.urlparse(u)):
+                print "Error: fast parse of %s gave %s at line %d" % (u, str(fast), lineno())
+                err_cnt += 1
+        n1 = NIname("nih:sha-256-32;982a6f4a;1")
+        n2 = NIname("nih:sha-256-32;982a6f4a;1")
+        n3 = NIname("nih:sha-256-32;982a6f4a;2")
+        if ((n1.validate_ni_url() != ni_errs.niSUCCESS) or
+            (n2.validate_ni_url() != ni_errs.niSUCCESS) or
+            (n2.get_alg_name() != "sha-256-32") or
+            (n3.validate_ni_url() != ni_errs.niBADPARAMS)):
+            print "Error: repeated validation gave wrong result at line %d" % lineno()
+            err_cnt += 1
+        n2.set_params("982a6f4a;2")
+        if n2.validate_ni_url() != ni_errs.niBADPARAMS:
+            print "Error: changed params not revalidated at line %d" % lineno()
+            err_cnt += 1
+        print "Fast parser checked - Error count: %d" % err_cnt
+
         print "\nChecking makenif, makebnf and checknif"
         print   "======================================\n"
         
@@ -2352,6 +2738,38 @@ if __name__ == "__main__":
         print "\nName: %s" % n.get_url() 
         NIproc.makenif(n, file_name)
         print "Name with SHA256 truncated digest: %s\n" % n.get_url()
+
+        print "\nChecking makenifs and NIDigestEngine..."
+        tmpl_urls = [ "ni:///sha-256;", "nih:sha-256-32;", "ni:///sha-256-120;",
+                      "ni:///shc-256;" ]
+        tmpls = [ NIname(u) for u in tmpl_urls ]
+        rets = NIproc.makenifs(tmpls, file_name)
+        for i in range(3):
+            n = NIname(tmpl_urls[i])
+            ret = NIproc.makenif(n, file_name)
+            if (rets[i] != ni_errs.niSUCCESS) or (ret != ni_errs.niSUCCESS) or \
+               (n.get_url() != tmpls[i].get_url()):
+                print "Error: makenifs and makenif differ for %s at line %d" % \
+                      (tmpls[i].get_url(), lineno())
+                err_cnt += 1
+            else:
+                print "Name with digest: %s" % tmpls[i].get_url()
+        if rets[3] == ni_errs.niSUCCESS:
+            print "Error: makenifs accepted bad template at line %d" % lineno()
+            err_cnt += 1
+        e = NIDigestEngine()
+        e.update(randbuf)
+        dgsts = e.get_digests()
+        for alg in NIname.get_all_algs():
+            info = NIname.hash_algs[alg]
+            if dgsts[alg] != info[NIname.AF](randbuf).digest()[:info[NIname.TL]]:
+                print "Error: NIDigestEngine digest for %s wrong at line %d" % (alg, lineno())
+                err_cnt += 1
+        if len(e.hashers) != 1:
+            print "Error: NIDigestEngine used %d hash objects at line %d" % (len(e.hashers),
+                                                                              lineno())
+            err_cnt += 1
+        print "NIDigestEngine checked for suites: %s" % ", ".join(sorted(dgsts.keys()))
         
         n = NIname("ni://tcd.ie.bollix/sha-256;")    
         print "\nName: %s" % n.get_url() 
@@ -0,0 +1,814 @@
+#!/usr/bin/python
+"""
+@package nilib
+@file nibulkget.py
+@brief Event driven engine for performing large numbers of NetInf 'get' operations concurrently
+@version Copyright (C) 2012 Trinity College Dublin and Folly Consulting Ltd
+      This is an adjunct to the NI URI library developed as
+      part of the SAIL project. (http://sail-project.eu)
+
+      Specification(s) - note, versions may change
+          - http://tools.ietf.org/html/draft-farrell-decade-ni-10
+          - http://tools.ietf.org/html/draft-hallambaker-decade-ni-params-03
+          - http://tools.ietf.org/html/draft-kutscher-icnrg-netinf-proto-00
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+       - http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+===============================================================================#
+
+@details
+NIBulkGetter runs many NetInf GET requests from a single thread using an
+asyncore event loop (with poll so that the number of sockets is not
+limited by select).  This replaces the pool of processes, each making one
+blocking urllib2 request at a time, used by nigetlist.
+
+- Requests are queued per destination host.  Each host has a pool of at
+  most max_per_host connections and the total number of requests in
+  flight is limited to max_in_flight.
+- Requests are sent as HTTP/1.0 with 'Connection: keep-alive'.  If the
+  server agrees (the response has a Content-Length and the connection is
+  not marked for closing) the connection is reused for the next request
+  to that host, otherwise a new connection is made.  niserver (see
+  httpshim.py) responds as HTTP/1.1 and keeps such connections open; with
+  the WSGI server it depends on how Apache is configured.
+- If a request fails part way through the response body the partly
+  written destination (or temporary) file is closed and removed.
+- The response body is fed to a FeedParser as it arrives so that the
+  content is written to the destination file and digested in a single
+  pass.  When the response is complete the digest is checked against the
+  ni name in the same way as nigetlist.getone.
+- Requests that fail because the connection failed, timed out or was
+  closed early, or that get a 5xx response, are retried up to the
+  retry limit.  A failure on a reused connection before any response is
+  received (the server closed an idle connection) is retried without
+  counting against the limit.
+
+The result of each request is passed to a callback as a tuple
+(boolean success, string canonical ni URI) - the same as the value
+returned by nigetlist.getone.
+"""
+import os
+import sys
+import time
+import json
+import random
+import socket
+import asyncore
+import tempfile
+from urllib import urlencode
+from collections import deque
+
+from ni import ni_errs, ni_errs_txt, NIproc
+from nifeedparser import DigestFile, FeedParser, FEED_BLK_SIZE
+
+#===============================================================================#
+# List of classes/global functions in file
+__all__ = ['NIBulkGetter']
+
+#===============================================================================#
+##@var MAX_PER_HOST_DFLT
+# Default maximum number of connections to each host
+MAX_PER_HOST_DFLT = 16
+
+##@var MAX_IN_FLIGHT_DFLT
+# Default maximum number of requests in progress at any one time
+MAX_IN_FLIGHT_DFLT = 1000
+
+##@var RETRIES_DFLT
+# Default number of times a failed request is retried
+RETRIES_DFLT = 2
+
+##@var TIMEOUT_DFLT
+# Default time in seconds without any activity before a request fails
+TIMEOUT_DFLT = 30.0
+
+##@var POLL_INTERVAL
+# Maximum time in seconds for one wait in the event loop
+POLL_INTERVAL = 0.5
+
+##@var MAX_HEADER_SIZE
+# Maximum size of response status line and headers
+MAX_HEADER_SIZE = 65536
+
+#===============================================================================#
+class _GetJob(object):
+    """
+    @brief Record of one GET request to be made
+    """
+    __slots__ = ("ni_url", "ni_url_str", "http_host", "dest", "tries", "stime")
+
+    def __init__(self, ni_url, http_host, dest):
+        """
+        @brief Constructor
+        @param ni_url NIname instance for the object to get
+        @param http_host string FQDN or IP address and port of host to send
+                         the request to
+        @param dest None or string pathname where content is written (if
+                    None a temporary file is used)
+        """
+        self.ni_url = ni_url
+        self.ni_url_str = ni_url.get_canonical_ni_url()
+        self.http_host = http_host
+        self.dest = dest
+        self.tries = 0
+        self.stime = None
+        return
+
+#===============================================================================#
+class _ResponseError(Exception):
+    """
+    @brief Raised when a response fails a check
+    """
+    def __init__(self, reason, retry=False):
+        """
+        @brief Constructor
+        @param reason string description of failure
+        @param retry boolean True if the request may be tried again
+        """
+        Exception.__init__(self, reason)
+        self.retry = retry
+        return
+
+#===============================================================================#
+class _GetConnection(asyncore.dispatcher):
+    """
+    @brief One connection to a host, used for a sequence of GET requests
+    """
+    def __init__(self, pool):
+        """
+        @brief Constructor - start connecting to the host of the pool
+        @param pool _HostPool instance this connection belongs to
+        """
+        asyncore.dispatcher.__init__(self, map=pool.getter.socket_map)
+        self.pool = pool
+        self.job = None
+        self.uses = 0
+        self.last_activity = time.time()
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.connect(pool.address)
+        except socket.error:
+            self.close()
+            raise
+        return
+
+    #--------------------------------------------------------------------------#
+    def start(self, job):
+        """
+        @brief Send the request for a job on this connection
+        @param job _GetJob instance
+        @return (none)
+        """
+        self.job = job
+        self.uses += 1
+        self.last_activity = time.time()
+        if job.stime is None:
+            job.stime = self.last_activity
+        ni_url = job.ni_url
+        form_data = urlencode({ "URI":   ni_url.get_url(),
+                                "msgid": random.randint(1, 32000),
+                                "ext":   "" })
+        self.out_buf = ("POST /netinfproto/get HTTP/1.0\r\n"
+                        "Host: %s\r\n"
+                        "Connection: keep-alive\r\n"
+                        "Content-Type: application/x-www-form-urlencoded\r\n"
+                        "Content-Length: %d\r\n\r\n%s" %
+                        (job.http_host, len(form_data), form_data))
+        self.head_buf = ""
+        self.status = None
+        self.headers = None
+        self.received = 0
+        self.remaining = None
+        self.msg_parser = None
+        self.digester = None
+        self.digested_file = None
+        self.temp_file = False
+        return
+
+    #--------------------------------------------------------------------------#
+    def writable(self):
+        return (not self.connected) or ((self.job is not None) and
+                                        (len(self.out_buf) > 0))
+
+    def readable(self):
+        return True
+
+    def handle_connect(self):
+        return
+
+    def handle_write(self):
+        sent = self.send(self.out_buf)
+        if sent > 0:
+            self.out_buf = self.out_buf[sent:]
+            self.last_activity = time.time()
+        return
+
+    #--------------------------------------------------------------------------#
+    def handle_read(self):
+        data = self.recv(FEED_BLK_SIZE)
+        if not data:
+            # asyncore calls handle_close for end of file
+            return
+        self.last_activity = time.time()
+        if self.job is None:
+            # Unsolicited data on an idle connection - can't be reused
+            self._drop()
+            return
+        self.received += len(data)
+        try:
+            if self.headers is None:
+                self.head_buf += data
+                i = self.head_buf.find("\r\n\r\n")
+                if i < 0:
+                    if len(self.head_buf) > MAX_HEADER_SIZE:
+                        raise _ResponseError("Response headers too long")
+                    return
+                data = self.head_buf[i+4:]
+                self._parse_head(self.head_buf[:i])
+                self.head_buf = ""
+            if len(data) > 0:
+                self._feed(data)
+            if self.remaining == 0:
+                self._complete()
+        except _ResponseError, e:
+            self._fail(str(e), e.retry)
+        return
+
+    #--------------------------------------------------------------------------#
+    def _parse_head(self, head):
+        """
+        @brief Decode response status line and headers and set up the parser
+        @param head string status line and headers without final blank line
+        @return (none)
+        @throw _ResponseError if the status is not 200 or response malformed
+        """
+        lines = head.split("\r\n")
+        status_line = lines[0].split(None, 2)
+        try:
+            self.version = status_line[0]
+            self.status = int(status_line[1])
+        except (IndexError, ValueError):
+            raise _ResponseError("Malformed HTTP status line: %s" % lines[0])
+        headers = {}
+        for line in lines[1:]:
+            (name, sep, value) = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        self.headers = headers
+        length = headers.get("content-length")
+        if length is not None:
+            try:
+                self.remaining = int(length)
+            except ValueError:
+                raise _ResponseError("Bad Content-Length header: %s" % length)
+        if self.status != 200:
+            raise _ResponseError("Get request returned HTTP code %d" %
+                                 self.status, retry=(self.status >= 500))
+
+        job = self.job
+        if job.dest is None:
+            fd, self.digested_file = tempfile.mkstemp()
+            fo = os.fdopen(fd, "w")
+            self.temp_file = True
+        else:
+            self.digested_file = job.dest
+            fo = None
+        try:
+            self.digester = DigestFile(self.digested_file, fo,
+                                       job.ni_url.get_hash_function())
+        except IOError, e:
+            raise _ResponseError("Unable to open %s: %s" %
+                                 (self.digested_file, str(e)))
+        # Expecting up to three MIME message objects
+        # - Top level multipart/mixed,
+        # - application/json with metadata, and
+        # - any type for content file
+        self.msg_parser = FeedParser(dest_list=[None, None, self.digester])
+        self.msg_parser.feed("Content-Type: %s\r\n\r\n" %
+                             headers.get("content-type", "text/plain"))
+        return
+
+    #--------------------------------------------------------------------------#
+    def _feed(self, data):
+        """
+        @brief Pass part of the response body to the parser
+        @param data string body data
+        @return (none)
+        @throw _ResponseError if there is more data than Content-Length
+        """
+        if self.remaining is not None:
+            if len(data) > self.remaining:
+                raise _ResponseError("Response longer than Content-Length")
+            self.remaining -= len(data)
+        self.msg_parser.feed(data)
+        return
+
+    #--------------------------------------------------------------------------#
+    def _complete(self):
+        """
+        @brief Check the complete response and report the result
+        @return (none)
+        """
+        job = self.job
+        self.job = None
+        msg = self.msg_parser.close()
+        self.msg_parser = None
+        try:
+            (msgid, length) = self._check(job, msg)
+            self.pool.getter.log("%s,GET rx fine,ni,%s,size,%d,time,%10.10f" %
+                                 (msgid, job.ni_url_str, length,
+                                  (time.time() - job.stime) * 1000))
+            ok = True
+        except _ResponseError, e:
+            self.pool.getter.log(str(e))
+            ok = False
+        if self.temp_file:
+            # Content was only wanted for checking
+            try:
+                os.remove(self.digested_file)
+            except OSError:
+                pass
+        keep_alive = ((self.remaining is not None) and
+                      (self.headers.get("connection", "").lower() != "close") and
+                      ((self.version == "HTTP/1.1") or
+                       (self.headers.get("connection", "").lower() ==
+                        "keep-alive")))
+        if not keep_alive:
+            self._drop()
+        self.pool.getter.job_done(job, ok)
+        if keep_alive:
+            self.pool.release(self)
+        return
+
+    #--------------------------------------------------------------------------#
+    def _check(self, job, msg):
+        """
+        @brief Check response is correctly formed and the digest verifies
+        @param job _GetJob instance
+        @param msg FiledMessage instance returned by the parser
+        @return tuple (msgid from the JSON metadata, integer content length)
+        @throw _ResponseError if any check fails
+        """
+        if len(msg.defects) > 0:
+            raise _ResponseError("Response was not a correctly formed MIME object")
+        parts = msg.get_payload()
+        if msg.is_multipart():
+            if len(parts) != 2:
+                raise _ResponseError("Error: Response from server does not have two parts.")
+            json_msg = parts[0]
+            ct_msg = parts[1]
+        else:
+            json_msg = msg
+            ct_msg = None
+        if json_msg.get("Content-type") != "application/json":
+            raise _ResponseError("First or only component (metadata) of result "
+                                 "is not of type application/json")
+        try:
+            json_report = json.loads(json_msg.get_payload())
+            msgid = json_report["msgid"]
+        except Exception, e:
+            raise _ResponseError("Error: Could not decode JSON report '%s': %s" %
+                                 (json_msg.get_payload(), str(e)))
+        if ct_msg is None:
+            # Destination was never used so has not been closed
+            self.digester.close()
+            raise _ResponseError("Content of %s was not returned" %
+                                 job.ni_url_str)
+        ni_url = job.ni_url
+        digest = self.digester.get_digest()[:ni_url.get_truncated_length()]
+        digest = NIproc.make_b64_urldigest(digest)
+        if digest != ni_url.get_digest():
+            raise _ResponseError("Digest of %s did not verify" %
+                                 ni_url.get_url())
+        return (msgid, ct_msg.get_payload_len())
+
+    #--------------------------------------------------------------------------#
+    def _fail(self, reason, retry):
+        """
+        @brief Abandon the current request and close the connection
+        @param reason string description of failure
+        @param retry boolean True if the request may be tried again
+        @return (none)
+        """
+        job = self.job
+        self.job = None
+        if self.msg_parser is not None:
+            try:
+                self.msg_parser.close()
+            except Exception:
+                pass
+            self.msg_parser = None
+        written = self.temp_file
+        if self.digester is not None:
+            # Partly written file is no use - close it (closing again
+            # after the parser has done so is harmless) and remove it
+            try:
+                self.digester.close()
+            except Exception:
+                pass
+            self.digester = None
+            written = True
+        if written and (self.digested_file is not None):
+            try:
+                os.remove(self.digested_file)
+            except OSError:
+                pass
+            self.digested_file = None
+        # Failure on a reused connection before anything was received just
+        # means the server closed the idle connection
+        stale = (self.uses > 1) and (self.received == 0)
+        self._drop()
+        if job is not None:
+            self.pool.getter.job_failed(job, reason, retry, stale)
+        return
+
+    def _drop(self):
+        """
+        @brief Close the connection and remove it from its pool
+        """
+        self.close()
+        self.pool.forget(self)
+        return
+
+    #--------------------------------------------------------------------------#
+    def handle_close(self):
+        if self.job is None:
+            self._drop()
+        elif (self.headers is not None) and (self.remaining is None):
+            # Response delimited by end of connection
+            self._complete()
+        else:
+            self._fail("Connection to %s closed before response was complete" %
+                       self.job.http_host, retry=True)
+        return
+
+    def handle_error(self):
+        (t, v, tb) = sys.exc_info()
+        if self.job is None:
+            self._drop()
+        else:
+            self._fail("Error on connection to %s: %s" %
+                       (self.job.http_host, str(v)), retry=True)
+        return
+
+    def check_timeout(self, now, timeout):
+        """
+        @brief Fail the current request if there has been no activity
+        @param now float current time
+        @param timeout float seconds allowed without activity
+        """
+        if (self.job is not None) and (now - self.last_activity > timeout):
+            self._fail("Request to %s timed out" % self.job.http_host,
+                       retry=True)
+        return
+
+#===============================================================================#
+class _HostPool(object):
+    """
+    @brief Queue of requests and pool of connections for one host
+    """
+    def __init__(self, getter, http_host):
+        """
+        @brief Constructor
+        @param getter NIBulkGetter instance
+        @param http_host string FQDN or IP address and optional port
+        @throw socket.error if the host name cannot be resolved
+        """
+        self.getter = getter
+        self.http_host = http_host
+        (host, sep, port) = http_host.partition(":")
+        if port == "":
+            port = 80
+        # Look up once rather than for every connection
+        addrs = socket.getaddrinfo(host, int(port), socket.AF_INET,
+                                   socket.SOCK_STREAM)
+        self.address = addrs[0][4]
+        self.pending = deque()
+        self.idle = []
+        self.conns = set()
+        return
+
+    def has_work(self):
+        return (len(self.pending) > 0) and ((len(self.idle) > 0) or
+                                            (len(self.conns) <
+                                             self.getter.max_per_host))
+
+    def start_one(self):
+        """
+        @brief Start the next pending request on an idle or new connection
+        @return (none)
+        """
+        job = self.pending.popleft()
+        self.getter.in_flight += 1
+        if len(self.idle) > 0:
+            conn = self.idle.pop()
+        else:
+            try:
+                conn = _GetConnection(self)
+            except socket.error, e:
+                self.getter.job_failed(job, "Unable to connect to %s: %s" %
+                                       (self.http_host, str(e)), True, False)
+                return
+            self.conns.add(conn)
+        conn.start(job)
+        return
+
+    def release(self, conn):
+        self.idle.append(conn)
+        self.getter.dispatch()
+        return
+
+    def forget(self, conn):
+        self.conns.discard(conn)
+        if conn in self.idle:
+            self.idle.remove(conn)
+        return
+
+#===============================================================================#
+class NIBulkGetter(object):
+    """
+    @brief Perform many NetInf 'get' requests concurrently from one thread
+    """
+    def __init__(self, callback, max_per_host=MAX_PER_HOST_DFLT,
+                 max_in_flight=MAX_IN_FLIGHT_DFLT, retries=RETRIES_DFLT,
+                 timeout=TIMEOUT_DFLT, log=None):
+        """
+        @brief Constructor
+        @param callback callable given result tuple (boolean success, string
+                        canonical ni URI) when each request finishes
+        @param max_per_host integer maximum connections to any one host
+        @param max_in_flight integer maximum requests in progress
+        @param retries integer number of times a failed request is retried
+        @param timeout float seconds without activity before request fails
+        @param log None or callable given a string to record progress and
+                   errors
+        """
+        self.callback = callback
+        self.max_per_host = max_per_host
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.timeout = timeout
+        if log is None:
+            log = lambda string: None
+        self.log = log
+        self.socket_map = {}
+        self.pools = {}
+        self.in_flight = 0
+        self.queued = 0
+        self._dispatching = False
+        return
+
+    #--------------------------------------------------------------------------#
+    def add(self, ni_url, http_host, dest):
+        """
+        @brief Queue a request
+        @param ni_url NIname instance for object to get
+        @param http_host string FQDN or IP address and port of host to send
+                         the request to
+        @param dest None or string pathname where content is written (if
+                    None the content is checked and then discarded)
+        @return (none)
+
+        The name is validated immediately - if it is not a complete ni URI
+        the failure is reported through the callback.
+        """
+        rv = ni_url.validate_ni_url(has_params = True)
+        if (rv != ni_errs.niSUCCESS):
+            self.log("Error: %s is not a complete, valid ni scheme URL: %s" %
+                     (ni_url.get_url(), ni_errs_txt[rv]))
+            self.callback((False, ni_url.get_url()))
+            return
+        job = _GetJob(ni_url, http_host, dest)
+        pool = self.pools.get(http_host)
+        if pool is None:
+            try:
+                pool = _HostPool(self, http_host)
+            except (socket.error, ValueError), e:
+                self.log("Error: Unable to access host %s: %s" %
+                         (http_host, str(e)))
+                self.callback((False, job.ni_url_str))
+                return
+            self.pools[http_host] = pool
+        pool.pending.append(job)
+        self.queued += 1
+        self.dispatch()
+        return
+
+    #--------------------------------------------------------------------------#
+    def dispatch(self):
+        """
+        @brief Start as many queued requests as the limits allow
+        @return (none)
+
+        Hosts take turns so that one host with a long queue does not
+        hold up the others.  Requests that finish or fail while starting
+        others call this again - that is ignored as the outer call will
+        pick up any resulting work.
+        """
+        if self._dispatching:
+            return
+        self._dispatching = True
+        try:
+            started = True
+            while started and (self.in_flight < self.max_in_flight):
+                started = False
+                for pool in self.pools.values():
+                    if self.in_flight >= self.max_in_flight:
+                        break
+                    if pool.has_work():
+                        self.queued -= 1
+                        pool.start_one()
+                        started = True
+        finally:
+            self._dispatching = False
+        return
+
+    #--------------------------------------------------------------------------#
+    def job_done(self, job, ok):
+        """
+        @brief Report the result of a finished request
+        @param job _GetJob instance
+        @param ok boolean True if content was retrieved and verified
+        """
+        self.in_flight -= 1
+        self.callback((ok, job.ni_url_str))
+        return
+
+    def job_failed(self, job, reason, retry, stale):
+        """
+        @brief Handle a request that failed before completing
+        @param job _GetJob instance
+        @param reason string description of failure
+        @param retry boolean True if the request may be tried again
+        @param stale boolean True if failure was on an idle connection that
+                     the server had closed (does not count as a try)
+        """
+        self.in_flight -= 1
+        if not stale:
+            job.tries += 1
+        if retry and (job.tries <= self.retries):
+            if not stale:
+                self.log("%s - retrying %s" % (reason, job.ni_url_str))
+            self.queued += 1
+            self.pools[job.http_host].pending.append(job)
+        else:
+            self.log(reason)
+            self.callback((False, job.ni_url_str))
+        self.dispatch()
+        return
+
+    #--------------------------------------------------------------------------#
+    def poll(self, timeout=0.0):
+        """
+        @brief Run one pass of the event loop
+        @param timeout float maximum seconds to wait for activity
+        @return integer number of requests queued or in progress
+        """
+        if len(self.socket_map) > 0:
+            asyncore.loop(timeout=timeout, use_poll=True, map=self.socket_map,
+                          count=1)
+        now = time.time()
+        for conn in self.socket_map.values():
+            conn.check_timeout(now, self.timeout)
+        self.dispatch()
+        return self.queued + self.in_flight
+
+    def run(self):
+        """
+        @brief Run the event loop until all queued requests have finished
+        @return (none)
+        """
+        while self.poll(POLL_INTERVAL) > 0:
+            pass
+        self.close()
+        return
+
+    def close(self):
+        """
+        @brief Close all idle connections
+        """
+        for conn in self.socket_map.values():
+            conn.close()
+        self.socket_map.clear()
+        for pool in self.pools.itervalues():
+            pool.idle = []
+            pool.conns.clear()
+        return
+
+#==============================================================================#
+if __name__ == "__main__":
+    import shutil
+    import hashlib
+    import threading
+    import BaseHTTPServer
+    import SocketServer
+    from cgi import parse_qs
+    from ni import NIname
+
+    # Content served by the test server indexed by ni URI.  The "short"
+    # object is sent with a Content-Length that is more than is sent.
+    objects = {}
+    def make_object(content):
+        url = "ni:///sha-256;%s" % \
+              NIproc.make_b64_urldigest(hashlib.sha256(content).digest())
+        objects[url] = content
+        return url
+
+    class TestServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+        connections = 0
+
+    class TestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        def setup(self):
+            BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+            self.server.connections += 1
+        def log_message(self, format, *args):
+            pass
+        def do_POST(self):
+            form = parse_qs(self.rfile.read(int(self.headers["Content-Length"])))
+            url = form["URI"][0]
+            content = objects.get(url)
+            if content is None:
+                self.send_error(404, "Not found")
+                return
+            mb = "=====1234567890"
+            body = ("--%s\r\nContent-Type: application/json\r\n\r\n%s\r\n"
+                    "--%s\r\nContent-Type: application/octet-stream\r\n\r\n"
+                    "%s\r\n--%s--\r\n" %
+                    (mb, json.dumps({ "msgid": form["msgid"][0],
+                                      "status": 200 }),
+                     mb, content, mb))
+            self.send_response(200)
+            self.send_header("Content-Type",
+                             "multipart/mixed; boundary=%s" % mb)
+            self.send_header("Content-Length", str(len(body)))
+            if content.startswith("short"):
+                body = body[:len(body)//2]
+                self.send_header("Connection", "close")
+            else:
+                self.send_header("Connection", "keep-alive")
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = TestServer(("127.0.0.1", 0), TestHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    http_host = "127.0.0.1:%d" % server.server_address[1]
+    tmp_dir = tempfile.mkdtemp()
+    errs = 0
+
+    # Many gets through a few connections
+    results = []
+    getter = NIBulkGetter(results.append, max_per_host=2)
+    n = 50
+    for i in range(n):
+        url = make_object("object %d %s" % (i, os.urandom(1000 * i)))
+        getter.add(NIname(url), http_host, None)
+    getter.run()
+    if (len(results) != n) or not all(r[0] for r in results):
+        print "Expected %d successful gets: %s" % (n, str(results))
+        errs += 1
+    if server.connections > 2:
+        print "Connections not reused: %d connections for %d gets" % \
+              (server.connections, n)
+        errs += 1
+
+    # Failure part way through the body removes the destination file
+    results = []
+    getter = NIBulkGetter(results.append, retries=0)
+    dest = os.path.join(tmp_dir, "short")
+    getter.add(NIname(make_object("short %s" % os.urandom(100000))),
+               http_host, dest)
+    getter.run()
+    if (len(results) != 1) or results[0][0]:
+        print "Expected failed get: %s" % str(results)
+        errs += 1
+    if os.path.exists(dest):
+        print "Partly written file %s was not removed" % dest
+        errs += 1
+
+    # Unknown object
+    results = []
+    getter = NIBulkGetter(results.append)
+    url = "ni:///sha-256;%s" % \
+          NIproc.make_b64_urldigest(hashlib.sha256("missing").digest())
+    getter.add(NIname(url), http_host, os.path.join(tmp_dir, "missing"))
+    getter.run()
+    if (len(results) != 1) or results[0][0]:
+        print "Expected failed get: %s" % str(results)
+        errs += 1
+
+    server.shutdown()
+    shutil.rmtree(tmp_dir)
+    print "Tests completed with %d errors" % errs
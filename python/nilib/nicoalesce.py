@@ -0,0 +1,334 @@
+#!/usr/bin/python
+"""
+@package nilib
+@file nicoalesce.py
+@brief Single-flight coalescing of concurrent requests for the same NDO.
+@version Copyright (C) 2012 Trinity College Dublin and Folly Consulting Ltd
+      This is an adjunct to the NI URI library developed as
+      part of the SAIL project. (http://sail-project.eu)
+
+      Specification(s) - note, versions may change
+          - http://tools.ietf.org/html/draft-farrell-decade-ni-10
+          - http://tools.ietf.org/html/draft-hallambaker-decade-ni-params-03
+          - http://tools.ietf.org/html/draft-kutscher-icnrg-netinf-proto-00
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+       - http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+================================================================================
+
+@details
+When several requests for the same NDO arrive while it is not in the local
+cache, only one of them (the 'leader') should go off and fetch it.  The
+others wait for the leader to finish and are handed the result directly.
+
+A RequestCoalescer keeps a table of InFlightRequest objects (a simple
+future/promise) keyed by a name string - normally the canonical ni URI of
+the NDO.  The first caller of 'begin' for a key becomes the leader and is
+responsible for calling either 'complete' (with the metadata and content
+file name) or 'fail' (with an HTTP style error code and message) on the
+coalescer.  Until that happens later callers receive the same
+InFlightRequest and can either block in 'wait' (with a timeout) or, for
+event driven users such as the DTN gateway, register a callback with
+'add_done_callback'.
+
+The entry is removed from the table before the waiters are woken so that
+a request arriving after completion starts a new fetch rather than picking
+up a stale result.
+"""
+
+#==============================================================================#
+#=== Standard modules for Python 2.[567].x distributions ===
+import threading
+
+#==============================================================================#
+# List of classes/global functions in file
+__all__ = ['InFlightRequest', 'RequestCoalescer']
+
+#==============================================================================#
+class InFlightRequest:
+    """
+    @brief Result placeholder for a fetch that is in progress
+
+    Holds either the metadata and content file name from a successful
+    fetch or an error code and message from a failed one.  The content
+    file name may be None if only metadata is available.
+    """
+
+    #--------------------------------------------------------------------------#
+    #=== Class constants ===
+    #--------------------------------------------------------------------------#
+    ##@var PENDING
+    # State before the leader has finished
+    PENDING = 0
+    ##@var SUCCEEDED
+    # State after the leader has supplied a result
+    SUCCEEDED = 1
+    ##@var FAILED
+    # State after the leader has reported failure
+    FAILED = 2
+
+    #--------------------------------------------------------------------------#
+    #=== Instance Variables ===
+    ##@var key
+    # string key under which the request is held in the coalescer table
+
+    ##@var state
+    # integer one of PENDING, SUCCEEDED or FAILED
+
+    ##@var metadata
+    # NetInfMetaData object instance with result metadata (SUCCEEDED only)
+
+    ##@var content_file
+    # string pathname of file with NDO content or None (SUCCEEDED only)
+
+    ##@var err_code
+    # integer HTTP style error code (FAILED only)
+
+    ##@var err_msg
+    # string error message (FAILED only)
+
+    ##@var waiters
+    # integer number of requests that joined this fetch after the leader
+
+    #--------------------------------------------------------------------------#
+    def __init__(self, key):
+        """
+        @brief Constructor
+        @param key string key for request in coalescer table
+        """
+        self.key = key
+        self.state = self.PENDING
+        self.metadata = None
+        self.content_file = None
+        self.err_code = None
+        self.err_msg = None
+        self.waiters = 0
+        self._event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+        return
+
+    #--------------------------------------------------------------------------#
+    def done(self):
+        """
+        @brief Check if the leader has finished
+        @return boolean True if result or failure has been set
+        """
+        return self.state != self.PENDING
+
+    #--------------------------------------------------------------------------#
+    def succeeded(self):
+        """
+        @brief Check if the leader finished successfully
+        @return boolean True if a result is available
+        """
+        return self.state == self.SUCCEEDED
+
+    #--------------------------------------------------------------------------#
+    def wait(self, timeout=None):
+        """
+        @brief Wait for the leader to finish
+        @param timeout float maximum seconds to wait or None to wait for ever
+        @return boolean True if finished, False if the wait timed out
+        """
+        self._event.wait(timeout)
+        return self.done()
+
+    #--------------------------------------------------------------------------#
+    def add_done_callback(self, fn):
+        """
+        @brief Arrange for fn to be called when the leader finishes
+        @param fn callable taking this InFlightRequest as its only parameter
+        @return (none)
+
+        If the request has already finished fn is called immediately.
+        Callbacks are otherwise run in the thread that finishes the request.
+        """
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+        return
+
+    #--------------------------------------------------------------------------#
+    def _finish(self, state, metadata, content_file, err_code, err_msg):
+        """
+        @brief Record outcome, wake waiters and run callbacks
+        @return boolean True unless the request had already finished
+        """
+        with self._lock:
+            if self.done():
+                return False
+            self.metadata = metadata
+            self.content_file = content_file
+            self.err_code = err_code
+            self.err_msg = err_msg
+            self.state = state
+            callbacks = self._callbacks
+            self._callbacks = []
+        self._event.set()
+        for fn in callbacks:
+            fn(self)
+        return True
+
+    #--------------------------------------------------------------------------#
+    def __repr__(self):
+        """
+        @brief Presentation string for InFlightRequest
+        @return string with key and state
+        """
+        return "InFlightRequest(%s, %s, waiters %d)" % \
+               (self.key, ("pending", "succeeded", "failed")[self.state],
+                self.waiters)
+
+#==============================================================================#
+class RequestCoalescer:
+    """
+    @brief Table of fetches in progress with single-flight semantics
+
+    Thread safe: all access to the table is serialized by a lock.
+    """
+
+    #--------------------------------------------------------------------------#
+    ##@var DFLT_WAIT_TIMEOUT
+    # Default maximum time (seconds) a waiter should wait for the leader
+    DFLT_WAIT_TIMEOUT = 60.0
+
+    #--------------------------------------------------------------------------#
+    def __init__(self, wait_timeout=DFLT_WAIT_TIMEOUT):
+        """
+        @brief Constructor
+        @param wait_timeout float default seconds for waiters to wait
+        """
+        self.wait_timeout = wait_timeout
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        # Counters
+        self.leaders = 0
+        self.joined = 0
+        return
+
+    #--------------------------------------------------------------------------#
+    def begin(self, key):
+        """
+        @brief Join or start the fetch for key
+        @param key string identifying the NDO (canonical ni URI)
+        @return 2-tuple (InFlightRequest instance,
+                         boolean True if caller is the leader)
+
+        A leader MUST eventually call complete or fail for the returned
+        InFlightRequest, otherwise waiters will only be released by
+        their timeouts.
+        """
+        with self.lock:
+            flight = self.in_flight.get(key)
+            if flight is not None:
+                flight.waiters += 1
+                self.joined += 1
+                return (flight, False)
+            flight = InFlightRequest(key)
+            self.in_flight[key] = flight
+            self.leaders += 1
+        return (flight, True)
+
+    #--------------------------------------------------------------------------#
+    def complete(self, flight, metadata, content_file):
+        """
+        @brief Leader reports successful fetch
+        @param flight InFlightRequest instance returned by begin
+        @param metadata NetInfMetaData instance for the NDO
+        @param content_file string pathname of content file or None
+        @return boolean True unless already finished
+        """
+        self._remove(flight)
+        return flight._finish(InFlightRequest.SUCCEEDED, metadata,
+                              content_file, None, None)
+
+    #--------------------------------------------------------------------------#
+    def fail(self, flight, err_code, err_msg):
+        """
+        @brief Leader reports failed fetch
+        @param flight InFlightRequest instance returned by begin
+        @param err_code integer HTTP style error code to give to waiters
+        @param err_msg string error message to give to waiters
+        @return boolean True unless already finished
+        """
+        self._remove(flight)
+        return flight._finish(InFlightRequest.FAILED, None, None,
+                              err_code, err_msg)
+
+    #--------------------------------------------------------------------------#
+    def stats(self):
+        """
+        @brief Report counters for the coalescer
+        @return dictionary of counter names and values
+        """
+        with self.lock:
+            return { "in_flight": len(self.in_flight),
+                     "leaders":   self.leaders,
+                     "joined":    self.joined }
+
+    #--------------------------------------------------------------------------#
+    def _remove(self, flight):
+        """
+        @brief Take flight out of the table if it is still the current entry
+        @param flight InFlightRequest instance
+        @return (none)
+        """
+        with self.lock:
+            if self.in_flight.get(flight.key) is flight:
+                del self.in_flight[flight.key]
+        return
+
+#==============================================================================#
+# TESTING CODE
+if __name__ == "__main__":
+    import time
+    rc = RequestCoalescer(wait_timeout=2.0)
+    results = []
+
+    def waiter():
+        f, leader = rc.begin("ni:///sha-256;abc")
+        assert not leader
+        if f.wait(rc.wait_timeout) and f.succeeded():
+            results.append((f.metadata, f.content_file))
+        else:
+            results.append((f.err_code, f.err_msg))
+
+    f, leader = rc.begin("ni:///sha-256;abc")
+    assert leader
+    thrds = [threading.Thread(target=waiter) for i in range(5)]
+    for t in thrds:
+        t.start()
+    time.sleep(0.2)
+    cb = []
+    f.add_done_callback(lambda fl: cb.append(fl.state))
+    rc.complete(f, "metadata", "/tmp/content")
+    for t in thrds:
+        t.join()
+    assert results == [("metadata", "/tmp/content")] * 5, results
+    assert cb == [InFlightRequest.SUCCEEDED]
+    # Entry gone after completion - next request leads a new fetch
+    f, leader = rc.begin("ni:///sha-256;abc")
+    assert leader
+    rc.fail(f, 404, "Named Data Object forwarding failed")
+    f.add_done_callback(lambda fl: cb.append(fl.state))
+    assert cb == [InFlightRequest.SUCCEEDED, InFlightRequest.FAILED]
+    # Waiter timeout
+    f, leader = rc.begin("ni:///sha-256;def")
+    f2, leader2 = rc.begin("ni:///sha-256;def")
+    assert (f is f2) and not leader2
+    assert not f2.wait(0.1)
+    print rc.stats()
+    print "All tests passed"
@@ -54,7 +54,7 @@ from nidtnmetadata import Metadata
 from ni import NIname
 
 #==============================================================================#
-class HTTPRequest:
+class HTTPRequest(object):
     """
     @brief Class to hold data sent by a DTN request to be actioned over HTTP CL
     """
@@ -90,6 +90,14 @@ class HTTPRequest:
 
     #--------------------------------------------------------------------------#
     # INSTANCE VARIABLES
+    # Fixed set of slots rather than a per-instance dictionary so that deep
+    # request queues use less memory.
+    __slots__ = ( "req_type", "req_seqno", "bundle", "make_response",
+                  "response_destn", "bpq_data", "json_in", "has_payload",
+                  "ni_name", "check_local_cache", "proc_started", "paused",
+                  "http_host_list", "http_host_next", "http_hosts_pending",
+                  "http_hosts_not_completed", "metadata", "content", "result",
+                  "timeout" )
 
     ##@var req_type
     # string one of HTTP_GET, HTTP_PUBLISH, HTTP_SEARCH or HTTP_RESPONSE
@@ -241,7 +249,7 @@ class HTTPRequest:
                           "Request seqno: %d" % self.req_seqno))
 
 #==============================================================================#
-class MsgDtnEvt:
+class MsgDtnEvt(object):
     """
     @brief Queue message encapsulation for bundles
     """
@@ -267,7 +275,12 @@ class MsgDtnEvt:
 
     #--------------------------------------------------------------------------#
     # INSTANCE VARIABLES
+    __slots__ = ( "_send_type", "_msg_seqno", "_msg_data" )
 
+    ##@var _send_type
+    # string one of MSG_FROM_DTN, MSG_TO_DTN, MSG_END
+    ##@var _msg_data
+    # HTTPRequest object instance carried by message (None for MSG_END)
     ##@var _msg_seqno
     # integer sequence number of this message obtained from next_seqno()
     ##@var _reply_to
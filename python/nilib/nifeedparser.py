@@ -33,7 +33,7 @@ of the FiledMessage class which is a wrapper round a standard message that manag
 writing the payload to a file.
 """
 
-__all__ = ['FeedParser', 'DigestFile', 'FiledMessage']
+__all__ = ['FeedParser', 'DigestFile', 'FiledMessage', 'FEED_BLK_SIZE']
 
 try:
     from cStringIO import StringIO
@@ -44,6 +44,9 @@ from email import errors
 from email import message
 import re
 import json
+from collections import deque
+
+from ni import NIDigestEngine
 
 NLCRE = re.compile('\r\n|\r|\n')
 NLCRE_bol = re.compile('(\r\n|\r|\n)')
@@ -57,6 +60,12 @@ NL = '\n'
 
 NeedMoreData = object()
 
+##@var FEED_BLK_SIZE
+# Size of blocks read from a response and fed to the parser.  Payloads
+# are passed through in raw blocks so large blocks keep the per-block
+# overhead down.
+FEED_BLK_SIZE = 65536
+
 class DigestFile:
     """
     @brief Offers a limited subset of the standard file interface so that
@@ -67,33 +76,48 @@ class DigestFile:
         @brief Pseudo file object that creates a digest as it writes
         @param name string destination file name
         @param fileobj None or fileobj where file can be written
-        @param digester instance of ParamDigester class
-
-        Remember the file name and digester 
+        @param digester hash function constructor (e.g., as returned by
+                        NIname.get_hash_function) or NIDigestEngine instance
+
+        Remember the file name and digester.  A hash function constructor
+        is wrapped in an NIDigestEngine so that get_digest returns the
+        untruncated output of that function.  If an NIDigestEngine is
+        supplied get_digests gives the truncated digests for all of the
+        suites it was set up with, all from the single pass over the data.
         """
         self._name = name
         if fileobj is None:
             self._file = open(self._name, "w")
         else:
             self._file = fileobj
-        self._digester = digester()
+        if isinstance(digester, NIDigestEngine):
+            self._engine = digester
+            self._hash_function = None
+        else:
+            self._engine = NIDigestEngine([], (digester,))
+            self._hash_function = digester
         self._digest = None
         return
 
     def write(self, data):
         #print "Digesting |%s||%d" % (data, len(data))
-        self._digester.update(data)
+        self._engine.update(data)
         self._file.write(data)
         return
 
     def close(self):
         self._file.close()
-        self._digest = self._digester.digest()
+        self._engine.finalize()
+        if self._hash_function is not None:
+            self._digest = self._engine.get_hash_digest(self._hash_function)
         return
 
     def get_digest(self):
         return self._digest
 
+    def get_digests(self):
+        return self._engine.get_digests()
+
     def __repr__(self):
         return self._name
 
@@ -142,6 +166,13 @@ class BufferedSubFile(object):
     current predicate matches the current line, a false EOF response
     (i.e. empty string) is returned instead.  This lets the parser adhere to a
     simple abstraction -- it parses until EOF closes the current message.
+
+    For the payload of a part, the object can be switched into a raw mode
+    where pushed data is handed back by readline in blocks as it arrives
+    rather than being split into lines: either for a known number of octets
+    (set_skip_count) or until one of a list of multipart boundaries is seen
+    (set_boundary_scan).  Anything after the raw section is split into lines
+    as usual.
     """
     def __init__(self):
         # The last partial line pushed into this object.
@@ -154,8 +185,16 @@ class BufferedSubFile(object):
         self._closed = False
         # Count of octets that should be skipped without doing matching
         self._skip_count = 0
-        # Raw data returned while skipping
-        self._raw_data = None
+        # Boundary strings (preceded by NL) that end the raw section or None
+        self._scan_seps = None
+        # Number of octets held back in case a boundary spans two pushes
+        self._scan_keep = 0
+        # True until the start of the raw section has been checked
+        self._scan_first = False
+        # Data held back while scanning for a boundary
+        self._scan_buf = ''
+        # Raw data blocks waiting to be returned, in order
+        self._raw = deque()
 
     def push_eof_matcher(self, pred):
         self._eofstack.append(pred)
@@ -164,20 +203,26 @@ class BufferedSubFile(object):
         return self._eofstack.pop()
 
     def close(self):
+        # Anything held back while scanning is treated as lines
+        if self._scan_seps is not None:
+            self._scan_seps = None
+            self._push_lines(self._scan_buf)
+            self._scan_buf = ''
+        self._skip_count = 0
         # Don't forget any trailing partial line.
         self._lines.append(self._partial)
-        if self._raw_data is not None:
-            self._lines.append(self._raw_data)
         self._partial = ''
-        self._raw_data = None
         self._closed = True
 
+    def _in_raw_mode(self):
+        return (self._skip_count > 0) or (self._scan_seps is not None)
+
     def readline(self):
-        if self._raw_data is not None:
-            data = self._raw_data
-            self._raw_data = None
-            return data
-        
+        if self._raw:
+            return self._raw.popleft()
+        if self._in_raw_mode():
+            return NeedMoreData
+
         if not self._lines:
             if self._closed:
                 return ''
@@ -201,42 +246,94 @@ class BufferedSubFile(object):
         assert line is not NeedMoreData
         self._lines.append(line)
 
+    def _take_pending(self):
+        # Retrieve data already pushed but not yet read so that it can be
+        # reprocessed in raw mode.
+        data = EMPTYSTRING.join(self._lines[::-1]) + self._partial
+        self._lines = []
+        self._partial = ''
+        return data
+
     def set_skip_count(self, skip_count):
-        if skip_count <= 0:
+        """Return the next skip_count octets as raw blocks."""
+        if (skip_count <= 0) or self._closed:
             return
-        self._skip_match = True
-        self._raw_data = ""
-        while (skip_count > 0) and (len(self._lines) > 0):
-            data = self._lines.pop()
-            ld = len(data)
-            if ld <= skip_count:
-                self._raw_data += data
-                skip_count -= ld
-            else:
-                self._raw_data += data[:ld]
-                self._lines.append(data[ld:])
-                skip_count = 0
-                
         self._skip_count = skip_count
+        self._push_raw(self._take_pending())
         return
 
-    def push(self, data):
-        """Push some new data into this object."""
-        # Handle any previous leftovers
-        data, self._partial = self._partial + data, ''
+    def set_boundary_scan(self, separators):
+        """Return raw blocks up to the first of the separators found at the
+        start of a line.  The raw section includes the newline before the
+        boundary which is left to be read as a line."""
+        if (not separators) or self._closed:
+            return
+        self._scan_seps = [NL + sep for sep in separators]
+        self._scan_keep = max([len(sep) for sep in self._scan_seps]) + 1
+        self._scan_first = True
+        self._scan_buf = ''
+        self._push_raw(self._take_pending())
+        return
 
-        # If currently skipping matching see if this finishes the skip
+    def _push_raw(self, data):
         if self._skip_count > 0:
             ld = len(data)
             if ld <= self._skip_count:
-                self._raw_data = data
+                if ld > 0:
+                    self._raw.append(data)
                 self._skip_count -= ld
-                self._lines = []
                 return
-            else:
-                self._raw_data = data[:self._skip_count]
-                data = data[self._skip_count:]
-                self.skip_count = 0
+            self._raw.append(data[:self._skip_count])
+            data = data[self._skip_count:]
+            self._skip_count = 0
+            self._push_lines(data)
+            return
+
+        data = self._scan_buf + data
+        if self._scan_first:
+            # The raw section may start with a boundary (empty payload).
+            # Wait until there is enough data to tell.
+            if len(data) < self._scan_keep:
+                self._scan_buf = data
+                return
+            self._scan_first = False
+            for sep in self._scan_seps:
+                if data.startswith(sep[1:]):
+                    self._scan_seps = None
+                    self._scan_buf = ''
+                    self._push_lines(data)
+                    return
+        best = -1
+        for sep in self._scan_seps:
+            i = data.find(sep)
+            if (i >= 0) and ((best < 0) or (i < best)):
+                best = i
+        if best >= 0:
+            # Return up to and including the NL.  If this is not really a
+            # boundary, the line matching will sort it out.
+            self._raw.append(data[:best+1])
+            self._scan_seps = None
+            self._scan_buf = ''
+            self._push_lines(data[best+1:])
+            return
+        if len(data) > self._scan_keep:
+            self._raw.append(data[:-self._scan_keep])
+            self._scan_buf = data[-self._scan_keep:]
+        else:
+            self._scan_buf = data
+        return
+
+    def push(self, data):
+        """Push some new data into this object."""
+        if self._in_raw_mode():
+            self._push_raw(data)
+        else:
+            self._push_lines(data)
+
+    def _push_lines(self, data):
+        # Handle any previous leftovers
+        data, self._partial = self._partial + data, ''
+
         # Crack into lines, but preserve the newlines on the end of each
         parts = NLCRE_crack.split(data)
         # The *ahem* interesting behaviour of re.split when supplied grouping
@@ -290,6 +387,8 @@ class FeedParser:
         else:
             self._dest_list = None
         self._dest_index = 0
+        # Stack of boundary separators for the enclosing multiparts
+        self._separators = []
 
     # Non-public interface for supporting Parser's headersonly flag
     def _set_headersonly(self):
@@ -500,6 +599,7 @@ class FeedParser:
                     # Recurse to parse this subpart; the input stream points
                     # at the subpart's first line.
                     self._input.push_eof_matcher(boundaryre.match)
+                    self._separators.append(separator)
                     for retval in self._parsegen():
                         if retval is NeedMoreData:
                             yield NeedMoreData
@@ -525,6 +625,7 @@ class FeedParser:
                             if mo:
                                 payload = payload[:-len(mo.group(0))]
                                 self._last.set_payload(payload)
+                    self._separators.pop()
                     self._input.pop_eof_matcher()
                     self._pop_message()
                     # Set the multipart up for newline cleansing, which will
@@ -572,9 +673,17 @@ class FeedParser:
         # Otherwise, it's some non-multipart type, so the entire rest of the
         # file contents becomes the payload.
         if self._dest_list is not None:
+            # Bulk data is passed straight through in raw blocks rather
+            # than line by line - for a known length if there is a
+            # Content-Length header, otherwise up to the next boundary.
             item_size = self._cur.get("content-length")
-            if item_size is not None:
+            try:
                 ld = int(item_size)
+            except (TypeError, ValueError):
+                ld = -1
+            if ld < 0:
+                self._input.set_boundary_scan(self._separators)
+            elif ld > 0:
                 #print "content length: %d" % ld
                 self._input.set_skip_count(ld)
                 for line in self._input:
@@ -668,3 +777,68 @@ class FeedParser:
         if lastheader:
             # XXX reconsider the joining of folded lines
             self._cur[lastheader] = EMPTYSTRING.join(lastvalue).rstrip('\r\n')
+
+#==============================================================================#
+if __name__ == "__main__":
+    import hashlib
+    import os
+
+    def make_response(content, eol, with_length):
+        mb = "=====1234567890"
+        json_part = json.dumps({ "status": 200 })
+        ct_hdrs = "Content-Type: application/octet-stream%s" % eol
+        if with_length:
+            ct_hdrs += "Content-Length: %d%s" % (len(content), eol)
+        body = ("--%s%sContent-Type: application/json%s%s%s%s%s--%s%s"
+                "%s%s%s%s--%s--%s" %
+                (mb, eol, eol, eol, json_part, eol, eol, mb, eol,
+                 ct_hdrs, eol, content, eol, mb, eol))
+        return ("Content-Type: multipart/mixed; boundary=%s\r\n\r\n" % mb,
+                body)
+
+    class KeptFile:
+        # File whose content can be retrieved after it is closed
+        def __init__(self):
+            self.blocks = []
+        def write(self, data):
+            self.blocks.append(data)
+        def close(self):
+            pass
+        def getvalue(self):
+            return EMPTYSTRING.join(self.blocks)
+
+    def parse_response(primer, body, blk_size):
+        out = KeptFile()
+        digester = DigestFile("test_file", out, hashlib.sha256)
+        parser = FeedParser(dest_list=[None, None, digester])
+        parser.feed(primer)
+        for i in range(0, len(body), blk_size):
+            parser.feed(body[i:i+blk_size])
+        msg = parser.close()
+        return (msg, out.getvalue(), digester.get_digest())
+
+    contents = [ "",
+                 "x",
+                 "line\n",
+                 "\r\n",
+                 os.urandom(100000),
+                 "Tricky\n--=====1234567890X\nnot a boundary\r\n--=====12\n",
+                 "--=====1234567890X payload starting like a boundary\n" ]
+    errs = 0
+    for content in contents:
+        for eol in ("\r\n", "\n"):
+            for with_length in (True, False):
+                (primer, body) = make_response(content, eol, with_length)
+                for blk_size in (1, 7, 64, 4096, FEED_BLK_SIZE):
+                    (msg, written, digest) = parse_response(primer, body,
+                                                            blk_size)
+                    parts = msg.get_payload()
+                    if ((len(msg.defects) > 0) or (len(parts) != 2) or
+                        (json.loads(parts[0].get_payload())["status"] != 200) or
+                        (written != content) or
+                        (digest != hashlib.sha256(content).digest())):
+                        print "Parse failed: content %r... eol %r length %s " \
+                              "block size %d" % (content[:20], eol,
+                                                 with_length, blk_size)
+                        errs += 1
+    print "Feed parser tests completed with %d errors" % errs
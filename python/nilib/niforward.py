@@ -48,7 +48,7 @@ import json
 import random
 import tempfile
 #import re
-#import time
+import time
 #import datetime
 #import textwrap
 # try:
@@ -58,12 +58,11 @@ import tempfile
 
 # import cgi
 import urllib
-import urllib2
+# urllib2 is imported in do_get_fwd - only needed when forwarding
 # import hashlib
 # import xml.etree.ElementTree as ET
 # import base64
-import email.parser
-import email.message
+from collections import OrderedDict
 
 # import magic
 # import DNS
@@ -74,6 +73,8 @@ import email.message
 from netinf_ver import NETINF_VER, NISERVER_VER
 from ni import NIname, NIdigester, NIproc, NI_SCHEME, NIH_SCHEME, ni_errs, ni_errs_txt
 from  metadata import NetInfMetaData
+from nifeedparser import FeedParser
+from nimetrics import FORWARD_ATTEMPTS, FORWARD_SUCCESSES
 
 
 DEBUG = True
@@ -95,20 +96,31 @@ NICLHTTP = 1
 #NICLDTN = 2
 #NICLUDP = 3
 
+# Size of blocks read from next hop when fetching an NDO
+FWD_BLK_SIZE = 65536
+
 # Enumerate router features - used in set NetInfRouterCore.features
 NIFWDNAME = 1                   # ni-name-based forwarding
 NIFWDLOOKUPHINTS = 2            # perform additional routing hint lookup
 NIFWDHINT = 3                   # hint-based forwarding
 NIFWDDEFAULT = 4                # default forwarding
 
+# Reasons for recording a forwarding miss - used in NegativeCache
+NEGNOTFOUND = 1                 # no next hop had the object
+NEGTIMEOUT = 2                  # next hop(s) did not respond in time
+
 #==============================================================================#
 # CLASSES
 
-class NextHop:
+class NextHop(object):
     """
     @brief Class for one nexthop entry
     """
 
+    # Slots rather than a per-instance dictionary to keep large
+    # forwarding tables small
+    __slots__ = ( "cl_type", "cl_address" )
+
     def __init__(self, cl_type, nexthop_address):
         self.cl_type = cl_type
         self.cl_address = nexthop_address
@@ -177,6 +189,173 @@ class HintForwardTable(dict):
         return
 
 
+class NegativeCache:
+    """
+    @brief Bounded, TTL-limited record of recent forwarding misses
+
+    When forwarding a GET fails to find an NDO, or times out, repeating the
+    next-hop scan for the same name straight away is almost certainly going
+    to fail again and just multiplies the load on the upstream nodes.  The
+    negative cache remembers the failure for a short time, keyed by the
+    canonical digest (alg;digest) of the name, so that further requests
+    can be answered immediately.
+
+    Not found and timeout results are kept for separate times because a
+    timeout is more likely to be a transient condition.  The number of
+    entries is limited: when the limit is reached the oldest entries are
+    discarded.  Expired entries are discarded lazily when looked up or
+    when space is needed.
+
+    Entries are removed when the NDO arrives in the cache by some other
+    route (e.g., a publish), so that it can be fetched from the cache.
+
+    The times and the number of entries can be set in the [forwarding]
+    section of the server configuration (NETINF_FWD_NEG_* environment
+    variables for the WSGI server); stats() is reported by the metrics
+    endpoint as netinf_fwd_negative_cache.
+
+    Access is serialized by a lock because instances are shared by all
+    the handler threads.
+    """
+
+    #--------------------------------------------------------------------------#
+    ##@var DFLT_NOTFOUND_TTL
+    # Default time (seconds) to remember that forwarding did not find an NDO
+    DFLT_NOTFOUND_TTL = 30.0
+
+    ##@var DFLT_TIMEOUT_TTL
+    # Default time (seconds) to remember that forwarding an NDO request timed out
+    DFLT_TIMEOUT_TTL = 5.0
+
+    ##@var DFLT_MAX_ENTRIES
+    # Default maximum number of entries held in the negative cache
+    DFLT_MAX_ENTRIES = 10000
+
+    #--------------------------------------------------------------------------#
+    def __init__(self, notfound_ttl=DFLT_NOTFOUND_TTL,
+                 timeout_ttl=DFLT_TIMEOUT_TTL,
+                 max_entries=DFLT_MAX_ENTRIES):
+        """
+        @brief Constructor
+        @param notfound_ttl float seconds to keep NEGNOTFOUND entries
+        @param timeout_ttl float seconds to keep NEGTIMEOUT entries
+        @param max_entries integer maximum number of entries held
+        """
+        self.ttls = { NEGNOTFOUND: float(notfound_ttl),
+                      NEGTIMEOUT:  float(timeout_ttl) }
+        self.max_entries = max_entries
+        # Maps key -> (reason, expiry time); kept in insertion order
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # Counters
+        self.hits = { NEGNOTFOUND: 0, NEGTIMEOUT: 0 }
+        self.misses = 0
+        self.inserts = 0
+        self.clears = 0
+        return
+
+    #--------------------------------------------------------------------------#
+    @staticmethod
+    def make_key(ni_name):
+        """
+        @brief Generate the key used for an NDO name
+        @param ni_name NIname validated name (ni or nih scheme)
+        @return string alg;digest with digest in ni (base64url) form
+
+        Using the canonical digest means that ni and nih versions of the
+        same name (and names with different authorities) share an entry.
+        """
+        return "%s;%s" % (ni_name.get_alg_name(), ni_name.trans_nih_to_ni())
+
+    #--------------------------------------------------------------------------#
+    def lookup(self, ni_name):
+        """
+        @brief Check if there is an unexpired entry for ni_name
+        @param ni_name NIname validated name to check
+        @return NEGNOTFOUND or NEGTIMEOUT if there is an entry, else None
+        """
+        key = self.make_key(ni_name)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                (reason, expiry) = entry
+                if expiry > time.time():
+                    self.hits[reason] += 1
+                    return reason
+                del self.entries[key]
+            self.misses += 1
+        return None
+
+    #--------------------------------------------------------------------------#
+    def add(self, ni_name, reason):
+        """
+        @brief Record a forwarding miss for ni_name
+        @param ni_name NIname validated name that could not be fetched
+        @param reason integer NEGNOTFOUND or NEGTIMEOUT
+        @return (none)
+        """
+        ttl = self.ttls.get(reason)
+        if not ttl:
+            # Unknown reason or this kind of caching switched off
+            return
+        key = self.make_key(ni_name)
+        now = time.time()
+        with self.lock:
+            if key in self.entries:
+                del self.entries[key]
+            elif len(self.entries) >= self.max_entries:
+                self._purge(now)
+            self.entries[key] = (reason, now + ttl)
+            self.inserts += 1
+        return
+
+    #--------------------------------------------------------------------------#
+    def clear(self, ni_name):
+        """
+        @brief Forget any forwarding miss recorded for ni_name
+        @param ni_name NIname validated name of NDO that has become available
+        @return boolean True if there was an entry
+        """
+        key = self.make_key(ni_name)
+        with self.lock:
+            if key in self.entries:
+                del self.entries[key]
+                self.clears += 1
+                return True
+        return False
+
+    #--------------------------------------------------------------------------#
+    def stats(self):
+        """
+        @brief Report counters for the negative cache
+        @return dictionary of counter names and values
+        """
+        with self.lock:
+            return { "entries":       len(self.entries),
+                     "hits_notfound": self.hits[NEGNOTFOUND],
+                     "hits_timeout":  self.hits[NEGTIMEOUT],
+                     "misses":        self.misses,
+                     "inserts":       self.inserts,
+                     "clears":        self.clears }
+
+    #--------------------------------------------------------------------------#
+    def _purge(self, now):
+        """
+        @brief Make space for a new entry - must be called with lock held
+        @param now float current time
+        @return (none)
+
+        Discard expired entries; if none have expired discard the oldest.
+        Entries are held in insertion order and are reinserted when updated
+        so the oldest entry is always first.
+        """
+        for key in [k for (k, (r, exp)) in self.entries.iteritems()
+                    if exp <= now]:
+            del self.entries[key]
+        while len(self.entries) >= self.max_entries:
+            self.entries.popitem(last=False)
+        return
+
 class NetInfRouterCore:
 
     def __init__(self, config, logger, features):
@@ -248,7 +427,7 @@ class NetInfRouterCore:
             return status, metadata, filename
 
         else:
-            return False, None
+            return False, None, None
 
 
 #--------------------------------------------------------------------------#
@@ -274,6 +453,8 @@ def do_get_fwd(logger,nexthops,uri,ext):
                      str - filename of file with NDO content)
     """
 
+    import urllib2
+
     logger.info("Inside do_fwd");
     metadata=None
     fname=""
@@ -285,6 +466,7 @@ def do_get_fwd(logger,nexthops,uri,ext):
         # Only http CL for now...
         if nexthop.cl_type != NICLHTTP:
             continue
+        FORWARD_ATTEMPTS.inc(labels=(nexthop.cl_address,))
 
         # Generate NetInf form access URL
         http_url = "http://%s/netinfproto/get" % nexthop.cl_address
@@ -308,6 +490,10 @@ def do_get_fwd(logger,nexthops,uri,ext):
             continue
         # Get HTTP result code
         http_result = http_object.getcode()
+        if (http_result != 200):
+            logger.info("do_fwd: weird http status code %d" % http_result)
+            http_object.close()
+            continue
 
         # Get message headers - an instance of email.Message
         http_info = http_object.info()
@@ -316,54 +502,76 @@ def do_get_fwd(logger,nexthops,uri,ext):
             obj_length = int(obj_length_str)
         else:
             obj_length = None
-        # Read results into buffer
-        # Would be good to try and do this better...
-        # if the object is large we will run into problems here
-        payload = http_object.read()
-        http_object.close()
 
         # The results may be either:
         # - a single application/json MIME item carrying metadata of object
         # - a two part multipart/mixed object with metadats and the content (of whatever type)
-        # Parse the MIME object
-
-        # Verify length and digest if HTTP result code was 200 - Success
-        if (http_result != 200):
-            logger.info("do_fwd: weird http status code %d" % http_result)
+        # Parse the MIME object as it arrives, writing the content part
+        # straight to a temporary file rather than accumulating the whole
+        # response in memory.  In dest_list, None results in output being
+        # written to a StringIO buffer.
+        try:
+            temp_fd,fname=tempfile.mkstemp();
+            fo = os.fdopen(temp_fd, "wb")
+        except Exception,e:
+            logger.info("do_fwd: file crap: %s" % str(e))
+            http_object.close()
             continue
+        msg_parser = FeedParser(dest_list=[None, None, fo])
+        msg_parser.feed("Content-Type: %s\r\n\r\n" %
+                        http_object.headers["content-type"])
+        payload_len = 0
+        try:
+            while True:
+                buf = http_object.read(FWD_BLK_SIZE)
+                if len(buf) == 0:
+                    break
+                msg_parser.feed(buf)
+                payload_len += len(buf)
+            msg = msg_parser.close()
+        except Exception, e:
+            logger.info("do_fwd: reading response from %s failed: %s" %
+                        (nexthop.cl_address, str(e)))
+            http_object.close()
+            fo.close()
+            os.remove(fname)
+            fname = ""
+            continue
+        http_object.close()
+        if not fo.closed:
+            fo.close()
 
-        if ((obj_length != None) and (len(payload) != obj_length)):
+        if ((obj_length != None) and (payload_len != obj_length)):
             logger.info("do_fwd: weird lengths payload=%d and obj=%d" %
-                        (len(payload),obj_length))
+                        (payload_len,obj_length))
+            os.remove(fname)
+            fname = ""
             continue
 
-        buf_ct = "Content-Type: %s\r\n\r\n" % http_object.headers["content-type"]
-        buf = buf_ct + payload
-        msg = email.parser.Parser().parsestr(buf)
         parts = msg.get_payload()
         if msg.is_multipart():
             if len(parts) != 2:
                 logger.info("do_fwd: funny number of parts: %d" % len(parts))
+                os.remove(fname)
+                fname = ""
                 continue
             json_msg = parts[0]
             ct_msg = parts[1]
-            try:
-                temp_fd,fname=tempfile.mkstemp();
-                f = os.fdopen(temp_fd, "w")
-                f.write(ct_msg.get_payload())
-                f.close()
-            except Exception,e:
-                logger.info("do_fwd: file crap: %s" % str(e))
-                return True,metadata,fname
         else:
+            # Metadata only - no content file
             json_msg = msg
             ct_msg = None
+            os.remove(fname)
+            fname = None
 
         # Extract JSON values from message
         # Check the message is a application/json
         if json_msg.get("Content-type") != "application/json":
             logger.info("do_fwd: weird content type: %s" %
                         json_msg.get("Content-type"))
+            if fname:
+                os.remove(fname)
+            fname = ""
             continue
 
         # Extract the JSON structure
@@ -371,6 +579,9 @@ def do_get_fwd(logger,nexthops,uri,ext):
             json_report = json.loads(json_msg.get_payload())
         except Exception, e:
             logger.info("do_fwd: can't decode json: %s" % str(e));
+            if fname:
+                os.remove(fname)
+            fname = ""
             continue
 
         curi=NIname(uri)
@@ -382,6 +593,7 @@ def do_get_fwd(logger,nexthops,uri,ext):
         # removed GET_RES handling present in do_get_fwd in nifwd.py / bengta
 
         # all good break out of loop
+        FORWARD_SUCCESSES.inc(labels=(nexthop.cl_address,))
         break
 
     # make up stuff to return
@@ -37,19 +37,18 @@ Version   Date	   Author		 Notes
 import sys
 import os.path
 import  random
-import cgi
 import urllib
-import urllib2
 import json
-import email.parser
-import email.message
 import tempfile
 
 import threading
-import redis
+# redis, urllib2 and email.parser are imported when first used so that
+# handlers that never forward do not load them
 
 from ni import ni_errs, ni_errs_txt, NIname, NIproc
 from  metadata import NetInfMetaData
+from nrs_cache import publish_invalidation
+from nimetrics import FORWARD_ATTEMPTS, FORWARD_SUCCESSES
 
 #===============================================================================#
 # moral equivalent of #define
@@ -144,13 +143,25 @@ class forwarder:
 		# etc are just local to the forwarder class
 		# another note: even if the main NetInf server is using only
 		# file based storage, this class only uses redis, always
-		self.db = redis.Redis()
+		# the client is made by get_db when it is first needed
+		self.db = None
 		self.cache_lock = threading.Lock()
 
 		# im_a_router=self.check_role(NIROUTER)
 
 		return
 
+	#===============================================================================#
+	"""
+		get the redis client, importing redis and making the client
+		the first time it is needed
+	"""
+	def get_db(self):
+		if self.db is None:
+			import redis
+			self.db = redis.Redis()
+		return self.db
+
 	#===============================================================================#
 	"""
 		set defaults for rolename values if they don't exist
@@ -160,20 +171,21 @@ class forwarder:
 
 		with self.cache_lock:
 			try:
-				self.db.set(NIROUTER + "/" + NIROUTER,True)
-				self.db.set(NIROUTER + "/" + GET_FWD,True)
-				self.db.set(NIROUTER + "/" + GET_RES,False)
-				self.db.set(NIROUTER + "/" + PUB_FWD,False)
-				self.db.set(NIROUTER + "/" + PUB_DST,False)
-				self.db.set(NIROUTER + "/" + SCH_FWD,False)
-				self.db.set(NIROUTER + "/" + SCH_DST,False)
+				self.get_db().set(NIROUTER + "/" + NIROUTER,True)
+				self.get_db().set(NIROUTER + "/" + GET_FWD,True)
+				self.get_db().set(NIROUTER + "/" + GET_RES,False)
+				self.get_db().set(NIROUTER + "/" + PUB_FWD,False)
+				self.get_db().set(NIROUTER + "/" + PUB_DST,False)
+				self.get_db().set(NIROUTER + "/" + SCH_FWD,False)
+				self.get_db().set(NIROUTER + "/" + SCH_DST,False)
 
 				# this is just temporary until we have a real
 				# RIB->FIB thing
 				nhs={}
 				nhs[0]='village.n4c.eu'
 				nhs[1]='bollox.example.com'
-				self.db.hmset(NIROUTER+"/"+GET_FWD+"/nh",nhs)
+				self.get_db().hmset(NIROUTER+"/"+GET_FWD+"/nh",nhs)
+				publish_invalidation(self.get_db(), NIROUTER+"/"+GET_FWD+"/nh")
 			except Exception, e:
 				# we're screwed!
 				self.loginfo("Exception in set_def_roles, %s" % str(e));
@@ -191,13 +203,13 @@ class forwarder:
 		roleset=False
 
 		try:
-			roleset=self.db.get(NIROUTER + "/" + rolename)
+			roleset=self.get_db().get(NIROUTER + "/" + rolename)
 		except Exception, e:
 			# oops, maybe never set? try that and then once more for luck
 			self.loginfo("Exception in check_role, %s" % str(e));
 			try:
 				self.set_def_roles()
-				roleset=self.db.get(NIROUTER + "/" + rolename)
+				roleset=self.get_db().get(NIROUTER + "/" + rolename)
 			except Exception, e:
 				self.loginfo("Exception 2 in check_role, %s" % str(e));
 				return FALSE
@@ -206,7 +218,7 @@ class forwarder:
 			# self.loginfo("Bummer 1 in check_role")
 			try:
 				self.set_def_roles()
-				roleset=self.db.get(NIROUTER + "/" + rolename)
+				roleset=self.get_db().get(NIROUTER + "/" + rolename)
 			except Exception, e:
 				self.loginfo("Exception 2 in check_role, %s" % str(e));
 				return False
@@ -234,8 +246,8 @@ class forwarder:
 		try:
 			nexthops={}
 			redis_key=NIROUTER + "/" + role + "/" + "nh"
-			all_vals = self.db.hgetall(redis_key)
-			nexthops=self.db.hmget(redis_key,all_vals)
+			all_vals = self.get_db().hgetall(redis_key)
+			nexthops=self.get_db().hmget(redis_key,all_vals)
 		except Exception, e:
 			self.loginfo("Exception in check_fwd, %s" % str(e));
 			return False,None
@@ -249,6 +261,9 @@ class forwarder:
 		fwd a request and wait for a response (with timeout)
 	"""
 	def do_get_fwd(self,nexthops,uri,ext,msgid):
+		import urllib2
+		import email.parser
+
 		self.loginfo("Inside do_fwd");
 		metadata=None
 		fname=""
@@ -256,6 +271,7 @@ class forwarder:
 		for nexthop in nexthops:
 			# send form along
 			self.loginfo("checking via %s" % nexthop)
+			FORWARD_ATTEMPTS.inc(labels=(nexthop,))
 
 			# Generate NetInf form access URL
 			http_url = "http://%s/netinfproto/get" % nexthop
@@ -392,6 +408,7 @@ class forwarder:
 					break;
 		
 			# all good break out of loop
+			FORWARD_SUCCESSES.inc(labels=(nexthop,))
 			break
 
 		# make up stuff to return
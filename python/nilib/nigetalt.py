@@ -65,11 +65,12 @@ import json
 import email.parser
 import email.message
 
-import dtnapi
+# dtnapi is imported in get_via_dtn so that HTTP operations work where
+# the DTN2 Python API is not installed
 from dtn_api_const import QUERY_EXTENSION_BLOCK, METADATA_BLOCK
 
 from ni import ni_errs, ni_errs_txt, NIname, NIproc
-from nifeedparser import DigestFile, FeedParser
+from nifeedparser import DigestFile, FeedParser, FEED_BLK_SIZE
 from nidtnbpq import BPQ
 from nidtnmetadata import Metadata
 
@@ -194,7 +195,7 @@ def get_via_http(ni_url, http_host, file_name, verbose, lax):
     # Grab and digest the HTTP response body in chunks
     msg_parser.feed(primer)
     payload_len = 0
-    blk_size = 4096
+    blk_size = FEED_BLK_SIZE
     while True:
         buf = http_object.read(blk_size)
         if len(buf) == 0:
@@ -329,6 +330,8 @@ def get_via_dtn(ni_url, dtn_eid, file_name, verbose, lax):
     # Generate EID + service tag for service to be accessed via DTN
     remote_service_eid = "dtn://" + dtn_eid + "/netinfproto/service/get"
 
+    import dtnapi
+
     # Create a connection to the DTN daemon
     dtn_handle = dtnapi.dtn_open()
     if dtn_handle == -1:
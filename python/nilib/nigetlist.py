@@ -40,7 +40,6 @@ Version   Date	   Author		 Notes
 """
 import sys
 import os.path
-import math
 import  random
 from optparse import OptionParser
 import urllib
@@ -55,7 +54,10 @@ from os.path import join
 import tempfile
 import logging
 from ni import ni_errs, ni_errs_txt, NIname, NIproc
-from nifeedparser import DigestFile, FeedParser
+from nifeedparser import DigestFile, FeedParser, FEED_BLK_SIZE
+from niloadgen import ZipfSampler
+from nibulkget import NIBulkGetter, MAX_PER_HOST_DFLT, MAX_IN_FLIGHT_DFLT, \
+					  RETRIES_DFLT
 
 
 #============================================================================#
@@ -181,7 +183,7 @@ def getone(ni_url, http_host, dest):
 	# Grab and digest the HTTP response body in chunks
 	msg_parser.feed(primer)
 	payload_len = 0
-	blk_size = 4096
+	blk_size = FEED_BLK_SIZE
 	while True:
 		buf = http_object.read(blk_size)
 		if len(buf) == 0:
@@ -269,12 +271,12 @@ def getres(tuple):
 	return
 
 #===============================================================================#
-def getlist(ndo_list, dest_dir, host, mprocs, limit):
+def getlist(ndo_list, dest_dir, host, mprocs, limit, bulk=None):
 	global complete_count, goodlist, badlist
 	count = 0
 	# start mprocs client processes, comment out the next 2 lines for single-thread
 	multi=False
-	if mprocs >1:
+	if mprocs >1 and bulk is None:
 			pool = multiprocessing.Pool(mprocs)
 			multi=True
 	try:
@@ -308,6 +310,10 @@ def getlist(ndo_list, dest_dir, host, mprocs, limit):
 			 
 			if multi:
 				pool.apply_async(getone,args=(ni_url, http_host, dest),callback=getres)
+			elif bulk is not None:
+				bulk.add(ni_url, http_host, dest)
+				# Keep the requests already queued moving
+				bulk.poll()
 			else:
 				getres(getone(ni_url, http_host, dest))
 			# count how many we do
@@ -317,27 +323,36 @@ def getlist(ndo_list, dest_dir, host, mprocs, limit):
 					if multi:
 							pool.close()
 							pool.join()
+					if bulk is not None:
+						bulk.run()
 					return (count, complete_count, goodlist, badlist)
 	except KeyboardInterrupt:
 		nilog("Keyboard interrupt")
 		if multi:
 				pool.close()
 				pool.join()
+		if bulk is not None:
+			bulk.run()
 		return (count, complete_count, goodlist, badlist)
 	except Exception, e:
 		nilog("Exception: %s" %  str(e))
 		if multi:
 				pool.close()
 				pool.join()
+		if bulk is not None:
+			bulk.run()
 		return (count, complete_count, goodlist, badlist)
 	# Close down the multiprocessing if used
 	if multi:
 			pool.close()
 			pool.join()
+	if bulk is not None:
+		bulk.run()
 	return (count,complete_count, goodlist,badlist)
 
 #===============================================================================#
-def getlistzipf(ndo_list, dest_dir, host, mprocs, limit, zipf_s, zipf_count):
+def getlistzipf(ndo_list, dest_dir, host, mprocs, limit, zipf_s, zipf_count,
+				bulk=None):
 	# zipf_s is the distribution parameter
 	# zipf_count is the number of times to do a GET
 	global complete_count, goodlist, badlist
@@ -345,7 +360,7 @@ def getlistzipf(ndo_list, dest_dir, host, mprocs, limit, zipf_s, zipf_count):
 	pop_size = 0
 	# start mprocs client processes, comment out the next 2 lines for single-thread
 	multi=False
-	if mprocs >1:
+	if mprocs >1 and bulk is None:
 			pool = multiprocessing.Pool(mprocs)
 			multi=True
 	try:
@@ -389,16 +404,10 @@ def getlistzipf(ndo_list, dest_dir, host, mprocs, limit, zipf_s, zipf_count):
 
 		# print "ndo_arr: %s" % ndo_arr
 
+		zipf = ZipfSampler(pop_size, zipf_s)
 		while count < zipf_count:
 			# randomly pick which to get according to zipf distribution
-			# 10 isn't random but will do 'till I figure it out
-			
-			# ind = zg.next() 
-
-			# get an index according to a Zipf distr.
-			ind = pop_size+1
-			while (ind >= pop_size):
-				ind=math.floor(random.expovariate(zipf_s))
+			ind = zipf.sample()
 
 			nilog("next zipper,%d" % ind )
 
@@ -412,6 +421,10 @@ def getlistzipf(ndo_list, dest_dir, host, mprocs, limit, zipf_s, zipf_count):
 			
 			if multi:
 				pool.apply_async(getone,args=(ni_url, http_host, dest),callback=getres)
+			elif bulk is not None:
+				bulk.add(ni_url, http_host, dest)
+				# Keep the requests already queued moving
+				bulk.poll()
 			else:
 				getres(getone(ni_url, http_host, dest))
 
@@ -422,6 +435,8 @@ def getlistzipf(ndo_list, dest_dir, host, mprocs, limit, zipf_s, zipf_count):
 					if multi:
 							pool.close()
 							pool.join()
+					if bulk is not None:
+						bulk.run()
 					return (count, complete_count, goodlist, badlist)
 
 	except KeyboardInterrupt:
@@ -429,17 +444,23 @@ def getlistzipf(ndo_list, dest_dir, host, mprocs, limit, zipf_s, zipf_count):
 		if multi:
 				pool.close()
 				pool.join()
+		if bulk is not None:
+			bulk.run()
 		return (count, complete_count, goodlist, badlist)
 	except Exception, e:
 		nilog("Exception: %s" %  str(e))
 		if multi:
 				pool.close()
 				pool.join()
+		if bulk is not None:
+			bulk.run()
 		return (count, complete_count, goodlist, badlist)
 	# Close down the multiprocessing if used
 	if multi:
 			pool.close()
 			pool.join()
+	if bulk is not None:
+		bulk.run()
 	return (count,complete_count, goodlist,badlist)
 
 #===============================================================================#
@@ -465,6 +486,7 @@ def py_nigetlist():
 	verbose = False
 	usage = "%prog [-l <list file name or - (for stdin)>] [-v] [-m <# processes>]\n" + \
 			"   [-n <host>] [-c <# max NDOs to get>] [-d <destination dir for files gotten>] [-z <number>]\n" + \
+			"   [-b [-p <# connections per host>] [-f <# requests in flight>] [-r <# retries>]]\n" + \
 			"The input file should contain lines with any of:\n" + \
 			" 1. Complete ni: URI with authority (netloc) component,\n" + \
 			" 2. ni: URI with empty authority (netloc) component, or\n" + \
@@ -493,6 +515,18 @@ def py_nigetlist():
 	parser.add_option("-z", "--zipf", dest="zipf_count", default=-1,
 					  type="int",
 					  help="The number of files to get treating the input list as a 0.5 exponent Zipf rank order") 
+	parser.add_option("-b", "--bulk", dest="bulk", default=False,
+					  action="store_true",
+					  help="Make the requests concurrently from this process over keep-alive connections instead of using a pool of processes (-m is ignored)")
+	parser.add_option("-p", "--per-host", dest="per_host", default=MAX_PER_HOST_DFLT,
+					  type="int",
+					  help="With -b, the maximum number of connections to each host (default %d)" % MAX_PER_HOST_DFLT)
+	parser.add_option("-f", "--in-flight", dest="in_flight", default=MAX_IN_FLIGHT_DFLT,
+					  type="int",
+					  help="With -b, the maximum number of requests in progress (default %d)" % MAX_IN_FLIGHT_DFLT)
+	parser.add_option("-r", "--retries", dest="retries", default=RETRIES_DFLT,
+					  type="int",
+					  help="With -b, the number of times a failed request is retried (default %d)" % RETRIES_DFLT)
 
 	(options, args) = parser.parse_args()
 
@@ -518,6 +552,13 @@ def py_nigetlist():
 	# Where temprary files will be created
 	tempfile.tempdir = "/tmp"
 
+	if options.bulk:
+		bulk = NIBulkGetter(getres, max_per_host=options.per_host,
+							max_in_flight=options.in_flight,
+							retries=options.retries, log=nilog)
+	else:
+		bulk = None
+
 
 	if options.zipf_count>0:
 		nilog("Starting ZIPF nigetlist,list,%s,to,%s,dest_dir,%s,processes,%d,count,%d" 
@@ -531,7 +572,8 @@ def py_nigetlist():
 		# the 0.5 is the right value for wiki traffic accordng to:
 		# https://en.wikipedia.org/wiki/Wikipedia:Does_Wikipedia_traffic_obey_Zipf%27s_law%3F
 		cnt, cc, goodlist, badlist = getlistzipf(list_chan, options.dest_dir, options.host,
-										 options.mprocs,options.count,0.5,options.zipf_count)
+										 options.mprocs,options.count,0.5,options.zipf_count,
+										 bulk=bulk)
 		debug("good: %s" % str(goodlist))
 		debug("bad: %s"% str(badlist))
 		debug("completed: %d" % cc)
@@ -547,7 +589,8 @@ def py_nigetlist():
 			nilog("Waiting for input from stdin")
 		# loop over all files below directory and putone() for each we find
 		cnt, cc, goodlist, badlist = getlist(list_chan, options.dest_dir, options.host,
-										 options.mprocs,options.count)
+										 options.mprocs,options.count,
+										 bulk=bulk)
 		debug("good: %s" % str(goodlist))
 		debug("bad: %s"% str(badlist))
 		debug("completed: %d" % cc)
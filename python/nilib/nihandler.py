@@ -53,11 +53,13 @@ The handler deals with a limited set of URLs
                  - /ni_cache/<digest algorithm id>;<digest>,
                  - /ni_meta/<digest algorithm id>;<digest>,
                  - /ni_qrcode/<digest algorithm id>;<digest>,
+                 - /ni_qrpng/<digest algorithm id>;<digest>,
                  - /getputform.html,
                  - /nrsconfig.html, (when running NRS server)
                  - /favicon.ico, and<
                  - /netinfproto/list
                  - /netinfproto/checkcache
+                 - /netinfproto/metrics
 - POST on paths (basic system):
                  - /netinfproto/get,
                  - /netinfproto/publish,
@@ -95,6 +97,14 @@ levels (each takes a string to be logged):
 - logwarn
 - loginfo
 
+and a timer for the phases of the request ('timer' - a nitiming.RequestTimer
+or nitiming.NULL_TIMER when phase timing is disabled).  The shim logs and
+aggregates the phase times when the request is finished.
+
+The counters, gauges and histograms in nimetrics.py are updated as requests
+are handled and reported by the 'metrics' instance variable (a
+nimetrics.MetricsExporter) for GET /netinfproto/metrics.
+
 TO DO: Add configuration to connect to non-default Redis server.
 
 The handler is designed so that it can be used from
@@ -221,28 +231,34 @@ import re
 import time
 import datetime
 import textwrap
+import Queue
 try:
     from cStringIO import StringIO
 except ImportError:
     from StringIO import StringIO
 
-import cgi
 import urllib
-import urllib2
 import hashlib
-import xml.etree.ElementTree as ET
-import base64
 
-#=== Modules needing special downloading
-import magic
-import DNS
-import qrcode
+# Modules only needed for particular requests are imported where they are
+# used so that they are not loaded until a request needs them:
+# - cgi: do_POST
+# - urllib2, xml.etree.ElementTree: external_search, fetch_search_result
+# - multiprocessing.pool: fetch_search_results
 
 #=== Local package modules ===
 
 from netinf_ver import NETINF_VER, NISERVER_VER
 from ni import NIname, NIdigester, NIproc, NI_SCHEME, NIH_SCHEME, ni_errs, ni_errs_txt
+from nitiming import PHASE_FORM, PHASE_VALIDATE, PHASE_CACHE_GET, \
+                     PHASE_AGGREGATE, PHASE_FORWARD, PHASE_CACHE_PUT
+import nimetrics
+from cache_listing import StaticCacheListing
+from nilisting import ListingQuery, FORMATS, gen_listing
+from qrcode_cache import etags_match
+from ctype_detect import ctype_detector
 import nifwd 
+import niforward
 
 # See if this run is either testing niserver.py or running standalone server
 # If either is true then use the HTTPRequestShim in httpshim.py
@@ -333,6 +349,16 @@ class NIHTTPRequestHandler(HTTPRequestShim):
     # for accessing QRcode image encoding an ni[h] URI 
     QRCODE_PRF      = "/ni_qrcode/"
     
+    ##@var QRPNG_PRF
+    # Start of path for http://<netloc>/ni_qrpng/<alg name>;<digest>
+    # for accessing the PNG image of the QRcode directly
+    QRPNG_PRF       = "/ni_qrpng/"
+
+    ##@var QRCODE_MAX_AGE
+    # Lifetime (seconds) allowed for QRcode pages and images in browser
+    # caches - they depend only on the ni URI so never change
+    QRCODE_MAX_AGE  = 86400
+    
     ##@var NI_HTTP
     # Path prefix for /.well-known/ni/ 
     NI_HTTP         = WKN + "ni/"
@@ -368,6 +394,10 @@ class NIHTTPRequestHandler(HTTPRequestShim):
     # URL path to invoke check/creation of cache directory tree via GET
     NETINF_CHECK   = "/netinfproto/checkcache"
 
+    ##@var NETINF_METRICS
+    # URL path to retrieve server metrics in Prometheus text format via GET
+    NETINF_METRICS = "/netinfproto/metrics"
+
     # === NetInf GET/PUBLISH/SEARCH form names used from the getputform ===
     ##@var NI_ACCESS_FORM
     # Path value for accessing GET/PUBLISH/SEARCH form
@@ -394,10 +424,14 @@ class NIHTTPRequestHandler(HTTPRequestShim):
     # Server name for Wikipedia searches
     WIKI_LOC        = "en.wikipedia.org"
     
+    ##@var SRCH_LIMIT
+    # Maximum number of results requested from the external search engine
+    SRCH_LIMIT      = 10
+
     ##@var WIKI_SRCH_API
     # Template for OpenSearch interface to Wikipedia
     WIKI_SRCH_API   = ("http://%s/w/api.php?action=opensearch&search=%s&" + \
-                       "limit=10&namespace=0&format=xml")
+                       "limit=%d&namespace=0&format=xml")
     
     ##@var SRCH_NAMESPACE
     # XML namespace used by OpenSearch suggestions returned from Wikipedia
@@ -418,6 +452,33 @@ class NIHTTPRequestHandler(HTTPRequestShim):
     # Wikipedia.
     SRCH_CACHE_DGST = "sha-256"
 
+    ##@var SRCH_FETCH_THREADS
+    # Maximum number of search results retrieved concurrently
+    SRCH_FETCH_THREADS = 5
+
+    ##@var SRCH_FETCH_TIMEOUT
+    # Timeout (seconds) for socket operations retrieving a search result
+    SRCH_FETCH_TIMEOUT = 10
+
+    ##@var SRCH_FETCH_WANTED
+    # Return search results as soon as this many have been cached - less
+    # than SRCH_LIMIT so that a few slow or failing items don't hold up
+    # the response
+    SRCH_FETCH_WANTED = SRCH_LIMIT // 2
+
+    ##@var SRCH_RESULTS_TIMEOUT
+    # Maximum time (seconds) to wait for search results to be retrieved
+    SRCH_RESULTS_TIMEOUT = 15
+
+    ##@var LOCAL_SRCH_ENGINE
+    # String recorded in 'engine' field of search results found in the
+    # local search index.
+    LOCAL_SRCH_ENGINE = "local"
+
+    ##@var LOCAL_SRCH_LIMIT
+    # Maximum number of results returned from the local search index
+    LOCAL_SRCH_LIMIT = 10
+
     # === NRS server related info ===
     ##@var NRS_CONF_FORM
     # Path value for accessing NRS configuration form
@@ -439,6 +500,11 @@ class NIHTTPRequestHandler(HTTPRequestShim):
     # Path to which to send form for NetInf GET operation
     NRS_VALS        = "/netinfproto/nrsvals"
 
+    ##@var NRS_SCAN_COUNT
+    # Number of keys requested in each SCAN of the NRS database by nrs_vals
+    # (and default page size when a cursor is supplied without a limit)
+    NRS_SCAN_COUNT  = 1000
+
     ##@var CHECK_CACHE_REPORT
     # string template used after successful cache check
     CHECK_CACHE_REPORT = """\
@@ -483,8 +549,29 @@ class NIHTTPRequestHandler(HTTPRequestShim):
     ##@var nrs_redis
     # object instance of Redis database interface (or None if provide_nrs False)
 
+    ##@var nrs_cache
+    # object NRSLookupCache instance holding recently read NRS entries (or None)
+
+    ##@var search_index
+    # object NDOSearchIndex instance for local searches (or None)
+
+    ##@var search_fallback
+    # boolean True if searches not satisfied locally go to the external engine
+
+    ##@var search_cache
+    # object SearchResultCache instance remembering recent searches (or None)
+
+    ##@var qrcode_cache
+    # object QRCodeCache instance holding rendered QRcode images
+
     ##@var cache
     # object instance of NetInfCache interface to cache storage
+
+    ##@var timer
+    # object RequestTimer (or NULL_TIMER) recording time spent in each phase
+
+    ##@var metrics
+    # object MetricsExporter generating the metrics report
     
     # === Logging convenience functions ===
     ##@var loginfo
@@ -551,12 +638,13 @@ class NIHTTPRequestHandler(HTTPRequestShim):
         Reject any requests other than for cache listing that have a
         query string.
 
-        There are five special cases:
+        There are six special cases:
         - 1. Getting a listing of the cache
         - 2. Returning the form code for GET/PUT/SEARCH form
         - 3. If running NRS server, return the form code for NRS configuration 
         - 4. Returning the NETINF favicon
           5. Running the cache check/create function (check_cache_dirs)
+          6. Returning the server metrics
 
         Otherwise, we expect one of
         - 5. a path that starts with the CONT_PRF prefix
@@ -567,8 +655,9 @@ class NIHTTPRequestHandler(HTTPRequestShim):
              which is a direct access for the metadata of one of the
              cached files, or
         - 7. a path that starts with the QRCODE_PRF prefix
-             which is a direct access for an image of QRcode for the ni[h]
-             URI of one of the cached files, or
+             which is a direct access for a page showing the QRcode for the
+             ni[h] URI of one of the cached files, or with the QRPNG_PRF
+             prefix for the PNG image of the QRcode itself, or
         - 8. a path that starts /.well-known/ni[h]/ that sends a redirect
              for the equivalent ni_cache URL (see 5 above). The redirect
              is required by standards that recommend that URLS containing
@@ -606,7 +695,7 @@ class NIHTTPRequestHandler(HTTPRequestShim):
             
         # Display a cache listing
         if self.path.lower().startswith(self.NETINF_LIST):
-            return self.showcache(self.path.lower())
+            return self.showcache(self.path)
 
         # None of the other GET URLs recognized by niserver wants a query string.
         if has_query_string:
@@ -662,6 +751,10 @@ class NIHTTPRequestHandler(HTTPRequestShim):
                 self.end_headers()
                 self.send_string(content)
             return None          
+
+        # Report the server metrics
+        if (self.path.lower() == self.NETINF_METRICS):
+            return self.send_metrics()
                         
         #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -#
         # Deal with operations that retrieve cached NDO content, metadata files
@@ -696,7 +789,9 @@ class NIHTTPRequestHandler(HTTPRequestShim):
         prefix_op = alg_digest_get_dict[url_path_prefix]
 
         # Turn the path into an NIname instance and validate it
-        rv, ni_name = self.path_to_ni_name(self.path[prefix_end:], prefix_op.sep)
+        with self.timer.span(PHASE_VALIDATE):
+            rv, ni_name = self.path_to_ni_name(self.path[prefix_end:],
+                                               prefix_op.sep)
         if rv != ni_errs.niSUCCESS:
             self.loginfo("Path format for %s inappropriate: %s" % (self.path,
                                                                    ni_errs_txt[rv]))
@@ -705,8 +800,11 @@ class NIHTTPRequestHandler(HTTPRequestShim):
 
         # Access the cache for the ni_name
         try:
-            metadata, content_file = self.cache.cache_get(ni_name)
+            with self.timer.span(PHASE_CACHE_GET):
+                metadata, content_file = self.cache.cache_get(ni_name)
+            nimetrics.CACHE_LOOKUPS.inc(labels=("hit",))
         except NoCacheEntry:
+            nimetrics.CACHE_LOOKUPS.inc(labels=("miss",))
             self.loginfo("Named Data Object not in cache: %s" % self.path)
             self.send_error(404, "Named Data Object not in cache")
             return None
@@ -728,37 +826,44 @@ class NIHTTPRequestHandler(HTTPRequestShim):
     def showcache(self, path):
         """
         @brief Code to generate a cache listing for some or all of the NDO cache.
-        @param path string path from original HTTP request (forced to lower case)
-        @return Pseudo-file object containing the HTML to display listing
+        @param path string path from original HTTP request
+        @return Pseudo-file object generating the listing
 
         This function is invoked for GET requests when the path is
-        /netinfproto/list optionally qualified by a query string of the
-        form ?alg=<hash algorithm name>.
-
-        If there is no query string directory listings for all available
-        hash algorithms are displayed.  Otherwise a listing for just one
-        algorithm is displayed.  The set of available algorithms is defined by
-        NIname.get_all_algs() which returns a list of the textual names of
-        the possible algorithms.
-
-        This method passes the list of algorithms for which listings are
-        required to the cache_list method in the cache.  The format of
-        the response is an array of dictionaries for each algorithm
-        This code dynamically builds some HTTP to display the selected
-        directory listing(s).  The entries for each algorithm are displayed with
-        the digest strings sorted insensitively.
-
-        If the content file is present the displayed ni URI is a link
-        to the .well-known HTTP URL that would retrieve the content.
-        If there is metadata for the ni[h] URI, the word 'meta' is displayed
-        after the URI giving a link to just the metadata.
+        /netinfproto/list optionally qualified by a query string.  The
+        query parameters are described in nilisting.py: they select the
+        algorithm to list (?alg=<hash algorithm name>), the output format
+        (rform=html, plain or json), the page size and starting cursor
+        (limit= and cursor=) and filters on whether the content is present
+        and on the time the entry was added or changed (content=, since=
+        and until=).  Parameter names and values other than the cursor are
+        not case sensitive.
+
+        If there is no alg parameter, listings for all available
+        hash algorithms are generated.  The set of available algorithms is
+        defined by NIname.get_all_algs() which returns a list of the textual
+        names of the possible algorithms.
+
+        The entries are taken from the ordered index of the shared cache
+        listing (see cache_listing.py) if the cache has one; otherwise the
+        cache_list method of the cache is used to make a temporary one.
+        The entries for each algorithm are listed with the digest strings
+        sorted insensitively.  The listing is generated progressively as
+        the response is written (see gen_listing in nilisting.py) so no
+        Content-Length header is sent.  If a limit is given and the page
+        is filled the listing ends with the cursor for the next page (a link
+        to it in HTML).
+
+        In the HTML listing, if the content file is present the displayed
+        ni URI is a link to the .well-known HTTP URL that would retrieve the
+        content.  The word 'meta' is displayed after the URI giving a link
+        to just the metadata.
         In addition, the word 'QRcode' is displayed with a link that will
         display a QRcode image for the ni name for the item. 
         """
         # Determine which directories to list - assume all by default
         algs_list = NIname.get_all_algs()
         query_dict = {}
-        rform = "html"
         ql = len(self.NETINF_LIST)
         if (len(path) > ql):
             # Note: the caller has already checked there is no fragment part
@@ -781,27 +886,29 @@ class NIHTTPRequestHandler(HTTPRequestShim):
                     return
                 qp = i.split("=")
                 if len(qp) == 1:
-                    query_dict[qp[0]] = ""
+                    query_dict[qp[0].lower()] = ""
                 elif len(qp) > 2:
                     self.loginfo("Bad query item in query string: %s" % path)
                     self.send_error(400, "Bad query item in query string: %s" %
                                     path)
                     return
                 else:
-                    query_dict[qp[0]] = qp[1] 
+                    query_dict[qp[0].lower()] = urllib.unquote_plus(qp[1])
                     
             if (self.ALG_QUERY in query_dict):
-                if (query_dict[self.ALG_QUERY] not in algs_list):
+                alg = query_dict[self.ALG_QUERY].lower()
+                if (alg not in algs_list):
                     self.send_error(404, "Cache for unknown algorithm requested")
                     return
                 else:
-                    algs_list = [ query_dict[self.ALG_QUERY]]
+                    algs_list = [ alg ]
 
-            rform = query_dict.get("rform", "html")
-            if not ((rform == "html") or (rform == "plain")): 
-                self.loginfo("Unrecognized response format for showcache: %s" % path)
-                self.send_error(400, "Unrecognized response format: %s" % path)
-                return
+        try:
+            query = ListingQuery(algs_list, query_dict)
+        except ValueError, e:
+            self.loginfo("Bad cache listing request %s: %s" % (path, str(e)))
+            self.send_error(400, "Bad cache listing request: %s" % str(e))
+            return None
 
         # Server access netloc
         if (self.server_port == 80):
@@ -810,99 +917,49 @@ class NIHTTPRequestHandler(HTTPRequestShim):
         else:
             netloc = "%s:%d" % (self.server_name, self.server_port)
 
-        # Get the cache listing as a dictionary
-        cache_list = self.cache.cache_list(algs_list)
-        if cache_list is None:
-            self.send_error(500, "Unable to list Named Data Object cache.")
-            return None
+        # Get the ordered listing
+        listing = self.cache.listing
+        if listing is None:
+            cache_list = self.cache.cache_list(algs_list)
+            if cache_list is None:
+                self.send_error(500, "Unable to list Named Data Object cache.")
+                return None
+            listing = StaticCacheListing(cache_list)
         
-        self.loginfo("showcache,algs,%s,rform,%s" % (";".join(algs_list), rform))
-
-        # Do simple plain output if requested
-        if rform == "plain":
-            # Set up a StringIO buffer to gather the text
-            f = StringIO()
-            os = "Named Data Object Cache Listing for server %s\n" % netloc
-            f.write(os)
-            f.write("=" * (len(os) - 1))
-            f.write("\n\n")
-
-            for alg in algs_list:
-                all_ordered = sorted(cache_list[alg],
-                                     key = lambda k: k["dgst"].lower())
-            
-                os = "Cache Listing for Algorithm %s\n" % alg
-                f.write(os)
-                f.write("-" * (len(os) - 1))
-                f.write("\n\n")
+        self.loginfo("showcache,algs,%s,rform,%s,limit,%s,cursor,%s" %
+                     (";".join(algs_list), query.rform, query.limit,
+                      query_dict.get("cursor")))
 
-                for name in sorted(cache_list[alg],
-                                   key = lambda k: k["dgst"].lower()):
-                    dgst = name["dgst"]
-                    # Indicate what is available
-                    if name["ce"]:
-                        f.write('Metadata and content: %s;%s\n' % (alg, dgst))
-                    else:
-                        f.write('Metadata only:        %s;%s\n' % (alg, dgst))
-                                        
-                f.write("\n")
-                
-            length = f.tell()
-            f.seek(0)
-            self.send_response(200)
-            self.send_header("Content-type", "text/plain")
-            self.send_header("Content-Disposition", "inline")
-            self.send_header("Content-Length", str(length))
-            self.send_header("Expires", self.date_time_string(time.time()+(24*60*60)))
-            self.send_header("Last-Modified", self.date_time_string())
-            self.end_headers()
-            return f
+        next_url = lambda c: "http://%s%s?%s" % (netloc, self.NETINF_LIST,
+                                                 query.query_string(c))
+        fmt = FORMATS[query.rform](self.server_name, netloc,
+                                   (self.NI_HTTP, self.META_PRF,
+                                    self.QRCODE_PRF), next_url)
 
-        # Otherwise do HTML output
-                                          
-        # Set up a StringIO buffer to gather the HTML
-        f = StringIO()
-        f.write('<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">')
-        f.write("<html>\n<title>Named Data Object Cache Listing for server %s</title>\n" % self.server_name)
-        f.write("<body>\n<h1>Named Data Object Cache Listing for server %s</h1>\n" % self.server_name)
-        f.write("<hr>\n<ul>")
-
-        for alg in algs_list:
-            all_ordered = sorted(cache_list[alg],
-                                 key = lambda k: k["dgst"].lower())
-            
-            f.write("</ul>\n<h2>Cache Listing for Algorithm %s</h2>\n<ul>\n" % alg)
-            ni_http_prefix   = "http://%s%s%s/" % (netloc, self.NI_HTTP, alg)
-            meta_http_prefix = "http://%s%s%s;" % (netloc, self.META_PRF, alg)
-            qrcode_http_prefix = "http://%s%s%s;" % (netloc, self.QRCODE_PRF, alg)
-            ni_prefix        = "ni:///%s;" % alg
-            nih_prefix       = "nih:/%s;" % alg
-            for name in sorted(cache_list[alg], key = lambda k: k["dgst"].lower()):
-                dgst = name["dgst"]
-                # Link or ni URL for content file
-                if name["ce"]:
-                    f.write('<li><a href="%s%s">%s%s</a> ' %
-                            (ni_http_prefix, dgst, ni_prefix, dgst))
-                else:
-                    # No link if content file is not present 
-                    f.write('<li>%s%s ' % (ni_prefix, dgst))
-                
-                f.write('(<a href="%s%s">meta</a>)' % (meta_http_prefix, dgst))
-                f.write('(<a href="%s%s">QRcode</a>)</li>\n' %
-                        (qrcode_http_prefix, dgst))
-                
-            f.write("\n")
-        f.write("</ul>\n<hr>\n</body>\n</html>\n")
-        length = f.tell()
-        f.seek(0)
         self.send_response(200)
-        self.send_header("Content-type", "text/html")
+        self.send_header("Content-type", fmt.content_type)
         self.send_header("Content-Disposition", "inline")
-        self.send_header("Content-Length", str(length))
         self.send_header("Expires", self.date_time_string(time.time()+(24*60*60)))
         self.send_header("Last-Modified", self.date_time_string())
         self.end_headers()
-        return f              
+        return GeneratorFile(gen_listing(listing, query, fmt))
+
+    #--------------------------------------------------------------------------#
+    def send_metrics(self):
+        """
+        @brief Send the server metrics in Prometheus text format
+        @return Pseudo-file object containing the report
+
+        The report covers all the processes sharing the metrics shared memory
+        segment if the shim has set one up (see nimetrics.py).
+        """
+        content = self.metrics.render()
+        self.send_response(200)
+        self.send_header("Content-Type", nimetrics.CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        return StringIO(content)
 
     #--------------------------------------------------------------------------#
     def send_fixed_file(self, pathname, content_type, err_string):
@@ -1148,8 +1205,8 @@ class NIHTTPRequestHandler(HTTPRequestShim):
         @param metadata NetInfMetadata instance holds metadata for ni_name
         @param content_file string pathname to content file if present or None
         @param msgid None (not used in this method)
-        @return file object pointing to StringIO containing image page with
-                            embedded QRcode image data or None
+        @return file object pointing to StringIO containing image page
+                            referencing the QRcode image or None
         
         On entry the incoming path has been parsed into the ni_qrcode prefix
         (which results in this method being called) and the alg-name and digest
@@ -1162,6 +1219,12 @@ class NIHTTPRequestHandler(HTTPRequestShim):
         but the interface is common for various GET patterns that result in
         various send_xx_header methods called via the alg_digest_get_dict.
 
+        The page refers to the image through the ni_qrpng URL (see
+        send_qrpng_header) rather than embedding it, so the browser can
+        cache the image separately.  The page depends only on the
+        canonical ni URI, so it carries an entity tag and a conditional
+        request with a matching If-None-Match header gets a 304 response.
+
         The parameters are all nominally validated and the cache entry
         checked for existence and correctness.  All that is necessary is to
         generate the HTTP response.
@@ -1176,31 +1239,102 @@ class NIHTTPRequestHandler(HTTPRequestShim):
             self.send_error(500, "Problem in send_qrcode_header")
             return None
 
-        # Make a Base64urlencoded string of a png image of QR code
-        f = StringIO()
-        qrcode.make(ni_string).save(f)
-        f.seek(0)
-        qrstr = base64.b64encode(f.getvalue())
-        f.seek(0)
+        # The page is distinguished from the image by the tag suffix
+        etag = self.qrcode_cache.etag(ni_string)[:-1] + '-html"'
+        if self.send_not_modified(etag):
+            return None
 
         # Construct HTML document
+        f = StringIO()
         f.write('<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">\n')
         f.write("<html>\n<body>\n<title>NetInf QRcode Image</title>\n")
         f.write("<h1>NetInf QRcode Image for ni Scheme URI </h1>\n")
         f.write("<h2>URI: %s</h2>" % ni_string)
         f.write("\n<br/>\n<center>")
 
-        f.write('<img src="data:image/png;base64,%s" alt="QRcode" />' % qrstr)
-        f.write('</center>\n<</body></html>')
+        f.write('<img src="%s%s" alt="QRcode" />' %
+                (self.QRPNG_PRF, ni_string[ni_string.rfind("/")+1:]))
+        f.write('</center>\n</body></html>')
         file_len = f.tell()
         f.seek(0, os.SEEK_SET)
         self.send_response(200)
         self.send_header("Content-Type", "text/html")
         self.send_header("Content-Length", str(file_len))
         self.send_header("Content-Disposition", "inline")
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "public, max-age=%d" %
+                         self.QRCODE_MAX_AGE)
         self.end_headers()
         return f
 
+    #--------------------------------------------------------------------------#
+    def send_qrpng_header(self, ni_name, metadata, content_file, msgid):
+        """
+        @brief Send HTTP headers and set up for sending the PNG image of the
+        QRcode for GET request access to an HTTP URL starting ni_qrpng.
+        @param ni_name NIname instance  representing alg-name/digest received
+                                        with HTTP GET request
+        @param metadata NetInfMetadata instance holds metadata for ni_name
+        @param content_file string pathname to content file if present or None
+        @param msgid None (not used in this method)
+        @return file object pointing to StringIO containing PNG image or None
+
+        As for send_qrcode_header except that the response is the image
+        itself (image/png).  Rendered images are taken from the shared
+        QRCodeCache (see qrcode_cache.py) so the QRcode is only generated
+        the first time it is requested.
+        """
+
+        # Retrieve canonical form of ni: URI from ni_name
+        try:
+            ni_string = ni_name.get_canonical_ni_url()
+        except Exception, e:
+            self.logerror("Bad ni_name supplied to send_qrpng_header for %s: %s" %
+                          ( self.path, str(e)))
+            self.send_error(500, "Problem in send_qrpng_header")
+            return None
+
+        if self.send_not_modified(self.qrcode_cache.etag(ni_string)):
+            return None
+
+        try:
+            png, etag = self.qrcode_cache.get_png(ni_string)
+        except Exception, e:
+            self.logerror("Unable to make QRcode image for %s: %s" %
+                          (ni_string, str(e)))
+            self.send_error(500, "Unable to make QRcode image")
+            return None
+
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(png)))
+        self.send_header("Content-Disposition", "inline")
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "public, max-age=%d" %
+                         self.QRCODE_MAX_AGE)
+        self.end_headers()
+        return StringIO(png)
+
+    #--------------------------------------------------------------------------#
+    def send_not_modified(self, etag):
+        """
+        @brief Send a 304 response if a conditional GET matches the entity tag
+        @param etag string quoted entity tag of the representation
+        @return boolean True if the 304 response has been sent
+
+        Only If-None-Match is checked: the representations this is used for
+        are fixed for a given URL so the tag alone decides.
+        """
+        if not etags_match(self.headers.get("If-None-Match"), etag):
+            return False
+        self.loginfo("Not modified: %s" % self.path)
+        self.send_response(304, "Not Modified")
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "public, max-age=%d" %
+                         self.QRCODE_MAX_AGE)
+        self.end_headers()
+        return True
+
     #--------------------------------------------------------------------------#
     def send_get_redirect(self, ni_name, metadata, content_file, msgid):
         """
@@ -1348,13 +1482,15 @@ class NIHTTPRequestHandler(HTTPRequestShim):
             return
         
         # Parse the form data posted
+        import cgi
         self.logdebug("Headers: %s" % str(self.headers))
-        form = cgi.FieldStorage(
-            fp=self.rfile, 
-            headers=self.headers,
-            environ={'REQUEST_METHOD':'POST',
-                     'CONTENT_TYPE':self.headers['Content-Type'],
-                     })
+        with self.timer.span(PHASE_FORM):
+            form = cgi.FieldStorage(
+                fp=self.rfile, 
+                headers=self.headers,
+                environ={'REQUEST_METHOD':'POST',
+                         'CONTENT_TYPE':self.headers['Content-Type'],
+                         })
         self.logdebug("POST Form parsed")
         
         # Call subsidiary routines to do the work
@@ -1397,86 +1533,206 @@ class NIHTTPRequestHandler(HTTPRequestShim):
     # to fetch the object. If forwarding is not turned on, or if forwarding
     # didn't find it, report it as not found.
     def try_forwarding(self, ni_name):
+        # Don't repeat the next-hop scan for names that recently failed
+        if ((hasattr(self, "fwd") or hasattr(self, "router")) and
+            hasattr(self, "fwd_neg_cache")):
+            reason = self.fwd_neg_cache.lookup(ni_name)
+            if reason is not None:
+                self.loginfo("neg_cache_hit,uri,%s,reason,%d" %
+                             (ni_name.get_url(), reason))
+                if reason == niforward.NEGTIMEOUT:
+                    return self.forwarding_failed(404, "Named Data Object forwarding timeout")
+                else:
+                    return self.forwarding_failed(404, "Named data Object forwarding could not find object")
+
         # SF check forwarding things for GETs here
         if hasattr(self, "fwd"):
             self.loginfo("Named Data Object not in cache: checking forwarding for %s" % ni_name)
             try_fwd,nexthops=self.fwd.check_fwd(nifwd.GET_FWD,ni_name,self.ext)
             if try_fwd is False:
                 self.loginfo("Named Data Object not in cache: %s" % self.path)
-                self.send_error(404, "Named Data Object not in cache")
-                return None
+                return self.forwarding_failed(404, "Named Data Object not in cache")
             else:
-                fwdres, metadata, content_file = self.fwd.do_get_fwd(
-                        nexthops,self.uri,self.ext,self.msgid)
+                with self.timer.span(PHASE_FORWARD):
+                    fwdres, metadata, content_file = self.fwd.do_get_fwd(
+                            nexthops,self.uri,self.ext,self.msgid)
                 if fwdres == nifwd.FWDSUCCESS:
                     self.loginfo("NetInf Fowarding success!: %d" % fwdres)
+                    # cache_put returns the merged metadata and the
+                    # name of the content file now in the cache, which is
+                    # all that is needed to send the response.
                     try:
                         self.loginfo("doing put cache")
-                        try:
-                            md_out, cfn, new_entry, ignore_upload = \
-                                            self.cache.cache_put(ni_name, metadata, content_file)
-                        except Exception, e:
-                            self.logdebug("put failed %s" % str(e))
+                        with self.timer.span(PHASE_CACHE_PUT):
+                            metadata, content_file, new_entry, ignore_upload = \
+                                        self.cache.cache_put(ni_name, metadata, content_file)
                         self.loginfo("fwd put cache succeeded")
-                        # This is slooow I bet, but let's see if it works for now
-                        # and fix up content_file later more quickly
-                        metadata, content_file = self.cache.cache_get(ni_name)
-                        self.loginfo("NetInf put_cache after fwd success1")
                     except Exception, e:
-                        print e
-                        self.loginfo("NetInf crap put_cache after fwd fail1 %s" % str(e))
-                        self.send_error(500, str(e))
-                        return None
+                        self.logerror("NetInf put_cache after forward failed %s" %
+                                      str(e))
+                        self.discard_fwd_content(content_file)
+                        return self.forwarding_failed(500, str(e))
                 elif fwdres == nifwd.FWDTIMEOUT:
                     self.loginfo("NetInf Fowarding timeout: %d" % fwdres)
-                    self.send_error(404, "Named Data Object forwarding timeout")
-                    return None
+                    self.record_fwd_miss(ni_name, niforward.NEGTIMEOUT)
+                    return self.forwarding_failed(404, "Named Data Object forwarding timeout")
                 elif fwdres == nifwd.FWDNOTFOUND:
                     self.loginfo("NetInf Forwarding did not find object at any location tried")
-                    self.send_error(404, "Named data Object forwarding could not find object")
-                    return None
+                    self.record_fwd_miss(ni_name, niforward.NEGNOTFOUND)
+                    return self.forwarding_failed(404, "Named data Object forwarding could not find object")
                 else:
                     self.loginfo("NetInf Fowarding failure: %d" % fwdres)
-                    self.send_error(404, "Named Data Object forwarding failed")
-                    return None
+                    return self.forwarding_failed(404, "Named Data Object forwarding failed")
 
         # Bengts new forwarding stuff
         elif hasattr(self, "router"): # This is set in niserver.py
             self.loginfo("Trying niforward.")
             # call forwarding, returns object in temp file content_file
-            status, metadata, content_file = self.router.do_forward_nexthop(
-                self.msgid, self.uri, self.ext)
+            with self.timer.span(PHASE_FORWARD):
+                status, metadata, content_file = self.router.do_forward_nexthop(
+                    self.msgid, self.uri, self.ext)
 
             if not status:
                 self.loginfo("NetInfRouterCore Forwarding failure 1")
-                self.send_error(404, "Named Data Object forwarding failed")
-                return None
+                self.record_fwd_miss(ni_name, niforward.NEGNOTFOUND)
+                return self.forwarding_failed(404, "Named Data Object forwarding failed")
 
-            # store it in cache - do we really have to do a cache lookup too???
+            # store it in cache - cache_put returns the merged metadata and
+            # the name of the content file in the cache, so no need for a
+            # further cache lookup
             try:
                 self.loginfo("doing put cache")
-                md_out, cfn, new_entry, ignore_upload = self.cache.cache_put(ni_name,
-                                                                             metadata,
-                                                                             content_file)
+                with self.timer.span(PHASE_CACHE_PUT):
+                    metadata, content_file, new_entry, ignore_upload = \
+                                self.cache.cache_put(ni_name, metadata,
+                                                     content_file)
                 self.loginfo("fwd put cache succeeded")
 
-                # This is slooow I bet, but let's see if it works for now
-                # and fix up content_file later more quickly
-                metadata, content_file = self.cache.cache_get(ni_name)
-
             except Exception, e:
-                self.loginfo("NetInf put/get_cache after forward failed %s" %
-                             str(e))
-                self.send_error(500, str(e))
-                return None
+                self.logerror("NetInf put_cache after forward failed %s" %
+                              str(e))
+                self.discard_fwd_content(content_file)
+                return self.forwarding_failed(500, str(e))
 
         else:
             self.loginfo("Named Data Object not in cache: %s" % self.path)
-            self.send_error(404, "Named Data Object not in cache")
-            return None
+            return self.forwarding_failed(404, "Named Data Object not in cache")
 
         return (metadata, content_file)
 
+    #--------------------------------------------------------------------------#
+    def discard_fwd_content(self, content_file):
+        """
+        @brief Remove the temporary file of forwarded content that was not cached
+        @param content_file string pathname of temporary file or None
+        @return (none)
+
+        cache_put may already have removed the file (or renamed it into
+        the cache and then removed it) before failing.
+        """
+        if (content_file is not None) and os.path.isfile(content_file):
+            try:
+                os.remove(content_file)
+            except OSError, e:
+                self.logerror("Unable to remove temporary file %s: %s" %
+                              (content_file, str(e)))
+        return
+
+    #--------------------------------------------------------------------------#
+    def record_fwd_miss(self, ni_name, reason):
+        """
+        @brief Remember that forwarding failed to retrieve ni_name
+        @param ni_name NIname validated name of NDO requested
+        @param reason integer niforward.NEGNOTFOUND or niforward.NEGTIMEOUT
+        @return (none)
+        """
+        if hasattr(self, "fwd_neg_cache"):
+            self.fwd_neg_cache.add(ni_name, reason)
+        return
+
+    #--------------------------------------------------------------------------#
+    def clear_fwd_miss(self, ni_name):
+        """
+        @brief Forget any forwarding failure recorded for ni_name
+        @param ni_name NIname validated name of NDO now in the cache
+        @return (none)
+        """
+        if hasattr(self, "fwd_neg_cache"):
+            if self.fwd_neg_cache.clear(ni_name):
+                self.loginfo("neg_cache_clear,uri,%s" % ni_name.get_url())
+        return
+
+    #--------------------------------------------------------------------------#
+    def coalesced_forwarding(self, ni_name):
+        """
+        @brief Fetch ni_name via try_forwarding unless a fetch is already running
+        @param ni_name NIname validated name of NDO not in the local cache
+        @return 2-tuple (metadata, content_file) or None if an error was sent
+
+        The first request for an object leads the fetch and hands the
+        outcome to the coalescer whatever happens, so that waiting requests
+        are never left hanging.  The leader checks the cache again before
+        forwarding in case an earlier leader has just fetched the object.  Waiting requests send the same response as
+        the leader, or a timeout error if the leader takes too long.
+        """
+        key = ni_name.get_canonical_ni_url()
+        flight, leader = self.coalescer.begin(key)
+
+        if not leader:
+            self.loginfo("waiting for %s" % str(flight))
+            with self.timer.span(PHASE_AGGREGATE):
+                done = flight.wait(self.coalescer.wait_timeout)
+            if not done:
+                self.loginfo("timed out waiting for %s" % str(flight))
+                self.send_error(404, "Named Data Object forwarding timeout")
+                return None
+            self.loginfo("waited for %s" % str(flight))
+            if not flight.succeeded():
+                self.send_error(flight.err_code, flight.err_msg)
+                return None
+            return (flight.metadata, flight.content_file)
+
+        # A previous leader may have cached the object and finished its
+        # flight after this request missed the cache - check again so
+        # that the object is not fetched twice
+        self.fwd_failure = None
+        res = None
+        try:
+            try:
+                with self.timer.span(PHASE_CACHE_GET):
+                    res = self.cache.cache_get(ni_name)
+                self.loginfo("in cache after previous forwarding")
+            except NoCacheEntry:
+                res = self.try_forwarding(ni_name)
+            except Exception, e:
+                self.logerror(str(e))
+                return self.forwarding_failed(500, str(e))
+        finally:
+            if res is not None:
+                self.coalescer.complete(flight, res[0], res[1])
+            elif self.fwd_failure is not None:
+                self.coalescer.fail(flight, self.fwd_failure[0],
+                                    self.fwd_failure[1])
+            else:
+                self.coalescer.fail(flight, 500,
+                                    "Named Data Object forwarding failed")
+        return res
+
+    #--------------------------------------------------------------------------#
+    def forwarding_failed(self, code, msg):
+        """
+        @brief Send error response for a failed forwarding attempt
+        @param code integer HTTP error code
+        @param msg string error message
+        @return None (for convenience when returning from try_forwarding)
+
+        The error is recorded so that it can be passed on to any requests
+        waiting for the same object (see coalesced_forwarding).
+        """
+        self.fwd_failure = (code, msg)
+        self.send_error(code, msg)
+        return None
+
     #--------------------------------------------------------------------------#
     def netinf_get(self, form):
         """
@@ -1519,114 +1775,49 @@ class NIHTTPRequestHandler(HTTPRequestShim):
                       (fov["URI"], fov["msgid"], fov["ext"]))
 
         # Generate NIname and validate it (it should have a Params field).
-        ni_name = NIname(form["URI"].value)
-        rv = ni_name.validate_ni_url()
+        with self.timer.span(PHASE_VALIDATE):
+            ni_name = NIname(form["URI"].value)
+            rv = ni_name.validate_ni_url()
         if rv is not ni_errs.niSUCCESS:
             self.loginfo("URI format of %s inappropriate: %s" % (self.path,
                                                                  ni_errs_txt[rv]))
             self.send_error(406, "ni: scheme URI not in appropriate format: %s" % ni_errs_txt[rv])
             return
 
-        #print (ni_name.get_alg_name(), ni_name.get_digest())
-        # We should use alg_name too, but the cache currently doesn't do
-        # this either.
-        ni_name_s = ni_name.get_digest()
-
         do_aggregation = hasattr(self, "request_aggregation")
 
-        # Request aggregation: if this is the first request for the object,
-        # create a lock and associate it with the object's name (in the
-        # dict 'requestlist') while the object is being fetched.
-        # If there instead is such a lock present, wait for it and then
-        # expect to find the object in the cache.
-        # The operations on 'requestlist' are guarded with a global lock
-        # 'requestlock'.
+        # Request aggregation: if the object is not in the cache, the first
+        # request for it becomes the 'leader' of an InFlightRequest held by
+        # the coalescer (see nicoalesce.py) and fetches it.  Any requests for
+        # the same object that arrive while the fetch is in progress wait
+        # for the leader (with a timeout) and are handed the metadata and
+        # content file, or the error the leader got, directly.
         # When request aggregation is not used, all requests behave as if
         # they were the only ones fetching the object.
-
-        thr = None
-        if do_aggregation:
-            with self.requestlock:
-                if ni_name_s in self.requestlist:
-                    # The object is being fetched - wait until it has arrived.
-                    thr = self.requestlist[ni_name_s]
-                else:
-                    # The object is not being fetched. We will either fetch it
-                    # or get it from the cache. Create a lock so that only
-                    # this thread fetches the object.
-                    lck = threading.Lock()
-                    lck.acquire()
-                    self.requestlist[ni_name_s] = lck
-
-        if thr:
-            # The object is being fetched by another thread - wait until
-            # this is finished, then try to get it from the cache.
-            self.loginfo("waiting for %s" % str(thr))
-            with thr:
-                pass
-            self.loginfo("waited for %s" % str(thr))
-
-            try:
-                self.loginfo("in cache 2?")
-                metadata, content_file = self.cache.cache_get(ni_name)
-                self.loginfo("in cache 2")
-
-            except NoCacheEntry:
-                self.loginfo("NetInfRouterCore Forwarding failure 2")
-                self.send_error(404, "Named Data Object forwarding failed")
-                return
-
-        else:
-            try:
-                self.loginfo("in cache?")
+        try:
+            self.loginfo("in cache?")
+            with self.timer.span(PHASE_CACHE_GET):
                 metadata, content_file = self.cache.cache_get(ni_name)
-                self.loginfo("in cache")
-            except NoCacheEntry:
-                self.loginfo("not in cache")
-
-                if do_aggregation:
-                    self.loginfo("alg_name %s" % str(ni_name.get_alg_name()))
-
+            self.loginfo("in cache")
+            nimetrics.CACHE_LOOKUPS.inc(labels=("hit",))
+        except NoCacheEntry:
+            self.loginfo("not in cache")
+            nimetrics.CACHE_LOOKUPS.inc(labels=("miss",))
+            if do_aggregation:
+                res = self.coalesced_forwarding(ni_name)
+            else:
                 res = self.try_forwarding(ni_name)
-
-                if res == None:
-                    if do_aggregation:
-                        # If we created a lock to prevent other threads from
-                        # fetching the same object, release that lock now.
-                        with self.requestlock:
-                            lck = self.requestlist[ni_name_s]
-                            lck.release()
-                            self.loginfo("released %s" % str(lck))
-                            del self.requestlist[ni_name_s]
-                    return
-
-                (metadata, content_file) = res
-
-            except Exception, e:
-                if do_aggregation:
-                    # If we created a lock to prevent other threads from
-                    # fetching the same object, release that lock now.
-                    with self.requestlock:
-                        lck = self.requestlist[ni_name_s]
-                        lck.release()
-                        self.loginfo("released %s" % str(lck))
-                        del self.requestlist[ni_name_s]
-                self.logerror(str(e))
-                self.send_error(500, str(e))
+            if res == None:
                 return
+            (metadata, content_file) = res
+        except Exception, e:
+            self.logerror(str(e))
+            self.send_error(500, str(e))
+            return
 
         self.loginfo("form_get,uri,%s,ctype,%s,size,%s" % (ni_name.get_canonical_ni_url(),
                                                            metadata.get_ctype(),
                                                            metadata.get_size()))
-        if do_aggregation:
-            # If we created a lock to prevent other threads from
-            # fetching the same object, release that lock now.
-            with self.requestlock:
-                lck = self.requestlist[ni_name_s]
-                lck.release()
-                self.loginfo("released %s" % str(lck))
-                del self.requestlist[ni_name_s]
-
 
         # Record size for higher level logging
         self.req_size = int(metadata.get_size())
@@ -1784,8 +1975,9 @@ class NIHTTPRequestHandler(HTTPRequestShim):
         (loc1, loc2) = self.form_to_locs(form)
         
         # Generate NIname and validate it (it should have a Params field).
-        ni_name = NIname(form["URI"].value)
-        rv = ni_name.validate_ni_url(has_params=True)
+        with self.timer.span(PHASE_VALIDATE):
+            ni_name = NIname(form["URI"].value)
+            rv = ni_name.validate_ni_url(has_params=True)
         if rv is not ni_errs.niSUCCESS:
             self.loginfo("URI format of %s inappropriate: %s" % (self.path,
                                                                  ni_errs_txt[rv]))
@@ -1816,6 +2008,14 @@ class NIHTTPRequestHandler(HTTPRequestShim):
             # Prepare hashing mechanisms
             hash_function = ni_name.get_hash_function()()
 
+            # If the form doesn't give a useful content type, it will be
+            # guessed from the start of the file as it is copied
+            form_ctype = form["octets"].type
+            if ((form_ctype is None) or (form_ctype == self.DFLT_MIME_TYPE)):
+                sniffer = ctype_detector.sniffer()
+            else:
+                sniffer = None
+
             # Copy file from incoming stream and generate digest
             file_len = 0
             g = form["octets"].file
@@ -1825,6 +2025,8 @@ class NIHTTPRequestHandler(HTTPRequestShim):
                     break
                 f.write(buf)
                 hash_function.update(buf)
+                if sniffer is not None:
+                    sniffer.update(buf)
                 file_len += len(buf)
             f.close()
 
@@ -1869,12 +2071,11 @@ class NIHTTPRequestHandler(HTTPRequestShim):
                 return
 
             # Work out content type for received file
-            ctype = form["octets"].type
-
-            if ((ctype is None) or (ctype == self.DFLT_MIME_TYPE)):
-                ctype = magic.from_file(temp_name, mime=True)
+            if sniffer is not None:
+                ctype = sniffer.content_type()
                 self.logdebug("Guessed content type from file is %s" % ctype)
             else:
+                ctype = form_ctype
                 self.logdebug("Supplied content type from form is %s" % ctype)
 
         # If ct= query string supplied in URL field..
@@ -1902,12 +2103,14 @@ class NIHTTPRequestHandler(HTTPRequestShim):
                             loc1, loc2, extrameta)
 
         try:
-            md_out, cfn, new_entry, ignore_upload = \
+            with self.timer.span(PHASE_CACHE_PUT):
+                md_out, cfn, new_entry, ignore_upload = \
                             self.cache.cache_put(ni_name, md, temp_name)
         except Exception, e:
             self.send_error(500, str(e))
             return
         ndo_in_cache = (cfn is not None)
+        self.clear_fwd_miss(ni_name)
 
         # Generate publish report
         self.send_publish_report(rform, ndo_in_cache, ignore_upload,
@@ -1932,9 +2135,14 @@ class NIHTTPRequestHandler(HTTPRequestShim):
         - rform:  Value indicating the form of the response (html, json or plain)
         - ext:    placeholder for extension fields (only 'meta' defined at present)
 
-        The search that is implemented currently sends the tokens string to the
-        OpenSearch interface for Wikipedia, asking for the response in the
-        SearchSuggestion2 XML format with up to 10 items flagged.
+        The tokens are first looked up in the local search index built from
+        the metadata of NDOs in the cache (see search_index.py).  If nothing
+        is found there and search_fallback is set, an external search engine
+        is used (see external_search) and the results cached.
+
+        The external search that is implemented currently sends the tokens
+        string to the OpenSearch interface for Wikipedia, asking for the
+        response in the SearchSuggestion2 XML format with up to 10 items flagged.
 
         The response (if any) is parsed and the items returned processed.
 
@@ -1998,7 +2206,7 @@ class NIHTTPRequestHandler(HTTPRequestShim):
                                                                        fov["ext"],
                                                                        op_timestamp))
 
-        # Formulate request for Wikipedia
+        # Check the search query
         tokens = form["tokens"].value
         self.logdebug("Search token string: |%s|" % tokens)
         if tokens == "":
@@ -2006,296 +2214,60 @@ class NIHTTPRequestHandler(HTTPRequestShim):
             self.send_error(418, "Empty search token string received.")
             return
             
-        wikireq=self.WIKI_SRCH_API % (self.WIKI_LOC, urllib.quote(tokens, safe=""))    
-
-        # Send GET request to Wikipedia server
-        try:
-            http_object = urllib2.urlopen(wikireq)
-        except Exception, e:
-            self.logwarn("Error: Unable to access Wikipedia URL %s: %s" % (wikireq, str(e)))
-            self.send_error(404, "Unable to access Wikipedia URL: %s" % str(e))
-            return
-
-        # Get HTTP result code
-        http_result = http_object.getcode()
-
-        # Get message headers - an instance of email.Message
-        http_info = http_object.info()
-        self.logdebug("Response type: %s" % http_info.gettype())
-        self.logdebug("Response info:\n%s" % http_info)
-
-        obj_length_str = http_info.getheader("Content-Length")
-        if (obj_length_str != None):
-            obj_length = int(obj_length_str)
+        # Reuse the results of a recent search with the same tokens if
+        # possible.  Otherwise try the local index of cached NDOs first,
+        # then (if allowed) the external search engine if nothing is found
+        # locally.
+        rslt = self.recent_search(tokens)
+        if rslt is not None:
+            srch_dict, cached_results = rslt
         else:
-            obj_length = None
-
-        # Read results into buffer
-        # Would be good to try and do this better...
-        # if the object is large we will run into problems here
-        payload = http_object.read()
-        http_object.close()
-        self.logdebug("Wikipedia: result string: %s" % payload)
-
-        # The results are expected to be a single object with MIME type text/xml
-
-        # Verify length and digest if HTTP result code was 200 - Success
-        if (http_result != 200):
-                self.logwarn("Wikipedia request returned HTTP code %d" % http_result)
-                self.send_error(http_result, "Wikipedia non-success response")
-                return
+            srch_dict = {}
+            srch_dict["searcher"] = self.SEARCH_REF
+            srch_dict["engine"]   = self.LOCAL_SRCH_ENGINE
+            srch_dict["tokens"]   = tokens
+            cached_results = self.local_search(tokens)
+            if (len(cached_results) == 0) and self.search_fallback:
+                rslt = self.external_search(tokens)
+                if rslt is None:
+                    # Error response has already been sent
+                    return
+                srch_dict, cached_results = rslt
+            if (self.search_cache is not None) and (len(cached_results) > 0):
+                self.search_cache.store(tokens, srch_dict,
+                    [ { "ni":   item["ni_obj"].get_canonical_ni_url(),
+                        "text": item["text"],
+                        "desc": item["desc"] } for item in cached_results ])
 
-        if ((obj_length != None) and (len(payload) != obj_length)):
-            self.logwarn("Warning: retrieved contents length (%d) does not match Content-Length header value (%d)" % (len(buf), obj_length))
+        self.loginfo("search,tokens,%s,results,%d" % (tokens,
+                                                      len(cached_results)))
+            
+        # Construct response
+        f = StringIO()
+        # Select response format
+        if rform == "json":
+            # JSON format: add basic items         
+            ct = "application/json"
+            rd = {}
+            rd["NetInf"] = NETINF_VER
+            rd["status"]  = 200
+            rd["msgid"] = form["msgid"].value
+            rd["ts"] = op_timestamp
+            rd["search"] = srch_dict
 
-        # Check returned results are in appropriate form
-        ct = http_info.getheader("Content-Type").lower()
-        if not ct.startswith("text/xml"):
-            self.logerror("Wikipedia returned document that was of type '%s' rather than 'text/xml'" %
-                          ct)
-            self.send_error(415, "Wikipedia returned results in a form '%s' other than 'text/xml'" % ct)
-            return
-
-        # Try to decode results - expect that there should be an array of up to ten result 'Item'
-        # elements inside a 'Section' element.  Extract text part of 'Url' (where to get document),
-        # 'Text' (matched text in item) and 'Description' (header of article).
-        # The results should be a single root element specifying almost everything to be in the
-        # XML namespace 'http://opensearch.org/searchsuggest2'
-        try:
-            root = ET.fromstring(payload)
-        except Exception, e:
-            self.logerror("Unable to parse returned Wikipedia document as XML element: %s" % str(e))
-            self.send_error(422, "Unable to parse returned Wikpaedia document: %s" % str(e))
-            return
-
-        # Set up qualified names for elements we are interested in
-        section_name = str(ET.QName(self.SRCH_NAMESPACE, "Section"))
-        item_name    = str(ET.QName(self.SRCH_NAMESPACE, "Item"))
-        url_name     = str(ET.QName(self.SRCH_NAMESPACE, "Url"))
-        text_name    = str(ET.QName(self.SRCH_NAMESPACE, "Text"))
-        desc_name    = str(ET.QName(self.SRCH_NAMESPACE, "Description"))
-
-        # Extract interesting parts of results - these are bodies (.text value) of
-        # Url, Text and Description elements
-        results = []
-        try:
-            if hasattr(root, "iter"):
-                for sect in root.iter(tag=section_name):
-                    for item in sect.iter(tag=item_name):
-                        r = {}
-                        r["url"] = item.find(url_name).text
-                        r["text"] = item.find(text_name).text.encode('ascii','replace')
-                        r["desc"] = item.find(desc_name).text.encode('ascii','replace')
-                        results.append(r)
-            else:
-                # Python 2.6/ElementTree 1.2
-                for sect in root.getiterator(tag=section_name):
-                    for item in sect.getiterator(tag=item_name):
-                        r = {}
-                        r["url"] = item.find(url_name).text
-                        r["text"] = item.find(text_name).text.encode('ascii','replace')
-                        r["desc"] = item.find(desc_name).text.encode('ascii','replace')
-                        results.append(r)
-                
-        except Exception, e:
-            self.logerror("Extraction of elements from Wikipedia results failed: %s" % str(e))
-            self.send_error(422, "Extraction of elements from Wikipedia results failed: %s" % str(e))
-            return
-
-        # Record the tokens for placing in the metadata of items found as a result
-        srch_dict = {}
-        srch_dict["searcher"] = self.SEARCH_REF
-        srch_dict["engine"]   = self.WIKI_LOC
-        srch_dict["tokens"]   = tokens
-        extrameta = { "search": srch_dict }
-
-        # Retrieve the results and cache them
-        # If retrieval fails discard the result
-        cached_results = []
-        for item in results:
-            # Construct a template canonicalized ni name for this result
-            # => No authority; No query string
-            ni_name = NIname((self.SRCH_CACHE_SCHM, "", self.SRCH_CACHE_DGST))
-            # The validation should be a formality but has to be done
-            # otherwise can't get hash function...
-            rv = ni_name.validate_ni_url(has_params = False)
-            if rv != ni_errs.niSUCCESS:
-                self.logerror("Validation of ni_name failed after setting digest: %s" %
-                              ni_errs_txt[rv])
-                continue
-
-            # Record timestamp for this get operation
-            timestamp = NetInfMetaData.metadata_timestamp_for_now()
-
-            # Access the item and get the data - this might be a bit slow.. live with it for now
-            url = item["url"]
-            try:
-                http_req = urllib2.Request(url, headers={'User-Agent' : "NetInf Browser"})
-                http_object = urllib2.urlopen(http_req)
-            except Exception, e:
-                self.logwarn("Warning: Unable to access results URL %s - ignoring: %s" %
-                             (url, str(e)))
-                continue
-
-            http_info = http_object.info()
-
-            self.logdebug("Response type: %s" % http_info.gettype())
-            self.logdebug("Response info:\n%s" % http_info)
-
-            # Verify access was successful and ignore result if not
-            if (http_result != 200):
-                    self.logwarn("Result access request returned HTTP code %d - ignoring result" % http_result)
-                    # Flush any octets that came with the failed request and close the http request object
-                    payload = http_object.read()
-                    http_object.close()
-                    continue
-
-            # Get content type for received object
-            ctype = http_info.gettype()
-
-            # Get content length for received object
-            obj_length_str = http_info.getheader("Content-Length")
-            if (obj_length_str != None):
-                obj_length = int(obj_length_str)
-            else:
-                obj_length = None
-
-            # The results are expected to be a single object with MIME as announced in headers
-
-            # Copy the file from the network to a temporary name in the right
-            # subdirectory of the storage_root.  This makes it trivial to rename it
-            # once the digest has been verified.
-            # This file name is unique to this thread and because it has # in it
-            # should never conflict with a digested file name which doesn't use #.
-            temp_fd, temp_name = self.cache.cache_mktemp()
-            # Convert file descriptor to file object
-            f = os.fdopen(temp_fd, "w")
-            
-            self.logdebug("Copying and digesting to temporary file %s" % temp_name)
-
-            # Prepare hashing mechanisms
-            hash_function = ni_name.get_hash_function()()
-
-            # Copy file from incoming stream and generate digest
-            try:
-                f = open(temp_name, "wb");
-            except Exception, e:
-                self.logerror("Failed to open temp file %s for writing: %s)" % (temp_name, str(e)))
-                continue
-            file_len = 0
-            try:
-                while 1:
-                    buf = http_object.read(16 * 1024)
-                    if not buf:
-                        break
-                    f.write(buf)
-                    hash_function.update(buf)
-                    file_len += len(buf)
-            except Exception, e:
-                self.logerror("Error while reading returned data for URL '%s' - ignoring result: %s" %
-                              (url, str(e)))
-                f.close()
-                http_object.close()
-                continue
-            f.close()
-            http_object.close()
-            self.logdebug("Finished copying")
-
-            # Check length read and length in HTTP header, if any, match
-            # (warning only if they don't)
-            if not ((obj_length is None) or (file_len == obj_length)):
-                self.logwarn(("Warning: Length of data read from network (%d) does not match " + \
-                              "length in HTTP header (%d) for URL '%s'") % (read_length, obj_length,
-                                                                            url))
-         
-            # Get binary digest and convert to urlsafe base64 or
-            # hex encoding depending on URI scheme
-            bin_dgst = hash_function.digest()
-            if (len(bin_dgst) != ni_name.get_digest_length()):
-                self.logerror("Binary digest for '%s' has unexpected length" % url)
-                os.remove(temp_name)
-                continue
-            if ni_name.get_scheme() == "ni":
-                digest = NIproc.make_b64_urldigest(bin_dgst[:ni_name.get_truncated_length()])
-                if digest is None:
-                    self.logerror("Failed to create urlsafe base64 encoded digest for URL '%s'")
-                    os.remove(temp_name)
-                    continue
-            else:
-                digest = NIproc.make_human_digest(bin_dgst[:ni_name.get_truncated_length()])
-                if digest is None:
-                    self.logerror("Failed to create human readable encoded digest for URL '%s'")
-                    os.remove(temp_name)
-                    continue
-
-            # Guess the content type if the header didn't say
-            if ((ctype is None) or (ctype == "") or(ctype == self.DFLT_MIME_TYPE)):
-                ctype = magic.from_file(temp_name, mime=True)
-                self.logdebug("Guessed content type from file for URL '%s' is %s" %
-                              (url, ctype))
-            else:
-                self.logdebug("Supplied content type from HTTP header for URL '%s' is %s" %
-                              (url, ctype))
-
-            # Synthesize the ni URL name for the URL
-            ni_name.set_params(digest)
-            # The validation should be a formality...
-            rv = ni_name.validate_ni_url(has_params = True)
-            if rv != ni_errs.niSUCCESS:
-                self.logerror("Validation of ni_name failed after setting digest: %s" %
-                              ni_errs_txt[rv])
-                continue
-
-            # Do initial store or update of metadata and add content file if
-            # available and needed
-            canonical_url = ni_name.get_canonical_ni_url()
-            # Create metadata instance for current information
-            md = NetInfMetaData(canonical_url, timestamp, ctype, file_len,
-                                url, None, extrameta)
-
-            try:
-                md_out, cfn, new_entry, ignore_upload = \
-                                self.cache.cache_put(ni_name, md, temp_name)
-            except Exception, e:
-                self.send_error(500, str(e))
-                return
-            ndo_in_cache = (cfn is not None)
-                
-            # FINALLY... record cached item ready to generate response
-            item["ni_obj"]    = ni_name
-            item["metadata"]  = md_out
-            cached_results.append(item)
-            self.logdebug("Successfully cached URL '%s' as '%s'" % (url, ni_name.get_url()))
-
-        self.loginfo("search,tokens,%s,results,%d" % (tokens,
-                                                      len(cached_results)))
-            
-        # Construct response
-        f = StringIO()
-        # Select response format
-        if rform == "json":
-            # JSON format: add basic items         
-            ct = "application/json"
-            rd = {}
-            rd["NetInf"] = NETINF_VER
-            rd["status"]  = 200
-            rd["msgid"] = form["msgid"].value
-            rd["ts"] = op_timestamp
-            rd["search"] = srch_dict
-
-            # Iterate through cached results
-            sr_list = []
-            for item in cached_results:
-                sr_list.append( { "ni" : item["ni_obj"].get_url() } )
-            rd["results"] = sr_list
-            
-            json.dump(rd, f)
-            
-        elif rform == "plain":
-            # Textual form report (useful for publish command line applications)
-            ct = "text/plain"
-            f.write("=== NetInf Search Results ===\n")
-            f.write("Search query: |%s|\n\n" % tokens)
+            # Iterate through cached results
+            sr_list = []
+            for item in cached_results:
+                sr_list.append( { "ni" : item["ni_obj"].get_url() } )
+            rd["results"] = sr_list
+            
+            json.dump(rd, f)
+            
+        elif rform == "plain":
+            # Textual form report (useful for publish command line applications)
+            ct = "text/plain"
+            f.write("=== NetInf Search Results ===\n")
+            f.write("Search query: |%s|\n\n" % tokens)
 
             # Iterate through cached results outputting link and information
             for item in cached_results:
@@ -2379,6 +2351,498 @@ class NIHTTPRequestHandler(HTTPRequestShim):
 
         return
         
+    #--------------------------------------------------------------------------#
+    def recent_search(self, tokens):
+        """
+        @brief Get the results of a recent search with the same tokens from
+               the search result cache
+        @param tokens string search query
+        @return None if there are no usable cached results or
+                2-tuple (dictionary describing search,
+                         list of dictionaries as for local_search)
+
+        The cached results are only used if all the NDOs are still in the
+        NDO cache.
+        """
+        if self.search_cache is None:
+            return None
+        entry = self.search_cache.lookup(tokens)
+        if entry is None:
+            return None
+        cached_results = []
+        for r in entry["results"]:
+            ni_name = NIname(r["ni"].encode("ascii"))
+            if ni_name.validate_ni_url(has_params = True) != ni_errs.niSUCCESS:
+                self.search_cache.forget(tokens)
+                return None
+            try:
+                metadata, cfn = self.cache.cache_get(ni_name)
+            except Exception, e:
+                self.logdebug("Search result %s no longer cached: %s" %
+                              (r["ni"], str(e)))
+                self.search_cache.forget(tokens)
+                return None
+            item = {}
+            item["ni_obj"]   = ni_name
+            item["metadata"] = metadata
+            item["text"]     = r["text"].encode('ascii','replace')
+            item["desc"]     = r["desc"].encode('ascii','replace')
+            cached_results.append(item)
+        self.logdebug("Using %d cached search results for |%s|" %
+                      (len(cached_results), tokens))
+        return (entry["search"], cached_results)
+
+    #--------------------------------------------------------------------------#
+    def local_search(self, tokens):
+        """
+        @brief Search the local index of cached NDO metadata
+        @param tokens string search query
+        @return list of dictionaries (possibly empty) for NDOs found with
+                entries 'ni_obj' (NIname instance), 'metadata' (NetInfMetaData
+                instance), 'text' (title string) and 'desc' (description string)
+
+        Results are in order of relevance.  Index entries for NDOs that
+        can no longer be retrieved from the cache are skipped.
+        """
+        if self.search_index is None:
+            return []
+        cached_results = []
+        for r in self.search_index.search(tokens, self.LOCAL_SRCH_LIMIT):
+            ni_name = NIname(r["ni"])
+            if ni_name.validate_ni_url(has_params = True) != ni_errs.niSUCCESS:
+                continue
+            try:
+                metadata, cfn = self.cache.cache_get(ni_name)
+            except Exception, e:
+                self.logdebug("Search index entry for %s not in cache: %s" %
+                              (r["ni"], str(e)))
+                continue
+            desc = "Content type: %s; size: %d; locators: %s" % \
+                   (metadata.get_ctype(), metadata.get_size(),
+                    " ".join(metadata.get_loclist()))
+            item = {}
+            item["ni_obj"]   = ni_name
+            item["metadata"] = metadata
+            item["text"]     = unicode(r["title"]).encode('ascii','replace')
+            item["desc"]     = unicode(desc).encode('ascii','replace')
+            cached_results.append(item)
+        return cached_results
+
+    #--------------------------------------------------------------------------#
+    def external_search(self, tokens):
+        """
+        @brief Search using an external search engine and cache the results
+        @param tokens string search query
+        @retval None if the search failed - an error response has been sent
+        @retval 2-tuple (dictionary describing search for 'search' entries
+                         in NDO metadata, list of dictionaries as for
+                         local_search for the NDOs found and cached)
+
+        The search that is implemented currently sends the tokens string to the
+        OpenSearch interface for Wikipedia (see netinf_search for details).
+        A handler subclass can override this method to use a different engine.
+        """
+        import urllib2
+        import xml.etree.ElementTree as ET
+
+        # Formulate request for Wikipedia
+        wikireq=self.WIKI_SRCH_API % (self.WIKI_LOC, urllib.quote(tokens, safe=""),
+                                      self.SRCH_LIMIT)
+
+        # Send GET request to Wikipedia server
+        try:
+            http_object = urllib2.urlopen(wikireq)
+        except Exception, e:
+            self.logwarn("Error: Unable to access Wikipedia URL %s: %s" % (wikireq, str(e)))
+            self.send_error(404, "Unable to access Wikipedia URL: %s" % str(e))
+            return None
+
+        # Get HTTP result code
+        http_result = http_object.getcode()
+
+        # Get message headers - an instance of email.Message
+        http_info = http_object.info()
+        self.logdebug("Response type: %s" % http_info.gettype())
+        self.logdebug("Response info:\n%s" % http_info)
+
+        obj_length_str = http_info.getheader("Content-Length")
+        if (obj_length_str != None):
+            obj_length = int(obj_length_str)
+        else:
+            obj_length = None
+
+        # Read results into buffer
+        # Would be good to try and do this better...
+        # if the object is large we will run into problems here
+        payload = http_object.read()
+        http_object.close()
+        self.logdebug("Wikipedia: result string: %s" % payload)
+
+        # The results are expected to be a single object with MIME type text/xml
+
+        # Verify length and digest if HTTP result code was 200 - Success
+        if (http_result != 200):
+                self.logwarn("Wikipedia request returned HTTP code %d" % http_result)
+                self.send_error(http_result, "Wikipedia non-success response")
+                return None
+
+        if ((obj_length != None) and (len(payload) != obj_length)):
+            self.logwarn("Warning: retrieved contents length (%d) does not match Content-Length header value (%d)" % (len(buf), obj_length))
+
+        # Check returned results are in appropriate form
+        ct = http_info.getheader("Content-Type").lower()
+        if not ct.startswith("text/xml"):
+            self.logerror("Wikipedia returned document that was of type '%s' rather than 'text/xml'" %
+                          ct)
+            self.send_error(415, "Wikipedia returned results in a form '%s' other than 'text/xml'" % ct)
+            return None
+
+        # Try to decode results - expect that there should be an array of up to ten result 'Item'
+        # elements inside a 'Section' element.  Extract text part of 'Url' (where to get document),
+        # 'Text' (matched text in item) and 'Description' (header of article).
+        # The results should be a single root element specifying almost everything to be in the
+        # XML namespace 'http://opensearch.org/searchsuggest2'
+        try:
+            root = ET.fromstring(payload)
+        except Exception, e:
+            self.logerror("Unable to parse returned Wikipedia document as XML element: %s" % str(e))
+            self.send_error(422, "Unable to parse returned Wikpaedia document: %s" % str(e))
+            return None
+
+        # Set up qualified names for elements we are interested in
+        section_name = str(ET.QName(self.SRCH_NAMESPACE, "Section"))
+        item_name    = str(ET.QName(self.SRCH_NAMESPACE, "Item"))
+        url_name     = str(ET.QName(self.SRCH_NAMESPACE, "Url"))
+        text_name    = str(ET.QName(self.SRCH_NAMESPACE, "Text"))
+        desc_name    = str(ET.QName(self.SRCH_NAMESPACE, "Description"))
+
+        # Extract interesting parts of results - these are bodies (.text value) of
+        # Url, Text and Description elements
+        results = []
+        try:
+            if hasattr(root, "iter"):
+                for sect in root.iter(tag=section_name):
+                    for item in sect.iter(tag=item_name):
+                        r = {}
+                        r["url"] = item.find(url_name).text
+                        r["text"] = item.find(text_name).text.encode('ascii','replace')
+                        r["desc"] = item.find(desc_name).text.encode('ascii','replace')
+                        results.append(r)
+            else:
+                # Python 2.6/ElementTree 1.2
+                for sect in root.getiterator(tag=section_name):
+                    for item in sect.getiterator(tag=item_name):
+                        r = {}
+                        r["url"] = item.find(url_name).text
+                        r["text"] = item.find(text_name).text.encode('ascii','replace')
+                        r["desc"] = item.find(desc_name).text.encode('ascii','replace')
+                        results.append(r)
+                
+        except Exception, e:
+            self.logerror("Extraction of elements from Wikipedia results failed: %s" % str(e))
+            self.send_error(422, "Extraction of elements from Wikipedia results failed: %s" % str(e))
+            return None
+
+        # Record the tokens for placing in the metadata of items found as a result
+        srch_dict = {}
+        srch_dict["searcher"] = self.SEARCH_REF
+        srch_dict["engine"]   = self.WIKI_LOC
+        srch_dict["tokens"]   = tokens
+        extrameta = { "search": srch_dict }
+
+        # Retrieve the results and cache them
+        # If retrieval fails discard the result
+        cached_results = self.fetch_search_results(results, extrameta)
+
+        return (srch_dict, cached_results)
+
+    #--------------------------------------------------------------------------#
+    def fetch_search_results(self, results, extrameta):
+        """
+        @brief Retrieve and cache the items found by an external search
+        @param results list of dictionaries with 'url', 'text' and 'desc'
+                       entries for each item found
+        @param extrameta dictionary with 'search' entry to be recorded in
+                         the metadata for each item
+        @return list of the dictionaries from results (in the same order)
+                for the items cached successfully with 'ni_obj' and
+                'metadata' entries added
+
+        The items are retrieved concurrently by a pool of at most
+        SRCH_FETCH_THREADS threads.  The results are returned when all the
+        items have been processed, when SRCH_FETCH_WANTED have been cached
+        successfully or after SRCH_RESULTS_TIMEOUT seconds, whichever is
+        soonest.  Items still being retrieved at that point continue to be
+        cached but are not included in the results.
+        """
+        if len(results) == 0:
+            return []
+
+        from multiprocessing.pool import ThreadPool
+        done_q = Queue.Queue()
+        def fetch(i, item):
+            try:
+                rslt = self.fetch_search_result(item, extrameta)
+            except Exception, e:
+                self.logerror("Retrieving search result '%s' failed: %s" %
+                              (item["url"], str(e)))
+                rslt = None
+            done_q.put((i, rslt))
+
+        pool = ThreadPool(min(len(results), self.SRCH_FETCH_THREADS))
+        for i in range(len(results)):
+            pool.apply_async(fetch, (i, results[i]))
+        # Worker threads exit when all the items have been processed
+        pool.close()
+
+        cached = {}
+        num_done = 0
+        deadline = time.time() + self.SRCH_RESULTS_TIMEOUT
+        while (num_done < len(results)) and \
+              (len(cached) < self.SRCH_FETCH_WANTED):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                i, rslt = done_q.get(timeout=remaining)
+            except Queue.Empty:
+                break
+            num_done += 1
+            if rslt is not None:
+                cached[i] = rslt
+
+        if num_done < len(results):
+            self.loginfo("Search results returned with %d of %d items still being retrieved" %
+                         (len(results) - num_done, len(results)))
+        return [cached[i] for i in sorted(cached.keys())]
+
+    #--------------------------------------------------------------------------#
+    def fetch_search_result(self, item, extrameta):
+        """
+        @brief Retrieve one item found by an external search, digest it and
+               put it in the cache
+        @param item dictionary with 'url', 'text' and 'desc' entries
+        @param extrameta dictionary with 'search' entry to be recorded in
+                         the metadata for the item
+        @return item with 'ni_obj' and 'metadata' entries added or None if
+                retrieval or caching failed
+
+        Runs in a worker thread - must not send any response.
+        """
+        # Construct a template canonicalized ni name for this result
+        # => No authority; No query string
+        ni_name = NIname((self.SRCH_CACHE_SCHM, "", self.SRCH_CACHE_DGST))
+        # The validation should be a formality but has to be done
+        # otherwise can't get hash function...
+        rv = ni_name.validate_ni_url(has_params = False)
+        if rv != ni_errs.niSUCCESS:
+            self.logerror("Validation of ni_name failed after setting digest: %s" %
+                          ni_errs_txt[rv])
+            return None
+
+        # Record timestamp for this get operation
+        timestamp = NetInfMetaData.metadata_timestamp_for_now()
+
+        # Don't fetch the item again if it is already cached with this URL
+        # as a locator - just record this search in its metadata
+        url = item["url"]
+        known = self.known_search_result(url, timestamp, extrameta)
+        if known is not None:
+            item["ni_obj"], item["metadata"] = known
+            self.logdebug("URL '%s' already cached as '%s'" %
+                          (url, item["ni_obj"].get_url()))
+            return item
+
+        # Access the item and get the data
+        import urllib2
+        try:
+            http_req = urllib2.Request(url, headers={'User-Agent' : "NetInf Browser"})
+            http_object = urllib2.urlopen(http_req,
+                                          timeout=self.SRCH_FETCH_TIMEOUT)
+        except Exception, e:
+            self.logwarn("Warning: Unable to access results URL %s - ignoring: %s" %
+                         (url, str(e)))
+            return None
+
+        http_info = http_object.info()
+
+        self.logdebug("Response type: %s" % http_info.gettype())
+        self.logdebug("Response info:\n%s" % http_info)
+
+        # Verify access was successful and ignore result if not
+        http_result = http_object.getcode()
+        if (http_result != 200):
+                self.logwarn("Result access request returned HTTP code %d - ignoring result" % http_result)
+                # Flush any octets that came with the failed request and close the http request object
+                payload = http_object.read()
+                http_object.close()
+                return None
+
+        # Get content type for received object
+        ctype = http_info.gettype()
+
+        # Get content length for received object
+        obj_length_str = http_info.getheader("Content-Length")
+        if (obj_length_str != None):
+            obj_length = int(obj_length_str)
+        else:
+            obj_length = None
+
+        # The results are expected to be a single object with MIME as announced in headers
+
+        # Copy the file from the network to a temporary name in the right
+        # subdirectory of the storage_root.  This makes it trivial to rename it
+        # once the digest has been verified.
+        # This file name is unique to this thread and because it has # in it
+        # should never conflict with a digested file name which doesn't use #.
+        temp_fd, temp_name = self.cache.cache_mktemp()
+        # Convert file descriptor to file object
+        f = os.fdopen(temp_fd, "w")
+        
+        self.logdebug("Copying and digesting to temporary file %s" % temp_name)
+
+        # Prepare hashing mechanisms
+        hash_function = ni_name.get_hash_function()()
+
+        # Copy file from incoming stream and generate digest
+        try:
+            f = open(temp_name, "wb");
+        except Exception, e:
+            self.logerror("Failed to open temp file %s for writing: %s)" % (temp_name, str(e)))
+            return None
+        # If the headers don't give a useful content type, it will be
+        # guessed from the start of the data as it is copied
+        if ((ctype is None) or (ctype == "") or (ctype == self.DFLT_MIME_TYPE)):
+            sniffer = ctype_detector.sniffer()
+        else:
+            sniffer = None
+        file_len = 0
+        try:
+            while 1:
+                buf = http_object.read(16 * 1024)
+                if not buf:
+                    break
+                f.write(buf)
+                hash_function.update(buf)
+                if sniffer is not None:
+                    sniffer.update(buf)
+                file_len += len(buf)
+        except Exception, e:
+            self.logerror("Error while reading returned data for URL '%s' - ignoring result: %s" %
+                          (url, str(e)))
+            f.close()
+            http_object.close()
+            return None
+        f.close()
+        http_object.close()
+        self.logdebug("Finished copying")
+
+        # Check length read and length in HTTP header, if any, match
+        # (warning only if they don't)
+        if not ((obj_length is None) or (file_len == obj_length)):
+            self.logwarn(("Warning: Length of data read from network (%d) does not match " + \
+                          "length in HTTP header (%d) for URL '%s'") % (read_length, obj_length,
+                                                                        url))
+     
+        # Get binary digest and convert to urlsafe base64 or
+        # hex encoding depending on URI scheme
+        bin_dgst = hash_function.digest()
+        if (len(bin_dgst) != ni_name.get_digest_length()):
+            self.logerror("Binary digest for '%s' has unexpected length" % url)
+            os.remove(temp_name)
+            return None
+        if ni_name.get_scheme() == "ni":
+            digest = NIproc.make_b64_urldigest(bin_dgst[:ni_name.get_truncated_length()])
+            if digest is None:
+                self.logerror("Failed to create urlsafe base64 encoded digest for URL '%s'")
+                os.remove(temp_name)
+                return None
+        else:
+            digest = NIproc.make_human_digest(bin_dgst[:ni_name.get_truncated_length()])
+            if digest is None:
+                self.logerror("Failed to create human readable encoded digest for URL '%s'")
+                os.remove(temp_name)
+                return None
+
+        # Guess the content type if the header didn't say
+        if sniffer is not None:
+            ctype = sniffer.content_type()
+            if ctype is None:
+                ctype = self.DFLT_MIME_TYPE
+            self.logdebug("Guessed content type from file for URL '%s' is %s" %
+                          (url, ctype))
+        else:
+            self.logdebug("Supplied content type from HTTP header for URL '%s' is %s" %
+                          (url, ctype))
+
+        # Synthesize the ni URL name for the URL
+        ni_name.set_params(digest)
+        # The validation should be a formality...
+        rv = ni_name.validate_ni_url(has_params = True)
+        if rv != ni_errs.niSUCCESS:
+            self.logerror("Validation of ni_name failed after setting digest: %s" %
+                          ni_errs_txt[rv])
+            return None
+
+        # Do initial store or update of metadata and add content file if
+        # available and needed
+        canonical_url = ni_name.get_canonical_ni_url()
+        # Create metadata instance for current information
+        md = NetInfMetaData(canonical_url, timestamp, ctype, file_len,
+                            url, None, extrameta)
+
+        try:
+            md_out, cfn, new_entry, ignore_upload = \
+                            self.cache.cache_put(ni_name, md, temp_name)
+        except Exception, e:
+            self.logerror("Caching result from URL '%s' failed: %s" %
+                          (url, str(e)))
+            return None
+        self.clear_fwd_miss(ni_name)
+            
+        # FINALLY... record cached item ready to generate response
+        item["ni_obj"]    = ni_name
+        item["metadata"]  = md_out
+        self.logdebug("Successfully cached URL '%s' as '%s'" % (url, ni_name.get_url()))
+        return item
+
+    #--------------------------------------------------------------------------#
+    def known_search_result(self, url, timestamp, extrameta):
+        """
+        @brief Check if url is a locator for an NDO already in the cache and
+               if so add the search information to its metadata
+        @param url string URL of item found by search
+        @param timestamp string timestamp for metadata update
+        @param extrameta dictionary with 'search' entry for the metadata
+        @return 2-tuple (NIname instance, NetInfMetaData instance after
+                update) or None if there is no cached NDO with content
+                for url
+        """
+        if self.search_index is None:
+            return None
+        ni_uri = self.search_index.find_by_locator(url)
+        if ni_uri is None:
+            return None
+        ni_name = NIname(ni_uri)
+        if ni_name.validate_ni_url(has_params = True) != ni_errs.niSUCCESS:
+            return None
+        try:
+            old_md, cfn = self.cache.cache_get(ni_name)
+        except Exception, e:
+            return None
+        if cfn is None:
+            return None
+        md = NetInfMetaData(ni_uri, timestamp, old_md.get_ctype(),
+                            old_md.get_size(), url, None, extrameta)
+        try:
+            md_out, cfn, new_entry, ignore_upload = \
+                    self.cache.cache_put(ni_name, md, None)
+        except Exception, e:
+            self.logwarn("Updating metadata for '%s' failed: %s" %
+                         (ni_uri, str(e)))
+            return None
+        return (ni_name, md_out)
+
     #--------------------------------------------------------------------------#
     def nrs_conf(self, form):
         """
@@ -2438,6 +2902,7 @@ class NIHTTPRequestHandler(HTTPRequestShim):
                           (redis_key, str(e), str(redis_vals)))
             self.send_error(412, "Updating NRS database entry caused exception: %s" % str(e))
             return
+        self.invalidate_nrs_entry(redis_key)
         
         # Written successfully - send response
         val_dict = self.read_nrs_entry(redis_key, optional)
@@ -2502,7 +2967,7 @@ class NIHTTPRequestHandler(HTTPRequestShim):
 
         # Lookup up URI value
         redis_key = fov["URI"]
-        val_dict = self.read_nrs_entry(redis_key, expected)
+        val_dict = self.lookup_nrs_entry(redis_key, expected)
         if val_dict is None:
             
             self.loginfo("No Redis entry for '%s' looked up" % redis_key)
@@ -2515,7 +2980,12 @@ class NIHTTPRequestHandler(HTTPRequestShim):
         length = f.tell()
         f.seek(0)
         
-        self.loginfo("nrs_get,key,%s,value,%s" % (redis_key, f.getvalue()))
+        if self.nrs_cache is not None:
+            self.loginfo("nrs_get,key,%s,value,%s,cache_hit_rate,%.3f" %
+                         (redis_key, f.getvalue(),
+                          self.nrs_cache.stats()["hit_rate"]))
+        else:
+            self.loginfo("nrs_get,key,%s,value,%s" % (redis_key, f.getvalue()))
 
         self.send_response(200, "NRS Entry lookup for '%s' successful" % redis_key)
         self.send_header("MIME-Version", "1.0")
@@ -2583,6 +3053,7 @@ class NIHTTPRequestHandler(HTTPRequestShim):
             self.send_error(412, "Deleting key in NRS database caused exception: %s" %
                             str(e))
             return
+        self.invalidate_nrs_entry(redis_key)
 
         self.loginfo("nrs_delete,key,%s" % redis_key)
 
@@ -2618,14 +3089,24 @@ class NIHTTPRequestHandler(HTTPRequestShim):
 
         The form sent with a NRS entry create/update request to
         http://<netloc>/netinfproto/nrsconf
-        may contain just the following optional field:
-        - pattern: a string acceptable as a parameter to the Redis keys API function.
+        may contain the following optional fields:
+        - pattern: a string acceptable as a parameter to the Redis SCAN
+                   MATCH option (same syntax as the keys API function).
+        - cursor:  a cursor returned by a previous nrsvals request - if
+                   present (or if limit is present) a single page of
+                   results is returned starting at the cursor.
+        - limit:   the (approximate) number of keys to return in a page.
 
         See the Redis documentation for acceptable patterns.
 
         If the pattern is missing, default to using the wildcard "*" pattern.
 
-        Lookup all Redis entries with keys matching the pattern.
+        Lookup all Redis entries with keys matching the pattern, walking
+        the keyspace incrementally with SCAN rather than KEYS so that the
+        Redis server is not blocked on large NRS databases.  If paging is
+        requested, SCAN is continued until at least 'limit' keys have been
+        found (SCAN may return a few more) or the scan finishes.
+
         It is expected each will contain a subset of the following hash keys
         with values:
         - hint1:    routing hint #1
@@ -2634,16 +3115,24 @@ class NIHTTPRequestHandler(HTTPRequestShim):
         - loc2:     locator #2
         - meta:     metadata
 
-        Construct a response as a JSON object containing two main fields:
+        The entries for each batch of keys returned by SCAN are read with a
+        single pipelined request.
+
+        Construct a response as a JSON object containing three main fields:
         - pattern:  The pattern used for the key matching
-        - results:  An array of JSON objects in the format of the
-                    return from the nrslookup form. 
+        - results:  An object with a member for each key matched in the
+                    format of the return from the nrslookup form.
+        - cursor:   The cursor to use to get the next page of results
+                    ("0" when all matching keys have been returned).
+        The response is streamed out as the batches are read so that the
+        whole result never has to be held in memory.  Since the length is
+        not known in advance no Content-Length header is sent.
         """
 
         # Validate form data
         # Check only expected keys and no more
         mandatory = []
-        optional = ["pattern"]
+        optional = ["pattern", "cursor", "limit"]
         expected = ["hint1", "hint2", "loc1", "loc2", "meta"]
         form_ok, fov = self.check_form_data(form, mandatory, optional, "nrsvals")
         if not form_ok:
@@ -2655,47 +3144,99 @@ class NIHTTPRequestHandler(HTTPRequestShim):
         else:
             redis_patt = fov["pattern"]
 
-        # Find keys matching pattern
+        # Set up paging
+        paged = ("cursor" in form.keys()) or ("limit" in form.keys())
+        try:
+            if "cursor" in form.keys():
+                cursor = int(fov["cursor"])
+            else:
+                cursor = 0
+            if "limit" in form.keys():
+                limit = int(fov["limit"])
+            else:
+                limit = self.NRS_SCAN_COUNT
+            if (cursor < 0) or (limit <= 0):
+                raise ValueError("cursor must be >= 0 and limit > 0")
+        except ValueError, e:
+            self.loginfo("nrs_vals: bad cursor or limit: %s" % str(e))
+            self.send_error(412, "Bad value for cursor or limit: %s" % str(e))
+            return
+
+        # Get the first batch of keys before sending the response header so
+        # that a database failure can still be reported as an error
         try:
-            key_list = self.nrs_redis.keys(redis_patt)
+            cursor, key_list = self.nrs_redis.scan(cursor, match=redis_patt,
+                                                   count=min(limit,
+                                                             self.NRS_SCAN_COUNT))
         except Exception, e:
-            self.logerror("Reading Redis keys for pattern '%s' caused exception %s" %
+            self.logerror("Scanning Redis keys for pattern '%s' caused exception %s" %
                           (redis_patt, str(e)))
             self.send_error(412, "Reading key list in NRS database caused exception: %s" %
                             str(e))
             return
 
-        # Make a dictionary with all keys
-        results = {}
-        for redis_key in key_list:
-            val_dict = self.read_nrs_entry(redis_key, expected)
-            if val_dict is not None:
-                results[redis_key] = val_dict
-
-        response = {}
-        response["pattern"] = redis_patt
-        response["results"] = results
-
-        self.loginfo("nrs_vals,pattern,%s,num_results,%d" % (redis_patt,
-                                                             len(results)))
-
-        # Generate successful response output
-        f = StringIO()
-        f.write(json.dumps(response))
-        length = f.tell()
-        f.seek(0)
-        
         self.send_response(200, "NRS Entry lookup for pattern '%s' successful" % redis_patt)
         self.send_header("MIME-Version", "1.0")
         self.send_header("Content-Type", "application/json")
         self.send_header("Content-Disposition", "inline")
-        self.send_header("Content-Length", str(length))
         self.send_header("Expires", self.date_time_string(time.time()+(24*60*60)))
         self.send_header("Last-Modified", self.date_time_string())
         self.end_headers()
-        self.send_string(f.getvalue())
-        f.close
-          
+        self.send_file(GeneratorFile(self.gen_nrs_vals(redis_patt, cursor,
+                                                       key_list, expected,
+                                                       paged, limit)))
+        return
+
+    #--------------------------------------------------------------------------#
+    def gen_nrs_vals(self, redis_patt, cursor, key_list, expected,
+                     paged, limit):
+        """
+        @brief Generator producing the JSON response body for nrs_vals
+        @param redis_patt string pattern used for matching keys
+        @param cursor integer SCAN cursor following key_list
+        @param key_list list of strings first batch of keys from SCAN
+        @param expected list of strings names of hash elements to read
+        @param paged boolean True if only one page of results is wanted
+        @param limit integer (approximate) number of keys in a page
+        @return (yields) strings making up the JSON object
+
+        Once the response header has been sent errors can no longer be
+        reported with an HTTP error code.  If a Redis operation fails part
+        way through the scan, the error is logged and the JSON object is
+        terminated with the cursor from which the scan could be resumed.
+        """
+        yield '{"pattern": %s, "results": {' % json.dumps(redis_patt)
+        num_keys = 0
+        num_results = 0
+        sep = ""
+        while True:
+            if len(key_list) > 0:
+                try:
+                    entries = self.read_nrs_entries(key_list, expected)
+                except Exception, e:
+                    self.logerror("Reading NRS entries for pattern '%s' caused exception %s" %
+                                  (redis_patt, str(e)))
+                    break
+                num_keys += len(key_list)
+                for redis_key, val_dict in entries:
+                    yield "%s%s: %s" % (sep, json.dumps(redis_key),
+                                        json.dumps(val_dict))
+                    sep = ", "
+                    num_results += 1
+            if (cursor == 0) or (paged and (num_keys >= limit)):
+                break
+            try:
+                cursor, key_list = self.nrs_redis.scan(cursor,
+                                                       match=redis_patt,
+                                                       count=self.NRS_SCAN_COUNT)
+            except Exception, e:
+                self.logerror("Scanning Redis keys for pattern '%s' caused exception %s" %
+                              (redis_patt, str(e)))
+                break
+        yield '}, "cursor": "%d"}' % cursor
+
+        self.loginfo("nrs_vals,pattern,%s,num_results,%d,cursor,%d" %
+                     (redis_patt, num_results, cursor))
         return
 
     #--------------------------------------------------------------------------#
@@ -2969,20 +3510,107 @@ class NIHTTPRequestHandler(HTTPRequestShim):
                            'locs*' hashes, respectively and 'meta' containing
                            the value of the 'meta' hash.
         """
-        # Check if there is any entry
         try:
-            all_vals = self.nrs_redis.hgetall(redis_key)
+            return self.fetch_nrs_entry(redis_key, val_names)
         except Exception, e:
             return None
 
+    #--------------------------------------------------------------------------#
+    def fetch_nrs_entry(self, redis_key, val_names):
+        """
+        @brief Read the entry in the NRS database for the redis_key as for
+               read_nrs_entry but pass on exceptions
+        @param redis_key string key name for NRS database
+        @param val_names list of strings with names of hash elements to read
+        @retval None if the key does not exist or has no entries
+        @retval dictionary object as for read_nrs_entry
+        @throw redis exceptions if the connection to the database fails
+        """
+        # Check if there is any entry
+        all_vals = self.nrs_redis.hgetall(redis_key)
         if len(all_vals) == 0:
             return None
         
+        vals = self.nrs_redis.hmget(redis_key, val_names)
+        return self.make_nrs_entry(val_names, vals)
+
+    #--------------------------------------------------------------------------#
+    def lookup_nrs_entry(self, redis_key, val_names):
+        """
+        @brief Read the entry in the NRS database for the redis_key via the
+               local NRS lookup cache (if there is one)
+        @param redis_key string key name for NRS database
+        @param val_names list of strings with names of hash elements to read
+        @return as for read_nrs_entry
+
+        Missing entries are cached as well as existing ones.  Failures to
+        read the database are not cached.  The cached dictionary is shared
+        so the caller must not modify it.
+        """
+        if self.nrs_cache is None:
+            return self.read_nrs_entry(redis_key, val_names)
         try:
-            vals = self.nrs_redis.hmget(redis_key, val_names)
+            return self.nrs_cache.get(redis_key,
+                                      lambda: self.fetch_nrs_entry(redis_key,
+                                                                   val_names),
+                                      kind="|".join(val_names))
         except Exception, e:
             return None
 
+    #--------------------------------------------------------------------------#
+    def invalidate_nrs_entry(self, redis_key):
+        """
+        @brief Tell local and remote NRS lookup caches that the entry for
+               redis_key has changed
+        @param redis_key string key name for NRS database
+        @return (none)
+        """
+        if self.nrs_cache is not None:
+            self.nrs_cache.invalidate(redis_key)
+        return
+
+    #--------------------------------------------------------------------------#
+    def read_nrs_entries(self, key_list, val_names):
+        """
+        @brief Read the entries in the NRS database for all keys in key_list
+               using a single pipelined request
+        @param key_list list of strings with key names for NRS database
+        @param val_names list of strings with names of hash elements to read
+        @return list of 2-tuples (key, dictionary as for read_nrs_entry) for
+                each key that has a non-empty hash entry
+        @throw redis exceptions if the connection to the database fails
+
+        Keys that do not exist, have no entries or are not hashes (the
+        database may be shared with the Redis NDO cache) are skipped.
+        """
+        pipe = self.nrs_redis.pipeline(transaction=False)
+        for redis_key in key_list:
+            pipe.hlen(redis_key)
+            pipe.hmget(redis_key, val_names)
+        replies = pipe.execute(raise_on_error=False)
+
+        results = []
+        for i in range(len(key_list)):
+            num_vals = replies[2*i]
+            vals = replies[(2*i)+1]
+            if isinstance(num_vals, Exception) or isinstance(vals, Exception):
+                continue
+            if num_vals == 0:
+                continue
+            results.append((key_list[i], self.make_nrs_entry(val_names, vals)))
+        return results
+
+    #--------------------------------------------------------------------------#
+    def make_nrs_entry(self, val_names, vals):
+        """
+        @brief Combine values read from an NRS entry into a dictionary
+        @param val_names list of strings with names of hash elements read
+        @param vals list of strings (or None) values corresponding to val_names
+        @return dictionary object representing JSON object with fields 'hints' and
+                           'locs' containing arrays of strings from 'hints*' and
+                           'locs*' hashes, respectively and 'meta' containing
+                           the value of the 'meta' hash.
+        """
         # Combine hints and locs into lists
         hints = []
         locs = []
@@ -3043,6 +3671,51 @@ class AlgDigestOp:
         self.send_op = send_op
         return
 
+#==============================================================================#
+class GeneratorFile:
+    """
+    @brief Minimal read-only file-like wrapper round a generator of strings
+
+    Allows a response body that is generated progressively to be passed
+    to send_file, so that it is written out (BaseHTTPRequestHandler) or
+    iterated over (WSGI) as it is produced rather than being assembled
+    in memory first.
+    """
+    def __init__(self, gen):
+        """
+        @brief Constructor
+        @param gen generator (or other iterator) yielding strings
+        """
+        self.gen = gen
+        self.buf = ""
+        return
+
+    def read(self, size=-1):
+        """
+        @brief Read up to size octets (all remaining if size < 0)
+        @param size integer maximum number of octets wanted
+        @return string - empty string when the generator is exhausted
+        """
+        while (size < 0) or (len(self.buf) < size):
+            try:
+                self.buf += self.gen.next()
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self.buf)
+        rv = self.buf[:size]
+        self.buf = self.buf[size:]
+        return rv
+
+    def close(self):
+        """
+        @brief Discard any remaining output
+        """
+        self.buf = ""
+        if hasattr(self.gen, "close"):
+            self.gen.close()
+        return
+
 #==============================================================================#
 # === GLOBAL VARIABLES ===
 
@@ -3072,6 +3745,10 @@ alg_digest_get_dict = {
         AlgDigestOp(NIHTTPRequestHandler.QRCODE_PRF, "get_qrcode", NI_SCHEME, 
                     ";", "Content access URL cannot be parsed: %s",
                     NIHTTPRequestHandler.send_qrcode_header),
+    NIHTTPRequestHandler.QRPNG_PRF:
+        AlgDigestOp(NIHTTPRequestHandler.QRPNG_PRF, "get_qrpng", NI_SCHEME, 
+                    ";", "Content access URL cannot be parsed: %s",
+                    NIHTTPRequestHandler.send_qrpng_header),
     NIHTTPRequestHandler.NI_HTTP:
         AlgDigestOp(NIHTTPRequestHandler.NI_HTTP, "get_wkn_ni", NI_SCHEME, 
                     "/", "Content access URL cannot be parsed: %s",
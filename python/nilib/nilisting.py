@@ -0,0 +1,416 @@
+#!/usr/bin/python
+"""
+@package nilib
+@file nilisting.py
+@brief Paginated cache listings for the NetInf server in HTML, text or JSON
+@version Copyright (C) 2012 Trinity College Dublin and Folly Consulting Ltd
+      This is an adjunct to the NI URI library developed as
+      part of the SAIL project. (http://sail-project.eu)
+
+      Specification(s) - note, versions may change
+          - http://tools.ietf.org/html/draft-farrell-decade-ni-10
+          - http://tools.ietf.org/html/draft-hallambaker-decade-ni-params-03
+          - http://tools.ietf.org/html/draft-kutscher-icnrg-netinf-proto-00
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+       - http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+===============================================================================#
+
+@details
+The cache listing (/netinfproto/list) accepts these query parameters:
+- alg=<hash alg>          list only one algorithm (checked by the handler)
+- rform=html|plain|json   format of the listing (default html)
+- limit=<n>               return at most n entries (1 to MAX_LIMIT) and a
+                          cursor for the next page if there may be more
+- cursor=<alg>;<digest>   start after this entry (from a previous page)
+- content=yes|no          only entries with (without) a content file
+- since=<secs>            only entries changed at or after this time
+- until=<secs>            only entries changed before this time
+Times are in seconds since the epoch.  Without a limit the whole listing
+is returned.
+
+gen_listing walks the ordered index of a cache listing (see
+cache_listing.py) and produces the response body a piece at a time, so the
+handler can stream it with GeneratorFile rather than building and sorting
+the whole listing in memory.  The formats are classes with one method for
+each part of the listing (head, algorithm heading, entry, algorithm end and
+tail) so that HTML, text and JSON output all come from the same walk.
+"""
+import json
+import urllib
+
+#===============================================================================#
+# List of classes/global functions in file
+__all__ = ['ListingQuery', 'HTMLListing', 'PlainListing', 'JSONListing',
+           'FORMATS', 'MAX_LIMIT', 'gen_listing']
+
+#===============================================================================#
+##@var MAX_LIMIT
+# Largest page size that can be requested
+MAX_LIMIT = 10000
+
+#===============================================================================#
+class ListingQuery(object):
+    """
+    @brief Checked parameters for a cache listing request
+    """
+    ##@var algs
+    # list of strings hash algorithms to list, in order
+
+    ##@var rform
+    # string output format - key in FORMATS
+
+    ##@var limit
+    # integer maximum number of entries or None for no limit
+
+    ##@var cursor
+    # 2-tuple (alg, digest) of entry to start after or None
+
+    ##@var content
+    # boolean True (False) to list only entries with (without) content or
+    # None for all entries
+
+    ##@var since
+    # float only entries with timestamp >= since (or None)
+
+    ##@var until
+    # float only entries with timestamp < until (or None)
+
+    ##@var params
+    # dictionary query parameters (other than cursor) to repeat in the link
+    # for the next page
+
+    #--------------------------------------------------------------------------#
+    def __init__(self, algs, query_dict):
+        """
+        @brief Check the query parameters
+        @param algs list of strings hash algorithms to list
+        @param query_dict dictionary of (unquoted) query parameters
+        @throw ValueError if any parameter is not acceptable
+        """
+        self.algs = algs
+        self.params = {}
+        for k in ("alg", "rform", "limit", "content", "since", "until"):
+            if k in query_dict:
+                self.params[k] = query_dict[k]
+
+        self.rform = query_dict.get("rform", "html").lower()
+        if self.rform not in FORMATS:
+            raise ValueError("Unrecognized response format: %s" % self.rform)
+
+        self.limit = None
+        if "limit" in query_dict:
+            try:
+                self.limit = int(query_dict["limit"])
+            except ValueError:
+                self.limit = 0
+            if not (0 < self.limit <= MAX_LIMIT):
+                raise ValueError("limit must be a number from 1 to %d" %
+                                 MAX_LIMIT)
+
+        self.cursor = None
+        if "cursor" in query_dict:
+            c = query_dict["cursor"].split(";")
+            if (len(c) != 2) or (c[0].lower() not in algs) or (c[1] == ""):
+                raise ValueError("Bad cursor: %s" % query_dict["cursor"])
+            self.cursor = (c[0].lower(), c[1])
+
+        self.content = None
+        if "content" in query_dict:
+            c = query_dict["content"].lower()
+            if c not in ("yes", "no"):
+                raise ValueError("content must be 'yes' or 'no'")
+            self.content = (c == "yes")
+
+        self.since = self._time(query_dict, "since")
+        self.until = self._time(query_dict, "until")
+        return
+
+    #--------------------------------------------------------------------------#
+    def _time(self, query_dict, k):
+        """
+        @brief Get a time parameter
+        @param query_dict dictionary of query parameters
+        @param k string name of parameter
+        @return float time or None if parameter not present
+        @throw ValueError if value is not a number
+        """
+        if k not in query_dict:
+            return None
+        try:
+            return float(query_dict[k])
+        except ValueError:
+            raise ValueError("%s must be a time in seconds since the epoch" % k)
+
+    #--------------------------------------------------------------------------#
+    def query_string(self, cursor):
+        """
+        @brief Make the query string for the next page of the listing
+        @param cursor string cursor for next page
+        @return string encoded query string (without '?')
+        """
+        params = sorted(self.params.items()) + [("cursor", cursor)]
+        return urllib.urlencode(params)
+
+#===============================================================================#
+class _ListingFormat(object):
+    """
+    @brief Base for listing formats - each method returns a string
+    """
+    ##@var content_type
+    # string MIME type of listing
+    content_type = None
+
+    #--------------------------------------------------------------------------#
+    def __init__(self, server_name, netloc, prefixes, next_url):
+        """
+        @brief Constructor
+        @param server_name string name of server for titles
+        @param netloc string network location of server for links
+        @param prefixes 3-tuple of path prefixes for links to content,
+                        metadata and QR code (e.g., "/.well-known/ni/")
+        @param next_url callable taking a cursor, returning URL of next page
+        """
+        self.server_name = server_name
+        self.netloc = netloc
+        (self.ni_http, self.meta_prf, self.qrcode_prf) = prefixes
+        self.next_url = next_url
+        return
+
+    def head(self):
+        return ""
+
+    def alg_head(self, alg):
+        return ""
+
+    def entry(self, alg, dgst, ce, ts):
+        return ""
+
+    def alg_tail(self, alg):
+        return ""
+
+    def tail(self, count, cursor):
+        return ""
+
+#===============================================================================#
+class HTMLListing(_ListingFormat):
+    """
+    @brief HTML page with links to content, metadata and QR code per entry
+    """
+    content_type = "text/html"
+
+    def head(self):
+        return ('<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">'
+                "<html>\n<title>Named Data Object Cache Listing for server %s</title>\n"
+                "<body>\n<h1>Named Data Object Cache Listing for server %s</h1>\n"
+                "<hr>\n<ul>") % (self.server_name, self.server_name)
+
+    def alg_head(self, alg):
+        self.ni_http_prefix = "http://%s%s%s/" % (self.netloc, self.ni_http, alg)
+        self.meta_http_prefix = "http://%s%s%s;" % (self.netloc, self.meta_prf,
+                                                    alg)
+        self.qrcode_http_prefix = "http://%s%s%s;" % (self.netloc,
+                                                      self.qrcode_prf, alg)
+        self.ni_prefix = "ni:///%s;" % alg
+        return "</ul>\n<h2>Cache Listing for Algorithm %s</h2>\n<ul>\n" % alg
+
+    def entry(self, alg, dgst, ce, ts):
+        # Link or ni URL for content file (no link if content not present)
+        if ce:
+            s = '<li><a href="%s%s">%s%s</a> ' % (self.ni_http_prefix, dgst,
+                                                  self.ni_prefix, dgst)
+        else:
+            s = '<li>%s%s ' % (self.ni_prefix, dgst)
+        return s + ('(<a href="%s%s">meta</a>)(<a href="%s%s">QRcode</a>)</li>\n' %
+                    (self.meta_http_prefix, dgst, self.qrcode_http_prefix, dgst))
+
+    def alg_tail(self, alg):
+        return "\n"
+
+    def tail(self, count, cursor):
+        s = "</ul>\n<hr>\n"
+        if cursor is not None:
+            s += '<p><a href="%s">Next page</a></p>\n<hr>\n' % \
+                 self.next_url(cursor)
+        return s + "</body>\n</html>\n"
+
+#===============================================================================#
+class PlainListing(_ListingFormat):
+    """
+    @brief Plain text listing, one line per entry
+    """
+    content_type = "text/plain"
+
+    def head(self):
+        s = "Named Data Object Cache Listing for server %s\n" % self.netloc
+        return s + ("=" * (len(s) - 1)) + "\n\n"
+
+    def alg_head(self, alg):
+        s = "Cache Listing for Algorithm %s\n" % alg
+        return s + ("-" * (len(s) - 1)) + "\n\n"
+
+    def entry(self, alg, dgst, ce, ts):
+        # Indicate what is available
+        if ce:
+            return 'Metadata and content: %s;%s\n' % (alg, dgst)
+        return 'Metadata only:        %s;%s\n' % (alg, dgst)
+
+    def alg_tail(self, alg):
+        return "\n"
+
+    def tail(self, count, cursor):
+        if cursor is None:
+            return ""
+        return "Next page: %s\n" % self.next_url(cursor)
+
+#===============================================================================#
+class JSONListing(_ListingFormat):
+    """
+    @brief JSON object with an array of entries and the cursor for the next page
+
+    {"server": <netloc>, "entries": [{"alg": , "dgst": , "ni": , "ce": ,
+    "ts": }, ...], "count": <entries>, "cursor": <cursor or null>}
+    """
+    content_type = "application/json"
+
+    def head(self):
+        self.sep = ""
+        return '{"server": %s, "entries": [' % json.dumps(self.netloc)
+
+    def entry(self, alg, dgst, ce, ts):
+        s = self.sep + json.dumps({ "alg": alg, "dgst": dgst,
+                                    "ni": "ni:///%s;%s" % (alg, dgst),
+                                    "ce": ce, "ts": ts })
+        self.sep = ", "
+        return s
+
+    def tail(self, count, cursor):
+        return '], "count": %d, "cursor": %s}' % (count, json.dumps(cursor))
+
+#===============================================================================#
+##@var FORMATS
+# dictionary mapping rform values to listing format classes
+FORMATS = { "html":  HTMLListing,
+            "plain": PlainListing,
+            "json":  JSONListing }
+
+#===============================================================================#
+def gen_listing(listing, query, fmt):
+    """
+    @brief Generator producing a cache listing (or one page of it)
+    @param listing object SharedCacheListing or StaticCacheListing instance
+    @param query object ListingQuery instance
+    @param fmt object listing format instance
+    @return (yields) strings making up the listing
+
+    The algorithms are listed in the order given in the query, starting
+    with the one in the cursor if there is one.  If the page fills up,
+    the tail gives the cursor for the last entry listed (the next page may
+    turn out to be empty).
+    """
+    yield fmt.head()
+    count = 0
+    last = None
+    started = query.cursor is None
+    for alg in query.algs:
+        after = None
+        if not started:
+            if alg != query.cursor[0]:
+                continue
+            after = query.cursor[1]
+            started = True
+        yield fmt.alg_head(alg)
+        for (dgst, ce, ts) in listing.iter_entries(alg, after, query.content,
+                                                   query.since, query.until):
+            yield fmt.entry(alg, dgst, ce, ts)
+            count += 1
+            if count == query.limit:
+                last = "%s;%s" % (alg, dgst)
+                break
+        yield fmt.alg_tail(alg)
+        if last is not None:
+            break
+    yield fmt.tail(count, last)
+    return
+
+#==============================================================================#
+if __name__ == "__main__":
+    from cache_listing import StaticCacheListing
+
+    errs = 0
+    listing = StaticCacheListing({
+        "sha-256": [ { "dgst": "b%d" % i, "ce": (i % 2) == 0, "ts": i }
+                     for i in range(5) ],
+        "sha-256-32": [ { "dgst": "A", "ce": True, "ts": 10 },
+                        { "dgst": "a", "ce": False, "ts": 20 } ] })
+    algs = ["sha-256", "sha-256-32"]
+
+    def run(q, algs=algs):
+        query = ListingQuery(algs, q)
+        fmt = FORMATS[query.rform]("srv", "srv:80",
+                                   ("/.well-known/ni/", "/ni_meta/",
+                                    "/ni_qrcode/"),
+                                   lambda c: "/netinfproto/list?" +
+                                             query.query_string(c))
+        return "".join(gen_listing(listing, query, fmt))
+
+    # Walk the whole listing in pages of 3 using the JSON cursors
+    seen = []
+    q = { "rform": "json", "limit": "3" }
+    pages = 0
+    while True:
+        js = json.loads(run(q))
+        pages += 1
+        seen.extend("%s;%s" % (e["alg"], e["dgst"]) for e in js["entries"])
+        if js["cursor"] is None:
+            break
+        q["cursor"] = js["cursor"]
+    want = ["sha-256;b%d" % i for i in range(5)] + \
+           ["sha-256-32;A", "sha-256-32;a"]
+    if (seen != want) or (pages != 3):
+        print "Wrong pages (%d): %s" % (pages, seen)
+        errs += 1
+
+    # Filters
+    js = json.loads(run({ "rform": "json", "content": "yes", "since": "1",
+                          "until": "15" }))
+    if [e["dgst"] for e in js["entries"]] != ["b2", "b4", "A"]:
+        print "Wrong filtered entries: %s" % js
+        errs += 1
+
+    # HTML and text share the walk
+    html = run({ "limit": "2" })
+    if ('<a href="http://srv:80/.well-known/ni/sha-256/b0">' not in html) or \
+       ("sha-256-32" in html) or \
+       ('Next page</a>' not in html) or ("cursor=sha-256%3Bb1" not in html):
+        print "Wrong HTML page:\n%s" % html
+        errs += 1
+    text = run({ "rform": "plain", "alg": "sha-256-32" }, ["sha-256-32"])
+    if ("Metadata and content: sha-256-32;A\nMetadata only:        sha-256-32;a\n"
+        not in text) or ("Next page" in text):
+        print "Wrong text listing:\n%s" % text
+        errs += 1
+
+    # Bad parameters
+    for q in ({ "rform": "xml" }, { "limit": "0" }, { "limit": "x" },
+              { "limit": str(MAX_LIMIT + 1) }, { "cursor": "md5;x" },
+              { "cursor": "sha-256" }, { "content": "maybe" },
+              { "since": "yesterday" }):
+        try:
+            ListingQuery(algs, q)
+            print "Bad query accepted: %s" % q
+            errs += 1
+        except ValueError:
+            pass
+
+    print "Tests completed with %d errors" % errs
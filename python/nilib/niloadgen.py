@@ -0,0 +1,466 @@
+#!/usr/bin/python
+"""
+@package nilib
+@file niloadgen.py
+@brief Load generator measuring NetInf server request latency under a reproducible Zipf workload
+@version Copyright (C) 2012 Trinity College Dublin and Folly Consulting Ltd
+      This is an adjunct to the NI URI library developed as
+      part of the SAIL project. (http://sail-project.eu)
+
+      Specification(s) - note, versions may change
+          - http://tools.ietf.org/html/draft-farrell-decade-ni-10
+          - http://tools.ietf.org/html/draft-hallambaker-decade-ni-params-03
+          - http://tools.ietf.org/html/draft-kutscher-icnrg-netinf-proto-00
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+       - http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+===============================================================================#
+
+@details
+Sends a mix of GET, PUBLISH and SEARCH requests to a NetInf server and
+records the latency of each request.
+
+The workload is open loop: request start times are drawn from a Poisson
+process with the requested mean arrival rate and each request is handed
+to a pool of worker threads at its scheduled time whether or not earlier
+requests have completed.  Latency is measured from the scheduled time, so
+time spent waiting for a free worker when the server falls behind counts
+against the server (avoiding 'coordinated omission').
+
+The NDO for each request is chosen from a list of names treated as a
+popularity ranking, using a Zipf distribution with the given exponent
+sampled from a precomputed cumulative distribution.  The operation type,
+arrival times and NDO choices all come from a random number generator
+seeded from the command line so that the same workload can be replayed
+against different server versions.
+
+Requests in the initial warmup period are sent but not recorded.
+
+- GET sends the name to /netinfproto/get and reads the whole response.
+- PUBLISH sends a metadata only publish of the name with a dummy locator.
+- SEARCH sends the search keywords to /netinfproto/search.
+
+Latencies are recorded in nitiming.LatencyHistogram instances - HDR style
+histograms with logarithmically sized buckets each split into linear
+sub-buckets, giving fixed relative precision over any range of values.
+The report is a JSON object with the configuration, request and status
+counts, achieved throughput and latency percentiles (p50, p90, p99, p999)
+in microseconds for each operation type and overall.
+"""
+import sys
+import os
+import json
+import time
+import random
+import bisect
+import httplib
+import threading
+import Queue
+from urllib import urlencode
+from optparse import OptionParser
+
+from ni import ni_errs, ni_errs_txt, NIname
+from nitiming import LatencyHistogram
+
+#===============================================================================#
+# List of classes/global functions in file
+__all__ = ['ZipfSampler', 'LoadGenerator', 'load_names',
+           'OP_GET', 'OP_PUBLISH', 'OP_SEARCH']
+
+#===============================================================================#
+##@var OP_GET
+# Operation type for NetInf GET
+OP_GET = "get"
+
+##@var OP_PUBLISH
+# Operation type for NetInf PUBLISH (metadata only)
+OP_PUBLISH = "publish"
+
+##@var OP_SEARCH
+# Operation type for NetInf SEARCH
+OP_SEARCH = "search"
+
+##@var OP_PATHS
+# Server path for each operation type
+OP_PATHS = { OP_GET:     "/netinfproto/get",
+             OP_PUBLISH: "/netinfproto/publish",
+             OP_SEARCH:  "/netinfproto/search" }
+
+##@var PUBLISH_LOC
+# Locator sent in PUBLISH requests
+PUBLISH_LOC = "http://loadgen.example.com"
+
+##@var BLK_SIZE
+# Size of blocks read when discarding response bodies
+BLK_SIZE = 65536
+
+#===============================================================================#
+class ZipfSampler(object):
+    """
+    @brief Draw ranks 0..n-1 with probability proportional to 1/(rank+1)**s
+    """
+    def __init__(self, n, s, rng=None):
+        """
+        @brief Constructor - build the cumulative distribution
+        @param n integer number of items ranked
+        @param s float Zipf exponent (0 gives a uniform distribution)
+        @param rng random.Random instance or None to make one
+        @throw ValueError if n is less than 1
+        """
+        if n < 1:
+            raise ValueError("Zipf distribution needs at least one item")
+        if rng is None:
+            rng = random.Random()
+        self.rng = rng
+        total = 0.0
+        cdf = []
+        for k in xrange(1, n + 1):
+            total += 1.0 / (k ** s)
+            cdf.append(total)
+        self.cdf = [c / total for c in cdf]
+        # Guard against rounding leaving the last entry below 1.0
+        self.cdf[-1] = 1.0
+        return
+
+    def sample(self):
+        """
+        @brief Draw a rank
+        @return integer rank in range 0..n-1 (0 is most popular)
+        """
+        return bisect.bisect_left(self.cdf, self.rng.random())
+
+#===============================================================================#
+def load_names(list_file, host):
+    """
+    @brief Read a list of ni names in popularity order
+    @param list_file file object with one name per line in any of the forms
+                     accepted by nigetlist (complete ni URI, ni URI with empty
+                     authority or alg;digest)
+    @param host string authority used for names without one
+    @return list of ni URI strings
+    @throw ValueError if a name is not a valid ni URI
+    """
+    names = []
+    for line in list_file:
+        line = line.strip()
+        if (line == "") or line.startswith("#"):
+            continue
+        if not line.startswith("ni:"):
+            line = "ni://%s/%s" % (host, line)
+        ni_url = NIname(line)
+        rv = ni_url.validate_ni_url(has_params = True)
+        if rv != ni_errs.niSUCCESS:
+            raise ValueError("%s is not a valid ni URI: %s" %
+                             (line, ni_errs_txt[rv]))
+        if ni_url.get_netloc() == "":
+            ni_url.set_netloc(host)
+        names.append(ni_url.get_url())
+    return names
+
+#===============================================================================#
+class LoadGenerator(object):
+    """
+    @brief Run an open loop workload against a server and record latencies
+    """
+    def __init__(self, http_host, names, mix, rate, duration, warmup=0.0,
+                 zipf_s=1.0, seed=None, workers=64, tokens="netinf"):
+        """
+        @brief Constructor
+        @param http_host string FQDN or IP address and port of server
+        @param names list of ni URI strings in popularity order
+        @param mix dictionary operation type -> relative frequency
+        @param rate float mean requests per second
+        @param duration float seconds of recorded load after warmup
+        @param warmup float seconds of unrecorded load before measurement
+        @param zipf_s float Zipf exponent for choice of names
+        @param seed integer or None random seed for workload
+        @param workers integer number of threads sending requests
+        @param tokens string keywords sent in SEARCH requests
+        """
+        self.http_host = http_host
+        self.names = names
+        self.ops = [op for op in (OP_GET, OP_PUBLISH, OP_SEARCH)
+                    if mix.get(op, 0) > 0]
+        if len(self.ops) == 0:
+            raise ValueError("No operations selected in mix")
+        total = float(sum([mix[op] for op in self.ops]))
+        cum = 0.0
+        self.op_cdf = []
+        for op in self.ops:
+            cum += mix[op] / total
+            self.op_cdf.append(cum)
+        self.op_cdf[-1] = 1.0
+        self.mix = mix
+        self.rate = rate
+        self.duration = duration
+        self.warmup = warmup
+        self.zipf_s = zipf_s
+        self.seed = seed
+        self.workers = workers
+        self.tokens = tokens
+        self.rng = random.Random(seed)
+        self.zipf = ZipfSampler(len(names), zipf_s, self.rng)
+        return
+
+    #--------------------------------------------------------------------------#
+    def schedule(self):
+        """
+        @brief Generate the workload
+        @return generator of tuples (float start time relative to start of
+                run, operation type, integer rank of name, boolean record)
+        """
+        end = self.warmup + self.duration
+        t = 0.0
+        while True:
+            t += self.rng.expovariate(self.rate)
+            if t >= end:
+                return
+            op = self.ops[bisect.bisect_left(self.op_cdf, self.rng.random())]
+            yield (t, op, self.zipf.sample(), t >= self.warmup)
+
+    #--------------------------------------------------------------------------#
+    def form(self, op, rank):
+        """
+        @brief Make the form data for a request
+        @param op operation type
+        @param rank integer rank of name in names list
+        @return string URL encoded form
+        """
+        msgid = self.rng.randint(1, 32000)
+        if op == OP_GET:
+            params = { "URI": self.names[rank], "msgid": msgid, "ext": "" }
+        elif op == OP_PUBLISH:
+            params = { "URI":     self.names[rank],
+                       "msgid":   msgid,
+                       "ext":     "",
+                       "fullPut": "no",
+                       "rform":   "json",
+                       "loc1":    PUBLISH_LOC,
+                       "loc2":    "" }
+        else:
+            params = { "tokens": self.tokens, "msgid": msgid,
+                       "rform": "json", "ext": "" }
+        return urlencode(params)
+
+    #--------------------------------------------------------------------------#
+    def worker(self, work_q, rslts):
+        """
+        @brief Thread body - send requests from the queue until None is read
+        @param work_q Queue.Queue of (float scheduled time, operation type,
+                      string form data, boolean record) tuples
+        @param rslts dictionary operation type -> [LatencyHistogram,
+                     dictionary status -> count] for this worker
+        """
+        conn = httplib.HTTPConnection(self.http_host)
+        headers = { "Content-Type": "application/x-www-form-urlencoded" }
+        while True:
+            item = work_q.get()
+            if item is None:
+                break
+            (sched, op, form_data, record) = item
+            try:
+                conn.request("POST", OP_PATHS[op], form_data, headers)
+                resp = conn.getresponse()
+                while resp.read(BLK_SIZE):
+                    pass
+                status = str(resp.status)
+            except Exception, e:
+                conn.close()
+                status = "error: %s" % e.__class__.__name__
+            done = time.time()
+            if record:
+                (hist, statuses) = rslts[op]
+                hist.record((done - sched) * 1000000)
+                statuses[status] = statuses.get(status, 0) + 1
+        conn.close()
+        return
+
+    #--------------------------------------------------------------------------#
+    def run(self):
+        """
+        @brief Run the workload
+        @return dictionary report suitable for encoding as JSON
+        """
+        work_q = Queue.Queue()
+        worker_rslts = []
+        threads = []
+        for i in range(self.workers):
+            rslts = dict([(op, [LatencyHistogram(), {}]) for op in self.ops])
+            worker_rslts.append(rslts)
+            t = threading.Thread(target=self.worker, args=(work_q, rslts))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        max_lag = 0.0
+        start = time.time()
+        for (t, op, rank, record) in self.schedule():
+            sched = start + t
+            delay = sched - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                max_lag = max(max_lag, -delay)
+            work_q.put((sched, op, self.form(op, rank), record))
+        for t in threads:
+            work_q.put(None)
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+
+        report = { "config": { "host":     self.http_host,
+                               "names":    len(self.names),
+                               "mix":      dict([(op, self.mix[op])
+                                                 for op in self.ops]),
+                               "rate":     self.rate,
+                               "duration": self.duration,
+                               "warmup":   self.warmup,
+                               "zipf_s":   self.zipf_s,
+                               "seed":     self.seed,
+                               "workers":  self.workers },
+                   "elapsed": elapsed,
+                   "max_dispatch_lag": max_lag,
+                   "ops": {} }
+        overall = LatencyHistogram()
+        for op in self.ops:
+            hist = LatencyHistogram()
+            statuses = {}
+            for rslts in worker_rslts:
+                hist.merge(rslts[op][0])
+                for (status, n) in rslts[op][1].iteritems():
+                    statuses[status] = statuses.get(status, 0) + n
+            overall.merge(hist)
+            report["ops"][op] = { "requests": hist.count,
+                                  "ok": statuses.get("200", 0),
+                                  "status": statuses,
+                                  "latency_usec": hist.to_dict() }
+        report["requests"] = overall.count
+        report["throughput"] = overall.count / self.duration if self.duration else 0.0
+        report["latency_usec"] = overall.to_dict()
+        return report
+
+#===============================================================================#
+def py_niloadgen():
+    """
+    @brief Command line program to run a load test against a NetInf server.
+
+    Run:
+
+    >  niloadgen.py --help
+
+    to see usage and options.
+
+    Exit code is 0 for success and negative for errors.
+    """
+    usage = "%prog -n <host:port> [-l <list file name or - (for stdin)>] " \
+            "[-r <requests/s>] [-t <seconds>] [-w <seconds>]\n" \
+            "   [-g <get ratio>] [-p <publish ratio>] [-s <search ratio>] " \
+            "[-z <Zipf exponent>] [-S <seed>]\n" \
+            "   [-c <# workers>] [-k <search keywords>] [-o <report file>]\n" \
+            "The list file gives the names in decreasing order of popularity " \
+            "in any of the forms accepted by nigetlist."
+    parser = OptionParser(usage)
+
+    parser.add_option("-n", "--node", dest="host",
+                      type="string",
+                      help="The FQDN and port of the server to load.")
+    parser.add_option("-l", "--list", dest="list", default="-",
+                      type="string",
+                      help="File with list of names or - for stdin (default).")
+    parser.add_option("-r", "--rate", dest="rate", default=100.0,
+                      type="float",
+                      help="Mean requests per second (default 100).")
+    parser.add_option("-t", "--time", dest="duration", default=60.0,
+                      type="float",
+                      help="Seconds of measured load (default 60).")
+    parser.add_option("-w", "--warmup", dest="warmup", default=10.0,
+                      type="float",
+                      help="Seconds of unmeasured load beforehand (default 10).")
+    parser.add_option("-g", "--get", dest="get", default=1.0,
+                      type="float",
+                      help="Relative frequency of GET requests (default 1).")
+    parser.add_option("-p", "--publish", dest="publish", default=0.0,
+                      type="float",
+                      help="Relative frequency of PUBLISH requests (default 0).")
+    parser.add_option("-s", "--search", dest="search", default=0.0,
+                      type="float",
+                      help="Relative frequency of SEARCH requests (default 0).")
+    parser.add_option("-z", "--zipf", dest="zipf_s", default=1.0,
+                      type="float",
+                      help="Zipf exponent for popularity of names (default 1.0).")
+    parser.add_option("-S", "--seed", dest="seed", default=1,
+                      type="int",
+                      help="Random seed for the workload (default 1).")
+    parser.add_option("-c", "--concurrency", dest="workers", default=64,
+                      type="int",
+                      help="Number of worker threads sending requests (default 64).")
+    parser.add_option("-k", "--keywords", dest="tokens", default="netinf",
+                      type="string",
+                      help="Keywords for SEARCH requests (default netinf).")
+    parser.add_option("-o", "--output", dest="output", default=None,
+                      type="string",
+                      help="File for JSON report (default stdout).")
+
+    (options, args) = parser.parse_args()
+
+    if len(args) != 0:
+        parser.error("Unrecognized arguments %s supplied." % str(args))
+        sys.exit(-1)
+    if options.host is None:
+        parser.error("You must supply the server with -n")
+        sys.exit(-1)
+    if (options.rate <= 0) or (options.duration <= 0) or (options.workers < 1):
+        parser.error("Rate, time and concurrency must be positive")
+        sys.exit(-1)
+
+    if options.list == "-":
+        list_chan = sys.stdin
+    else:
+        try:
+            list_chan = open(options.list, "r")
+        except IOError, e:
+            print "Error: Unable to open list of names %s: %s" % (options.list,
+                                                                  str(e))
+            sys.exit(-2)
+    try:
+        names = load_names(list_chan, options.host)
+        gen = LoadGenerator(options.host, names,
+                            { OP_GET:     options.get,
+                              OP_PUBLISH: options.publish,
+                              OP_SEARCH:  options.search },
+                            options.rate, options.duration, options.warmup,
+                            options.zipf_s, options.seed, options.workers,
+                            options.tokens)
+    except ValueError, e:
+        print "Error: %s" % str(e)
+        sys.exit(-3)
+
+    report = gen.run()
+    report_str = json.dumps(report, indent=2, sort_keys=True)
+    if options.output is None:
+        print report_str
+    else:
+        try:
+            f = open(options.output, "w")
+            f.write(report_str)
+            f.write("\n")
+            f.close()
+        except IOError, e:
+            print "Error: Unable to write report to %s: %s" % (options.output,
+                                                               str(e))
+            sys.exit(-4)
+    sys.exit(0)
+
+#===============================================================================#
+if __name__ == "__main__":
+    py_niloadgen()
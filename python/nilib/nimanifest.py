@@ -0,0 +1,345 @@
+#!/usr/bin/python
+"""
+@package nilib
+@file nimanifest.py
+@brief Command line tool and API to generate ni and nih names for all the files in a directory tree and record them in a manifest
+@version Copyright (C) 2012 Trinity College Dublin and Folly Consulting Ltd
+      This is an adjunct to the NI URI library developed as
+      part of the SAIL project. (http://sail-project.eu)
+
+      Specification(s) - note, versions may change
+          - http://tools.ietf.org/html/draft-farrell-decade-ni-10
+          - http://tools.ietf.org/html/draft-hallambaker-decade-ni-params-03
+          - http://tools.ietf.org/html/draft-kutscher-icnrg-netinf-proto-00
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+       - http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+===============================================================================#
+
+@details
+Walks a directory tree and names every file found, recording the results
+in a manifest file.  The digests are generated by a pool of processes, each
+using NIproc.makenifs so that the ni and nih names for a file come from a
+single pass over its content.
+
+The manifest is a text file with one JSON encoded object per line:
+- path:  pathname of the file relative to the top of the tree
+- size:  integer size of file in octets
+- ni:    ni URI for the file
+- nih:   nih URI for the file
+- ctype: MIME content type of the file
+- ino:   inode number of the file when it was named
+- mtime: modification time of the file when it was named
+
+When the manifest is regenerated, the entry for a file is reused without
+reading the file if its inode number, modification time and size are
+unchanged and the names were made with the same templates, so re-running
+on a mostly unchanged tree only needs to hash the files that have changed.
+By default the manifest is kept in the file MANIFEST_NAME at the top of the
+tree (and that file is not itself named).
+"""
+import sys
+import os
+import json
+import time
+import multiprocessing
+from optparse import OptionParser
+
+from ni import ni_errs, ni_errs_txt, NIname, NIproc
+from ctype_detect import ctype_detector
+
+#===============================================================================#
+# List of classes/global functions in file
+__all__ = ['MANIFEST_NAME', 'name_file', 'load_manifest', 'write_manifest',
+           'build_manifest']
+
+#===============================================================================#
+##@var DIGEST_DFLT
+# Default digest hashing algorithm's name in ni.py
+DIGEST_DFLT = "sha-256"
+
+##@var MANIFEST_NAME
+# Default name of manifest file at the top of the directory tree
+MANIFEST_NAME = ".nimanifest"
+
+##@var CHUNK_SIZE
+# Number of files handed to a pool process at a time
+CHUNK_SIZE = 8
+
+#===============================================================================#
+# verbose = True
+verbose = False
+
+def debug(string):
+    """
+    @brief Print out debugging information string
+    @param string to be printed (in)
+    """
+    if verbose:
+        print string
+    return
+
+#===============================================================================#
+def name_file(job):
+    """
+    @brief Make the manifest entry for one file
+    @param job tuple (full pathname, relative pathname, stat result,
+                      ni template, nih template)
+    @return tuple (manifest entry dictionary or None, error string or None)
+
+    Runs in the pool processes so must be a module level function.
+    """
+    (full_path, rel_path, st, ni_tmpl, nih_tmpl) = job
+    ni_url = NIname(ni_tmpl)
+    nih_url = NIname(nih_tmpl)
+    rets = NIproc.makenifs([ni_url, nih_url], full_path)
+    for ret in rets:
+        if ret != ni_errs.niSUCCESS:
+            return (None, "%s: %s" % (rel_path, ni_errs_txt[ret]))
+    ctype = ctype_detector.from_file(full_path)
+    if ctype is None:
+        # Guessing didn't work - default
+        ctype = "application/octet-stream"
+    return ({ "path":  rel_path,
+              "size":  st.st_size,
+              "ni":    ni_url.get_url(),
+              "nih":   nih_url.get_url(),
+              "ctype": ctype,
+              "ino":   st.st_ino,
+              "mtime": st.st_mtime }, None)
+
+#===============================================================================#
+def load_manifest(manifest_file):
+    """
+    @brief Read an existing manifest
+    @param manifest_file string pathname of manifest
+    @return dictionary relative pathname -> manifest entry dictionary
+            (empty if the manifest does not exist)
+
+    Lines that cannot be decoded are ignored.
+    """
+    entries = {}
+    try:
+        f = open(manifest_file, "r")
+    except IOError:
+        return entries
+    try:
+        for line in f:
+            try:
+                entry = json.loads(line)
+                entries[entry["path"]] = entry
+            except Exception:
+                debug("Ignoring bad manifest line: %s" % line)
+    finally:
+        f.close()
+    return entries
+
+#===============================================================================#
+def write_manifest(manifest_file, entries):
+    """
+    @brief Write a manifest, replacing any previous version atomically
+    @param manifest_file string pathname of manifest
+    @param entries list of manifest entry dictionaries
+    @return (none)
+    @throw IOError or OSError if the manifest cannot be written
+    """
+    temp_file = "%s.%d" % (manifest_file, os.getpid())
+    f = open(temp_file, "w")
+    try:
+        for entry in entries:
+            f.write(json.dumps(entry, sort_keys=True))
+            f.write("\n")
+    finally:
+        f.close()
+    os.rename(temp_file, manifest_file)
+    return
+
+#===============================================================================#
+def build_manifest(dir_name, manifest_file=None, ni_alg=DIGEST_DFLT,
+                   nih_alg=DIGEST_DFLT, authority="", nprocs=None):
+    """
+    @brief Name all the files in a directory tree and write the manifest
+    @param dir_name string pathname of top of directory tree
+    @param manifest_file string pathname of manifest or None to use
+                         MANIFEST_NAME in dir_name
+    @param ni_alg string hash algorithm name for ni URIs
+    @param nih_alg string hash algorithm name for nih URIs
+    @param authority string authority (FQDN) for ni URIs (may be empty)
+    @param nprocs integer number of processes used for hashing or None
+                  to use one per CPU (1 hashes in this process)
+    @return tuple (list of manifest entries, list of error strings,
+                   dictionary of counts - files, reused, hashed, failed)
+    @throw ValueError if either algorithm is not known
+    @throw IOError or OSError if the manifest cannot be written
+
+    Entries from an existing manifest are reused for files whose inode,
+    modification time and size have not changed.  Files that have
+    disappeared are dropped from the manifest.
+    """
+    for alg in (ni_alg, nih_alg):
+        if alg not in NIname.get_all_algs():
+            raise ValueError("Unknown digest algorithm: %s" % alg)
+    ni_tmpl = "ni://%s/%s;" % (authority, ni_alg)
+    nih_tmpl = "nih:%s;" % nih_alg
+    if manifest_file is None:
+        manifest_file = os.path.join(dir_name, MANIFEST_NAME)
+    skip_file = os.path.abspath(manifest_file)
+
+    old_entries = load_manifest(manifest_file)
+    entries = []
+    jobs = []
+    for root, dirs, files in os.walk(dir_name):
+        dirs.sort()
+        for name in sorted(files):
+            full_path = os.path.join(root, name)
+            if os.path.abspath(full_path) == skip_file:
+                continue
+            try:
+                st = os.stat(full_path)
+            except OSError, e:
+                debug("Cannot stat %s: %s" % (full_path, str(e)))
+                continue
+            rel_path = os.path.relpath(full_path, dir_name)
+            old = old_entries.get(rel_path)
+            if ((old is not None) and
+                (old.get("ino") == st.st_ino) and
+                (old.get("mtime") == st.st_mtime) and
+                (old.get("size") == st.st_size) and
+                old.get("ni", "").startswith(ni_tmpl) and
+                old.get("nih", "").startswith(nih_tmpl)):
+                entries.append(old)
+            else:
+                jobs.append((full_path, rel_path, st, ni_tmpl, nih_tmpl))
+
+    counts = { "files":  len(entries) + len(jobs),
+               "reused": len(entries),
+               "hashed": 0,
+               "failed": 0 }
+    errors = []
+    if len(jobs) > 0:
+        if nprocs is None:
+            nprocs = multiprocessing.cpu_count()
+        if (nprocs > 1) and (len(jobs) > 1):
+            pool = multiprocessing.Pool(min(nprocs, len(jobs)))
+            try:
+                rslts = pool.imap_unordered(name_file, jobs, CHUNK_SIZE)
+                for (entry, err) in rslts:
+                    if entry is None:
+                        errors.append(err)
+                    else:
+                        entries.append(entry)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for job in jobs:
+                (entry, err) = name_file(job)
+                if entry is None:
+                    errors.append(err)
+                else:
+                    entries.append(entry)
+    counts["failed"] = len(errors)
+    counts["hashed"] = len(jobs) - len(errors)
+
+    entries.sort(key=lambda entry: entry["path"])
+    write_manifest(manifest_file, entries)
+    return (entries, errors, counts)
+
+#===============================================================================#
+def py_nimanifest():
+    """
+    @brief Command line program to name all the files in a directory tree
+           and write a manifest of the names.
+
+    Run:
+
+    >  nimanifest.py --help
+
+    to see usage and options.
+
+    Exit code is 0 for success, 1 if any file could not be named, and
+    negative for other errors.
+    """
+    global verbose
+
+    # Options parsing and verification stuff
+    usage = "%prog -d <pathname of content directory> [-m <manifest file>] " \
+            "[-a <ni hash alg>] [-b <nih hash alg>] [-n <FQDN>] [-p NN] [-v]"
+    parser = OptionParser(usage)
+
+    parser.add_option("-d", "--dir", dest="dir_name",
+                      type="string",
+                      help="Pathname for directory tree to be named.")
+    parser.add_option("-m", "--manifest", dest="manifest_file",
+                      type="string",
+                      help="Pathname of manifest file. Defaults to %s in "
+                           "the directory." % MANIFEST_NAME)
+    parser.add_option("-a", "--alg", dest="ni_alg", default=DIGEST_DFLT,
+                      type="string",
+                      help="Hash algorithm to be used for ni URIs. "
+                           "Defaults to %s." % DIGEST_DFLT)
+    parser.add_option("-b", "--nih-alg", dest="nih_alg", default=DIGEST_DFLT,
+                      type="string",
+                      help="Hash algorithm to be used for nih URIs. "
+                           "Defaults to %s." % DIGEST_DFLT)
+    parser.add_option("-n", "--node", dest="authority", default="",
+                      type="string",
+                      help="FQDN to be used as authority in ni URIs (default none).")
+    parser.add_option("-p", "--processes", dest="nprocs", default=None,
+                      type="int",
+                      help="Number of hashing processes (default one per CPU).")
+    parser.add_option("-v", "--verbose", dest="verbose", default=False,
+                      action="store_true",
+                      help="Report each file that could not be named.")
+
+    (options, args) = parser.parse_args()
+
+    if len(args) != 0:
+        parser.error("Unrecognized arguments %s supplied." % str(args))
+        sys.exit(-1)
+    if options.dir_name is None:
+        parser.error("You must supply a directory name with -d")
+        sys.exit(-1)
+    if not os.path.isdir(options.dir_name):
+        parser.error("%s is not a directory" % options.dir_name)
+        sys.exit(-1)
+    verbose = options.verbose
+
+    stime = time.time()
+    try:
+        (entries, errors, counts) = build_manifest(options.dir_name,
+                                                   options.manifest_file,
+                                                   options.ni_alg,
+                                                   options.nih_alg,
+                                                   options.authority,
+                                                   options.nprocs)
+    except ValueError, e:
+        parser.error(str(e))
+        sys.exit(-1)
+    except EnvironmentError, e:
+        print "Error: Unable to write manifest: %s" % str(e)
+        sys.exit(-2)
+
+    for err in errors:
+        debug("Unable to name %s" % err)
+    print "files,%d,reused,%d,hashed,%d,failed,%d,time,%.3f" % \
+          (counts["files"], counts["reused"], counts["hashed"],
+           counts["failed"], time.time() - stime)
+
+    if len(errors) > 0:
+        sys.exit(1)
+    sys.exit(0)
+
+#===============================================================================#
+if __name__ == "__main__":
+    py_nimanifest()
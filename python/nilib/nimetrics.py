@@ -0,0 +1,993 @@
+#!/usr/bin/python
+"""
+@package nilib
+@file nimetrics.py
+@brief Counters, gauges and histograms exported by the NetInf server in Prometheus text format
+@version Copyright (C) 2012 Trinity College Dublin and Folly Consulting Ltd
+      This is an adjunct to the NI URI library developed as
+      part of the SAIL project. (http://sail-project.eu)
+
+      Specification(s) - note, versions may change
+          - http://tools.ietf.org/html/draft-farrell-decade-ni-10
+          - http://tools.ietf.org/html/draft-hallambaker-decade-ni-params-03
+          - http://tools.ietf.org/html/draft-kutscher-icnrg-netinf-proto-00
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+       - http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+===============================================================================#
+
+@details
+Each process has one MetricsRegistry (REGISTRY) holding the metrics listed
+below.  Modules update them directly, e.g.,
+
+    CACHE_LOOKUPS.inc(labels=("hit",))
+
+Each metric has its own lock which is only held while a value is updated,
+so updates from the handler threads cost little and do not contend with
+each other.  A metric with label names keeps a value for each combination
+of label values it has been given.
+
+Gauges can be given a function instead of being set explicitly (e.g., for
+the number of running handler threads).  The function is only called when
+the metrics are collected for a scrape.
+
+The values are sent in response to GET /netinfproto/metrics using the
+Prometheus text exposition format (version 0.0.4) by a MetricsExporter.
+
+When several processes serve the same cache (e.g., Apache with mod_wsgi
+in multi-process mode) each process has its own registry and a scrape is
+answered by whichever process gets the request.  To give the totals for
+all the processes, the exporter can be given the name of a posix_ipc
+shared memory segment divided into SHM_SLOTS slots.  Each process claims
+a slot and a background thread writes a JSON snapshot of its registry
+into it every PUBLISH_INTERVAL seconds while requests are being handled;
+the snapshot is also written whenever the process answers a scrape.
+Access to the slots is serialized by a posix_ipc semaphore with the same
+name.  The scraping process merges the snapshots:
+- counters and histograms are summed over all slots, including those of
+  processes that have exited until their slot is reused;
+- gauges are summed (or the maximum taken, for GAUGE_MAX gauges) over the
+  processes that are still running;
+- gauges computed by functions are only evaluated in the scraping process.
+"""
+import os
+import time
+import json
+import mmap
+import struct
+import hashlib
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+
+try:
+    import posix_ipc as pipc
+    pipc_loaded = True
+except ImportError:
+    pipc_loaded = False
+
+#===============================================================================#
+# List of classes/global functions in file
+__all__ = ['MetricsRegistry', 'Counter', 'Gauge', 'Histogram',
+           'MetricsExporter', 'REGISTRY', 'shm_name_for', 'timed_call',
+           'stats_by_label', 'method_label', 'OTHER_METHOD',
+           'CONTENT_TYPE',
+           'GAUGE_SUM', 'GAUGE_MAX', 'DEFAULT_BUCKETS', 'REQUESTS',
+           'REQUESTS_IN_PROGRESS', 'REQUEST_SECONDS', 'RESPONSE_BYTES',
+           'CACHE_LOOKUPS', 'FORWARD_ATTEMPTS', 'FORWARD_SUCCESSES',
+           'PHASE_SECONDS', 'HANDLER_THREADS', 'DTN_REQUESTS',
+           'DTN_RESPONSE_QUEUE', 'REDIS_PING_SECONDS', 'FWD_NEG_CACHE']
+
+#===============================================================================#
+##@var CONTENT_TYPE
+# Content-Type of the metrics response
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+##@var OTHER_METHOD
+# Label used in the request metrics for any unsupported method
+OTHER_METHOD = "other"
+
+##@var GAUGE_SUM
+# Gauge aggregation mode - add up values from all processes
+GAUGE_SUM = "sum"
+
+##@var GAUGE_MAX
+# Gauge aggregation mode - take the largest value from any process
+GAUGE_MAX = "max"
+
+##@var DEFAULT_BUCKETS
+# Upper bounds (seconds) of the histogram buckets used unless others given
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+##@var SHM_SLOTS
+# Number of processes that can share a metrics shared memory segment
+SHM_SLOTS = 64
+
+##@var SHM_SLOT_SIZE
+# Size of each slot in the shared memory segment (octets)
+SHM_SLOT_SIZE = 65536
+
+##@var SHM_SLOT_HDR
+# struct format for slot header - process id and length of JSON snapshot
+SHM_SLOT_HDR = "!II"
+
+##@var PUBLISH_INTERVAL
+# Minimum time (seconds) between snapshots written to shared memory
+PUBLISH_INTERVAL = 1.0
+
+#===============================================================================#
+def _label_str(label_names, label_values, extra=None):
+    """
+    @brief Format the label set for a sample line
+    @param label_names sequence of label name strings
+    @param label_values sequence of label value strings
+    @param extra 2-tuple (name, value) appended to labels or None
+    @return string '{name="value",...}' or empty string if no labels
+    """
+    pairs = zip(label_names, label_values)
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join(['%s="%s"' % (n, str(v).replace("\\", "\\\\").
+                                                     replace("\n", "\\n").
+                                                     replace('"', '\\"'))
+                              for (n, v) in pairs])
+
+#------------------------------------------------------------------------------#
+def _num_str(value):
+    """
+    @brief Format a sample value
+    @param value integer or float
+    @return string representation accepted by Prometheus
+    """
+    if isinstance(value, float):
+        if value == float("inf"):
+            return "+Inf"
+        return repr(value)
+    return str(value)
+
+#===============================================================================#
+class _Metric(object):
+    """
+    @brief Common part of counters, gauges and histograms
+    """
+    ##@var TYPE
+    # string Prometheus metric type
+    TYPE = None
+
+    def __init__(self, name, help_text, label_names):
+        """
+        @brief Constructor
+        @param name string metric name
+        @param help_text string description of metric
+        @param label_names tuple of label name strings
+        """
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        ##@var values
+        # dictionary tuple of label values -> value
+        self.values = {}
+        self.lock = threading.Lock()
+        return
+
+    def _key(self, labels):
+        """
+        @brief Check label values and make them into a dictionary key
+        @param labels sequence of label values (one per label name)
+        @return tuple of label value strings
+        @throw ValueError if the number of labels is wrong
+        """
+        if len(labels) != len(self.label_names):
+            raise ValueError("Metric %s needs labels %s" %
+                             (self.name, str(self.label_names)))
+        return tuple([str(v) for v in labels])
+
+    def collect(self, functions=True):
+        """
+        @brief Snapshot the metric
+        @param functions boolean True if gauge functions should be evaluated
+        @return dictionary (JSON serializable) describing the metric and its
+                values or None if there is nothing to report
+        """
+        with self.lock:
+            samples = [[list(k), v] for (k, v) in self.values.iteritems()]
+        return { "name":   self.name,
+                 "help":   self.help_text,
+                 "type":   self.TYPE,
+                 "labels": list(self.label_names),
+                 "samples": samples }
+
+#------------------------------------------------------------------------------#
+class Counter(_Metric):
+    """
+    @brief Value that only goes up (e.g., number of requests)
+    """
+    TYPE = "counter"
+
+    def inc(self, amount=1, labels=()):
+        """
+        @brief Increase the counter
+        @param amount integer or float increment (not negative)
+        @param labels sequence of label values
+        @return (none)
+        """
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+        return
+
+    def get(self, labels=()):
+        """
+        @brief Read the counter
+        @param labels sequence of label values
+        @return integer or float value (0 if never incremented)
+        """
+        return self.values.get(self._key(labels), 0)
+
+#------------------------------------------------------------------------------#
+class Gauge(_Metric):
+    """
+    @brief Value that can go up and down (e.g., queue length)
+    """
+    TYPE = "gauge"
+
+    def __init__(self, name, help_text, label_names, mode=GAUGE_SUM):
+        """
+        @brief Constructor
+        @param name string metric name
+        @param help_text string description of metric
+        @param label_names tuple of label name strings
+        @param mode string GAUGE_SUM or GAUGE_MAX - how values from
+                    several processes are combined
+        """
+        _Metric.__init__(self, name, help_text, label_names)
+        self.mode = mode
+        self.function = None
+        return
+
+    def set(self, value, labels=()):
+        """
+        @brief Set the gauge
+        @param value integer or float new value
+        @param labels sequence of label values
+        @return (none)
+        """
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+        return
+
+    def inc(self, amount=1, labels=()):
+        """
+        @brief Increase the gauge
+        @param amount integer or float increment
+        @param labels sequence of label values
+        @return (none)
+        """
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+        return
+
+    def dec(self, amount=1, labels=()):
+        """
+        @brief Decrease the gauge
+        @param amount integer or float decrement
+        @param labels sequence of label values
+        @return (none)
+        """
+        self.inc(-amount, labels)
+        return
+
+    def set_function(self, function):
+        """
+        @brief Compute the gauge when metrics are collected
+        @param function callable with no arguments returning the value (or a
+                        dictionary tuple of label values -> value if the
+                        gauge has labels), or None to stop using a function
+        @return (none)
+
+        The function is called from the thread answering the scrape.  If it
+        raises an exception the gauge is left out of the report.
+        """
+        self.function = function
+        return
+
+    def collect(self, functions=True):
+        function = self.function
+        if function is None:
+            rslt = _Metric.collect(self)
+        elif not functions:
+            return None
+        else:
+            try:
+                v = function()
+            except Exception:
+                return None
+            if isinstance(v, dict):
+                samples = [[list(k), n] for (k, n) in v.iteritems()]
+            else:
+                samples = [[[], v]]
+            rslt = { "name":   self.name,
+                     "help":   self.help_text,
+                     "type":   self.TYPE,
+                     "labels": list(self.label_names),
+                     "samples": samples }
+        rslt["mode"] = self.mode
+        return rslt
+
+#------------------------------------------------------------------------------#
+class Histogram(_Metric):
+    """
+    @brief Distribution of observed values (e.g., request durations)
+
+    Values are counted in buckets with fixed upper bounds.  The value kept
+    for each label set is [list of counts per bucket (the last for values
+    above the largest bound), sum of values, number of values].
+    """
+    TYPE = "histogram"
+
+    def __init__(self, name, help_text, label_names, buckets=DEFAULT_BUCKETS):
+        """
+        @brief Constructor
+        @param name string metric name
+        @param help_text string description of metric
+        @param label_names tuple of label name strings
+        @param buckets sequence of increasing bucket upper bounds
+        """
+        _Metric.__init__(self, name, help_text, label_names)
+        self.buckets = tuple(buckets)
+        return
+
+    def observe(self, value, labels=()):
+        """
+        @brief Record a value
+        @param value integer or float value
+        @param labels sequence of label values
+        @return (none)
+        """
+        key = self._key(labels)
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            v = self.values.get(key)
+            if v is None:
+                v = [[0] * (len(self.buckets) + 1), 0, 0]
+                self.values[key] = v
+            v[0][i] += 1
+            v[1] += value
+            v[2] += 1
+        return
+
+    def collect(self, functions=True):
+        with self.lock:
+            samples = [[list(k), [list(v[0]), v[1], v[2]]]
+                       for (k, v) in self.values.iteritems()]
+        return { "name":    self.name,
+                 "help":    self.help_text,
+                 "type":    self.TYPE,
+                 "labels":  list(self.label_names),
+                 "buckets": list(self.buckets),
+                 "samples": samples }
+
+#===============================================================================#
+class MetricsRegistry(object):
+    """
+    @brief The set of metrics kept by a process
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        ##@var metrics
+        # OrderedDict metric name -> metric instance in order of creation
+        self.metrics = OrderedDict()
+        return
+
+    def _get_or_create(self, cls, name, *args):
+        """
+        @brief Find an existing metric or create a new one
+        @param cls class of metric
+        @param name string metric name
+        @param args further arguments for constructor
+        @return metric instance
+        @throw ValueError if there is a metric with the name of another type
+        """
+        with self.lock:
+            m = self.metrics.get(name)
+            if m is None:
+                m = cls(name, *args)
+                self.metrics[name] = m
+            elif not isinstance(m, cls):
+                raise ValueError("Metric %s already registered as %s" %
+                                 (name, m.TYPE))
+        return m
+
+    def counter(self, name, help_text, label_names=()):
+        """
+        @brief Get the counter with the given name, creating it if needed
+        @param name string metric name (should end in _total)
+        @param help_text string description
+        @param label_names sequence of label names
+        @return Counter instance
+        """
+        return self._get_or_create(Counter, name, help_text, label_names)
+
+    def gauge(self, name, help_text, label_names=(), mode=GAUGE_SUM):
+        """
+        @brief Get the gauge with the given name, creating it if needed
+        @param name string metric name
+        @param help_text string description
+        @param label_names sequence of label names
+        @param mode string GAUGE_SUM or GAUGE_MAX
+        @return Gauge instance
+        """
+        return self._get_or_create(Gauge, name, help_text, label_names, mode)
+
+    def histogram(self, name, help_text, label_names=(),
+                  buckets=DEFAULT_BUCKETS):
+        """
+        @brief Get the histogram with the given name, creating it if needed
+        @param name string metric name
+        @param help_text string description
+        @param label_names sequence of label names
+        @param buckets sequence of increasing bucket upper bounds
+        @return Histogram instance
+        """
+        return self._get_or_create(Histogram, name, help_text, label_names,
+                                   buckets)
+
+    def collect(self, functions=True):
+        """
+        @brief Snapshot all the metrics
+        @param functions boolean True if gauge functions should be evaluated
+        @return list of metric dictionaries (see _Metric.collect)
+        """
+        with self.lock:
+            metrics = self.metrics.values()
+        rslt = []
+        for m in metrics:
+            d = m.collect(functions)
+            if d is not None:
+                rslt.append(d)
+        return rslt
+
+#===============================================================================#
+def merge_snapshots(snapshots):
+    """
+    @brief Combine metric snapshots from several processes
+    @param snapshots list of 2-tuples (boolean True if process is running,
+                     list of metric dictionaries from MetricsRegistry.collect)
+    @return list of merged metric dictionaries in order of first appearance
+    """
+    merged = OrderedDict()
+    for (alive, metrics) in snapshots:
+        for m in metrics:
+            if (m["type"] == "gauge") and not alive:
+                continue
+            tgt = merged.get(m["name"])
+            if tgt is None:
+                tgt = dict(m)
+                tgt["samples"] = OrderedDict()
+                merged[m["name"]] = tgt
+            elif (tgt["type"] != m["type"]) or \
+                 (tgt.get("buckets") != m.get("buckets")):
+                # Inconsistent definitions (e.g., mixed versions) - keep first
+                continue
+            samples = tgt["samples"]
+            for (labels, v) in m["samples"]:
+                key = tuple(labels)
+                old = samples.get(key)
+                if old is None:
+                    if m["type"] == "histogram":
+                        v = [list(v[0]), v[1], v[2]]
+                    samples[key] = v
+                elif m["type"] == "histogram":
+                    old[0] = [a + b for (a, b) in zip(old[0], v[0])]
+                    old[1] += v[1]
+                    old[2] += v[2]
+                elif m.get("mode") == GAUGE_MAX:
+                    samples[key] = max(old, v)
+                else:
+                    samples[key] = old + v
+    return merged.values()
+
+#------------------------------------------------------------------------------#
+def render_text(metrics):
+    """
+    @brief Format metrics in Prometheus text exposition format
+    @param metrics list of metric dictionaries with samples as a dictionary
+                   tuple of label values -> value (see merge_snapshots)
+    @return string report
+    """
+    lines = []
+    for m in metrics:
+        name = m["name"]
+        names = m["labels"]
+        lines.append("# HELP %s %s" % (name, m["help"].replace("\\", "\\\\").
+                                                      replace("\n", "\\n")))
+        lines.append("# TYPE %s %s" % (name, m["type"]))
+        for (labels, v) in sorted(m["samples"].iteritems()):
+            if m["type"] != "histogram":
+                lines.append("%s%s %s" % (name, _label_str(names, labels),
+                                          _num_str(v)))
+                continue
+            (counts, total, n) = v
+            cumulative = 0
+            for (bound, c) in zip(m["buckets"] + [float("inf")], counts):
+                cumulative += c
+                lines.append("%s_bucket%s %d" %
+                             (name,
+                              _label_str(names, labels,
+                                         ("le", _num_str(float(bound)))),
+                              cumulative))
+            lines.append("%s_sum%s %s" % (name, _label_str(names, labels),
+                                          _num_str(total)))
+            lines.append("%s_count%s %d" % (name, _label_str(names, labels), n))
+    lines.append("")
+    return "\n".join(lines)
+
+#------------------------------------------------------------------------------#
+def timed_call(function):
+    """
+    @brief Time a call (e.g., for a gauge function measuring latency)
+    @param function callable with no arguments
+    @return float seconds taken by the call
+    """
+    t0 = time.time()
+    function()
+    return time.time() - t0
+
+#------------------------------------------------------------------------------#
+def stats_by_label(stats):
+    """
+    @brief Convert a dictionary of statistics for a labelled gauge function
+    @param stats dictionary of statistic names and values (e.g., the
+                 result of a stats() method)
+    @return dictionary tuple (statistic name,) -> value
+    """
+    return dict([((k,), v) for (k, v) in stats.iteritems()])
+
+#------------------------------------------------------------------------------#
+def method_label(handler):
+    """
+    @brief Label for the request metrics giving the method of a request
+    @param handler request handler instance with command attribute
+    @return string method if the handler has a do_<method> function for
+            it, otherwise OTHER_METHOD
+
+    The method comes from the client so any unsupported method is lumped
+    into OTHER_METHOD to keep the number of labels small.
+    """
+    command = handler.command
+    if command and hasattr(handler, "do_" + command):
+        return command
+    return OTHER_METHOD
+
+#------------------------------------------------------------------------------#
+def shm_name_for(storage_root):
+    """
+    @brief Make the shared memory segment name for servers sharing a cache
+    @param storage_root string pathname of the cache storage root
+    @return string posix_ipc name
+    """
+    return "/netinf_metrics_%s" % \
+           hashlib.sha1(os.path.abspath(storage_root)).hexdigest()[:16]
+
+#===============================================================================#
+class MetricsExporter(object):
+    """
+    @brief Produce the metrics report for a process, optionally including
+           the other processes sharing a shared memory segment
+    """
+    def __init__(self, logger, registry=None, shm_name=None):
+        """
+        @brief Constructor
+        @param logger object logger instance to output messages
+        @param registry MetricsRegistry instance (default REGISTRY)
+        @param shm_name string posix_ipc name for shared memory segment and
+                        semaphore used to aggregate over processes, or None
+                        to report only this process
+
+        If the posix_ipc module is not available or the segment cannot be
+        opened only this process is reported.
+        """
+        self.logger = logger
+        self.registry = registry if registry is not None else REGISTRY
+        self.shm = None
+        self.sem = None
+        self.map = None
+        self.slot = None
+        self.pid = None
+        self.publish_lock = threading.Lock()
+        ##@var dirty
+        # boolean True if requests have finished since the last snapshot
+        self.dirty = False
+        ##@var publisher_pid
+        # integer process id for which the publisher thread was started
+        self.publisher_pid = None
+        if shm_name is None:
+            return
+        if not pipc_loaded:
+            logger.warn("posix_ipc not available - metrics for this process only")
+            return
+        try:
+            self.sem = pipc.Semaphore(shm_name, flags=pipc.O_CREAT,
+                                      mode=0600, initial_value=1)
+            self.shm = pipc.SharedMemory(shm_name, flags=pipc.O_CREAT,
+                                         mode=0600,
+                                         size=SHM_SLOTS * SHM_SLOT_SIZE)
+            self.map = mmap.mmap(self.shm.fd, self.shm.size)
+            self.shm.close_fd()
+        except Exception, e:
+            logger.error("Unable to open metrics shared memory %s: %s" %
+                         (shm_name, str(e)))
+            self.shm = None
+            self.map = None
+        return
+
+    def shared(self):
+        """
+        @brief Check if metrics are aggregated through shared memory
+        @return boolean True if shared memory segment is in use
+        """
+        return self.map is not None
+
+    def _claim_slot(self):
+        """
+        @brief Find a slot for this process - must be called holding sem
+        @return integer slot index or None if all slots are in use
+
+        Slots that have never been used are preferred so that the counters
+        of processes that have gone away are kept as long as possible.
+        """
+        pid = os.getpid()
+        free = None
+        dead = None
+        for i in xrange(SHM_SLOTS):
+            (slot_pid, length) = struct.unpack_from(SHM_SLOT_HDR, self.map,
+                                                    i * SHM_SLOT_SIZE)
+            if slot_pid == pid:
+                return i
+            if slot_pid == 0:
+                if free is None:
+                    free = i
+            elif (dead is None) and not self._alive(slot_pid):
+                dead = i
+        if free is None:
+            free = dead
+        if free is not None:
+            struct.pack_into(SHM_SLOT_HDR, self.map, free * SHM_SLOT_SIZE,
+                             pid, 0)
+        return free
+
+    def _alive(self, pid):
+        """
+        @brief Check if a process is still running
+        @param pid integer process id
+        @return boolean True if process exists
+        """
+        try:
+            os.kill(pid, 0)
+        except OSError, e:
+            return e.errno != 3     # ESRCH
+        return True
+
+    def request_done(self):
+        """
+        @brief Note that a request has finished so that the publisher thread
+               writes a new snapshot
+        @return (none)
+
+        The publisher thread is started on the first call in each process
+        (threads do not survive a fork).
+        """
+        if self.map is None:
+            return
+        self.dirty = True
+        if self.publisher_pid != os.getpid():
+            with self.publish_lock:
+                if self.publisher_pid != os.getpid():
+                    self.publisher_pid = os.getpid()
+                    t = threading.Thread(target=self._publisher,
+                                         name="Metrics publisher")
+                    t.setDaemon(True)
+                    t.start()
+        return
+
+    def _publisher(self):
+        """
+        @brief Publisher thread - write a snapshot every PUBLISH_INTERVAL
+               if any requests have finished
+        @return (none)
+        """
+        while self.map is not None:
+            time.sleep(PUBLISH_INTERVAL)
+            if self.dirty:
+                self.dirty = False
+                self.publish()
+        return
+
+    def publish(self):
+        """
+        @brief Write a snapshot of this process' metrics to its slot
+        @return (none)
+        """
+        if self.map is None:
+            return
+        self.publish_lock.acquire()
+        try:
+            js = json.dumps(self.registry.collect(functions=False))
+            hdr_len = struct.calcsize(SHM_SLOT_HDR)
+            if len(js) > SHM_SLOT_SIZE - hdr_len:
+                self.logger.warn("Metrics snapshot too large for shared memory (%d)" %
+                                 len(js))
+                return
+            self.sem.acquire()
+            try:
+                if (self.slot is None) or (self.pid != os.getpid()):
+                    self.pid = os.getpid()
+                    self.slot = self._claim_slot()
+                    if self.slot is None:
+                        self.logger.warn("No free slot in metrics shared memory")
+                        return
+                base = self.slot * SHM_SLOT_SIZE
+                self.map[base + hdr_len:base + hdr_len + len(js)] = js
+                struct.pack_into(SHM_SLOT_HDR, self.map, base,
+                                 self.pid, len(js))
+            finally:
+                self.sem.release()
+        except Exception, e:
+            self.logger.error("Unable to publish metrics: %s" % str(e))
+        finally:
+            self.publish_lock.release()
+        return
+
+    def snapshots(self):
+        """
+        @brief Read the snapshots of the other processes from shared memory
+        @return list of 2-tuples (boolean process running, list of metric
+                dictionaries) - empty if shared memory is not in use
+        """
+        rslt = []
+        if self.map is None:
+            return rslt
+        hdr_len = struct.calcsize(SHM_SLOT_HDR)
+        pid = os.getpid()
+        blocks = []
+        self.sem.acquire()
+        try:
+            for i in xrange(SHM_SLOTS):
+                base = i * SHM_SLOT_SIZE
+                (slot_pid, length) = struct.unpack_from(SHM_SLOT_HDR,
+                                                        self.map, base)
+                if (slot_pid == 0) or (slot_pid == pid) or (length == 0):
+                    continue
+                blocks.append((slot_pid,
+                               self.map[base + hdr_len:base + hdr_len + length]))
+        finally:
+            self.sem.release()
+        for (slot_pid, js) in blocks:
+            try:
+                rslt.append((self._alive(slot_pid), json.loads(js)))
+            except ValueError:
+                self.logger.warn("Bad metrics snapshot for process %d" %
+                                 slot_pid)
+        return rslt
+
+    def render(self):
+        """
+        @brief Generate the metrics report
+        @return string report in Prometheus text format
+
+        The snapshot for this process is taken afresh (including gauge
+        functions) and also published so other processes see it.
+        """
+        self.publish()
+        snaps = [(True, self.registry.collect())] + self.snapshots()
+        return render_text(merge_snapshots(snaps))
+
+    def close(self, unlink=False):
+        """
+        @brief Stop using shared memory
+        @param unlink boolean True if segment and semaphore should be removed
+        @return (none)
+        """
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+            if unlink:
+                try:
+                    self.shm.unlink()
+                    self.sem.unlink()
+                except Exception:
+                    pass
+            self.sem.close()
+        return
+
+#===============================================================================#
+##@var REGISTRY
+# MetricsRegistry instance for this process
+REGISTRY = MetricsRegistry()
+
+#- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -#
+# Metrics maintained by the server modules
+
+##@var REQUESTS
+# Counter of HTTP requests handled by method
+REQUESTS = REGISTRY.counter("netinf_requests_total",
+                            "HTTP requests handled.", ("method",))
+
+##@var REQUESTS_IN_PROGRESS
+# Gauge of requests being handled
+REQUESTS_IN_PROGRESS = REGISTRY.gauge("netinf_requests_in_progress",
+                                      "HTTP requests being handled.")
+
+##@var REQUEST_SECONDS
+# Histogram of time taken to handle requests by method
+REQUEST_SECONDS = REGISTRY.histogram("netinf_request_duration_seconds",
+                                     "Time taken to handle HTTP requests.",
+                                     ("method",))
+
+##@var RESPONSE_BYTES
+# Counter of response body octets sent
+RESPONSE_BYTES = REGISTRY.counter("netinf_response_body_bytes_total",
+                                  "Octets sent in HTTP response bodies.")
+
+##@var CACHE_LOOKUPS
+# Counter of NDO cache lookups by result (hit or miss)
+CACHE_LOOKUPS = REGISTRY.counter("netinf_cache_lookups_total",
+                                 "NDO cache lookups.", ("result",))
+
+##@var FORWARD_ATTEMPTS
+# Counter of requests forwarded to each next hop
+FORWARD_ATTEMPTS = REGISTRY.counter("netinf_forward_attempts_total",
+                                    "GET requests forwarded to next hop.",
+                                    ("nexthop",))
+
+##@var FORWARD_SUCCESSES
+# Counter of forwarded requests for which the next hop supplied the NDO
+FORWARD_SUCCESSES = REGISTRY.counter("netinf_forward_successes_total",
+                                     "Forwarded GET requests answered by next hop.",
+                                     ("nexthop",))
+
+##@var PHASE_SECONDS
+# Histogram of time spent in each request phase (see nitiming.py)
+PHASE_SECONDS = REGISTRY.histogram("netinf_request_phase_seconds",
+                                   "Time spent in each phase of a request.",
+                                   ("phase",))
+
+##@var HANDLER_THREADS
+# Gauge of running handler threads (standalone server)
+HANDLER_THREADS = REGISTRY.gauge("netinf_handler_threads",
+                                 "Running HTTP handler threads.")
+
+##@var DTN_REQUESTS
+# Gauge of requests in progress in the HTTP<->DTN gateway
+DTN_REQUESTS = REGISTRY.gauge("netinf_dtn_requests_in_progress",
+                              "Requests being handled by the DTN gateway.")
+
+##@var DTN_RESPONSE_QUEUE
+# Gauge of messages waiting to be sent into the DTN network
+DTN_RESPONSE_QUEUE = REGISTRY.gauge("netinf_dtn_response_queue_length",
+                                    "Messages queued for the DTN network.")
+
+##@var REDIS_PING_SECONDS
+# Gauge of Redis round trip time measured when metrics are scraped
+REDIS_PING_SECONDS = REGISTRY.gauge("netinf_redis_ping_seconds",
+                                    "Redis PING round trip time.",
+                                    mode=GAUGE_MAX)
+
+##@var FWD_NEG_CACHE
+# Gauge of forwarding negative cache entries and counters by statistic
+# (see niforward.NegativeCache.stats)
+FWD_NEG_CACHE = REGISTRY.gauge("netinf_fwd_negative_cache",
+                               "Forwarding negative cache statistics.",
+                               ("stat",))
+
+#==============================================================================#
+# TESTING CODE
+#==============================================================================#
+if __name__ == "__main__":
+    import logging
+    logger = logging.getLogger("test")
+    logger.setLevel(logging.DEBUG)
+    ch = logging.StreamHandler()
+    logger.addHandler(ch)
+
+    errs = 0
+    reg = MetricsRegistry()
+    c = reg.counter("test_requests_total", "Requests.", ("method",))
+    c.inc(labels=("GET",))
+    c.inc(2, labels=("GET",))
+    c.inc(labels=("POST",))
+    if reg.counter("test_requests_total", "Requests.", ("method",)) is not c:
+        print "Counter not reused"
+        errs += 1
+    try:
+        reg.gauge("test_requests_total", "Wrong.")
+        print "Type clash not detected"
+        errs += 1
+    except ValueError:
+        pass
+    try:
+        c.inc()
+        print "Missing labels not detected"
+        errs += 1
+    except ValueError:
+        pass
+    g = reg.gauge("test_queue", "Queue.")
+    g.inc(5)
+    g.dec(2)
+    f = reg.gauge("test_threads", "Threads.")
+    f.set_function(lambda: 7)
+    st = reg.gauge("test_stats", "Stats.", ("stat",))
+    st.set_function(lambda: stats_by_label({ "hits": 2, "entries": 5 }))
+    h = reg.histogram("test_seconds", "Time.", buckets=(0.1, 1.0))
+    for v in (0.05, 0.1, 0.5, 2.0):
+        h.observe(v)
+
+    text = render_text(merge_snapshots([(True, reg.collect())]))
+    print text
+    for line in ('test_requests_total{method="GET"} 3',
+                 'test_requests_total{method="POST"} 1',
+                 'test_queue 3',
+                 'test_threads 7',
+                 'test_stats{stat="hits"} 2',
+                 'test_stats{stat="entries"} 5',
+                 'test_seconds_bucket{le="0.1"} 2',
+                 'test_seconds_bucket{le="1.0"} 3',
+                 'test_seconds_bucket{le="+Inf"} 4',
+                 'test_seconds_count 4'):
+        if line not in text.split("\n"):
+            print "Missing line: %s" % line
+            errs += 1
+
+    # Two processes - one running, one gone
+    snap = reg.collect(functions=False)
+    if "test_threads" in [m["name"] for m in snap]:
+        print "Function gauge published"
+        errs += 1
+    merged = merge_snapshots([(True, reg.collect()), (True, snap),
+                              (False, snap)])
+    text = render_text(merged).split("\n")
+    for line in ('test_requests_total{method="GET"} 9',
+                 'test_queue 6',
+                 'test_threads 7',
+                 'test_seconds_count 12'):
+        if line not in text:
+            print "Missing merged line: %s" % line
+            errs += 1
+
+    if pipc_loaded:
+        name = "/netinf_metrics_test_%d" % os.getpid()
+        exp = MetricsExporter(logger, reg, name)
+        if exp.shared():
+            pid = os.fork()
+            if pid == 0:
+                c.inc(10, labels=("GET",))
+                exp.publish()
+                os._exit(0)
+            os.waitpid(pid, 0)
+            text = exp.render().split("\n")
+            # Child has exited: its counters remain, its gauges go
+            for line in ('test_requests_total{method="GET"} 16',
+                         'test_queue 3'):
+                if line not in text:
+                    print "Missing shared line: %s" % line
+                    errs += 1
+            exp.close(unlink=True)
+    else:
+        print "posix_ipc not available - shared memory not tested"
+
+    print "Tests completed with %d errors" % errs
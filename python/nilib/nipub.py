@@ -45,7 +45,7 @@ import os.path
 import  random
 from optparse import OptionParser
 import urllib2
-import magic
+from ctype_detect import ctype_detector
 import json
 
 import mimetools
@@ -286,8 +286,7 @@ def py_nipub():
             sys.exit(-5)
 
         # Guess the mimetype of the file
-        m = magic.Magic(mime=True)
-        ctype = m.from_file(options.file_name)
+        ctype = ctype_detector.from_fileobj(f)
         debug("Content-Type: %s" % ctype)
         if ctype is None:
             # Guessing didn't work - default
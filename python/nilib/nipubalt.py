@@ -47,10 +47,11 @@ import os.path
 import  random
 from optparse import OptionParser
 import urllib2
-import magic
+from ctype_detect import ctype_detector
 import json
 
-import dtnapi
+# dtnapi is imported in publish_with_dtn so that HTTP operations work where
+# the DTN2 Python API is not installed
 from dtn_api_const import QUERY_EXTENSION_BLOCK, METADATA_BLOCK
 
 import mimetools
@@ -151,8 +152,7 @@ def publish_with_http(ni_name, destination, authority, hash_alg, ext, locs,
                                  (file_name, str(e)), -11)
 
         # Guess the mimetype of the file
-        m = magic.Magic(mime=True)
-        ctype = m.from_file(file_name)
+        ctype = ctype_detector.from_fileobj(f)
         debug("Content-Type: %s" % ctype)
         if ctype is None:
             # Guessing didn't work - default
@@ -309,8 +309,7 @@ def publish_with_dtn(ni_name, destination, authority, hash_alg, ext_json, locs,
                                       ni_errs_txt[rv]), -21)
 
         # Guess the mimetype of the file
-        m = magic.Magic(mime=True)
-        ctype = m.from_file(file_name)
+        ctype = ctype_detector.from_file(file_name)
         debug("Content-Type: %s" % ctype)
         if ctype is None:
             # Guessing didn't work - default
@@ -334,6 +333,8 @@ def publish_with_dtn(ni_name, destination, authority, hash_alg, ext_json, locs,
     ext_json["fullPut"] = full_put
     ext_json["rform"] = rform
     
+    import dtnapi
+
     # Create a connection to the DTN daemon
     dtn_handle = dtnapi.dtn_open()
     if dtn_handle == -1:
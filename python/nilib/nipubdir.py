@@ -39,7 +39,7 @@ import os
 import  random
 from optparse import OptionParser
 import urllib2
-import magic
+from ctype_detect import ctype_detector
 import json
 import platform
 import time
@@ -100,10 +100,11 @@ def nilog(string):
 
 
 #===============================================================================#
-def pubone(file_name,alg,host):
+def pubone(file_name,alg,host,chunked=False):
     """
     @brief Do a NetInf PUBLISH for one file
     @param file_name is the file to do now
+    @param chunked if True send the form with chunked transfer encoding
     """
 
     hash_alg=alg
@@ -129,8 +130,7 @@ def pubone(file_name,alg,host):
        debug("Cannot open file %s: Error: %s" %(file_name, str(e)))
        return
     # Guess the mimetype of the file
-    m = magic.Magic(mime=True)
-    ctype = m.from_file(file_name)
+    ctype = ctype_detector.from_fileobj(f)
     debug("Content-Type: %s" % ctype)
     if ctype is None:
         # Guessing didn't work - default
@@ -143,9 +143,11 @@ def pubone(file_name,alg,host):
                                  filename=file_name,
                                  digester = ni_digester)
     # Make dictionary that will dynamically retrieve ni URI when it has been made
-    uri_dict = { "generator": octet_param.get_url,
-                     "length": (len(ni_digester.get_url()) + len(";") +
-                                ni_digester.get_b64_encoded_length())}
+    # (the length is only needed if the form size must be known in advance)
+    uri_dict = { "generator": octet_param.get_url }
+    if not chunked:
+        uri_dict["length"] = (len(ni_digester.get_url()) + len(";") +
+                              ni_digester.get_b64_encoded_length())
     msgid=str(random.randint(1, 2**64)) 
     param_list = [octet_param,
                       ("URI",      uri_dict),
@@ -154,7 +156,7 @@ def pubone(file_name,alg,host):
                       ("fullPut",   "yes"),
                       ("rform",  rform)]
     # Construct data generator and header strings
-    datagen, headers = multipart_encode(param_list)
+    datagen, headers = multipart_encode_vectored(param_list, chunked=chunked)
     if verbose:
         debug("Parameters prepared: %s"% "".join(datagen))
 
@@ -246,7 +248,7 @@ def getres(uri):
     
 
 #===============================================================================#
-def pubdirs(path,alg,host,mprocs,limit):
+def pubdirs(path,alg,host,mprocs,limit,chunked=False):
     from os.path import join
     count = 0
     goodlist = []
@@ -260,10 +262,10 @@ def pubdirs(path,alg,host,mprocs,limit):
     for root, dirs, files in os.walk(path):
         for name in files:
             if multi:
-                pool.apply_async(pubone,args=(join(root,name),alg,host),callback=getres)
+                pool.apply_async(pubone,args=(join(root,name),alg,host,chunked),callback=getres)
                 niuri=resuri
             else:
-                niuri=pubone(join(root,name),alg,host)
+                niuri=pubone(join(root,name),alg,host,chunked)
             if niuri is None:
                 badlist.append(join(root,name))
             else:
@@ -303,7 +305,7 @@ def py_nipubdir():
     
 
     # Options parsing and verification stuff
-    usage = "%%prog -d <pathname of content directory> -n <FQDN of netinf node> [-a <hash alg>] [-m NN] [-c count]"
+    usage = "%%prog -d <pathname of content directory> -n <FQDN of netinf node> [-a <hash alg>] [-m NN] [-c count] [-k]"
 
     parser = OptionParser(usage)
     
@@ -322,6 +324,9 @@ def py_nipubdir():
     parser.add_option("-c", "--count", dest="count", default=0,
                       type="int",
                       help="The number of files to publish (default: all)")
+    parser.add_option("-k", "--chunked", dest="chunked", default=False,
+                      action="store_true",
+                      help="Send forms with chunked transfer encoding.")
 
     (options, args) = parser.parse_args()
 
@@ -344,7 +349,7 @@ def py_nipubdir():
             % (options.dir_name,options.host,options.hash_alg,options.mprocs,options.count))
 
     # loop over all files below directory and putone() for each we find
-    count,goodlist,badlist=pubdirs(options.dir_name,options.hash_alg,options.host,options.mprocs,options.count)
+    count,goodlist,badlist=pubdirs(options.dir_name,options.hash_alg,options.host,options.mprocs,options.count,options.chunked)
 
     # print goodlist
     # print badlist
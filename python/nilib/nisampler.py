@@ -0,0 +1,335 @@
+#!/usr/bin/python
+"""
+@package nilib
+@file nisampler.py
+@brief Sampling profiler for the handler threads of a running NetInf server
+@version Copyright (C) 2012 Trinity College Dublin and Folly Consulting Ltd
+      This is an adjunct to the NI URI library developed as
+      part of the SAIL project. (http://sail-project.eu)
+
+      Specification(s) - note, versions may change
+          - http://tools.ietf.org/html/draft-farrell-decade-ni-10
+          - http://tools.ietf.org/html/draft-hallambaker-decade-ni-params-03
+          - http://tools.ietf.org/html/draft-kutscher-icnrg-netinf-proto-00
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+       - http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+===============================================================================#
+
+@details
+The SamplingProfiler runs in its own thread and, every few milliseconds,
+takes a snapshot of the Python stack of every thread whose name starts with
+a given prefix (by default the "NI HTTP handler - n" threads created in
+httpshim.py).  Nothing is installed in the profiled threads (unlike the
+profile and cProfile modules) so the overhead is limited to the sampler
+thread holding the GIL while it walks the stacks, and the server can be
+profiled under real load without restarting it.
+
+At the end of the run the samples are written out in the 'collapsed stack'
+format used by flamegraph.pl (and speedscope etc.): one line per distinct
+stack with the frames from the outermost inwards separated by semicolons
+followed by the number of times the stack was seen, e.g.,
+
+    run (threading.py:752);handle (httpshim.py:386);do_GET (nihandler.py:710) 12
+
+Frames are labelled with the function name, the file name and the line on
+which the function starts, so that all samples taken in one function are
+merged whichever line was executing.
+
+niserver_main.py starts and stops the profiler in response to commands sent
+to the control port (see niserver_stop.py).
+"""
+import os
+import sys
+import time
+import threading
+
+#===============================================================================#
+# List of classes/global functions in file
+__all__ = ['SamplingProfiler', 'DEFAULT_INTERVAL', 'DEFAULT_DURATION',
+           'MAX_DURATION', 'HANDLER_THREAD_PREFIX']
+
+#===============================================================================#
+##@var DEFAULT_INTERVAL
+# Time between samples in seconds
+DEFAULT_INTERVAL = 0.005
+
+##@var DEFAULT_DURATION
+# Length of a profiling run in seconds if none is specified
+DEFAULT_DURATION = 30
+
+##@var MAX_DURATION
+# Upper limit on the length of a profiling run in seconds
+MAX_DURATION = 3600
+
+##@var HANDLER_THREAD_PREFIX
+# Start of the names given to the handler threads in httpshim.py
+HANDLER_THREAD_PREFIX = "NI HTTP handler"
+
+#===============================================================================#
+class SamplingProfiler(object):
+    """
+    @brief Periodically sample the stacks of the server's handler threads
+
+    Only one run can be in progress at once.  A run ends either when its
+    duration expires or when stop is called; the collapsed stacks are then
+    written to the output file by the sampler thread.
+    """
+    ##@var logger
+    # object logger instance to output messages
+
+    ##@var interval
+    # float time between samples in seconds
+
+    ##@var thread_prefix
+    # string start of the names of the threads to be sampled (None for all)
+
+    ##@var lock
+    # object Lock instance serializing start and stop
+
+    ##@var sampler
+    # object Thread instance running the current profile (None if idle)
+
+    ##@var stopping
+    # boolean set to end the current run early
+
+    #--------------------------------------------------------------------------#
+    def __init__(self, logger, interval=DEFAULT_INTERVAL,
+                 thread_prefix=HANDLER_THREAD_PREFIX):
+        """
+        @brief Constructor
+        @param logger object logger instance to output messages
+        @param interval float time between samples in seconds
+        @param thread_prefix string start of names of threads to be sampled
+                             or None to sample every thread but the sampler
+        """
+        self.logger = logger
+        self.interval = interval
+        self.thread_prefix = thread_prefix
+        self.lock = threading.Lock()
+        self.sampler = None
+        self.stopping = False
+        return
+
+    #--------------------------------------------------------------------------#
+    def running(self):
+        """
+        @brief Check if a profiling run is in progress
+        @return boolean True if the sampler thread is running
+        """
+        with self.lock:
+            return (self.sampler is not None) and self.sampler.isAlive()
+
+    #--------------------------------------------------------------------------#
+    def start(self, duration, out_file):
+        """
+        @brief Start a profiling run
+        @param duration float length of the run in seconds
+        @param out_file string path name of file for the collapsed stacks
+                        (an existing file is never overwritten - the
+                        profile is not written if it is already there)
+        @return boolean True if the run was started, False if one is already
+                in progress
+        @throw ValueError if the duration is not in 0 < duration <= MAX_DURATION
+        """
+        if (duration <= 0) or (duration > MAX_DURATION):
+            raise ValueError("Profile duration must be greater than 0 and "
+                             "at most %d seconds" % MAX_DURATION)
+        with self.lock:
+            if (self.sampler is not None) and self.sampler.isAlive():
+                return False
+            self.stopping = False
+            self.sampler = threading.Thread(target=self._sample,
+                                            args=(duration, out_file),
+                                            name="Sampling profiler")
+            self.sampler.setDaemon(True)
+            self.sampler.start()
+        self.logger.info("Sampling profiler started for %.1f seconds "
+                         "writing to %s" % (duration, out_file))
+        return True
+
+    #--------------------------------------------------------------------------#
+    def stop(self, wait=True):
+        """
+        @brief End the current profiling run early
+        @param wait boolean if True, wait until the output file has been written
+        @return boolean True if a run was in progress
+        """
+        with self.lock:
+            sampler = self.sampler
+            if (sampler is None) or not sampler.isAlive():
+                return False
+            self.stopping = True
+        if wait:
+            sampler.join()
+        return True
+
+    #--------------------------------------------------------------------------#
+    def _sample(self, duration, out_file):
+        """
+        @brief Body of sampler thread - collect stacks and write them out
+        @param duration float length of the run in seconds
+        @param out_file string path name of file for the collapsed stacks
+        @return (none)
+
+        Frame labels are cached by code object so that each sample costs
+        little more than a dictionary lookup per frame.
+        """
+        me = threading.currentThread().ident
+        prefix = self.thread_prefix
+        interval = self.interval
+        labels = {}
+        stacks = {}
+        samples = 0
+        end_time = time.time() + duration
+        while (not self.stopping) and (time.time() < end_time):
+            if prefix is None:
+                names = None
+            else:
+                names = dict((t.ident, t.getName())
+                             for t in threading.enumerate())
+            for (ident, frame) in sys._current_frames().iteritems():
+                if ident == me:
+                    continue
+                if (names is not None) and \
+                   not names.get(ident, "").startswith(prefix):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    label = labels.get(code)
+                    if label is None:
+                        label = "%s (%s:%d)" % (code.co_name,
+                                                os.path.basename(code.co_filename),
+                                                code.co_firstlineno)
+                        labels[code] = label
+                    stack.append(label)
+                    frame = frame.f_back
+                stack.reverse()
+                key = ";".join(stack)
+                stacks[key] = stacks.get(key, 0) + 1
+            del frame
+            samples += 1
+            time.sleep(interval)
+
+        try:
+            fd = os.open(out_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+            f = os.fdopen(fd, "w")
+            try:
+                for key in sorted(stacks):
+                    f.write("%s %d\n" % (key, stacks[key]))
+            finally:
+                f.close()
+        except (IOError, OSError), e:
+            self.logger.error("Unable to write profile to %s: %s" %
+                              (out_file, str(e)))
+            return
+        self.logger.info("Sampling profiler wrote %d stacks (%d thread samples "
+                         "in %d sweeps) to %s" %
+                         (len(stacks), sum(stacks.itervalues()),
+                          samples, out_file))
+        return
+
+#==============================================================================#
+if __name__ == "__main__":
+    import logging
+    import tempfile
+    logging.basicConfig()
+    logger = logging.getLogger("test")
+    logger.setLevel(logging.INFO)
+
+    errs = 0
+    stop_spin = False
+
+    def spin_inner():
+        n = 0
+        while not stop_spin:
+            n += 1
+        return n
+
+    def spin_outer():
+        return spin_inner()
+
+    workers = []
+    for i in range(2):
+        t = threading.Thread(target=spin_outer,
+                             name="%s - %d" % (HANDLER_THREAD_PREFIX, i))
+        t.setDaemon(True)
+        t.start()
+        workers.append(t)
+    other = threading.Thread(target=time.sleep, args=(2,), name="Other")
+    other.setDaemon(True)
+    other.start()
+
+    out_file = tempfile.mktemp(suffix=".folded")
+    profiler = SamplingProfiler(logger, interval=0.002)
+    try:
+        profiler.start(0, out_file)
+        print "Zero duration accepted"
+        errs += 1
+    except ValueError:
+        pass
+    if not profiler.start(0.5, out_file):
+        print "Profiler did not start"
+        errs += 1
+    if profiler.start(0.5, out_file):
+        print "Second profiler run started while first in progress"
+        errs += 1
+    if not profiler.running():
+        print "Profiler not running"
+        errs += 1
+    time.sleep(0.3)
+    if not profiler.stop():
+        print "Stop did not find profiler running"
+        errs += 1
+    if profiler.running() or profiler.stop():
+        print "Profiler still running after stop"
+        errs += 1
+    stop_spin = True
+
+    lines = open(out_file).read().splitlines()
+    os.remove(out_file)
+    if len(lines) == 0:
+        print "No stacks written"
+        errs += 1
+    total = 0
+    for line in lines:
+        (stack, count) = line.rsplit(" ", 1)
+        total += int(count)
+        frames = stack.split(";")
+        if not frames[-1].startswith("spin_inner (nisampler.py:"):
+            print "Unexpected leaf frame: %s" % line
+            errs += 1
+        if not any(f.startswith("spin_outer ") for f in frames):
+            print "Caller missing from stack: %s" % line
+            errs += 1
+    if total < 20:
+        print "Too few samples: %d" % total
+        errs += 1
+    print lines[0] if lines else ""
+
+    # Run ending by itself, sampling all threads
+    out_file = tempfile.mktemp(suffix=".folded")
+    profiler = SamplingProfiler(logger, interval=0.002, thread_prefix=None)
+    profiler.start(0.2, out_file)
+    time.sleep(0.5)
+    if profiler.running():
+        print "Profiler did not stop at end of duration"
+        errs += 1
+    text = open(out_file).read()
+    os.remove(out_file)
+    if ("_sample (nisampler.py" in text) or ("<module>" not in text):
+        print "Unexpected stacks sampling all threads:\n%s" % text
+        errs += 1
+
+    print "Tests completed with %d errors" % errs
@@ -205,23 +205,11 @@ except ImportError:
 from BaseHTTPServer import HTTPServer
 from SocketServer import ThreadingMixIn
 
-import cgi
-import urllib
-import urllib2
-import hashlib
-import xml.etree.ElementTree as ET
-import base64
-
 #=== Modules needing special downloading
-import magic
-import DNS
-import qrcode
-
-try:
-    import redis
-    redis_loaded = True
-except ImportError:
-    redis_loaded = False
+# These are imported when they are first needed so that servers that do not
+# use the features they support do not pay for loading them:
+# - redis: see import_redis - NRS server, Redis cache or DTN gateway
+# - DNS: see ni_http_server - authority other than localhost
 
 #=== Local package modules ===
 
@@ -229,6 +217,15 @@ import netinf_ver
 import ni
 from nihandler import NIHTTPRequestHandler
 import niforward
+from nicoalesce import RequestCoalescer
+from nitiming import PhaseStats
+import nimetrics
+from nimetrics import MetricsExporter, timed_call, stats_by_label
+from nrs_cache import NRSLookupCache
+from search_index import NDOSearchIndex
+from cache_listing import SharedCacheListing
+from search_cache import SearchResultCache
+from qrcode_cache import QRCodeCache
 
 # NOTE: nidtnhttpgateway is imported if gateway is to be run - see below
 
@@ -236,11 +233,11 @@ import niforward
 # whether redis_store or file_store was imported.  Must have
 # Redis module if using Redis cache.
 if "redis_store" in sys.modules:
-    if not redis_loaded:
-        raise ImportError("Need Redis module if using Redis-based cache")
+    import redis
     from cache_redis import RedisNetInfCache as NetInfCache
     use_redis_cache = True
 else:
+    redis = None
     from cache_single import SingleNetInfCache as NetInfCache
     use_redis_cache = False
 
@@ -250,8 +247,8 @@ __all__ = ['NetInfMetaData', 'NIHTTPServer', 'ni_http_server']
 #==============================================================================#
 # GLOBAL VARIABLES
 
-##@var redis_loaded
-# Flag indicating if it was possible to load the Redis module.
+##@var redis
+# The redis module once it has been imported by import_redis (None before).
 # The program can do without Redis if not providing NRS services
 # and using filesystem cache.
 
@@ -259,6 +256,21 @@ __all__ = ['NetInfMetaData', 'NIHTTPServer', 'ni_http_server']
 # Flag indicating if the cache is using the Redis database mmechanism.
 # This is is true if the redis_store module had been loaded.
 
+#==============================================================================#
+def import_redis():
+    """
+    @brief Import the redis module the first time it is needed
+    @return redis module or None if it cannot be imported
+    """
+    global redis
+    if redis is None:
+        try:
+            import redis as redis_module
+        except ImportError:
+            return None
+        redis = redis_module
+    return redis
+
 #==============================================================================#
 
 class NIHTTPServer(ThreadingMixIn, HTTPServer):
@@ -318,6 +330,33 @@ class NIHTTPServer(ThreadingMixIn, HTTPServer):
     # object StrictRedis instance used for communication between the NRS server
     # and the Redis database.
 
+    ##@var nrs_cache
+    # object NRSLookupCache instance holding recently read NRS entries
+    # (or None if not using Redis).
+
+    ##@var cache_listing
+    # object SharedCacheListing instance updated by cache and used for listings
+
+    ##@var search_index
+    # object NDOSearchIndex instance updated by cache and used for searches
+
+    ##@var search_fallback
+    # boolean True if searches not satisfied locally use the external engine
+
+    ##@var search_cache
+    # object SearchResultCache instance - in Redis if available else memory
+
+    ##@var qrcode_cache
+    # object QRCodeCache instance holding rendered QRcode images
+
+    ##@var phase_stats
+    # object PhaseStats instance aggregating per-request phase times
+    # (or None if phase timing is disabled)
+
+    ##@var metrics
+    # object MetricsExporter reporting the counters in nimetrics.py for
+    # GET /netinfproto/metrics
+
     ##@var dtn_gateway_enabled
     # boolean True if run_gateway is True and the gateway was started
     #              successfully.
@@ -360,7 +399,8 @@ class NIHTTPServer(ThreadingMixIn, HTTPServer):
                  config, logger, getputform, nrsform, provide_nrs, favicon,
                  redis_db=0, run_gateway=False,
                  ni_router=False, default_route=None,
-                 request_aggregation=False):
+                 request_aggregation=False, search_fallback=True,
+                 phase_timing=False):
         """
         @brief Constructor for the NI HTTP threaded server.
         @param addr tuple two elements (<IP address>, <TCP port>) where server listens
@@ -376,6 +416,10 @@ class NIHTTPServer(ThreadingMixIn, HTTPServer):
         @param redis_db integer number of Redis database to use
                                 (if provide_nrs True or using Redis NDO cache)
         @param run_gateway boolean True if DTN<->HTTP functionality is enabled.
+        @param search_fallback boolean True if searches not matched in the
+                               local search index use the external engine
+        @param phase_timing boolean True if the time spent in each phase of
+                            a request is to be logged and aggregated
         @return (none)
 
         Save the parameters (except for addr) as instance variables.
@@ -419,6 +463,11 @@ class NIHTTPServer(ThreadingMixIn, HTTPServer):
         self.nrsform = nrsform
         self.provide_nrs = provide_nrs
         self.favicon = favicon
+        self.search_fallback = search_fallback
+        if phase_timing:
+            self.phase_stats = PhaseStats()
+        else:
+            self.phase_stats = None
         self.dtn_gateway_enabled = False
         self.dtn_gateway = None
 
@@ -433,7 +482,7 @@ class NIHTTPServer(ThreadingMixIn, HTTPServer):
         # Assume it is the default local_host, port 6379 for the time being
         if provide_nrs or use_redis_cache or run_gateway:
             try:
-                self.nrs_redis = redis.StrictRedis(db=redis_db)
+                self.nrs_redis = import_redis().StrictRedis(db=redis_db)
             except Exception, e:
                 logger.error("Unable to connect to Redis server: %s" % str(e))
                 sys.exit(-1)
@@ -447,6 +496,14 @@ class NIHTTPServer(ThreadingMixIn, HTTPServer):
         else:
             self.nrs_redis = None
 
+        # Local cache of NRS lookups - invalidations are shared through Redis
+        # pub/sub so that other servers using the same database see changes
+        if self.nrs_redis is not None:
+            self.nrs_cache = NRSLookupCache(self.nrs_redis, logger)
+            self.nrs_cache.start_listener()
+        else:
+            self.nrs_cache = None
+
         # If cache is using Redis, tell cache what the Redis connection is
         if hasattr(self.cache, "set_redis_conn"):
             if not self.cache.set_redis_conn(self.nrs_redis):
@@ -456,6 +513,25 @@ class NIHTTPServer(ThreadingMixIn, HTTPServer):
         if not self.cache.check_cache_dirs():
             sys.exit(-1)
 
+        # Listing of the cache in shared memory - built from the cache when
+        # the first server using it starts, then kept updated by cache_put
+        self.cache_listing = SharedCacheListing(self.storage_root, logger)
+        if self.cache_listing.attach(self.cache.cache_list):
+            self.cache.set_listing(self.cache_listing)
+
+        # Local search index over cached metadata - rebuild it from the
+        # cache if there isn't one yet, then keep it updated by cache_put
+        self.search_index = NDOSearchIndex(self.storage_root, logger)
+        if not self.search_index.exists():
+            self.search_index.rebuild(self.cache)
+        self.cache.set_search_index(self.search_index)
+
+        # Results of recent searches - shared through Redis if it is in use
+        self.search_cache = SearchResultCache(logger, self.nrs_redis)
+
+        # Rendered QRcode images - kept on disk beside the NDO cache
+        self.qrcode_cache = QRCodeCache(logger, self.storage_root)
+
         # If requested try to start HTTP<->DTN gateway
         if run_gateway:
             # Load gateway control module - this avoids pulling in
@@ -486,10 +562,44 @@ class NIHTTPServer(ThreadingMixIn, HTTPServer):
             logger.info("NI router initialised with " +
                         "default next-hop '{}'".format(default_route))
 
+        # Recent forwarding misses - shared by all handler threads
+        # Times to remember misses and number of entries from [forwarding]
+        neg_params = {}
+        conf_section = "forwarding"
+        if ((config is not None) and (config.has_section(conf_section))):
+            for (conf_option, param, conv) in \
+                (("negcache_notfound_ttl", "notfound_ttl", config.getfloat),
+                 ("negcache_timeout_ttl",  "timeout_ttl",  config.getfloat),
+                 ("negcache_max_entries",  "max_entries",  config.getint)):
+                if config.has_option(conf_section, conf_option):
+                    try:
+                        neg_params[param] = conv(conf_section, conf_option)
+                    except ValueError:
+                        logger.error("Value supplied for %s is not an "
+                                     "acceptable number - using default" %
+                                     conf_option)
+        self.fwd_neg_cache = niforward.NegativeCache(**neg_params)
+
+        # Metrics report - all the handlers are threads in this process
+        # so there is no need to aggregate through shared memory.
+        # The gauges for server state are computed when a report is made.
+        self.metrics = MetricsExporter(logger)
+        nimetrics.HANDLER_THREADS.set_function(self.running_thread_count)
+        nimetrics.FWD_NEG_CACHE.set_function(
+                            lambda: stats_by_label(self.fwd_neg_cache.stats()))
+        if self.nrs_redis is not None:
+            nimetrics.REDIS_PING_SECONDS.set_function(
+                                lambda: timed_call(self.nrs_redis.ping))
+        if self.dtn_gateway_enabled:
+            nimetrics.DTN_REQUESTS.set_function(
+                                lambda: len(self.dtn_gateway.http_action.curr_reqs))
+            nimetrics.DTN_RESPONSE_QUEUE.set_function(
+                                self.dtn_gateway.response_q.qsize)
+
         if request_aggregation:
             self.request_aggregation=True
-            self.requestlist = dict()
-            self.requestlock = threading.Lock()
+            # Single-flight table of NDO fetches in progress
+            self.coalescer = RequestCoalescer()
 
         self.running_threads = set()
         self.next_handler_num = 1
@@ -545,6 +655,15 @@ class NIHTTPServer(ThreadingMixIn, HTTPServer):
             if thread in self.running_threads:
                 self.running_threads.remove(thread)
 
+    #--------------------------------------------------------------------------#
+    def running_thread_count(self):
+        """
+        @brief Report the number of running handler threads
+        @return integer size of running_threads set (0 after end_run)
+        """
+        with self.thread_running_lock:
+            return len(getattr(self, "running_threads", ()))
+
     #--------------------------------------------------------------------------#
     def end_run(self):
         """
@@ -557,12 +676,20 @@ class NIHTTPServer(ThreadingMixIn, HTTPServer):
         If there are any threads in the running_threads set, request their closure.
         This closes the read and write file objects used by the handler.
 
+        Log the summary of request phase times if phase timing is enabled.
+
+        Release the shared memory cache listing (removing it if no other
+        server is using it).
+
         Finally shutdown the server.
         """
         for thread in self.running_threads:
             if thread.request_thread.isAlive():
                 thread.request.close()
         del self.running_threads
+        if self.phase_stats is not None:
+            self.logger.info(self.phase_stats.summary())
+        self.cache_listing.close()
         if self.dtn_gateway_enabled:
             self.dtn_gateway.shutdown_gateway()
         self.shutdown()
@@ -575,7 +702,8 @@ def ni_http_server(storage_root, authority, server_port, logger, config,
                    getputform, nrsform, provide_nrs, favicon,
                    redis_db=0, run_gateway = False, ni_router = False,
                    default_route=None,
-                   request_aggregation=False):
+                   request_aggregation=False, search_fallback=True,
+                   phase_timing=False):
     """
     @brief Set up the NI HTTP threaded server.
     @param storage_root string pathname for root of cache directory tree
@@ -589,6 +717,10 @@ def ni_http_server(storage_root, authority, server_port, logger, config,
     @param favicon string pathname for browser favicon.ico icon file
     @param redis_db integer number of Redis database to use
     @param run_gateway boolean True if DTN<->HTTP functionality is enabled.
+    @param search_fallback boolean True if searches not matched locally use
+                           the external search engine
+    @param phase_timing boolean True if request phase times are to be logged
+                        and aggregated
     @return threaded HTTP server instance object ready for use
     
     Before creating the server:
@@ -614,6 +746,7 @@ def ni_http_server(storage_root, authority, server_port, logger, config,
         ipaddr = socket.gethostbyname(authority)
     else:
         try:
+            import DNS
             ipaddr = DNS.dnslookup(authority, "A")[0]
         except:
             logger.warn("Cannot get IP address for authority from DNS")
@@ -623,7 +756,7 @@ def ni_http_server(storage_root, authority, server_port, logger, config,
                                                         server_port))
 
     if provide_nrs or run_gateway:
-        if not redis_loaded:
+        if import_redis() is None:
             logger.error("Unable to import redis module needed for NRS server and/or DTN gateway")
             sys.exit(-1)
         logger.info("Successfully loaded redis module for NRS server and/or DTN gateway")
@@ -634,7 +767,7 @@ def ni_http_server(storage_root, authority, server_port, logger, config,
                         config, logger, getputform, nrsform,
                         provide_nrs, favicon,
                         redis_db, run_gateway, ni_router, default_route,
-                        request_aggregation)
+                        request_aggregation, search_fallback, phase_timing)
 
 #==============================================================================#
 
@@ -63,6 +63,8 @@ import logging.config
 import ConfigParser
 from optparse import OptionParser
 
+from nisampler import SamplingProfiler, DEFAULT_DURATION
+
 # Will also import niserver when we have decided which cache to use.
 
 #==============================================================================#
@@ -74,6 +76,18 @@ from optparse import OptionParser
 # UDP port number used to send a shutdown control request.
 CTRL_PORT = 2114
 
+##@var CTRL_MAX_MSG
+# Maximum size of a command read from the control port
+CTRL_MAX_MSG = 1024
+
+##@var CTRL_PROFILE_CMD
+# First word of control port commands for the sampling profiler
+CTRL_PROFILE_CMD = "profile"
+
+##@var PROFILE_SUFFIX
+# File name suffix for collapsed stack files written by the profiler
+PROFILE_SUFFIX = ".folded"
+
 ##@var SERVER_PORT
 # Default port number for HTTP server to listen on
 SERVER_PORT = 8080
@@ -86,6 +100,69 @@ FAVICON_FILE = "/favicon.ico"
 # Default Redis DB number
 REDIS_DB_NUM = 0
 
+#==============================================================================#
+def control_command(cmd, profiler, log_base):
+    """
+    @brief Act on a command received on the control port
+    @param cmd string contents of the control packet
+    @param profiler object SamplingProfiler instance for the server
+    @param log_base string directory for default profile output files
+    @return 2-tuple (boolean True if the server should be shut down,
+                     string reply to send to the sender of the command)
+
+    Profiler commands are
+    - profile start [<seconds> [<output file>]]
+    - profile stop
+    - profile status
+    Any other packet is a request to shut the server down (the contents of
+    shutdown packets have never been checked so that is left as it was).
+    The output file is always written in log_base - the control port is
+    not authenticated so the name given must be a plain file name (no
+    directory part).  PROFILE_SUFFIX is added to the name if it does not
+    already end with it and existing files are never overwritten, so the
+    server's own logs cannot be clobbered.  The default is
+    niserver_profile_<date>-<time>.folded.
+    """
+    words = cmd.split()
+    if (len(words) == 0) or (words[0] != CTRL_PROFILE_CMD):
+        return (True, "stopping")
+    action = words[1] if len(words) > 1 else "status"
+    if action == "start":
+        if len(words) > 4:
+            return (False, "error: usage: profile start [<seconds> [<file>]]")
+        try:
+            duration = float(words[2]) if len(words) > 2 else DEFAULT_DURATION
+        except ValueError:
+            return (False, "error: bad duration '%s'" % words[2])
+        if len(words) > 3:
+            out_name = words[3]
+            if ((os.path.basename(out_name) != out_name) or
+                (out_name in (os.curdir, os.pardir)) or
+                (os.altsep is not None and os.altsep in out_name)):
+                return (False, "error: output file must be a plain file "
+                               "name: '%s'" % out_name)
+            if not out_name.endswith(PROFILE_SUFFIX):
+                out_name += PROFILE_SUFFIX
+        else:
+            out_name = "niserver_profile_%s%s" % \
+                       (time.strftime("%Y%m%d-%H%M%S"), PROFILE_SUFFIX)
+        out_file = os.path.join(log_base, out_name)
+        if os.path.lexists(out_file):
+            return (False, "error: output file %s already exists" % out_file)
+        try:
+            if not profiler.start(duration, out_file):
+                return (False, "error: profiler already running")
+        except ValueError, e:
+            return (False, "error: %s" % str(e))
+        return (False, "profiling for %g seconds to %s" % (duration, out_file))
+    elif action == "stop":
+        if not profiler.stop():
+            return (False, "error: profiler not running")
+        return (False, "profile written")
+    elif action == "status":
+        return (False, "running" if profiler.running() else "idle")
+    return (False, "error: unknown profile command '%s'" % action)
+
 #==============================================================================#
 def py_niserver_start(default_config_file):
     """
@@ -103,8 +180,9 @@ def py_niserver_start(default_config_file):
     - Check authority for server
     - Create thread for main NI server listener (for incoming requests)
     - Start thread
-    - Create control socket for shutdown instructions
-    - Go to sleep waiting for shutdown command or signal
+    - Create control socket for shutdown and profiler instructions
+    - Go to sleep waiting for shutdown command or signal, starting and
+      stopping the sampling profiler if asked to (see control_command)
     - On shutdown request or signal close down server and exit
 
     To check the command line parameters use@n
@@ -203,6 +281,8 @@ def py_niserver_start(default_config_file):
     ni_router = None            # No command line argument
     default_route = None        # No command line argument
     request_aggregation = None
+    search_fallback = None      # No command line argument
+    phase_timing = None         # No command line argument
 
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -#
     # Can do without config file if -l, -n, -s, -g and -r are specified
@@ -272,6 +352,16 @@ def py_niserver_start(default_config_file):
                     parser.error("No option for %s in section %s in configuration file %s" %
                                  (conf_option, conf_section, config_file))
                     os._exit(1)
+        if config.has_section(conf_section):
+            conf_option = "phase_timing"
+            if config.has_option(conf_section, conf_option):
+                try:
+                    phase_timing = config.getboolean(conf_section,
+                                                     conf_option)
+                except ValueError:
+                    parser.error("Value supplied for %s is not an "
+                                 "acceptable boolean representation" %
+                                 conf_option)
 
         conf_section = "locations"
         if ((log_base is None) or (storage_root is None) or
@@ -407,6 +497,18 @@ def py_niserver_start(default_config_file):
             if config.has_option(conf_section, conf_option):
                 default_route = config.get(conf_section, conf_option)
 
+        conf_section = "search"
+        if config.has_section(conf_section):
+            conf_option = "search_fallback"
+            if config.has_option(conf_section, conf_option):
+                try:
+                    search_fallback = config.getboolean(conf_section,
+                                                        conf_option)
+                except ValueError:
+                    parser.error("Value supplied for %s is not an "
+                                 "acceptable boolean representation" %
+                                 conf_option)
+
     #- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -#
     # Check we have all the configuration we need and apply fallback
     # defaults for others
@@ -469,6 +571,14 @@ def py_niserver_start(default_config_file):
 
     if (request_aggregation is None):
         request_aggregation = False
+
+    # Default to using external search engine when local search finds nothing
+    if (search_fallback is None):
+        search_fallback = True
+
+    # Default to not timing the phases of each request
+    if (phase_timing is None):
+        phase_timing = False
         
     # Now load the main server module so that it gets the right cache module loaded            
     from niserver import ni_http_server
@@ -548,7 +658,9 @@ def py_niserver_start(default_config_file):
                                niserver_logger, config, getputform, nrsform,
                                provide_nrs, favicon, redis_db, run_gateway,
                                ni_router=ni_router, default_route=default_route,
-                               request_aggregation=request_aggregation)
+                               request_aggregation=request_aggregation,
+                               search_fallback=search_fallback,
+                               phase_timing=phase_timing)
 
     # Start a thread with the server -- that thread will then start one
     # more thread for each request
@@ -565,28 +677,41 @@ def py_niserver_start(default_config_file):
     loginfo("NI serverlistener running in thread: %s" %
             ni_server_listener.getName())
 
-    # The main thread now goes to sleep until either an interrupt or incoming data
-    # (any incoming data) on CTRL_PORT (typically 2114).
-    # Shutdown control is restricted to local machine.
+    # The main thread now goes to sleep until either an interrupt or a
+    # shutdown command (any packet that is not a profiler command) on
+    # CTRL_PORT (typically 2114).
+    # Control is restricted to local machine.
     HOST = "localhost"
     ctrl_skt = socket.socket(socket.AF_INET,socket.SOCK_DGRAM,0)
     ctrl_skt.bind((HOST, ctrl_port))
     read_fds = [ctrl_skt]
     write_fds = []
     exc_fds = []
+    profiler = SamplingProfiler(niserver_logger)
     
     try:
-        # Wait indefinitely (no timeout specified) for input on ctrl_skt or signal.
-        sel_fds = select.select(read_fds, write_fds, exc_fds)
-        if not (ctrl_skt in sel_fds[0]):
-            loginfo("Main thread terminated due to signal")
-        else:
-            loginfo("Main thread terminated through control interface")
+        while True:
+            # Wait indefinitely (no timeout specified) for input on ctrl_skt or signal.
+            sel_fds = select.select(read_fds, write_fds, exc_fds)
+            if not (ctrl_skt in sel_fds[0]):
+                loginfo("Main thread terminated due to signal")
+                break
+            (cmd, addr) = ctrl_skt.recvfrom(CTRL_MAX_MSG)
+            (shutdown, reply) = control_command(cmd, profiler, log_base)
+            try:
+                ctrl_skt.sendto(reply, addr)
+            except socket.error:
+                pass
+            if shutdown:
+                loginfo("Main thread terminated through control interface")
+                break
+            loginfo("Control command '%s': %s" % (cmd.strip(), reply))
     except:
         loginfo("Main thread received keyboard interrupt: %s" % sys.exc_info()[0])
     
-    # Shutdown
+    # Shutdown - write out any profile in progress
     ctrl_skt.close()
+    profiler.stop()
     
     # Shutdown the HTTP server listener
     ni_server.end_run()
@@ -35,7 +35,18 @@ waiting for a (UDP) packet to be received on the control port.  When such a
 packet is received or a signal is sent to the niserver, the select returns.
 The main thread then shuts down the niserver which is running in another
 thread so that server_shutdown can be used. The contents of the packet are
-irrelevant.
+irrelevant unless it starts with 'profile', in which case it controls the
+sampling profiler in the server (see nisampler.py) and the server keeps
+running:
+
+    niserver_stop.py [<port>] profile start [<seconds> [<output file>]]
+    niserver_stop.py [<port>] profile stop
+    niserver_stop.py [<port>] profile status
+
+The server replies with the name of the collapsed stack file being written
+(always in the server's log directory, so the output file must be a plain
+file name; '.folded' is added if missing and an existing file is never
+overwritten) or an error message.
 
 @code
 Revision History
@@ -51,6 +62,10 @@ Version   Date       Author         Notes
 import socket
 import sys
 
+##@var REPLY_TIMEOUT
+# Time in seconds to wait for the server to reply to a profile command
+REPLY_TIMEOUT = 5.0
+
 def stop_niserver(port=2114):
     print "Stopping niserver HTTP daemon..."
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -60,8 +75,26 @@ def stop_niserver(port=2114):
     return(0)
 
 #-------------------------------------------------------------------------------
+def profile_niserver(args, port=2114):
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.settimeout(REPLY_TIMEOUT)
+    try:
+        s.sendto(" ".join(["profile"] + args), ("localhost", port))
+        reply = s.recv(1024)
+    except socket.error, e:
+        print "No reply from niserver on port {}: {}".format(port, str(e))
+        return(1)
+    finally:
+        s.close()
+    print reply
+    return(1 if reply.startswith("error") else 0)
+
 if __name__ == "__main__":
-    if len(sys.argv) > 1:
-        stop_niserver(int(sys.argv[1]))
+    args = sys.argv[1:]
+    port = 2114
+    if (len(args) > 0) and args[0].isdigit():
+        port = int(args.pop(0))
+    if (len(args) > 0) and (args[0] == "profile"):
+        sys.exit(profile_niserver(args[1:], port))
     else:
-        stop_niserver()
+        stop_niserver(port)
@@ -0,0 +1,477 @@
+#!/usr/bin/python
+"""
+@package nilib
+@file nitiming.py
+@brief Per-request phase timing and latency histograms for the NetInf server
+@version Copyright (C) 2012 Trinity College Dublin and Folly Consulting Ltd
+      This is an adjunct to the NI URI library developed as
+      part of the SAIL project. (http://sail-project.eu)
+
+      Specification(s) - note, versions may change
+          - http://tools.ietf.org/html/draft-farrell-decade-ni-10
+          - http://tools.ietf.org/html/draft-hallambaker-decade-ni-params-03
+          - http://tools.ietf.org/html/draft-kutscher-icnrg-netinf-proto-00
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+       - http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+===============================================================================#
+
+@details
+The handler in nihandler.py splits the work done for a request into phases
+(form parsing, name validation, cache lookup, waiting for an aggregated
+request, forwarding, cache put and sending the response body).  Each
+request gets a RequestTimer that accumulates the time spent in each phase,
+either with the span context manager:
+
+    with self.timer.span(PHASE_CACHE_GET):
+        metadata, content_file = self.cache.cache_get(ni_name)
+
+or with explicit start/stop calls when the phase does not fit a block.
+
+When the request is finished the shim logs the phase times as a structured
+line ('phases,req,<command>,path,<path>,msgid,<msgid>,<phase>,<ms>,...')
+and adds them to the server wide PhaseStats histograms.
+
+When phase timing is not configured the handler is given NULL_TIMER whose
+methods do nothing (and whose span returns a shared do-nothing context
+manager), so the instrumentation costs a method call per phase and no
+clock reads.
+
+LatencyHistogram is an HDR style histogram with logarithmically sized
+buckets each split into linear sub-buckets, giving fixed relative
+precision over any range of values.  It is also used by niloadgen.py.
+"""
+import time
+import threading
+
+from nimetrics import PHASE_SECONDS
+
+#===============================================================================#
+# List of classes/global functions in file
+__all__ = ['LatencyHistogram', 'RequestTimer', 'PhaseStats', 'NULL_TIMER',
+           'new_timer', 'PERCENTILES', 'PHASES', 'PHASE_FORM',
+           'PHASE_VALIDATE', 'PHASE_CACHE_GET', 'PHASE_AGGREGATE',
+           'PHASE_FORWARD', 'PHASE_CACHE_PUT', 'PHASE_SEND']
+
+#===============================================================================#
+##@var PERCENTILES
+# Percentiles reported for each histogram
+PERCENTILES = ((50.0, "p50"), (90.0, "p90"), (99.0, "p99"), (99.9, "p999"))
+
+##@var PHASE_FORM
+# Parsing the form sent with a POST request
+PHASE_FORM = "form"
+
+##@var PHASE_VALIDATE
+# Turning the requested ni URI into an NIname and validating it
+PHASE_VALIDATE = "validate"
+
+##@var PHASE_CACHE_GET
+# Looking up the NDO in the local cache
+PHASE_CACHE_GET = "cache_get"
+
+##@var PHASE_AGGREGATE
+# Waiting for another request already fetching the same NDO
+PHASE_AGGREGATE = "aggregate"
+
+##@var PHASE_FORWARD
+# Fetching the NDO from a next hop
+PHASE_FORWARD = "forward"
+
+##@var PHASE_CACHE_PUT
+# Storing the NDO and/or its metadata in the local cache
+PHASE_CACHE_PUT = "cache_put"
+
+##@var PHASE_SEND
+# Writing the response body
+PHASE_SEND = "send"
+
+##@var PHASES
+# All the phases in the order they are logged
+PHASES = (PHASE_FORM, PHASE_VALIDATE, PHASE_CACHE_GET, PHASE_AGGREGATE,
+          PHASE_FORWARD, PHASE_CACHE_PUT, PHASE_SEND)
+
+#===============================================================================#
+class LatencyHistogram(object):
+    """
+    @brief HDR style histogram of integer values (e.g., latencies in usecs)
+
+    Values below 2**SUB_BITS are counted exactly.  Larger values are
+    counted in buckets covering 1/2**SUB_BITS of their power of two range,
+    so recorded values are accurate to better than 1%.  Buckets are kept
+    in a dictionary indexed by the lowest value in the bucket so that only
+    buckets in use take up space and histograms can be merged.
+    """
+    ##@var SUB_BITS
+    # Number of bits of precision kept for each value
+    SUB_BITS = 8
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        return
+
+    def record(self, value):
+        """
+        @brief Record one value
+        @param value integer value (negative values are recorded as 0)
+        @return (none)
+        """
+        value = max(0, int(value))
+        shift = value.bit_length() - self.SUB_BITS
+        if shift > 0:
+            bucket = (value >> shift) << shift
+        else:
+            bucket = value
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        if (self.min is None) or (value < self.min):
+            self.min = value
+        if (self.max is None) or (value > self.max):
+            self.max = value
+        return
+
+    def merge(self, other):
+        """
+        @brief Add the values recorded in another histogram to this one
+        @param other LatencyHistogram instance
+        @return (none)
+        """
+        for (bucket, n) in other.counts.iteritems():
+            self.counts[bucket] = self.counts.get(bucket, 0) + n
+        self.count += other.count
+        self.total += other.total
+        for v in (other.min, other.max):
+            if v is not None:
+                if (self.min is None) or (v < self.min):
+                    self.min = v
+                if (self.max is None) or (v > self.max):
+                    self.max = v
+        return
+
+    def percentile(self, pct):
+        """
+        @brief Get the value below which the given percentage of values fall
+        @param pct float percentage (0.0 to 100.0)
+        @return integer lowest value of bucket containing the percentile or
+                None if nothing has been recorded
+        """
+        if self.count == 0:
+            return None
+        target = max(1, int(round(self.count * pct / 100.0)))
+        seen = 0
+        for bucket in sorted(self.counts.iterkeys()):
+            seen += self.counts[bucket]
+            if seen >= target:
+                return bucket
+        return self.max
+
+    def to_dict(self):
+        """
+        @brief Summarize the histogram for a report
+        @return dictionary with count, min, max, mean, percentiles and the
+                non-empty buckets as a list of [value, count] pairs
+        """
+        rslt = { "count": self.count,
+                 "min":   self.min,
+                 "max":   self.max,
+                 "mean":  (float(self.total) / self.count) if self.count else None }
+        for (pct, label) in PERCENTILES:
+            rslt[label] = self.percentile(pct)
+        rslt["buckets"] = [[b, self.counts[b]] for b in sorted(self.counts)]
+        return rslt
+
+#===============================================================================#
+class _Span(object):
+    """
+    @brief Context manager timing one phase of a request
+    """
+    __slots__ = ("timer", "phase")
+
+    def __init__(self, timer, phase):
+        self.timer = timer
+        self.phase = phase
+        return
+
+    def __enter__(self):
+        self.timer.start(self.phase)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        # Time spent is recorded whether or not the phase succeeded
+        self.timer.stop(self.phase)
+        return False
+
+#------------------------------------------------------------------------------#
+class RequestTimer(object):
+    """
+    @brief Accumulate the time spent in each phase of one request
+
+    A phase may be entered more than once (e.g., two cache puts); the
+    times are added together.
+    """
+    __slots__ = ("spans", "started")
+
+    def __init__(self):
+        ##@var spans
+        # dictionary phase name -> float seconds spent in phase
+        self.spans = {}
+        ##@var started
+        # dictionary phase name -> float time phase was started
+        self.started = {}
+        return
+
+    def start(self, phase):
+        """
+        @brief Start timing a phase
+        @param phase string phase name (one of PHASES)
+        @return (none)
+        """
+        self.started[phase] = time.time()
+        return
+
+    def stop(self, phase):
+        """
+        @brief Stop timing a phase and add the time to its total
+        @param phase string phase name (one of PHASES)
+        @return (none)
+
+        Stopping a phase that has not been started is ignored.
+        """
+        t0 = self.started.pop(phase, None)
+        if t0 is not None:
+            self.spans[phase] = self.spans.get(phase, 0.0) + (time.time() - t0)
+        return
+
+    def span(self, phase):
+        """
+        @brief Make a context manager timing the block it wraps
+        @param phase string phase name (one of PHASES)
+        @return _Span instance
+        """
+        return _Span(self, phase)
+
+    def enabled(self):
+        """
+        @brief Check if this timer records anything
+        @return boolean True
+        """
+        return True
+
+    def log_fields(self):
+        """
+        @brief Format the phase times for a structured log line
+        @return string comma separated <phase>,<milliseconds> pairs for the
+                phases that were entered, in the order of PHASES
+        """
+        return ",".join(["%s,%.3f" % (phase, self.spans[phase] * 1000)
+                         for phase in PHASES if phase in self.spans])
+
+#------------------------------------------------------------------------------#
+class _NullSpan(object):
+    """
+    @brief Context manager that does nothing
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+#------------------------------------------------------------------------------#
+class _NullTimer(object):
+    """
+    @brief Stand in for RequestTimer when phase timing is disabled
+    """
+    __slots__ = ()
+
+    ##@var NULL_SPAN
+    # _NullSpan instance returned by every call of span
+    NULL_SPAN = _NullSpan()
+
+    def start(self, phase):
+        return
+
+    def stop(self, phase):
+        return
+
+    def span(self, phase):
+        return self.NULL_SPAN
+
+    def enabled(self):
+        return False
+
+    def log_fields(self):
+        return ""
+
+##@var NULL_TIMER
+# Shared _NullTimer instance used by all requests when timing is disabled
+NULL_TIMER = _NullTimer()
+
+#===============================================================================#
+class PhaseStats(object):
+    """
+    @brief Server wide histograms of the time spent in each request phase
+
+    Times are recorded in microseconds.  One instance is shared by all the
+    handler threads in a server process.  The times are also added to the
+    nimetrics PHASE_SECONDS histogram for the metrics report.
+    """
+    def __init__(self):
+        ##@var lock
+        # threading.Lock serializing access to hists
+        self.lock = threading.Lock()
+        ##@var hists
+        # dictionary phase name -> LatencyHistogram
+        self.hists = dict([(phase, LatencyHistogram()) for phase in PHASES])
+        ##@var requests
+        # integer number of requests recorded
+        self.requests = 0
+        return
+
+    def record(self, timer):
+        """
+        @brief Add the phase times for a finished request
+        @param timer RequestTimer instance for the request
+        @return (none)
+        """
+        with self.lock:
+            self.requests += 1
+            for (phase, secs) in timer.spans.iteritems():
+                self.hists[phase].record(secs * 1000000)
+        for (phase, secs) in timer.spans.iteritems():
+            PHASE_SECONDS.observe(secs, labels=(phase,))
+        return
+
+    def snapshot(self):
+        """
+        @brief Copy the histograms so they can be reported without the lock
+        @return 2-tuple (integer requests recorded, dictionary phase name ->
+                LatencyHistogram copy)
+        """
+        with self.lock:
+            copies = {}
+            for (phase, hist) in self.hists.iteritems():
+                h = LatencyHistogram()
+                h.merge(hist)
+                copies[phase] = h
+            return (self.requests, copies)
+
+    def to_dict(self):
+        """
+        @brief Summarize the histograms for a report
+        @return dictionary with number of requests and summary of the
+                histogram for each phase that has been entered
+        """
+        (requests, hists) = self.snapshot()
+        rslt = { "requests": requests }
+        for phase in PHASES:
+            if hists[phase].count > 0:
+                rslt[phase] = hists[phase].to_dict()
+        return rslt
+
+    def summary(self):
+        """
+        @brief Format a one line summary of the histograms for logging
+        @return string 'phase_summary,requests,<n>' followed by
+                ',<phase>,<count>,<p50>,<p99>,<max>' (usecs) for each phase
+                that has been entered
+        """
+        (requests, hists) = self.snapshot()
+        fields = ["phase_summary,requests,%d" % requests]
+        for phase in PHASES:
+            h = hists[phase]
+            if h.count > 0:
+                fields.append("%s,%d,%d,%d,%d" % (phase, h.count,
+                                                  h.percentile(50.0),
+                                                  h.percentile(99.0), h.max))
+        return ",".join(fields)
+
+#------------------------------------------------------------------------------#
+def new_timer(phase_stats):
+    """
+    @brief Get a timer for a new request
+    @param phase_stats PhaseStats instance or None if timing is disabled
+    @return RequestTimer instance or NULL_TIMER if phase_stats is None
+    """
+    if phase_stats is None:
+        return NULL_TIMER
+    return RequestTimer()
+
+#==============================================================================#
+# TESTING CODE
+#==============================================================================#
+if __name__ == "__main__":
+    import json
+
+    errs = 0
+    stats = PhaseStats()
+    for i in range(3):
+        timer = new_timer(stats)
+        with timer.span(PHASE_VALIDATE):
+            pass
+        timer.start(PHASE_SEND)
+        time.sleep(0.01)
+        timer.stop(PHASE_SEND)
+        timer.start(PHASE_SEND)
+        timer.stop(PHASE_SEND)
+        # Not started - ignored
+        timer.stop(PHASE_FORWARD)
+        try:
+            with timer.span(PHASE_CACHE_GET):
+                raise KeyError("missing")
+        except KeyError:
+            pass
+        print timer.log_fields()
+        stats.record(timer)
+
+    d = stats.to_dict()
+    if d["requests"] != 3:
+        print "Wrong number of requests: %d" % d["requests"]
+        errs += 1
+    if sorted(d.keys()) != sorted(["requests", PHASE_VALIDATE, PHASE_SEND,
+                                   PHASE_CACHE_GET]):
+        print "Wrong phases recorded: %s" % str(d.keys())
+        errs += 1
+    if d[PHASE_SEND]["min"] < 10000:
+        print "Send phase too short: %d" % d[PHASE_SEND]["min"]
+        errs += 1
+    print stats.summary()
+    json.dumps(d)
+
+    timer = new_timer(None)
+    if timer is not NULL_TIMER or timer.enabled():
+        print "Expected null timer"
+        errs += 1
+    with timer.span(PHASE_FORM):
+        timer.start(PHASE_SEND)
+        timer.stop(PHASE_SEND)
+    if timer.log_fields() != "":
+        print "Null timer logged fields"
+        errs += 1
+
+    h = LatencyHistogram()
+    for v in range(1, 1001):
+        h.record(v * 1000)
+    p50 = h.percentile(50.0)
+    if abs(p50 - 500000) > 500000 / 100:
+        print "Percentile out of range: %d" % p50
+        errs += 1
+
+    print "Tests completed with %d errors" % errs
@@ -0,0 +1,297 @@
+#!/usr/bin/python
+"""
+@package nilib
+@file nrs_cache.py
+@brief Process-local read-through cache for NRS database lookups.
+@version Copyright (C) 2012 Trinity College Dublin and Folly Consulting Ltd
+      This is an adjunct to the NI URI library developed as
+      part of the SAIL project. (http://sail-project.eu)
+
+      Specification(s) - note, versions may change
+          - http://tools.ietf.org/html/draft-farrell-decade-ni-10
+          - http://tools.ietf.org/html/draft-hallambaker-decade-ni-params-03
+          - http://tools.ietf.org/html/draft-kutscher-icnrg-netinf-proto-00
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+       - http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+================================================================================
+
+@details
+The NRS database (and the next hop table used for forwarding) is held in
+Redis.  It changes rarely but is read for every NRS lookup and every DTN
+request handled by the gateway.  NRSLookupCache keeps recently read values
+in memory so that repeated lookups do not need a Redis round trip.
+
+The cache is read-through: 'get' is given the Redis key and a callable that
+reads the value from Redis if it is not cached.  Entries are held in least
+recently used order and the number of entries is bounded.  Each entry also
+has a time to live as a safety net in case an invalidation is missed.
+
+Writers (nrs_conf and nrs_delete in the HTTP handler, the forwarder when it
+sets up default next hops) call 'invalidate' (or the module function
+'publish_invalidation' if they have no cache instance) after changing a key.
+This removes the local entry and publishes the key on a Redis pub/sub
+channel.  Each cache instance can run a listener thread subscribed to the
+channel so that caches in other processes (e.g., mod_wsgi daemon processes)
+drop their copies as well.  Publishing "*" clears every cache.
+
+Counters of hits, misses and invalidations are kept and can be retrieved
+with 'stats'.
+"""
+
+#==============================================================================#
+#=== Standard modules for Python 2.[567].x distributions ===
+import threading
+import time
+from collections import OrderedDict
+
+#==============================================================================#
+# List of classes/global functions in file
+__all__ = ['NRSLookupCache', 'publish_invalidation', 'NRS_INVALIDATE_CHANNEL']
+
+#==============================================================================#
+# === GLOBAL CONSTANTS ===
+
+##@var NRS_INVALIDATE_CHANNEL
+# Name of Redis pub/sub channel used to announce changed NRS keys
+NRS_INVALIDATE_CHANNEL = "NIROUTER/NRS_INVALIDATE"
+
+##@var INVALIDATE_ALL
+# Value published on NRS_INVALIDATE_CHANNEL to clear all cached values
+INVALIDATE_ALL = "*"
+
+#==============================================================================#
+def publish_invalidation(redis_conn, redis_key):
+    """
+    @brief Tell all NRS lookup caches that redis_key has changed
+    @param redis_conn StrictRedis (or Redis) instance
+    @param redis_key string key that has been changed or deleted
+    @return boolean True if the message was published
+
+    Failure to publish is not fatal: caches will pick up the change
+    when their entry expires.
+    """
+    try:
+        redis_conn.publish(NRS_INVALIDATE_CHANNEL, redis_key)
+    except Exception:
+        return False
+    return True
+
+#==============================================================================#
+class NRSLookupCache:
+    """
+    @brief Size bounded, TTL limited, read-through cache of NRS values
+
+    Thread safe - shared by all handler threads in a process.
+    """
+
+    #--------------------------------------------------------------------------#
+    ##@var DFLT_MAX_ENTRIES
+    # Default maximum number of values held
+    DFLT_MAX_ENTRIES = 2000
+
+    ##@var DFLT_TTL
+    # Default time (seconds) for which a value is used without rereading
+    DFLT_TTL = 60.0
+
+    #--------------------------------------------------------------------------#
+    def __init__(self, redis_conn, logger=None, max_entries=DFLT_MAX_ENTRIES,
+                 ttl=DFLT_TTL):
+        """
+        @brief Constructor
+        @param redis_conn StrictRedis instance used for pub/sub
+        @param logger object logger instance or None
+        @param max_entries integer maximum number of values held
+        @param ttl float seconds before a value is reread
+        """
+        self.redis_conn = redis_conn
+        self.logger = logger
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # Maps (kind, redis_key) -> (value, expiry); least recently used first
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # Incremented by every invalidation - a value read from Redis is
+        # only stored if no invalidation happened while it was being read
+        self.generation = 0
+        self.listener = None
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        return
+
+    #--------------------------------------------------------------------------#
+    def get(self, redis_key, loader, kind="entry"):
+        """
+        @brief Return the cached value for redis_key or read it with loader
+        @param redis_key string Redis key to look up
+        @param loader callable with no parameters that reads the value from
+                      Redis - exceptions are passed on and nothing is cached
+        @param kind string distinguishes different views of the same key
+        @return value (possibly None) from cache or loader
+
+        None results are cached as well so that repeated lookups of
+        missing keys don't go to Redis either.
+        """
+        ck = (kind, redis_key)
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(ck)
+            if (entry is not None) and (entry[1] > now):
+                # Move to most recently used position
+                del self.entries[ck]
+                self.entries[ck] = entry
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            gen = self.generation
+
+        value = loader()
+
+        with self.lock:
+            if gen == self.generation:
+                if ck in self.entries:
+                    del self.entries[ck]
+                elif len(self.entries) >= self.max_entries:
+                    self.entries.popitem(last=False)
+                self.entries[ck] = (value, now + self.ttl)
+        return value
+
+    #--------------------------------------------------------------------------#
+    def invalidate(self, redis_key, publish=True):
+        """
+        @brief Forget cached values for redis_key
+        @param redis_key string key changed (or INVALIDATE_ALL)
+        @param publish boolean True if other processes should be told
+        @return (none)
+        """
+        self._drop(redis_key)
+        if publish and (self.redis_conn is not None):
+            if not publish_invalidation(self.redis_conn, redis_key):
+                self._log("NRS cache: publishing invalidation of %s failed" %
+                          redis_key)
+        return
+
+    #--------------------------------------------------------------------------#
+    def start_listener(self):
+        """
+        @brief Start a daemon thread listening for invalidations
+        @return boolean True if the listener is running
+
+        If the subscription fails the cache is still usable; other
+        processes' changes will be seen when entries expire.
+        """
+        if self.listener is not None:
+            return True
+        try:
+            pubsub = self.redis_conn.pubsub()
+            pubsub.subscribe(NRS_INVALIDATE_CHANNEL)
+        except Exception, e:
+            self._log("NRS cache: unable to subscribe to %s: %s" %
+                      (NRS_INVALIDATE_CHANNEL, str(e)))
+            return False
+        self.listener = threading.Thread(target=self._listen, args=(pubsub,),
+                                         name="nrs-cache-listener")
+        self.listener.daemon = True
+        self.listener.start()
+        return True
+
+    #--------------------------------------------------------------------------#
+    def stats(self):
+        """
+        @brief Report counters for the cache
+        @return dictionary of counter names and values
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return { "entries":       len(self.entries),
+                     "hits":          self.hits,
+                     "misses":        self.misses,
+                     "hit_rate":      (float(self.hits) / lookups) if lookups else 0.0,
+                     "invalidations": self.invalidations }
+
+    #--------------------------------------------------------------------------#
+    def _drop(self, redis_key):
+        """
+        @brief Remove entries for redis_key (all entries for INVALIDATE_ALL)
+        @param redis_key string key to remove
+        @return (none)
+        """
+        with self.lock:
+            self.generation += 1
+            self.invalidations += 1
+            if redis_key == INVALIDATE_ALL:
+                self.entries.clear()
+                return
+            for ck in [ck for ck in self.entries if ck[1] == redis_key]:
+                del self.entries[ck]
+        return
+
+    #--------------------------------------------------------------------------#
+    def _listen(self, pubsub):
+        """
+        @brief Listener thread body - drop keys announced on the channel
+        @param pubsub redis PubSub instance subscribed to the channel
+        @return (none)
+
+        If the connection fails everything is dropped (changes may have
+        been missed) and the thread exits; start_listener can be called
+        again to restart it.
+        """
+        try:
+            for msg in pubsub.listen():
+                if msg["type"] == "message":
+                    self._drop(msg["data"])
+        except Exception, e:
+            self._log("NRS cache: invalidation listener failed: %s" % str(e))
+        self._drop(INVALIDATE_ALL)
+        self.listener = None
+        return
+
+    #--------------------------------------------------------------------------#
+    def _log(self, msg):
+        """
+        @brief Log a warning if there is a logger
+        @param msg string message
+        """
+        if self.logger is not None:
+            self.logger.warn(msg)
+        return
+
+#==============================================================================#
+# TESTING CODE
+if __name__ == "__main__":
+    reads = []
+    def loader():
+        reads.append(1)
+        return { "hints": [], "locs": ["example.com"], "meta": None }
+
+    c = NRSLookupCache(None, max_entries=2, ttl=10.0)
+    v1 = c.get("ni:///sha-256;abc", loader)
+    v2 = c.get("ni:///sha-256;abc", loader)
+    assert (v1 is v2) and (len(reads) == 1)
+    c.invalidate("ni:///sha-256;abc")
+    c.get("ni:///sha-256;abc", loader)
+    assert len(reads) == 2
+    # Size bound - least recently used dropped
+    c.get("k2", loader)
+    c.get("k3", loader)
+    assert ("entry", "ni:///sha-256;abc") not in c.entries
+    # Expiry
+    c.ttl = 0.0
+    c.get("k4", loader)
+    c.get("k4", loader)
+    assert len(reads) == 6
+    print c.stats()
+    print "All tests passed"
@@ -0,0 +1,337 @@
+#!/usr/bin/python
+"""
+@package nilib
+@file qrcode_cache.py
+@brief Cache of rendered QRcode images for ni scheme URIs.
+@version Copyright (C) 2012 Trinity College Dublin and Folly Consulting Ltd
+      This is an adjunct to the NI URI library developed as
+      part of the SAIL project. (http://sail-project.eu)
+
+      Specification(s) - note, versions may change
+          - http://tools.ietf.org/html/draft-farrell-decade-ni-10
+          - http://tools.ietf.org/html/draft-hallambaker-decade-ni-params-03
+          - http://tools.ietf.org/html/draft-kutscher-icnrg-netinf-proto-00
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+       - http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+================================================================================
+
+@details
+The /ni_qrcode/ and /ni_qrpng/ URLs return a QRcode encoding the canonical
+ni scheme URI of a cached NDO.  Generating the image with the (pure Python)
+qrcode module takes several milliseconds of CPU, but the image depends only
+on the canonical URI, so QRCodeCache keeps the PNG images already made.
+
+Images are kept in an in-process dictionary bounded by number of entries,
+dropping the least recently used entry first.  If a storage root is given,
+each image is also written to
+    <storage_root>/qrcode_dir/<alg>/<digest>.png
+alongside the ndo_dir and meta_dir trees used by the NDO cache, so that
+images survive a server restart and are shared by all server processes
+using the same storage.  Failures reading or writing the files are logged
+and the image is regenerated.
+
+Every image has an entity tag derived from the URI (and a format version)
+which the handler uses to answer conditional GET requests with 304.
+"""
+
+#==============================================================================#
+#=== Standard modules for Python 2.[567].x distributions ===
+import os
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from StringIO import StringIO
+
+#=== Modules needing special downloading
+# qrcode (and the PIL modules it uses) is imported when the first image
+# has to be rendered - see get_png
+
+#==============================================================================#
+# List of classes/global functions in file
+__all__ = ['QRCodeCache', 'QRCODE_DIR', 'etags_match']
+
+#==============================================================================#
+##@var QRCODE_DIR
+# Subdirectory of the storage root holding rendered images
+QRCODE_DIR = "/qrcode_dir/"
+
+#==============================================================================#
+def etags_match(if_none_match, etag):
+    """
+    @brief Check an If-None-Match header value against an entity tag
+    @param if_none_match string value of If-None-Match header (or None)
+    @param etag string quoted entity tag of the current representation
+    @return boolean True if the header matches the tag (so 304 is appropriate)
+
+    Weak tags (W/"...") are compared by their opaque part as allowed for
+    GET requests.
+    """
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+#==============================================================================#
+class QRCodeCache:
+    """
+    @brief LRU bounded cache of PNG QRcode images in memory and on disk
+
+    Thread safe.
+    """
+
+    #--------------------------------------------------------------------------#
+    #=== Class constants ===
+    #--------------------------------------------------------------------------#
+    ##@var DFLT_MAX_ENTRIES
+    # Default maximum number of images held in memory
+    DFLT_MAX_ENTRIES = 500
+
+    ##@var FORMAT_VERSION
+    # Included in entity tags - change if the rendering is altered
+    FORMAT_VERSION = "1"
+
+    #--------------------------------------------------------------------------#
+    def __init__(self, logger, storage_root=None,
+                 max_entries=DFLT_MAX_ENTRIES):
+        """
+        @brief Constructor
+        @param logger object logger instance
+        @param storage_root string root of cache directory tree or None
+                                   to keep images in memory only
+        @param max_entries integer maximum number of images held in memory
+        """
+        self.logger = logger
+        self.storage_root = storage_root
+        self.max_entries = max_entries
+        # In memory store: canonical ni URI -> (PNG string, entity tag)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # Counters
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        return
+
+    #--------------------------------------------------------------------------#
+    def etag(self, ni_string):
+        """
+        @brief Make the entity tag for the image of an ni URI
+        @param ni_string string canonical ni scheme URI
+        @return string quoted entity tag
+
+        The tag can be computed without rendering the image so that
+        conditional requests are answered without touching the cache.
+        """
+        h = hashlib.sha1("%s %s" % (self.FORMAT_VERSION, ni_string))
+        return '"qr-%s"' % h.hexdigest()[:24]
+
+    #--------------------------------------------------------------------------#
+    def get_png(self, ni_string):
+        """
+        @brief Get the PNG image of the QRcode for an ni URI
+        @param ni_string string canonical ni scheme URI
+        @return tuple (string PNG image data, string quoted entity tag)
+
+        Looks in memory, then on disk, and renders the image if neither
+        has it.
+        """
+        with self.lock:
+            entry = self.entries.get(ni_string)
+            if entry is not None:
+                # Reinsert as most recently used
+                del self.entries[ni_string]
+                self.entries[ni_string] = entry
+                self.hits += 1
+                return entry
+
+        png = self._disk_lookup(ni_string)
+        if png is not None:
+            with self.lock:
+                self.disk_hits += 1
+        else:
+            import qrcode
+            f = StringIO()
+            qrcode.make(ni_string).save(f)
+            png = f.getvalue()
+            f.close()
+            self._disk_store(ni_string, png)
+            with self.lock:
+                self.misses += 1
+
+        entry = (png, self.etag(ni_string))
+        with self.lock:
+            if ni_string in self.entries:
+                del self.entries[ni_string]
+            elif len(self.entries) >= self.max_entries:
+                self.entries.popitem(last=False)
+            self.entries[ni_string] = entry
+        return entry
+
+    #--------------------------------------------------------------------------#
+    def stats(self):
+        """
+        @brief Report counters for the cache
+        @return dictionary of counter names and values
+        """
+        with self.lock:
+            return { "hits":      self.hits,
+                     "disk_hits": self.disk_hits,
+                     "misses":    self.misses,
+                     "entries":   len(self.entries) }
+
+    #--------------------------------------------------------------------------#
+    #=== Private methods ===
+    #--------------------------------------------------------------------------#
+    def _pathname(self, ni_string):
+        """
+        @brief Construct the file name for the image of an ni URI
+        @param ni_string string canonical ni scheme URI (ni:///<alg>;<digest>)
+        @return string pathname or None if not storing images on disk or
+                       the URI does not have the expected form
+        """
+        if self.storage_root is None:
+            return None
+        (alg, sep, digest) = ni_string[ni_string.rfind("/")+1:].partition(";")
+        if (not sep) or (alg == "") or (digest == ""):
+            return None
+        return "%s%s%s/%s.png" % (self.storage_root, QRCODE_DIR, alg, digest)
+
+    #--------------------------------------------------------------------------#
+    def _disk_lookup(self, ni_string):
+        """
+        @brief Read a previously stored image
+        @param ni_string string canonical ni scheme URI
+        @return string PNG image data or None if not available
+        """
+        path = self._pathname(ni_string)
+        if path is None:
+            return None
+        try:
+            f = open(path, "rb")
+        except IOError:
+            return None
+        try:
+            png = f.read()
+        except IOError, e:
+            self.logger.warn("qrcode_cache: Unable to read %s: %s" %
+                             (path, str(e)))
+            png = None
+        f.close()
+        return png if png else None
+
+    #--------------------------------------------------------------------------#
+    def _disk_store(self, ni_string, png):
+        """
+        @brief Write an image to disk for reuse
+        @param ni_string string canonical ni scheme URI
+        @param png string PNG image data
+        @return (none)
+
+        The image is written to a temporary file in the same directory and
+        renamed so that other processes never see a partial file.
+        """
+        path = self._pathname(ni_string)
+        if path is None:
+            return
+        dir_name = os.path.dirname(path)
+        try:
+            if not os.path.isdir(dir_name):
+                try:
+                    os.makedirs(dir_name, 0755)
+                except OSError:
+                    # Another process may have created it meanwhile
+                    if not os.path.isdir(dir_name):
+                        raise
+            (fd, tmp_path) = tempfile.mkstemp(dir=dir_name, suffix=".tmp")
+            try:
+                os.write(fd, png)
+            finally:
+                os.close(fd)
+            os.rename(tmp_path, path)
+        except (IOError, OSError), e:
+            self.logger.warn("qrcode_cache: Unable to store %s: %s" %
+                             (path, str(e)))
+        return
+
+#==============================================================================#
+if __name__ == "__main__":
+    import shutil
+    import logging
+    logging.basicConfig()
+    logger = logging.getLogger("test")
+    logger.setLevel(logging.INFO)
+
+    errs = 0
+    uri1 = "ni:///sha-256;f4OxZX_x_FO5LcGBSKHWXfwtSx-j1ncoSt3SABJtkGk"
+    uri2 = "ni:///sha-256-32;mAhdQA"
+
+    if not etags_match('"a", W/"b"', '"b"') or etags_match('"a"', '"b"') or \
+       not etags_match("*", '"b"') or etags_match(None, '"b"'):
+        print "etags_match gave wrong result"
+        errs += 1
+
+    # Memory only
+    qc = QRCodeCache(logger, max_entries=1)
+    (png, tag) = qc.get_png(uri1)
+    if not png.startswith("\x89PNG"):
+        print "Image is not a PNG"
+        errs += 1
+    if tag != qc.etag(uri1) or tag == qc.etag(uri2):
+        print "Unexpected entity tag %s" % tag
+        errs += 1
+    if qc.get_png(uri1) != (png, tag):
+        print "Cached image differs"
+        errs += 1
+    qc.get_png(uri2)
+    qc.get_png(uri1)
+    st = qc.stats()
+    if (st["hits"] != 1) or (st["misses"] != 3) or (st["entries"] != 1):
+        print "Unexpected statistics (LRU bound not applied?): %s" % str(st)
+        errs += 1
+
+    # With disk store - a second cache instance finds the stored image
+    root = tempfile.mkdtemp()
+    try:
+        qc = QRCodeCache(logger, root)
+        qc.get_png(uri1)
+        path = "%s%ssha-256/%s.png" % (root, QRCODE_DIR, uri1.split(";")[1])
+        if not os.path.isfile(path):
+            print "Image not stored at %s" % path
+            errs += 1
+        qc2 = QRCodeCache(logger, root)
+        if qc2.get_png(uri1) != (png, tag):
+            print "Image from disk differs"
+            errs += 1
+        st = qc2.stats()
+        if (st["disk_hits"] != 1) or (st["misses"] != 0):
+            print "Image not read from disk: %s" % str(st)
+            errs += 1
+        if len(os.listdir(os.path.dirname(path))) != 1:
+            print "Temporary files left behind"
+            errs += 1
+        if qc2._pathname("ni:///sha-256") is not None:
+            print "Malformed URI given a path name"
+            errs += 1
+    finally:
+        shutil.rmtree(root)
+
+    print "Tests completed with %d errors" % errs
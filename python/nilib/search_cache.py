@@ -0,0 +1,312 @@
+#!/usr/bin/python
+"""
+@package nilib
+@file search_cache.py
+@brief Cache of NetInf search results keyed by normalized search tokens.
+@version Copyright (C) 2012 Trinity College Dublin and Folly Consulting Ltd
+      This is an adjunct to the NI URI library developed as
+      part of the SAIL project. (http://sail-project.eu)
+
+      Specification(s) - note, versions may change
+          - http://tools.ietf.org/html/draft-farrell-decade-ni-10
+          - http://tools.ietf.org/html/draft-hallambaker-decade-ni-params-03
+          - http://tools.ietf.org/html/draft-kutscher-icnrg-netinf-proto-00
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+       - http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+================================================================================
+
+@details
+A search (netinfproto/search) may involve an external search engine and
+retrieval of every item found.  SearchResultCache remembers the outcome of
+recent searches so that a repeated search costs a single lookup.
+
+The key is the normalized token string (lower case, words separated by
+single spaces) so that trivially different queries share an entry.  The
+value is a dictionary with
+- 'search':  the 'search' metadata dictionary (searcher, engine, tokens)
+- 'results': list of dictionaries with 'ni' (canonical ni URI), 'text'
+             and 'desc' for each NDO found
+The value is stored JSON encoded.
+
+Entries expire after a time to live and the number of entries is bounded,
+dropping the least recently used entries first.
+
+If a Redis connection is supplied the entries are kept in the Redis
+database (so that they are shared by all server processes using the
+database) under keys SEARCH_KEY_PREFIX + normalized tokens, with the Redis
+TTL set.  A sorted set (SEARCH_LRU_KEY) of normalized tokens scored by
+last access time is used to find the least recently used entries without
+reading the whole set.  Otherwise an in-process dictionary is used.
+Failures accessing Redis are logged and treated as cache misses.
+"""
+
+#==============================================================================#
+#=== Standard modules for Python 2.[567].x distributions ===
+import json
+import time
+import threading
+from collections import OrderedDict
+
+#==============================================================================#
+# List of classes/global functions in file
+__all__ = ['SearchResultCache']
+
+#==============================================================================#
+class SearchResultCache:
+    """
+    @brief LRU and TTL bounded cache of search results in Redis or memory
+
+    Thread safe.
+    """
+
+    #--------------------------------------------------------------------------#
+    #=== Class constants ===
+    #--------------------------------------------------------------------------#
+    ##@var SEARCH_KEY_PREFIX
+    # Prefix of Redis keys for search result entries
+    SEARCH_KEY_PREFIX = "NIROUTER/SEARCH/"
+
+    ##@var SEARCH_LRU_KEY
+    # Redis sorted set of normalized token strings scored by time of last
+    # access
+    SEARCH_LRU_KEY = "NIROUTER/SEARCH_LRU"
+
+    ##@var DFLT_TTL
+    # Default time (seconds) for which search results are reused
+    DFLT_TTL = 600
+
+    ##@var DFLT_MAX_ENTRIES
+    # Default maximum number of searches remembered
+    DFLT_MAX_ENTRIES = 1000
+
+    #--------------------------------------------------------------------------#
+    def __init__(self, logger, redis_conn=None, ttl=DFLT_TTL,
+                 max_entries=DFLT_MAX_ENTRIES):
+        """
+        @brief Constructor
+        @param logger object logger instance
+        @param redis_conn StrictRedis instance or None to use memory
+        @param ttl integer seconds for which results are reused
+        @param max_entries integer maximum number of searches remembered
+        """
+        self.logger = logger
+        self.redis_conn = redis_conn
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # In memory store: normalized tokens -> (JSON string, expiry)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        return
+
+    #--------------------------------------------------------------------------#
+    @staticmethod
+    def normalize(tokens):
+        """
+        @brief Make the cache key for a search token string
+        @param tokens string search query
+        @return string lower case query with words separated by single spaces
+        """
+        return " ".join(tokens.lower().split())
+
+    #--------------------------------------------------------------------------#
+    def lookup(self, tokens):
+        """
+        @brief Find cached results for a search
+        @param tokens string search query
+        @return dictionary with 'search' and 'results' entries or None
+        """
+        key = self.normalize(tokens)
+        if self.redis_conn is not None:
+            js = self._redis_lookup(key)
+        else:
+            js = self._mem_lookup(key)
+        with self.lock:
+            if js is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(js)
+
+    #--------------------------------------------------------------------------#
+    def store(self, tokens, srch_dict, results):
+        """
+        @brief Remember results of a search
+        @param tokens string search query
+        @param srch_dict dictionary describing search (searcher, engine, tokens)
+        @param results list of dictionaries with 'ni', 'text' and 'desc'
+        @return (none)
+        """
+        key = self.normalize(tokens)
+        js = json.dumps({ "search": srch_dict, "results": results })
+        if self.redis_conn is not None:
+            self._redis_store(key, js)
+        else:
+            self._mem_store(key, js)
+        return
+
+    #--------------------------------------------------------------------------#
+    def forget(self, tokens):
+        """
+        @brief Remove any cached results for a search
+        @param tokens string search query
+        @return (none)
+        """
+        key = self.normalize(tokens)
+        if self.redis_conn is not None:
+            try:
+                pipe = self.redis_conn.pipeline(transaction=False)
+                pipe.delete(self.SEARCH_KEY_PREFIX + key)
+                pipe.zrem(self.SEARCH_LRU_KEY, key)
+                pipe.execute()
+            except Exception, e:
+                self.logger.warn("search_cache: Redis delete failed: %s" % str(e))
+        else:
+            with self.lock:
+                self.entries.pop(key, None)
+        return
+
+    #--------------------------------------------------------------------------#
+    def stats(self):
+        """
+        @brief Report counters for the cache
+        @return dictionary of counter names and values
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return { "hits":     self.hits,
+                     "misses":   self.misses,
+                     "hit_rate": (float(self.hits) / lookups) if lookups else 0.0 }
+
+    #--------------------------------------------------------------------------#
+    #=== Private methods ===
+    #--------------------------------------------------------------------------#
+    def _mem_lookup(self, key):
+        """
+        @brief Look up key in the in-memory store
+        @param key string normalized tokens
+        @return string JSON encoded entry or None
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            del self.entries[key]
+            if entry[1] <= time.time():
+                return None
+            # Reinsert as most recently used
+            self.entries[key] = entry
+            return entry[0]
+
+    #--------------------------------------------------------------------------#
+    def _mem_store(self, key, js):
+        """
+        @brief Put entry in the in-memory store, dropping the least
+               recently used entry if full
+        @param key string normalized tokens
+        @param js string JSON encoded entry
+        """
+        with self.lock:
+            if key in self.entries:
+                del self.entries[key]
+            elif len(self.entries) >= self.max_entries:
+                self.entries.popitem(last=False)
+            self.entries[key] = (js, time.time() + self.ttl)
+        return
+
+    #--------------------------------------------------------------------------#
+    def _zadd(self, conn, key):
+        """
+        @brief Record the current time as the last access time of key
+        @param conn StrictRedis instance or pipeline
+        @param key string normalized tokens
+
+        ZADD is sent with execute_command because the argument order of
+        zadd differs between versions of redis-py.
+        """
+        return conn.execute_command("ZADD", self.SEARCH_LRU_KEY, time.time(),
+                                    key)
+
+    #--------------------------------------------------------------------------#
+    def _redis_lookup(self, key):
+        """
+        @brief Look up key in Redis and record the access for LRU
+        @param key string normalized tokens
+        @return string JSON encoded entry or None
+        """
+        try:
+            js = self.redis_conn.get(self.SEARCH_KEY_PREFIX + key)
+            if js is not None:
+                self._zadd(self.redis_conn, key)
+        except Exception, e:
+            self.logger.warn("search_cache: Redis lookup failed: %s" % str(e))
+            return None
+        return js
+
+    #--------------------------------------------------------------------------#
+    def _redis_store(self, key, js):
+        """
+        @brief Put entry in Redis with TTL and remove least recently used
+               entries beyond max_entries
+        @param key string normalized tokens
+        @param js string JSON encoded entry
+        """
+        try:
+            pipe = self.redis_conn.pipeline(transaction=False)
+            pipe.setex(self.SEARCH_KEY_PREFIX + key, self.ttl, js)
+            self._zadd(pipe, key)
+            pipe.zcard(self.SEARCH_LRU_KEY)
+            num_entries = pipe.execute()[-1]
+            if num_entries > self.max_entries:
+                # Entries that have expired stay in the set until they
+                # are the least recently used
+                old_keys = self.redis_conn.zrange(self.SEARCH_LRU_KEY, 0,
+                                                  num_entries - self.max_entries - 1)
+                if old_keys:
+                    pipe = self.redis_conn.pipeline(transaction=False)
+                    for k in old_keys:
+                        pipe.delete(self.SEARCH_KEY_PREFIX + k)
+                    pipe.zrem(self.SEARCH_LRU_KEY, *old_keys)
+                    pipe.execute()
+        except Exception, e:
+            self.logger.warn("search_cache: Redis store failed: %s" % str(e))
+        return
+
+#==============================================================================#
+# TESTING CODE
+if __name__ == "__main__":
+    import logging
+    logging.basicConfig()
+    logger = logging.getLogger("test")
+    sc = SearchResultCache(logger, max_entries=2, ttl=10)
+    sd = { "searcher": "test", "engine": "local", "tokens": "Dublin  City" }
+    rl = [ { "ni": "ni:///sha-256;abc", "text": "Dublin", "desc": "City" } ]
+    assert sc.lookup("dublin city") is None
+    sc.store("Dublin  City", sd, rl)
+    assert sc.lookup(" DUBLIN city ") == { "search": sd, "results": rl }
+    sc.store("a", sd, [])
+    sc.lookup("dublin city")
+    sc.store("b", sd, [])
+    # "a" was least recently used
+    assert sc.lookup("a") is None
+    assert sc.lookup("dublin city") is not None
+    sc.forget("dublin city")
+    assert sc.lookup("dublin city") is None
+    sc.ttl = 0
+    sc.store("c", sd, [])
+    assert sc.lookup("c") is None
+    print sc.stats()
+    print "All tests passed"
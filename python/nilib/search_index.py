@@ -0,0 +1,506 @@
+#!/usr/bin/python
+"""
+@package nilib
+@file search_index.py
+@brief Local full-text search index over the metadata of cached NDOs.
+@version Copyright (C) 2012 Trinity College Dublin and Folly Consulting Ltd
+      This is an adjunct to the NI URI library developed as
+      part of the SAIL project. (http://sail-project.eu)
+
+      Specification(s) - note, versions may change
+          - http://tools.ietf.org/html/draft-farrell-decade-ni-10
+          - http://tools.ietf.org/html/draft-hallambaker-decade-ni-params-03
+          - http://tools.ietf.org/html/draft-kutscher-icnrg-netinf-proto-00
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+       - http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+================================================================================
+
+@details
+NDOSearchIndex maintains an inverted index (term -> NDOs containing term)
+built from the NetInfMetaData of each NDO in the cache.  The following
+metadata fields are indexed, with the weights shown:
+- tokens of previous searches that found the NDO ('search' entries)   3
+- keys and values in the 'metadata' objects of the details entries   1/2
+- the content type                                                    1
+- the locators                                                        1
+
+The cache calls 'index_ndo' every time an entry is created or updated by
+cache_put (see set_search_index in the cache modules), so the index is
+updated incrementally.  'search' ranks NDOs by the number of query terms
+they match and then by the sum of weight * inverse document frequency
+over the matched terms.
+
+Persistence: each (re)indexed NDO is appended as a JSON encoded line to
+a journal file in the cache storage root.  When the index is loaded the
+journal is replayed with later lines overriding earlier ones for the same
+NDO.  When the journal contains many superseded lines it is rewritten
+('compact').  Several processes (e.g., mod_wsgi daemons) can share a
+journal: 'refresh' replays lines appended by other processes since the
+journal was last read and is called before each search.
+
+If the journal does not exist the index can be rebuilt from the cache
+tree with 'rebuild'.
+"""
+
+#==============================================================================#
+#=== Standard modules for Python 2.[567].x distributions ===
+import os
+import re
+import json
+import math
+import threading
+from types import *
+
+#=== Local package modules ===
+from ni import NIname, ni_errs
+
+#==============================================================================#
+# List of classes/global functions in file
+__all__ = ['NDOSearchIndex']
+
+#==============================================================================#
+class NDOSearchIndex:
+    """
+    @brief Persistent inverted index of cached NDO metadata
+
+    Thread safe - one instance is shared by all handler threads.
+    """
+
+    #--------------------------------------------------------------------------#
+    #=== Class constants ===
+    #--------------------------------------------------------------------------#
+    ##@var INDEX_FILE
+    # Name of journal file in cache storage root
+    INDEX_FILE = "/.search_index"
+
+    ##@var SEARCH_WEIGHT
+    # Weight of terms from tokens of searches that found the NDO
+    SEARCH_WEIGHT = 3
+
+    ##@var META_VALUE_WEIGHT
+    # Weight of terms from metadata values
+    META_VALUE_WEIGHT = 2
+
+    ##@var OTHER_WEIGHT
+    # Weight of terms from metadata keys, content type and locators
+    OTHER_WEIGHT = 1
+
+    ##@var COMPACT_RATIO
+    # Rewrite the journal when it has this many lines per indexed NDO
+    COMPACT_RATIO = 3
+
+    ##@var MIN_TERM_LEN
+    # Shorter terms are not indexed
+    MIN_TERM_LEN = 2
+
+    ##@var TERM_RE
+    # Regular expression matching a term (alphanumeric run)
+    TERM_RE = re.compile(r"[^\W_]+", re.UNICODE)
+
+    #--------------------------------------------------------------------------#
+    #=== Instance Variables ===
+    ##@var index_path
+    # string pathname of journal file
+
+    ##@var docs
+    # dictionary ni URI -> dictionary with 'ct', 'title' and 'terms'
+    #                      (dictionary term -> weight) for the NDO
+
+    ##@var postings
+    # dictionary term -> dictionary ni URI -> weight
+
+    ##@var locators
+    # dictionary locator -> ni URI of NDO with that locator in its metadata
+
+    ##@var journal_lines
+    # integer number of lines in journal file
+
+    ##@var journal_pos
+    # integer offset in journal up to which lines have been replayed
+
+    #--------------------------------------------------------------------------#
+    def __init__(self, storage_root, logger):
+        """
+        @brief Constructor - load the index from the journal (if any)
+        @param storage_root string pathname for root of cache tree
+        @param logger object logger instance
+        """
+        self.index_path = storage_root + self.INDEX_FILE
+        self.logger = logger
+        self.loginfo  = logger.info
+        self.logdebug = logger.debug
+        self.logwarn  = logger.warn
+        self.logerror = logger.error
+        self.lock = threading.Lock()
+        self._reset()
+        with self.lock:
+            self._replay()
+        return
+
+    #--------------------------------------------------------------------------#
+    @classmethod
+    def tokenize(cls, text):
+        """
+        @brief Split text into lower case index terms
+        @param text string or unicode to split
+        @return list of unicode terms (in order, may contain duplicates)
+        """
+        if type(text) not in (StringType, UnicodeType):
+            text = unicode(text)
+        elif type(text) == StringType:
+            text = text.decode("utf-8", "replace")
+        return [t for t in cls.TERM_RE.findall(text.lower())
+                if len(t) >= cls.MIN_TERM_LEN]
+
+    #--------------------------------------------------------------------------#
+    def exists(self):
+        """
+        @brief Check if there is a journal file for the index
+        @return boolean True if the journal file exists
+        """
+        return os.path.isfile(self.index_path)
+
+    #--------------------------------------------------------------------------#
+    def index_ndo(self, metadata):
+        """
+        @brief Add or replace the index entry for an NDO
+        @param metadata NetInfMetaData instance with all metadata for the NDO
+                        (i.e., as returned by cache_put or cache_get)
+        @return (none)
+
+        Errors writing the journal are logged but otherwise ignored:
+        the in-memory index is still updated.
+        """
+        doc = self._make_doc(metadata)
+        line = json.dumps(doc) + "\n"
+        with self.lock:
+            self._replay()
+            self._add_doc(doc)
+            # The line is counted when it is next replayed - other
+            # processes may have appended lines in the meantime
+            try:
+                f = open(self.index_path, "ab")
+                f.write(line)
+                f.close()
+            except Exception, e:
+                self.logerror("search_index: unable to append to %s: %s" %
+                              (self.index_path, str(e)))
+            if self.journal_lines > (self.COMPACT_RATIO * max(len(self.docs), 100)):
+                self._write_journal()
+        return
+
+    #--------------------------------------------------------------------------#
+    def search(self, query, limit=10):
+        """
+        @brief Find NDOs whose metadata match query
+        @param query string search tokens
+        @param limit integer maximum number of results
+        @return list of dictionaries with keys 'ni' (canonical ni URI),
+                'ct', 'title' and 'score' in descending order of relevance
+
+        Terms not in the index are ignored.  NDOs that match more of the
+        query terms are ranked above those matching fewer.
+        """
+        terms = set(self.tokenize(query))
+        with self.lock:
+            self._replay()
+            num_docs = len(self.docs)
+            scores = {}
+            matched = {}
+            for t in terms:
+                plist = self.postings.get(t)
+                if not plist:
+                    continue
+                idf = math.log(1.0 + (float(num_docs) / len(plist)))
+                for ni_uri, weight in plist.iteritems():
+                    scores[ni_uri] = scores.get(ni_uri, 0.0) + (weight * idf)
+                    matched[ni_uri] = matched.get(ni_uri, 0) + 1
+            ranked = sorted(scores.keys(),
+                            key=lambda n: (matched[n], scores[n]),
+                            reverse=True)[:limit]
+            return [ { "ni":    ni_uri,
+                       "ct":    self.docs[ni_uri]["ct"],
+                       "title": self.docs[ni_uri]["title"],
+                       "score": scores[ni_uri] } for ni_uri in ranked ]
+
+    #--------------------------------------------------------------------------#
+    def find_by_locator(self, loc):
+        """
+        @brief Find an indexed NDO that has loc as one of its locators
+        @param loc string locator (URL)
+        @return string canonical ni URI of NDO or None if not known
+        """
+        with self.lock:
+            self._replay()
+            return self.locators.get(loc)
+
+    #--------------------------------------------------------------------------#
+    def refresh(self):
+        """
+        @brief Pick up entries appended to the journal by other processes
+        @return (none)
+        """
+        with self.lock:
+            self._replay()
+        return
+
+    #--------------------------------------------------------------------------#
+    def compact(self):
+        """
+        @brief Rewrite the journal with one line per indexed NDO
+        @return boolean True if the journal was rewritten successfully
+        """
+        with self.lock:
+            self._replay()
+            return self._write_journal()
+
+    #--------------------------------------------------------------------------#
+    def rebuild(self, cache):
+        """
+        @brief Recreate the index from the metadata of all NDOs in a cache
+        @param cache object NetInfCache instance (any of the cache modules)
+        @return integer number of NDOs indexed or None if cache listing failed
+        """
+        listing = cache.cache_list()
+        if listing is None:
+            self.logerror("search_index: unable to list cache for rebuild")
+            return None
+        docs = []
+        for alg, entries in listing.iteritems():
+            for entry in entries:
+                ni_name = NIname("ni:///%s;%s" % (alg, entry["dgst"]))
+                if ni_name.validate_ni_url(has_params=True) != ni_errs.niSUCCESS:
+                    continue
+                try:
+                    metadata, cfn = cache.cache_get(ni_name)
+                except Exception, e:
+                    self.logwarn("search_index: skipping %s in rebuild: %s" %
+                                 (ni_name.get_url(), str(e)))
+                    continue
+                docs.append(self._make_doc(metadata))
+        with self.lock:
+            self._reset()
+            for doc in docs:
+                self._add_doc(doc)
+            self._write_journal()
+        self.loginfo("search_index: rebuilt index with %d NDOs" % len(docs))
+        return len(docs)
+
+    #--------------------------------------------------------------------------#
+    def stats(self):
+        """
+        @brief Report size of the index
+        @return dictionary with numbers of NDOs, terms and journal lines
+        """
+        with self.lock:
+            return { "ndos":          len(self.docs),
+                     "terms":         len(self.postings),
+                     "journal_lines": self.journal_lines }
+
+    #--------------------------------------------------------------------------#
+    #=== Private methods ===
+    #--------------------------------------------------------------------------#
+    def _reset(self):
+        """
+        @brief Empty the in-memory index
+        """
+        self.docs = {}
+        self.postings = {}
+        self.locators = {}
+        self.journal_lines = 0
+        self.journal_pos = 0
+        self.journal_ino = None
+        return
+
+    #--------------------------------------------------------------------------#
+    def _make_doc(self, metadata):
+        """
+        @brief Extract the indexed terms from the metadata for an NDO
+        @param metadata NetInfMetaData instance
+        @return dictionary with 'ni', 'ct', 'title', 'locs' and 'terms' entries
+        """
+        terms = {}
+        def add_terms(text, weight):
+            for t in self.tokenize(text):
+                terms[t] = terms.get(t, 0) + weight
+
+        def add_values(val):
+            if type(val) == DictType:
+                for k, v in val.iteritems():
+                    add_terms(k, self.OTHER_WEIGHT)
+                    add_values(v)
+            elif type(val) == ListType:
+                for v in val:
+                    add_values(v)
+            elif val is not None:
+                add_terms(val, self.META_VALUE_WEIGHT)
+
+        ct = metadata.get_ctype()
+        if ct:
+            add_terms(ct, self.OTHER_WEIGHT)
+        locs = metadata.get_loclist()
+        for loc in locs:
+            add_terms(loc, self.OTHER_WEIGHT)
+        metadict, srchlist = metadata.get_metadata()
+        add_values(metadict)
+        title = None
+        if srchlist is not None:
+            for s in srchlist:
+                add_terms(s["tokens"], self.SEARCH_WEIGHT)
+            title = srchlist[0]["tokens"]
+        if title is None:
+            title = metadict.get("title")
+        if (title is None) and (len(locs) > 0):
+            title = locs[0]
+        if title is None:
+            title = metadata.get_ni()
+        return { "ni": metadata.get_ni(), "ct": ct, "title": title,
+                 "locs": locs, "terms": terms }
+
+    #--------------------------------------------------------------------------#
+    def _add_doc(self, doc):
+        """
+        @brief Put doc in the in-memory index replacing any earlier version
+        @param doc dictionary as returned by _make_doc
+        """
+        ni_uri = doc["ni"]
+        old = self.docs.get(ni_uri)
+        if old is not None:
+            for t in old["terms"]:
+                plist = self.postings.get(t)
+                if plist is not None:
+                    plist.pop(ni_uri, None)
+                    if len(plist) == 0:
+                        del self.postings[t]
+            for loc in old.get("locs", []):
+                if self.locators.get(loc) == ni_uri:
+                    del self.locators[loc]
+        self.docs[ni_uri] = doc
+        for t, weight in doc["terms"].iteritems():
+            self.postings.setdefault(t, {})[ni_uri] = weight
+        for loc in doc.get("locs", []):
+            self.locators[loc] = ni_uri
+        return
+
+    #--------------------------------------------------------------------------#
+    def _replay(self):
+        """
+        @brief Apply journal lines not yet seen to the in-memory index
+        Must be called with lock held.
+
+        If the journal has been replaced (compacted by another process)
+        the whole journal is reloaded.
+        """
+        try:
+            st = os.stat(self.index_path)
+        except OSError:
+            return
+        if (st.st_ino != self.journal_ino) or (st.st_size < self.journal_pos):
+            self._reset()
+            self.journal_ino = st.st_ino
+        if st.st_size == self.journal_pos:
+            return
+        try:
+            f = open(self.index_path, "rb")
+            f.seek(self.journal_pos)
+            for line in f:
+                if not line.endswith("\n"):
+                    # Partial line still being written by another process
+                    break
+                self.journal_pos += len(line)
+                self.journal_lines += 1
+                try:
+                    self._add_doc(json.loads(line))
+                except Exception, e:
+                    self.logwarn("search_index: bad journal line ignored: %s" %
+                                 str(e))
+            f.close()
+        except Exception, e:
+            self.logerror("search_index: unable to read %s: %s" %
+                          (self.index_path, str(e)))
+        return
+
+    #--------------------------------------------------------------------------#
+    def _write_journal(self):
+        """
+        @brief Write a new journal with one line per NDO and atomically
+               replace the old one.
+        Must be called with lock held.
+        @return boolean True if successful
+        """
+        tmp_path = "%s.%d" % (self.index_path, os.getpid())
+        try:
+            f = open(tmp_path, "wb")
+            for doc in self.docs.itervalues():
+                f.write(json.dumps(doc) + "\n")
+            f.close()
+            os.rename(tmp_path, self.index_path)
+            st = os.stat(self.index_path)
+        except Exception, e:
+            self.logerror("search_index: unable to write %s: %s" %
+                          (self.index_path, str(e)))
+            return False
+        self.journal_ino = st.st_ino
+        self.journal_pos = st.st_size
+        self.journal_lines = len(self.docs)
+        return True
+
+#==============================================================================#
+# TESTING CODE
+if __name__ == "__main__":
+    import logging
+    import tempfile
+    import shutil
+    from metadata import NetInfMetaData
+
+    logging.basicConfig()
+    logger = logging.getLogger("test")
+    root = tempfile.mkdtemp()
+    try:
+        idx = NDOSearchIndex(root, logger)
+        md1 = NetInfMetaData("ni:///sha-256;abc", "2012-10-10T10:00:00+00:00",
+                             "text/html", 100, "http://en.wikipedia.org/wiki/Dublin",
+                             None, { "search": { "searcher": "test",
+                                                 "engine": "wikipedia",
+                                                 "tokens": "Dublin city" } })
+        md2 = NetInfMetaData("ni:///sha-256;def", "2012-10-10T10:00:00+00:00",
+                             "image/jpeg", 200, "http://example.com/liffey.jpg",
+                             None, { "title": "River Liffey in Dublin" })
+        idx.index_ndo(md1)
+        idx.index_ndo(md2)
+        r = idx.search("dublin liffey")
+        assert [x["ni"] for x in r] == ["ni:///sha-256;def", "ni:///sha-256;abc"], r
+        assert idx.search("wikipedia")[0]["ni"] == "ni:///sha-256;abc"
+        assert idx.search("nothing here") == []
+        assert idx.find_by_locator("http://example.com/liffey.jpg") == \
+               "ni:///sha-256;def"
+        # Re-index replaces old terms
+        md2.json_obj["details"][0]["metadata"] = { "title": "Shannon" }
+        idx.index_ndo(md2)
+        assert idx.search("river") == []
+        # Persistence and incremental pick up by another instance
+        idx2 = NDOSearchIndex(root, logger)
+        assert idx2.stats()["ndos"] == 2
+        assert idx2.search("shannon")[0]["ni"] == "ni:///sha-256;def"
+        idx.index_ndo(md1)
+        idx2.refresh()
+        assert idx2.stats()["journal_lines"] == 4
+        assert idx.compact()
+        idx2.refresh()
+        assert idx2.stats() == { "ndos": 2, "terms": idx.stats()["terms"],
+                                 "journal_lines": 2 }
+        print idx.stats()
+        print "All tests passed"
+    finally:
+        shutil.rmtree(root)
@@ -136,6 +136,38 @@ class _StreamingHTTPMixin:
                 self.close()
             raise
 
+#==============================================================================#
+def _is_chunked(req):
+    """
+    @brief Check if a request body is to be sent with chunked transfer encoding
+    @param req object request to be sent
+    @return boolean True if the request has a Transfer-Encoding: chunked header
+    """
+    return req.get_header("Transfer-encoding", "").lower() == "chunked"
+
+#------------------------------------------------------------------------------#
+def _do_request_chunked(handler_class, handler, req):
+    """
+    @brief Canonicalize a request with a chunked body
+    @param handler_class class urllib2 handler whose do_request_ is used
+    @param handler object handler instance
+    @param req object request to be sent
+    @return canonicalized request
+
+    urllib2 insists on adding a Content-Length header for a request with a
+    body, which is wrong for a chunked body (and fails for an iterable).
+    The body is hidden while the request is canonicalized.  The
+    Content-Type header must already be set (multipart_encode_vectored
+    does this).
+    """
+    data = req.data
+    req.data = None
+    try:
+        req = handler_class.do_request_(handler, req)
+    finally:
+        req.data = data
+    return req
+
 #==============================================================================#
 class StreamingHTTPConnection(_StreamingHTTPMixin, httplib.HTTPConnection):
     """
@@ -224,13 +256,16 @@ class StreamingHTTPHandler(urllib2.HTTPHandler):
         @return canonicalized request
         
         Make sure that Content-Length is specified
-        if we're using an interable value
+        if we're using an interable value, unless the body is sent
+        with chunked transfer encoding
 
         Call superclass to process the request
         """
         # Make sure that if we're using an iterable object as the request
         # body, that we've also specified Content-Length
         if req.has_data():
+            if _is_chunked(req):
+                return _do_request_chunked(urllib2.HTTPHandler, self, req)
             data = req.get_data()
             if hasattr(data, 'read') or hasattr(data, 'next'):
                 if not req.has_header('Content-length'):
@@ -274,9 +309,12 @@ if hasattr(httplib, 'HTTPS'):
             @return response object
             
             Make sure that if we're using an iterable object as the request
-            body, that we've also specified Content-Length
+            body, that we've also specified Content-Length (unless the body
+            is sent with chunked transfer encoding)
             """
             if req.has_data():
+                if _is_chunked(req):
+                    return _do_request_chunked(urllib2.HTTPSHandler, self, req)
                 data = req.get_data()
                 if hasattr(data, 'read') or hasattr(data, 'next'):
                     if not req.has_header('Content-length'):
@@ -0,0 +1,148 @@
+#!/usr/bin/python
+"""
+@package nilib
+@file bench_encode.py
+@brief Throughput benchmark for the multipart/form-data encoders in encode.py
+@version Copyright (C) 2012 Trinity College Dublin and Folly Consulting Ltd
+      This is an adjunct to the NI URI library developed as
+      part of the SAIL project. (http://sail-project.eu)
+
+      Specification(s) - note, versions may change
+          - http://tools.ietf.org/html/draft-farrell-decade-ni-10
+          - http://tools.ietf.org/html/draft-hallambaker-decade-ni-params-03
+          - http://tools.ietf.org/html/draft-kutscher-icnrg-netinf-proto-00
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+       - http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+================================================================================
+
+@details
+Encodes a publish form (as built by nipubdir) for a temporary file of the
+requested size with multipart_encode and with multipart_encode_vectored
+(with and without chunked transfer encoding), generating the ni URI digest
+on the fly.  The encoded blocks are written to a socket pair and read back
+by a thread to mimic sending the request.
+
+Reports the CPU time used by the process and the upload rate per core
+(MB of form encoded per CPU second) for each encoder.
+
+The results are written to stdout.
+"""
+
+#==============================================================================#
+import os
+import sys
+import socket
+import tempfile
+import threading
+import time
+from optparse import OptionParser
+
+from nilib.ni import NIdigester, NI_SCHEME
+from nilib.encode import MultipartParam, multipart_encode, \
+                         multipart_encode_vectored
+
+#==============================================================================#
+def sink(sock):
+    """
+    @brief Read and discard everything sent on a socket
+    @param sock socket to read from
+    """
+    while sock.recv(1 << 20):
+        pass
+    return
+
+#------------------------------------------------------------------------------#
+def encode_once(file_name, encoder, **kwargs):
+    """
+    @brief Encode and send a publish form for a file
+    @param file_name string pathname of content file
+    @param encoder callable multipart_encode or multipart_encode_vectored
+    @param kwargs additional arguments for encoder
+    @return tuple (integer octets sent, float CPU seconds used)
+    """
+    digester = NIdigester()
+    digester.set_url((NI_SCHEME, "example.com", "/sha-256"))
+    f = open(file_name, "rb")
+    octet_param = MultipartParam("octets", fileobj=f,
+                                 filetype="application/octet-stream",
+                                 filename=file_name, digester=digester)
+    uri_dict = { "generator": octet_param.get_url,
+                 "length": (len(digester.get_url()) + len(";") +
+                            digester.get_b64_encoded_length()) }
+    param_list = [octet_param,
+                  ("URI",     uri_dict),
+                  ("msgid",   "12345"),
+                  ("ext",     "{ \"meta\": { } }"),
+                  ("fullPut", "yes"),
+                  ("rform",   "json")]
+
+    (tx, rx) = socket.socketpair()
+    reader = threading.Thread(target=sink, args=(rx,))
+    reader.start()
+    sent = 0
+    t0 = os.times()
+    datagen, headers = encoder(param_list, **kwargs)
+    for block in datagen:
+        tx.sendall(block)
+        sent += len(block)
+    t1 = os.times()
+    tx.close()
+    reader.join()
+    rx.close()
+    f.close()
+    return (sent, (t1[0] - t0[0]) + (t1[1] - t0[1]))
+
+#==============================================================================#
+def bench_encode():
+    """
+    @brief Run the benchmark
+    """
+    parser = OptionParser("%prog [-s <file size MB>] [-r <repeats>]")
+    parser.add_option("-s", "--size", dest="size", default=64,
+                      type="int",
+                      help="Size of file to upload in MB (default 64).")
+    parser.add_option("-r", "--repeats", dest="repeats", default=3,
+                      type="int",
+                      help="Number of uploads with each encoder (default 3).")
+    (options, args) = parser.parse_args()
+
+    (fd, file_name) = tempfile.mkstemp(prefix="bench_encode")
+    try:
+        blk = os.urandom(1 << 20)
+        for i in range(options.size):
+            os.write(fd, blk)
+        os.close(fd)
+
+        encoders = [ ("multipart_encode", multipart_encode, {}),
+                     ("vectored", multipart_encode_vectored, {}),
+                     ("vectored chunked", multipart_encode_vectored,
+                      { "chunked": True }) ]
+        print "%-18s %10s %10s %12s" % ("Encoder", "MB", "CPU s", "MB/s/core")
+        for (label, encoder, kwargs) in encoders:
+            total = 0
+            cpu = 0.0
+            for i in range(options.repeats):
+                (sent, used) = encode_once(file_name, encoder, **kwargs)
+                total += sent
+                cpu += used
+            mb = total / 1048576.0
+            print "%-18s %10.1f %10.2f %12.1f" % (label, mb, cpu,
+                                                   mb / cpu if cpu else 0.0)
+    finally:
+        os.remove(file_name)
+    return
+
+#==============================================================================#
+if __name__ == "__main__":
+    bench_encode()
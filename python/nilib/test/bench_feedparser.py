@@ -0,0 +1,135 @@
+#!/usr/bin/python
+"""
+@package nilib
+@file bench_feedparser.py
+@brief Throughput benchmark for parsing multipart GET responses with nifeedparser
+@version Copyright (C) 2012 Trinity College Dublin and Folly Consulting Ltd
+      This is an adjunct to the NI URI library developed as
+      part of the SAIL project. (http://sail-project.eu)
+
+      Specification(s) - note, versions may change
+          - http://tools.ietf.org/html/draft-farrell-decade-ni-10
+          - http://tools.ietf.org/html/draft-hallambaker-decade-ni-params-03
+          - http://tools.ietf.org/html/draft-kutscher-icnrg-netinf-proto-00
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+       - http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+================================================================================
+
+@details
+Builds a multipart/mixed response of the form returned by a NetInf GET
+(JSON metadata followed by the content) in memory and feeds it to the
+parser in blocks, as the GET clients do, digesting the content as it is
+written to /dev/null.
+
+Runs with the content part carrying a Content-Length header (as nihandler
+sends it) and without (so the parser has to scan for the boundary), each
+with 4096 octet blocks (the size previously used by the clients) and with
+FEED_BLK_SIZE blocks.  For comparison the parser is also run without a
+destination list which makes it split the content into lines.
+
+Reports the CPU time used and the parse rate per core (MB per CPU second).
+The results are written to stdout.
+"""
+
+#==============================================================================#
+import os
+import sys
+import json
+import hashlib
+from optparse import OptionParser
+
+from nilib.nifeedparser import FeedParser, DigestFile, FEED_BLK_SIZE
+
+#==============================================================================#
+def make_response(content, with_length):
+    """
+    @brief Make a GET response body
+    @param content string content octets
+    @param with_length boolean True if content part has Content-Length
+    @return tuple (string primer with top level Content-Type, string body)
+    """
+    mb = "=====1234567890"
+    ct_hdrs = "Content-Type: application/octet-stream\nMIME-Version: 1.0\n"
+    if with_length:
+        ct_hdrs += "Content-Length: %d\n" % len(content)
+    body = "".join(["--%s\n" % mb,
+                    "Content-Type: application/json\nMIME-Version: 1.0\n\n",
+                    json.dumps({ "status": 200 }),
+                    "\n\n--%s\n" % mb,
+                    ct_hdrs, "\n",
+                    content,
+                    "\n--%s--\n" % mb])
+    return ("Content-Type: multipart/mixed; boundary=%s\r\n\r\n" % mb, body)
+
+#------------------------------------------------------------------------------#
+def parse_once(primer, body, blk_size, use_dest):
+    """
+    @brief Parse a response fed in blocks
+    @param primer string top level header
+    @param body string response body
+    @param blk_size integer size of blocks fed to parser
+    @param use_dest boolean True to write content to a DigestFile
+    @return float CPU seconds used
+    """
+    if use_dest:
+        digester = DigestFile("/dev/null", None, hashlib.sha256)
+        parser = FeedParser(dest_list=[None, None, digester])
+    else:
+        parser = FeedParser()
+    t0 = os.times()
+    parser.feed(primer)
+    for i in xrange(0, len(body), blk_size):
+        parser.feed(body[i:i+blk_size])
+    msg = parser.close()
+    t1 = os.times()
+    if len(msg.defects) > 0:
+        print "Parse reported defects: %s" % str(msg.defects)
+    return (t1[0] - t0[0]) + (t1[1] - t0[1])
+
+#==============================================================================#
+def bench_feedparser():
+    """
+    @brief Run the benchmark
+    """
+    parser = OptionParser("%prog [-s <content size MB>] [-r <repeats>]")
+    parser.add_option("-s", "--size", dest="size", default=64,
+                      type="int",
+                      help="Size of content in MB (default 64).")
+    parser.add_option("-r", "--repeats", dest="repeats", default=3,
+                      type="int",
+                      help="Number of parses of each kind (default 3).")
+    (options, args) = parser.parse_args()
+
+    content = os.urandom(options.size << 20)
+    runs = [ ("lines",          False, True,  4096),
+             ("lines",          False, True,  FEED_BLK_SIZE),
+             ("Content-Length", True,  True,  4096),
+             ("Content-Length", True,  True,  FEED_BLK_SIZE),
+             ("boundary scan",  True,  False, 4096),
+             ("boundary scan",  True,  False, FEED_BLK_SIZE) ]
+    print "%-16s %8s %10s %10s %12s" % ("Mode", "Block", "MB", "CPU s",
+                                        "MB/s/core")
+    for (label, use_dest, with_length, blk_size) in runs:
+        (primer, body) = make_response(content, with_length)
+        cpu = 0.0
+        for i in range(options.repeats):
+            cpu += parse_once(primer, body, blk_size, use_dest)
+        mb = options.repeats * len(body) / 1048576.0
+        print "%-16s %8d %10.1f %10.2f %12.1f" % (label, blk_size, mb, cpu,
+                                                   mb / cpu if cpu else 0.0)
+    return
+
+#==============================================================================#
+if __name__ == "__main__":
+    bench_feedparser()
@@ -0,0 +1,145 @@
+#!/usr/bin/python
+"""
+@package nilib
+@file bench_memory.py
+@brief Memory benchmark for the per-request objects NIname, NextHop, HTTPRequest and MsgDtnEvt
+@version Copyright (C) 2012 Trinity College Dublin and Folly Consulting Ltd
+      This is an adjunct to the NI URI library developed as
+      part of the SAIL project. (http://sail-project.eu)
+
+      Specification(s) - note, versions may change
+          - http://tools.ietf.org/html/draft-farrell-decade-ni-10
+          - http://tools.ietf.org/html/draft-hallambaker-decade-ni-params-03
+          - http://tools.ietf.org/html/draft-kutscher-icnrg-netinf-proto-00
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+       - http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+================================================================================
+
+@details
+Creates a number of instances of each class and reports the memory used
+by the instances themselves (not the attribute values, which are shared)
+compared with the same attributes held in a per-instance dictionary as
+they were before the classes were given __slots__.
+
+The DTN classes are skipped if the dtnapi module is not installed.
+
+The results are written to stdout.
+"""
+
+#==============================================================================#
+import sys
+from optparse import OptionParser
+
+from nilib.ni import NIname, NIproc
+from nilib.niforward import NextHop, NICLHTTP
+
+#==============================================================================#
+class DictBacked:
+    """
+    @brief Old style class with attributes in a per-instance dictionary
+    """
+    pass
+
+#------------------------------------------------------------------------------#
+def slot_names(obj):
+    """
+    @brief Get the names of all the slots of an object
+    @param obj object instance of class with __slots__
+    @return list of slot names
+    """
+    names = []
+    for cls in type(obj).__mro__:
+        names.extend(cls.__dict__.get("__slots__", ()))
+    return names
+
+#------------------------------------------------------------------------------#
+def sizes(obj):
+    """
+    @brief Work out the memory used by an object and a dictionary based
+           equivalent
+    @param obj object instance of class with __slots__
+    @return tuple (integer octets used by obj, integer octets used by
+                   equivalent with attribute dictionary)
+    """
+    d = DictBacked()
+    for name in slot_names(obj):
+        if hasattr(obj, name):
+            setattr(d, name, getattr(obj, name))
+    return (sys.getsizeof(obj), sys.getsizeof(d) + sys.getsizeof(d.__dict__))
+
+#------------------------------------------------------------------------------#
+def report(label, objs):
+    """
+    @brief Print the memory used by a list of objects
+    @param label string name of class
+    @param objs list of object instances
+    @return (none)
+    """
+    slotted = 0
+    dicted = 0
+    for obj in objs:
+        (s, d) = sizes(obj)
+        slotted += s
+        dicted += d
+    n = len(objs)
+    print "%-12s %8d %10.1f %10.1f %10.2f %10.2f %6.0f%%" % \
+          (label, n, float(slotted) / n, float(dicted) / n,
+           slotted / 1048576.0, dicted / 1048576.0,
+           100.0 * slotted / dicted)
+    return
+
+#==============================================================================#
+def bench_memory():
+    """
+    @brief Run the benchmark
+    """
+    parser = OptionParser("%prog [-n <number of instances>]")
+    parser.add_option("-n", "--number", dest="number", default=100000,
+                      type="int",
+                      help="Number of instances of each class (default 100000).")
+    (options, args) = parser.parse_args()
+    n = options.number
+
+    print "%-12s %8s %10s %10s %10s %10s %7s" % \
+          ("Class", "Count", "Slots B", "Dict B", "Slots MB", "Dict MB",
+           "Ratio")
+
+    names = []
+    for i in range(n):
+        name = NIname("ni://example.com/sha-256;")
+        NIproc.makenib(name, str(i))
+        names.append(name)
+    report("NIname", names)
+
+    report("NextHop", [NextHop(NICLHTTP, "node%d.example.com:8080" % i)
+                       for i in range(n)])
+
+    try:
+        import dtnapi
+        from nilib.nidtnbpq import BPQ
+        from nilib.nidtnevtmsg import HTTPRequest, MsgDtnEvt
+    except ImportError, e:
+        print "DTN classes skipped: %s" % str(e)
+        return
+
+    reqs = [HTTPRequest(HTTPRequest.HTTP_GET, dtnapi.dtn_bundle(), BPQ(), {},
+                        ni_name=names[i])
+            for i in range(n)]
+    report("HTTPRequest", reqs)
+    report("MsgDtnEvt", [MsgDtnEvt(MsgDtnEvt.MSG_TO_DTN, req) for req in reqs])
+    return
+
+#==============================================================================#
+if __name__ == "__main__":
+    bench_memory()
@@ -0,0 +1,545 @@
+#!/usr/bin/python
+"""
+@package nilib
+@file bench_micro.py
+@brief Micro-benchmarks for the NetInf library and server hot paths
+@version Copyright (C) 2012 Trinity College Dublin and Folly Consulting Ltd
+      This is an adjunct to the NI URI library developed as
+      part of the SAIL project. (http://sail-project.eu)
+
+      Specification(s) - note, versions may change
+          - http://tools.ietf.org/html/draft-farrell-decade-ni-10
+          - http://tools.ietf.org/html/draft-hallambaker-decade-ni-params-03
+          - http://tools.ietf.org/html/draft-kutscher-icnrg-netinf-proto-00
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+       - http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+================================================================================
+
+@details
+Times a set of operations that are on the hot paths of the clients and
+the server:
+
+- niname.*        NIname parse and validate (cached and uncached names)
+- niproc.*        NIproc.digest_file on a 1 MiB file
+- metadata.*      NetInfMetaData.summary
+- cache.<kind>.*  cache_put (new and update) and cache_get for the single
+                  process, multiprocess and Redis caches
+- handler.*       NIHTTPRequestHandler.send_get_header response assembly
+- feedparser.*    parsing a 1 MiB GET response with nifeedparser
+- bpq.*           nidtnbpq.BPQ build_for_net and init_from_net
+
+Each benchmark is run enough times to take at least the minimum time and
+the best of several repeats is reported as microseconds per operation.
+Benchmarks whose modules cannot be imported here (e.g., posix_ipc, magic
+or the _nistruct extension are not installed) are reported as skipped.
+
+The Redis cache benchmark uses fakeredis if it is installed.  Otherwise it
+needs a real Redis server and an explicitly chosen database that is empty
+(the database is flushed afterwards).
+
+Results are written as JSON (to stdout or a file) so that they can be
+saved as a baseline.  When a baseline is given, each result is compared
+with it and the change reported; the exit code is 1 if any benchmark is
+slower than the baseline by more than the threshold.
+"""
+
+#==============================================================================#
+import os
+import sys
+import json
+import time
+import shutil
+import base64
+import logging
+import platform
+import tempfile
+from optparse import OptionParser
+
+from nilib.ni import NIname, NIproc
+
+#==============================================================================#
+##@var MIN_TIME
+# Minimum time in seconds for one repeat of a benchmark
+MIN_TIME = 0.2
+
+##@var REPEATS
+# Default number of repeats of each benchmark
+REPEATS = 3
+
+##@var FILE_SIZE
+# Size of content files used by benchmarks
+FILE_SIZE = 1 << 20
+
+##@var NAME_COUNT
+# Number of distinct names used by benchmarks that need many names
+NAME_COUNT = 4096
+
+##@var NEW_ENTRY_COUNT
+# Number of names available for the cache new entry benchmarks
+NEW_ENTRY_COUNT = 50000
+
+#==============================================================================#
+class SkipBench(Exception):
+    """
+    @brief Raised by benchmark setup if it cannot run here
+    """
+    pass
+
+#------------------------------------------------------------------------------#
+def make_names(count, prefix="ni://example.com/sha-256;"):
+    """
+    @brief Make a list of distinct ni URI strings
+    @param count integer number of names
+    @param prefix string scheme, authority and algorithm
+    @return list of strings
+    """
+    names = []
+    for i in range(count):
+        n = NIname(prefix)
+        NIproc.makenib(n, "bench content %d" % i)
+        names.append(n.get_url())
+    return names
+
+#------------------------------------------------------------------------------#
+def make_file(dir_name, size=FILE_SIZE):
+    """
+    @brief Make a file of random content
+    @param dir_name string directory for file
+    @param size integer file size in octets
+    @return string pathname of file
+    """
+    (fd, file_name) = tempfile.mkstemp(dir=dir_name)
+    os.write(fd, os.urandom(size))
+    os.close(fd)
+    return file_name
+
+#------------------------------------------------------------------------------#
+def cycle(items):
+    """
+    @brief Make a function that returns the items of a list in rotation
+    @param items list
+    @return function with no parameters
+    """
+    state = { "i": 0 }
+    n = len(items)
+    def next_item():
+        i = state["i"]
+        state["i"] = (i + 1) % n
+        return items[i]
+    return next_item
+
+#==============================================================================#
+# Benchmark setup functions
+# Each takes the working directory and options and returns a list of
+# tuples (name, function to time, number of octets processed per call or 0).
+#==============================================================================#
+def bench_niname(work_dir, options):
+    url = make_names(1)[0]
+    def parse_validate_cached():
+        NIname(url).validate_ni_url(has_params=True)
+    # More names than the validated name cache holds
+    next_url = cycle(make_names(NAME_COUNT))
+    def parse_validate_uncached():
+        NIname(next_url()).validate_ni_url(has_params=True)
+    return [("niname.parse_validate.cached", parse_validate_cached, 0),
+            ("niname.parse_validate.uncached", parse_validate_uncached, 0)]
+
+#------------------------------------------------------------------------------#
+def bench_niproc(work_dir, options):
+    file_name = make_file(work_dir)
+    ni_url = NIname("ni:///sha-256")
+    ni_url.validate_ni_url(has_params=False)
+    def digest_file():
+        NIproc.digest_file(ni_url, file_name)
+    return [("niproc.digest_file.sha-256.1MiB", digest_file, FILE_SIZE)]
+
+#------------------------------------------------------------------------------#
+def bench_metadata(work_dir, options):
+    from nilib.metadata import NetInfMetaData
+    md = NetInfMetaData(make_names(1)[0], "2012-12-01T12:00:00+00:00",
+                        "application/octet-stream", FILE_SIZE,
+                        "http://node1.example.com", "http://node2.example.com",
+                        { "meta": { "publish": "bench", "tags": ["a", "b"] } })
+    for i in range(5):
+        md.add_new_details("2012-12-0%dT12:00:00+00:00" % (i + 2),
+                           "http://node%d.example.com" % (i + 3), None,
+                           { "meta": { "update": i } })
+    def summary():
+        md.summary("http://local.example.com")
+    return [("metadata.summary", summary, 0)]
+
+#------------------------------------------------------------------------------#
+def cache_benches(kind, cache, work_dir):
+    """
+    @brief Make the benchmarks for a cache instance
+    @param kind string label for cache type
+    @param cache cache instance with empty cache
+    @param work_dir string working directory
+    @return list of benchmark tuples
+    """
+    from nilib.metadata import NetInfMetaData
+    def ni_names(urls):
+        names = []
+        for url in urls:
+            n = NIname(url)
+            n.validate_ni_url(has_params=True)
+            names.append(n)
+        return names
+    def metadata(n):
+        return NetInfMetaData(n.get_canonical_ni_url(),
+                              "2012-12-01T12:00:00+00:00",
+                              "application/octet-stream", 1000,
+                              "http://node1.example.com", None, {})
+    # Entries for the update and get benchmarks are made beforehand
+    names = ni_names(make_names(NAME_COUNT))
+    for n in names:
+        cache.cache_put(n, metadata(n), None)
+    # Names for new entries are made from random digests as hashing
+    # content for this many names would take too long
+    new_names = ni_names(["ni://example.com/sha-256;%s" %
+                          base64.urlsafe_b64encode(os.urandom(32)).rstrip("=")
+                          for i in xrange(NEW_ENTRY_COUNT)])
+    new_names.reverse()
+    def put_new():
+        if len(new_names) == 0:
+            raise SkipBench("More than %d new entries needed" %
+                            NEW_ENTRY_COUNT)
+        n = new_names.pop()
+        cache.cache_put(n, metadata(n), None)
+    next_update = cycle(names)
+    def put_update():
+        n = next_update()
+        cache.cache_put(n, metadata(n), None)
+    next_get = cycle(names)
+    def get():
+        cache.cache_get(next_get())
+    return [("cache.%s.put_new" % kind, put_new, 0),
+            ("cache.%s.put_update" % kind, put_update, 0),
+            ("cache.%s.get" % kind, get, 0)]
+
+def bench_cache_single(work_dir, options):
+    from nilib.cache_single import SingleNetInfCache
+    root = tempfile.mkdtemp(dir=work_dir)
+    return cache_benches("single",
+                         SingleNetInfCache(root + "/", logging.getLogger("bench")),
+                         work_dir)
+
+def bench_cache_multi(work_dir, options):
+    from nilib.cache_multi import MultiNetInfCache
+    root = tempfile.mkdtemp(dir=work_dir)
+    return cache_benches("multi",
+                         MultiNetInfCache(root + "/", logging.getLogger("bench")),
+                         work_dir)
+
+def bench_cache_redis(work_dir, options):
+    from nilib.cache_redis import RedisNetInfCache
+    try:
+        import fakeredis
+        redis_conn = fakeredis.FakeStrictRedis()
+    except ImportError:
+        if options.redis_db is None:
+            raise SkipBench("fakeredis not installed and no Redis database "
+                            "given with -R")
+        import redis
+        redis_conn = redis.StrictRedis(db=options.redis_db)
+        try:
+            if redis_conn.dbsize() != 0:
+                raise SkipBench("Redis database %d is not empty" %
+                                options.redis_db)
+        except redis.RedisError, e:
+            raise SkipBench("Redis not accessible: %s" % str(e))
+        options.flush_redis.append(redis_conn)
+    root = tempfile.mkdtemp(dir=work_dir)
+    cache = RedisNetInfCache(root + "/", logging.getLogger("bench"))
+    if not cache.set_redis_conn(redis_conn):
+        raise SkipBench("Unable to set up Redis cache")
+    return cache_benches("redis", cache, work_dir)
+
+#------------------------------------------------------------------------------#
+def bench_handler(work_dir, options):
+    from nilib.nihandler import NIHTTPRequestHandler
+    from nilib.metadata import NetInfMetaData
+
+    class BenchHandler(NIHTTPRequestHandler):
+        # Handler with the output methods replaced by counting the octets
+        def __init__(self):
+            self.authority = "local.example.com"
+            self.out_len = 0
+            log = logging.getLogger("bench")
+            self.logdebug = log.debug
+            self.logerror = log.error
+            self.loginfo = log.info
+            self.logwarn = log.warn
+        def send_response(self, code, message=None):
+            self.out_len += len(message or "") + 12
+        def send_header(self, keyword, value):
+            self.out_len += len(keyword) + len(value) + 4
+        def end_headers(self):
+            self.out_len += 2
+        def send_string(self, buf):
+            self.out_len += len(buf)
+        def send_file(self, source):
+            source.close()
+        def send_error(self, code, message=None):
+            raise SkipBench("send_get_header failed: %d %s" % (code, message))
+
+    handler = BenchHandler()
+    ni_url = NIname(make_names(1)[0])
+    ni_url.validate_ni_url(has_params=True)
+    md = NetInfMetaData(ni_url.get_canonical_ni_url(),
+                        "2012-12-01T12:00:00+00:00",
+                        "application/octet-stream", FILE_SIZE,
+                        "http://node1.example.com", None, {})
+    content_file = make_file(work_dir)
+    def send_get_header():
+        handler.send_get_header(ni_url, md, content_file, "12345")
+    def send_get_header_metadata():
+        handler.send_get_header(ni_url, md, None, "12345")
+    return [("handler.send_get_header.content", send_get_header, 0),
+            ("handler.send_get_header.metadata", send_get_header_metadata, 0)]
+
+#------------------------------------------------------------------------------#
+def bench_feedparser(work_dir, options):
+    import hashlib
+    from nilib.nifeedparser import FeedParser, DigestFile, FEED_BLK_SIZE
+    mb = "=====1234567890"
+    content = os.urandom(FILE_SIZE)
+    body = "".join(["--%s\n" % mb,
+                    "Content-Type: application/json\nMIME-Version: 1.0\n\n",
+                    json.dumps({ "status": 200, "msgid": "12345" }),
+                    "\n\n--%s\n" % mb,
+                    "Content-Type: application/octet-stream\n",
+                    "Content-Length: %d\n\n" % len(content),
+                    content,
+                    "\n--%s--\n" % mb])
+    primer = "Content-Type: multipart/mixed; boundary=%s\r\n\r\n" % mb
+    blocks = [body[i:i+FEED_BLK_SIZE]
+              for i in range(0, len(body), FEED_BLK_SIZE)]
+    def parse():
+        digester = DigestFile("/dev/null", None, hashlib.sha256)
+        parser = FeedParser(dest_list=[None, None, digester])
+        parser.feed(primer)
+        for block in blocks:
+            parser.feed(block)
+        parser.close()
+    return [("feedparser.get_response.1MiB", parse, len(body))]
+
+#------------------------------------------------------------------------------#
+def bench_bpq(work_dir, options):
+    from nilib.nidtnbpq import BPQ
+    bpq = BPQ()
+    bpq.set_bpq_kind(BPQ.BPQ_BLOCK_KIND_QUERY)
+    bpq.set_matching_rule(BPQ.BPQ_MATCHING_RULE_EXACT)
+    bpq.set_creation_info(1357000000, 42)
+    bpq.set_src_eid("dtn://node1.dtn/netinfproto/app/response")
+    bpq.set_bpq_id("msgid_12345")
+    bpq.set_bpq_val(make_names(1)[0])
+    packed = bpq.build_for_net()
+    if packed is None:
+        raise SkipBench("BPQ build_for_net failed")
+    def pack():
+        bpq.build_for_net()
+    def unpack():
+        BPQ().init_from_net(packed)
+    return [("bpq.build_for_net", pack, 0),
+            ("bpq.init_from_net", unpack, 0)]
+
+#------------------------------------------------------------------------------#
+##@var BENCH_SETUPS
+# List of (group name, setup function)
+BENCH_SETUPS = [ ("niname",       bench_niname),
+                 ("niproc",       bench_niproc),
+                 ("metadata",     bench_metadata),
+                 ("cache.single", bench_cache_single),
+                 ("cache.multi",  bench_cache_multi),
+                 ("cache.redis",  bench_cache_redis),
+                 ("handler",      bench_handler),
+                 ("feedparser",   bench_feedparser),
+                 ("bpq",          bench_bpq) ]
+
+#==============================================================================#
+def time_bench(func, repeats, min_time):
+    """
+    @brief Time a function
+    @param func function with no parameters
+    @param repeats integer number of timed repeats
+    @param min_time float minimum seconds for each repeat
+    @return tuple (float best seconds per call, integer calls per repeat)
+    """
+    # Find a number of calls that takes at least min_time
+    number = 1
+    while True:
+        t0 = time.time()
+        for i in xrange(number):
+            func()
+        elapsed = time.time() - t0
+        if elapsed >= min_time:
+            break
+        if elapsed <= 0:
+            number *= 10
+        else:
+            number = max(number * 2,
+                         int(number * min_time * 1.2 / elapsed))
+    best = elapsed / number
+    for r in range(repeats - 1):
+        t0 = time.time()
+        for i in xrange(number):
+            func()
+        best = min(best, (time.time() - t0) / number)
+    return (best, number)
+
+#------------------------------------------------------------------------------#
+def run_benches(options):
+    """
+    @brief Run the selected benchmarks
+    @param options options from command line
+    @return dictionary results report
+    """
+    report = { "python":    platform.python_version(),
+               "platform":  platform.platform(),
+               "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "results":   {},
+               "skipped":   {} }
+    work_dir = tempfile.mkdtemp(prefix="bench_micro")
+    options.flush_redis = []
+    try:
+        for (group, setup) in BENCH_SETUPS:
+            if (options.filter is not None) and (options.filter not in group):
+                continue
+            try:
+                benches = setup(work_dir, options)
+            except (ImportError, SkipBench), e:
+                report["skipped"][group] = str(e)
+                print >>sys.stderr, "%-40s skipped: %s" % (group, str(e))
+                continue
+            for (name, func, octets) in benches:
+                try:
+                    (secs, number) = time_bench(func, options.repeats,
+                                                options.min_time)
+                except SkipBench, e:
+                    report["skipped"][name] = str(e)
+                    print >>sys.stderr, "%-40s skipped: %s" % (name, str(e))
+                    continue
+                rslt = { "usec_per_op": secs * 1000000,
+                         "ops_per_sec": 1.0 / secs if secs > 0 else None,
+                         "calls":       number,
+                         "repeats":     options.repeats }
+                if octets > 0:
+                    rslt["mb_per_sec"] = octets / secs / 1048576.0
+                report["results"][name] = rslt
+                print >>sys.stderr, "%-40s %12.2f usec/op" % \
+                      (name, rslt["usec_per_op"])
+    finally:
+        for redis_conn in options.flush_redis:
+            redis_conn.flushdb()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return report
+
+#------------------------------------------------------------------------------#
+def compare(report, baseline, threshold):
+    """
+    @brief Compare results with a baseline and print a table of changes
+    @param report dictionary results of this run
+    @param baseline dictionary results of baseline run
+    @param threshold float percentage slowdown counted as a regression
+    @return list of names of benchmarks that have regressed
+    """
+    regressions = []
+    print >>sys.stderr, "\n%-40s %12s %12s %9s" % ("Benchmark", "Base usec",
+                                                   "Now usec", "Change")
+    base_results = baseline.get("results", {})
+    for name in sorted(report["results"]):
+        now = report["results"][name]["usec_per_op"]
+        base = base_results.get(name)
+        if base is None:
+            print >>sys.stderr, "%-40s %12s %12.2f %9s" % (name, "-", now, "new")
+            continue
+        base = base["usec_per_op"]
+        change = 100.0 * (now - base) / base
+        flag = ""
+        if change > threshold:
+            flag = " REGRESSION"
+            regressions.append(name)
+        print >>sys.stderr, "%-40s %12.2f %12.2f %+8.1f%%%s" % \
+              (name, base, now, change, flag)
+    report["baseline"] = { "timestamp":   baseline.get("timestamp"),
+                           "threshold":   threshold,
+                           "regressions": regressions }
+    return regressions
+
+#==============================================================================#
+def bench_micro():
+    """
+    @brief Run the benchmark suite
+    """
+    parser = OptionParser("%prog [-k <name filter>] [-r <repeats>] "
+                          "[-m <min seconds>] [-o <results file>]\n"
+                          "       [-b <baseline file> [-t <threshold %>]] "
+                          "[-R <Redis db>]")
+    parser.add_option("-k", "--filter", dest="filter", default=None,
+                      type="string",
+                      help="Only run benchmark groups containing this string.")
+    parser.add_option("-r", "--repeats", dest="repeats", default=REPEATS,
+                      type="int",
+                      help="Number of repeats of each benchmark (default %d)." %
+                           REPEATS)
+    parser.add_option("-m", "--min-time", dest="min_time", default=MIN_TIME,
+                      type="float",
+                      help="Minimum seconds per repeat (default %.1f)." %
+                           MIN_TIME)
+    parser.add_option("-o", "--output", dest="output", default=None,
+                      type="string",
+                      help="File for JSON results (default stdout).")
+    parser.add_option("-b", "--baseline", dest="baseline", default=None,
+                      type="string",
+                      help="JSON results file from an earlier run to compare with.")
+    parser.add_option("-t", "--threshold", dest="threshold", default=10.0,
+                      type="float",
+                      help="Percentage slowdown reported as a regression (default 10).")
+    parser.add_option("-R", "--redis-db", dest="redis_db", default=None,
+                      type="int",
+                      help="Empty Redis database number for the Redis cache "
+                           "benchmark if fakeredis is not installed.")
+    (options, args) = parser.parse_args()
+
+    baseline = None
+    if options.baseline is not None:
+        try:
+            f = open(options.baseline, "r")
+            baseline = json.load(f)
+            f.close()
+        except (IOError, ValueError), e:
+            parser.error("Unable to read baseline %s: %s" % (options.baseline,
+                                                             str(e)))
+
+    report = run_benches(options)
+    regressions = []
+    if baseline is not None:
+        regressions = compare(report, baseline, options.threshold)
+
+    report_str = json.dumps(report, indent=2, sort_keys=True)
+    if options.output is None:
+        print report_str
+    else:
+        f = open(options.output, "w")
+        f.write(report_str)
+        f.write("\n")
+        f.close()
+    if len(regressions) > 0:
+        sys.exit(1)
+    sys.exit(0)
+
+#==============================================================================#
+if __name__ == "__main__":
+    bench_micro()
@@ -0,0 +1,316 @@
+#!/usr/bin/python
+"""
+@package nilib
+@file bench_startup.py
+@brief Start up time benchmark for the nilib command line entry points
+@version Copyright (C) 2012 Trinity College Dublin and Folly Consulting Ltd
+      This is an adjunct to the NI URI library developed as
+      part of the SAIL project. (http://sail-project.eu)
+
+      Specification(s) - note, versions may change
+          - http://tools.ietf.org/html/draft-farrell-decade-ni-10
+          - http://tools.ietf.org/html/draft-hallambaker-decade-ni-params-03
+          - http://tools.ietf.org/html/draft-kutscher-icnrg-netinf-proto-00
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+       - http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+================================================================================
+
+@details
+Measures how long each console script entry point listed in setup.py takes
+to get ready to run, i.e., to import the module containing its entry
+function.  The short lived clients (pyniget, pynipub, ...) pay this on
+every invocation, as does each mod_wsgi process when it loads the server.
+
+For each entry point a small wrapper script named after the console script
+(as setuptools does when installing it, so that modules that look at the
+name of the __main__ module behave as they would when installed) is run
+in a fresh interpreter a number of times.  The wrapper reports the time
+taken by the import and which of the modules in HEAVY_MODULES it caused
+to be loaded.  The time from starting the interpreter until it exits is
+also measured.  The best and median of the runs are reported in
+milliseconds.
+
+The server modules in EXTRA_ENTRY_POINTS are timed as well.
+
+Entry points whose modules cannot be imported here (e.g., dtnapi is not
+installed) are reported as skipped.
+
+Results are written as JSON (to stdout or a file).  When the results of an
+earlier run are given as a baseline, the import times are compared with
+it and the exit code is 1 if any has grown by more than the threshold.
+"""
+
+#==============================================================================#
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+#==============================================================================#
+##@var RUNS
+# Default number of times each entry point is started
+RUNS = 10
+
+##@var HEAVY_MODULES
+# Modules that are expensive to import and only needed for some features
+HEAVY_MODULES = [ "magic", "DNS", "qrcode", "PIL", "redis", "dtnapi",
+                  "posix_ipc", "cgi", "urllib2", "email.parser",
+                  "xml.etree.ElementTree", "multiprocessing",
+                  "logging.handlers" ]
+
+##@var EXTRA_ENTRY_POINTS
+# Server modules loaded other than through a console script - the request
+# handler loaded by the mod_wsgi application scripts and the standalone server
+EXTRA_ENTRY_POINTS = [ ("netinf_file.wsgi", "nilib.nihandler",
+                        "NIHTTPRequestHandler"),
+                       ("niserver", "nilib.niserver", "ni_http_server") ]
+
+##@var ENTRY_POINT_RE
+# Regular expression matching console script definitions in setup.py
+ENTRY_POINT_RE = re.compile(r"'\s*(\w+)\s*=\s*([\w.]+)\s*:\s*(\w+)\s*'")
+
+##@var WRAPPER
+# Wrapper script run for each entry point.  The time module is built in so
+# importing it first does not distort the measurement.
+WRAPPER = """import time
+t0 = time.time()
+import sys
+try:
+    from %(module)s import %(func)s
+    err = None
+except Exception, e:
+    err = "%%s: %%s" %% (e.__class__.__name__, str(e))
+t1 = time.time()
+import json
+heavy = [ m for m in %(heavy)r if m in sys.modules ]
+sys.stdout.write(json.dumps({ "import": t1 - t0, "heavy": heavy,
+                              "error": err }))
+"""
+
+#==============================================================================#
+def read_entry_points(setup_file):
+    """
+    @brief Find the console script entry points defined in setup.py
+    @param setup_file string pathname of setup.py
+    @return list of tuples (script name, module name, function name)
+
+    A stray '.py' on the end of a module name is removed.
+    """
+    f = open(setup_file, "r")
+    text = f.read()
+    f.close()
+    entry_points = []
+    for (script, module, func) in ENTRY_POINT_RE.findall(text):
+        if module.endswith(".py"):
+            module = module[:-3]
+        entry_points.append((script, module, func))
+    return entry_points
+
+#------------------------------------------------------------------------------#
+def median(values):
+    """
+    @brief Find the median of a list of numbers
+    @param values list of numbers (not empty)
+    @return median value
+    """
+    values = sorted(values)
+    n = len(values)
+    if n % 2 == 1:
+        return values[n // 2]
+    return (values[n // 2 - 1] + values[n // 2]) / 2.0
+
+#------------------------------------------------------------------------------#
+def time_entry_point(work_dir, script, module, func, runs, env):
+    """
+    @brief Time start up of one entry point
+    @param work_dir string directory for wrapper script
+    @param script string console script name
+    @param module string name of module containing entry function
+    @param func string name of entry function
+    @param runs integer number of times to start it
+    @param env dictionary environment for the interpreter
+    @return dictionary results (or with 'error' if it cannot be imported)
+    """
+    wrapper = os.path.join(work_dir, script)
+    f = open(wrapper, "w")
+    f.write(WRAPPER % { "module": module, "func": func,
+                        "heavy": HEAVY_MODULES })
+    f.close()
+    import_times = []
+    process_times = []
+    for i in range(runs):
+        t0 = time.time()
+        p = subprocess.Popen([sys.executable, wrapper], env=env,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        (out, err) = p.communicate()
+        process_times.append(time.time() - t0)
+        try:
+            rslt = json.loads(out)
+        except ValueError:
+            return { "error": "wrapper failed: %s" % err.strip() }
+        if rslt["error"] is not None:
+            return { "error": rslt["error"] }
+        import_times.append(rslt["import"])
+    return { "import_ms":          min(import_times) * 1000,
+             "import_ms_median":   median(import_times) * 1000,
+             "process_ms":         min(process_times) * 1000,
+             "process_ms_median":  median(process_times) * 1000,
+             "runs":               runs,
+             "heavy_modules":      rslt["heavy"] }
+
+#------------------------------------------------------------------------------#
+def run_benches(options):
+    """
+    @brief Time all the selected entry points
+    @param options options from command line
+    @return dictionary results report
+    """
+    report = { "python":    platform.python_version(),
+               "platform":  platform.platform(),
+               "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "results":   {},
+               "skipped":   {} }
+    env = dict(os.environ)
+    path = env.get("PYTHONPATH")
+    env["PYTHONPATH"] = options.lib_dir if not path else \
+                        os.pathsep.join([options.lib_dir, path])
+    work_dir = tempfile.mkdtemp(prefix="bench_startup")
+    try:
+        entry_points = read_entry_points(options.setup_file) + \
+                       EXTRA_ENTRY_POINTS
+        for (script, module, func) in entry_points:
+            if (options.filter is not None) and (options.filter not in script):
+                continue
+            rslt = time_entry_point(work_dir, script, module, func,
+                                    options.runs, env)
+            if "error" in rslt:
+                report["skipped"][script] = rslt["error"]
+                print >>sys.stderr, "%-20s skipped: %s" % (script,
+                                                           rslt["error"])
+                continue
+            report["results"][script] = rslt
+            print >>sys.stderr, "%-20s import %8.1f ms  process %8.1f ms  %s" % \
+                  (script, rslt["import_ms"], rslt["process_ms"],
+                   " ".join(rslt["heavy_modules"]))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return report
+
+#------------------------------------------------------------------------------#
+def compare(report, baseline, threshold):
+    """
+    @brief Compare import times with a baseline and print a table of changes
+    @param report dictionary results of this run
+    @param baseline dictionary results of baseline run
+    @param threshold float percentage slowdown counted as a regression
+    @return list of names of entry points that have regressed
+    """
+    regressions = []
+    print >>sys.stderr, "\n%-20s %10s %10s %9s" % ("Entry point", "Base ms",
+                                                   "Now ms", "Change")
+    base_results = baseline.get("results", {})
+    for name in sorted(report["results"]):
+        now = report["results"][name]["import_ms"]
+        base = base_results.get(name)
+        if base is None:
+            print >>sys.stderr, "%-20s %10s %10.1f %9s" % (name, "-", now, "new")
+            continue
+        base = base["import_ms"]
+        change = 100.0 * (now - base) / base
+        flag = ""
+        if change > threshold:
+            flag = " REGRESSION"
+            regressions.append(name)
+        print >>sys.stderr, "%-20s %10.1f %10.1f %+8.1f%%%s" % \
+              (name, base, now, change, flag)
+    report["baseline"] = { "timestamp":   baseline.get("timestamp"),
+                           "threshold":   threshold,
+                           "regressions": regressions }
+    return regressions
+
+#==============================================================================#
+def bench_startup():
+    """
+    @brief Run the start up benchmark
+    """
+    test_dir = os.path.dirname(os.path.abspath(__file__))
+    lib_dir = os.path.dirname(os.path.dirname(test_dir))
+    parser = OptionParser("%prog [-k <name filter>] [-n <runs>] "
+                          "[-o <results file>]\n"
+                          "       [-b <baseline file> [-t <threshold %>]] "
+                          "[-s <setup.py>] [-l <library dir>]")
+    parser.add_option("-k", "--filter", dest="filter", default=None,
+                      type="string",
+                      help="Only time entry points containing this string.")
+    parser.add_option("-n", "--runs", dest="runs", default=RUNS,
+                      type="int",
+                      help="Number of times each entry point is started "
+                           "(default %d)." % RUNS)
+    parser.add_option("-o", "--output", dest="output", default=None,
+                      type="string",
+                      help="File for JSON results (default stdout).")
+    parser.add_option("-b", "--baseline", dest="baseline", default=None,
+                      type="string",
+                      help="JSON results file from an earlier run to compare with.")
+    parser.add_option("-t", "--threshold", dest="threshold", default=10.0,
+                      type="float",
+                      help="Percentage slowdown reported as a regression (default 10).")
+    parser.add_option("-s", "--setup", dest="setup_file",
+                      default=os.path.join(lib_dir, "setup.py"),
+                      type="string",
+                      help="setup.py listing the entry points.")
+    parser.add_option("-l", "--lib-dir", dest="lib_dir", default=lib_dir,
+                      type="string",
+                      help="Directory containing the nilib package "
+                           "(added to PYTHONPATH).")
+    (options, args) = parser.parse_args()
+    if options.runs < 1:
+        parser.error("Number of runs must be at least 1")
+    baseline = None
+    if options.baseline is not None:
+        try:
+            f = open(options.baseline, "r")
+            baseline = json.load(f)
+            f.close()
+        except (IOError, ValueError), e:
+            parser.error("Unable to read baseline %s: %s" % (options.baseline,
+                                                             str(e)))
+    try:
+        report = run_benches(options)
+    except IOError, e:
+        parser.error("Unable to read %s: %s" % (options.setup_file, str(e)))
+    regressions = []
+    if baseline is not None:
+        regressions = compare(report, baseline, options.threshold)
+    report_str = json.dumps(report, indent=2, sort_keys=True)
+    if options.output is None:
+        print report_str
+    else:
+        f = open(options.output, "w")
+        f.write(report_str)
+        f.write("\n")
+        f.close()
+    if len(regressions) > 0:
+        sys.exit(1)
+    sys.exit(0)
+
+#==============================================================================#
+if __name__ == "__main__":
+    bench_startup()
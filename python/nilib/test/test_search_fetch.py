@@ -0,0 +1,114 @@
+#!/usr/bin/python
+"""
+@package nilib
+@file test_search_fetch.py
+@brief Tests for concurrent retrieval of external search results in nihandler.py
+@version Copyright (C) 2012 Trinity College Dublin and Folly Consulting Ltd
+      This is an adjunct to the NI URI library developed as
+      part of the SAIL project. (http://sail-project.eu)
+
+      Specification(s) - note, versions may change
+          - http://tools.ietf.org/html/draft-farrell-decade-ni-10
+          - http://tools.ietf.org/html/draft-hallambaker-decade-ni-params-03
+          - http://tools.ietf.org/html/draft-kutscher-icnrg-netinf-proto-00
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+       - http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+================================================================================
+
+@details
+Checks that NIHTTPRequestHandler.fetch_search_results returns as soon as
+SRCH_FETCH_WANTED of the (at most SRCH_LIMIT) items found by a search have
+been cached, without waiting for slow items, and that it waits for all the
+items when too few succeed.
+
+Retrieval of each item is simulated by overriding fetch_search_result, so
+no network access or cache is needed.  The output is written to stdout.
+"""
+
+#==============================================================================#
+import sys
+import time
+import threading
+
+from nilib.nihandler import NIHTTPRequestHandler
+
+#==============================================================================#
+class TestHandler(NIHTTPRequestHandler):
+    """
+    @brief Handler with simulated search result retrieval
+
+    The first 'fast' items are retrieved at once, the rest take 'delay'
+    seconds.  Items whose index is in 'failures' are not cached.
+    """
+    def __init__(self, fast, delay, failures=()):
+        self.fast = fast
+        self.delay = delay
+        self.failures = failures
+        self.released = threading.Event()
+        self.loginfo = self.logdebug = self.logerror = lambda s: None
+        return
+
+    def fetch_search_result(self, item, extrameta):
+        i = item["index"]
+        if i >= self.fast:
+            self.released.wait(self.delay)
+        if i in self.failures:
+            return None
+        item["ni_obj"] = "ni:///sha-256;%d" % i
+        return item
+
+#------------------------------------------------------------------------------#
+def make_results():
+    """
+    @brief Make a full set of search results
+    @return list of SRCH_LIMIT result dictionaries
+    """
+    return [ { "url": "http://example.com/%d" % i, "text": "t", "desc": "d",
+               "index": i }
+             for i in range(NIHTTPRequestHandler.SRCH_LIMIT) ]
+
+#==============================================================================#
+# EXECUTE TESTS
+#==============================================================================#
+errs = 0
+wanted = NIHTTPRequestHandler.SRCH_FETCH_WANTED
+limit = NIHTTPRequestHandler.SRCH_LIMIT
+if wanted >= limit:
+    print "SRCH_FETCH_WANTED (%d) must be less than SRCH_LIMIT (%d)" % \
+          (wanted, limit)
+    errs += 1
+
+# Enough fast items - should return with the first SRCH_FETCH_WANTED
+h = TestHandler(wanted, 5.0)
+t0 = time.time()
+cached = h.fetch_search_results(make_results(), {})
+elapsed = time.time() - t0
+h.released.set()
+print "Early return: %d items in %.2f s" % (len(cached), elapsed)
+if elapsed >= 2.0:
+    print "Results were not returned early"
+    errs += 1
+if [c["index"] for c in cached] != range(wanted):
+    print "Unexpected results: %s" % str([c["index"] for c in cached])
+    errs += 1
+
+# Too many failures - waits for all the items
+h = TestHandler(limit, 0, failures=range(limit - wanted + 1))
+cached = h.fetch_search_results(make_results(), {})
+print "With failures: %d items" % len(cached)
+if len(cached) != wanted - 1:
+    print "Expected %d items" % (wanted - 1)
+    errs += 1
+
+print "Tests completed with %d errors" % errs
@@ -89,6 +89,14 @@ SetEnv NETINF_GETPUTFORM <file path name>
 SetEnv NETINF_NRSFORM <file path name>
 SetEnv NETINF_FAVICON <file path name>
 SetEnv NETINF_PROVIDE_NRS <boolean> [yes/true/1|no/false/0]
+SetEnv NETINF_SEARCH_FALLBACK <boolean> [yes/true/1|no/false/0] (optional,
+       default yes - use external search engine if nothing found locally)
+SetEnv NETINF_PHASE_TIMING <boolean> [yes/true/1|no/false/0] (optional,
+       default no - log and aggregate the time spent in each request phase)
+SetEnv NETINF_FWD_NEG_NOTFOUND_TTL <seconds> (optional, default 30)
+SetEnv NETINF_FWD_NEG_TIMEOUT_TTL <seconds> (optional, default 5)
+SetEnv NETINF_FWD_NEG_MAX_ENTRIES <integer> (optional, default 10000)
+       - how long forwarding misses are remembered and how many are kept
 
 3) Convenience functions to provide logging functions at various informational
    levels (each takes a string to be logged).  The resulting string is fed
@@ -151,11 +159,8 @@ import time
 import random
 
 #=== Modules needing special downloading
-try:
-    import redis
-    redis_loaded = True
-except ImportError:
-    redis_loaded = False
+# redis is imported when the first request finds it needs a Redis client
+# (NRS server or Redis cache) so processes that do not use it never load it
 
 #=== Local package modules ===
 
@@ -165,7 +170,9 @@ from netinf_ver import NETINF_VER, NISERVER_VER
 # whether redis_store or file_store was imported.  Must have
 # Redis module if using Redis cache.
 if "redis_store" in sys.modules or "nilib.redis_store" in sys.modules:
-    if not redis_loaded:
+    try:
+        import redis
+    except ImportError:
         raise ImportError("Redis module not available")
     from cache_redis import RedisNetInfCache as NetInfCache
     using_redis_cache = True
@@ -176,6 +183,16 @@ print >>sys.stderr, "using_redis_cache: %s" % using_redis_cache
 
 # NetInf fowarding
 from nifwd import forwarder
+from niforward import NegativeCache
+from nrs_cache import NRSLookupCache
+from search_index import NDOSearchIndex
+from cache_listing import SharedCacheListing
+from search_cache import SearchResultCache
+from qrcode_cache import QRCodeCache
+from nitiming import PhaseStats, new_timer, PHASE_SEND
+import nimetrics
+from nimetrics import MetricsExporter, shm_name_for, timed_call, \
+                     stats_by_label
 
 #==============================================================================#
 # List of classes/global functions in file
@@ -275,11 +292,6 @@ netinf_handler = None
 # parallel.
 netinf_cache = None
 
-##@var redis_loaded
-# Flag indicating if it was possible to load the Redis module.
-# The program can do without Redis if not providing NRS services
-# and using filesystem cache.
-
 ##@var using_redis_cache
 # Flag indicating if the cache is using the Redis database mmechanism.
 # This is is true if the redis_store module had been loaded.
@@ -289,6 +301,48 @@ netinf_cache = None
 # Only one needed per process - deals with multiple threads effectively
 netinf_redis = None
 
+##@var netinf_nrs_cache
+# nrs_cache.NRSLookupCache instance holding recently read NRS entries.
+# Invalidations are shared with other processes through Redis pub/sub.
+netinf_nrs_cache = None
+
+##@var netinf_cache_listing
+# cache_listing.SharedCacheListing instance used by netinf_cache.  The
+# shared memory segment is shared by all the processes using the cache and
+# removed when the last one exits.
+netinf_cache_listing = None
+
+##@var netinf_search_index
+# search_index.NDOSearchIndex instance for the cache in this process.
+# Processes sharing the cache share the index journal file.
+netinf_search_index = None
+
+##@var netinf_search_cache
+# search_cache.SearchResultCache instance - uses Redis if available so that
+# all processes share results, otherwise memory in this process.
+netinf_search_cache = None
+
+##@var netinf_qrcode_cache
+# qrcode_cache.QRCodeCache instance for this process.  The rendered images
+# are also stored under the storage root where all processes can use them.
+netinf_qrcode_cache = None
+
+##@var netinf_phase_stats
+# nitiming.PhaseStats instance aggregating request phase times in this
+# process (None until a request asks for phase timing).
+netinf_phase_stats = None
+
+##@var netinf_metrics
+# nimetrics.MetricsExporter instance for this process.  Totals are shared
+# with the other processes using the same storage root through posix_ipc
+# shared memory.
+netinf_metrics = None
+
+##@var netinf_neg_cache
+# niforward.NegativeCache instance recording recent forwarding misses.
+# Shared by all the handler threads in this process.
+netinf_neg_cache = None
+
 #===========================================================================#
 class HeaderDict:
     """
@@ -826,6 +880,21 @@ class wsgiHTTPRequestShim:
     ##@var nrs_redis
     # object instance of Redis database interface (or None if provide_nrs False)
 
+    ##@var nrs_cache
+    # object NRSLookupCache instance shared by all handlers (or None)
+
+    ##@var search_index
+    # object NDOSearchIndex instance shared by all handlers
+
+    ##@var search_fallback
+    # boolean True if searches not satisfied locally use the external engine
+
+    ##@var search_cache
+    # object SearchResultCache instance shared by all handlers
+
+    ##@var qrcode_cache
+    # object QRCodeCache instance shared by all handlers
+
     # === CGI derived variables ===
     
     ##@var server_name
@@ -947,6 +1016,22 @@ class wsgiHTTPRequestShim:
     ##@var cache
     # object instance of NetInfCache interface to cache storage
 
+    ##@var phase_stats
+    # object PhaseStats instance shared by all handlers in the process
+    # (or None if phase timing is disabled)
+
+    ##@var timer
+    # object RequestTimer for the current request (or NULL_TIMER)
+
+    ##@var metrics
+    # object MetricsExporter shared by all handlers in the process
+
+    ##@var in_progress
+    # boolean True while the request is counted in REQUESTS_IN_PROGRESS
+
+    ##@var finished
+    # boolean True once the end of the request has been logged (see close)
+
     #--------------------------------------------------------------------------#
     def __init__(self, log_facility=None):
         """
@@ -1091,6 +1176,16 @@ class wsgiHTTPRequestShim:
         # Set up to record information for response
         self.clear_response()
         self.error_sent = False
+        self.timer = new_timer(None)
+        self.in_progress = False
+        self.finished = False
+
+        # For logging
+        self.stime = time.time()
+        self.msgid = "dunno"
+        self.req_size = -1
+        self.path = "(Not yet known)"
+        self.client_address = "(Not yet known)"
 
         # Alter logging level from default (INFO) if NetInf env var set
         self.log_level = self.NETINF_LOG_MAP[environ.get("NETINF_LOG_LEVEL",
@@ -1183,12 +1278,62 @@ class wsgiHTTPRequestShim:
             self.send_error(500, "Value of NETINF_PROVIDE_NRS must be one of yes/true/1/no/false/0.")
             return self.trigger_response(start_response)            
 
+        # Convert optional NETINF_SEARCH_FALLBACK to boolean (default yes)
+        search_fallback = environ.get("NETINF_SEARCH_FALLBACK", "yes").lower()
+        if search_fallback in ["yes", "true", "1"]:
+            self.search_fallback = True
+        elif search_fallback in ["no", "false", "0"] :
+            self.search_fallback = False
+        else:
+            self.logerror("Cannot convert NETINF_SEARCH_FALLBACK to boolean: %s" %
+                          search_fallback)
+            self.send_error(500, "Value of NETINF_SEARCH_FALLBACK must be one of yes/true/1/no/false/0.")
+            return self.trigger_response(start_response)
+
+        # Convert optional NETINF_PHASE_TIMING to boolean (default no)
+        # and give the request a timer (see nitiming.py)
+        global netinf_phase_stats
+        phase_timing = environ.get("NETINF_PHASE_TIMING", "no").lower()
+        if phase_timing in ["yes", "true", "1"]:
+            if netinf_phase_stats is None:
+                netinf_phase_stats = PhaseStats()
+            self.phase_stats = netinf_phase_stats
+        elif phase_timing in ["no", "false", "0"] :
+            self.phase_stats = None
+        else:
+            self.logerror("Cannot convert NETINF_PHASE_TIMING to boolean: %s" %
+                          phase_timing)
+            self.send_error(500, "Value of NETINF_PHASE_TIMING must be one of yes/true/1/no/false/0.")
+            return self.trigger_response(start_response)
+        self.timer = new_timer(self.phase_stats)
+
+        # On first instantiation - create the forwarding negative cache
+        # using the optional NETINF_FWD_NEG_* settings
+        global netinf_neg_cache
+        if netinf_neg_cache is None:
+            neg_params = {}
+            for (env_name, param, conv) in \
+                (("NETINF_FWD_NEG_NOTFOUND_TTL", "notfound_ttl", float),
+                 ("NETINF_FWD_NEG_TIMEOUT_TTL",  "timeout_ttl",  float),
+                 ("NETINF_FWD_NEG_MAX_ENTRIES",  "max_entries",  int)):
+                if env_name in environ:
+                    try:
+                        neg_params[param] = conv(environ[env_name])
+                    except ValueError:
+                        self.logerror("Value of %s is not an acceptable "
+                                      "number - using default" % env_name)
+            netinf_neg_cache = NegativeCache(**neg_params)
+            nimetrics.FWD_NEG_CACHE.set_function(
+                            lambda: stats_by_label(netinf_neg_cache.stats()))
+        self.fwd_neg_cache = netinf_neg_cache
+
         # On first instantiation - create Redis client if necessary
         global netinf_redis, using_redis_cache
         if (netinf_redis is None) and (self.provide_nrs or using_redis_cache):        
             # If an NRS server is wanted, create a Redis client instance
             # Assume it is the default local_host, port 6379 for the time being
             try:
+                import redis
                 netinf_redis = redis.StrictRedis(db=int(redis_db))
             except Exception, e:
                 self.logerror("Unable create connection for Redis server: %s" % str(e))
@@ -1206,6 +1351,25 @@ class wsgiHTTPRequestShim:
                                                               str(using_redis_cache)))
         self.nrs_redis = netinf_redis
 
+        # Local NRS lookup cache - one per process
+        global netinf_nrs_cache
+        if (netinf_nrs_cache is None) and (netinf_redis is not None):
+            netinf_nrs_cache = NRSLookupCache(netinf_redis, self.logger)
+            netinf_nrs_cache.start_listener()
+        self.nrs_cache = netinf_nrs_cache
+
+        # Search result cache - one per process
+        global netinf_search_cache
+        if netinf_search_cache is None:
+            netinf_search_cache = SearchResultCache(self.logger, netinf_redis)
+        self.search_cache = netinf_search_cache
+
+        # QRcode image cache - one per process
+        global netinf_qrcode_cache
+        if netinf_qrcode_cache is None:
+            netinf_qrcode_cache = QRCodeCache(self.logger, self.storage_root)
+        self.qrcode_cache = netinf_qrcode_cache
+
         # Setup the cache manager instance on first instantiation.
         global netinf_cache
         if netinf_cache is None:
@@ -1223,18 +1387,50 @@ class wsgiHTTPRequestShim:
                 
         self.cache = netinf_cache
 
-        # For logging
-        self.stime = time.time()
-        self.msgid = "dunno"
-        self.req_size = -1
-            
-        # Call appropriate command processor
-        mname = 'do_' + self.command
-        if not hasattr(self, mname):
-            self.send_error(501, "Unsupported method (%s)" % self.command)
-        else:
-            method = getattr(self, mname)
-            method()
+        # Setup the shared memory cache listing on first instantiation
+        global netinf_cache_listing
+        if netinf_cache_listing is None:
+            netinf_cache_listing = SharedCacheListing(self.storage_root,
+                                                      self.logger)
+            if netinf_cache_listing.attach(netinf_cache.cache_list):
+                netinf_cache.set_listing(netinf_cache_listing)
+
+        # Setup the local search index on first instantiation
+        global netinf_search_index
+        if netinf_search_index is None:
+            netinf_search_index = NDOSearchIndex(self.storage_root, self.logger)
+            if not netinf_search_index.exists():
+                netinf_search_index.rebuild(netinf_cache)
+            netinf_cache.set_search_index(netinf_search_index)
+        self.search_index = netinf_search_index
+
+        # Setup the metrics exporter on first instantiation
+        global netinf_metrics
+        if netinf_metrics is None:
+            shm_name = shm_name_for(self.storage_root)
+            netinf_metrics = MetricsExporter(self.logger, shm_name=shm_name)
+            if netinf_redis is not None:
+                nimetrics.REDIS_PING_SECONDS.set_function(
+                                lambda: timed_call(netinf_redis.ping))
+        self.metrics = netinf_metrics
+
+        # Count the request until close is called - or here if the
+        # command processor fails so that no response is returned
+        nimetrics.REQUESTS_IN_PROGRESS.inc()
+        self.in_progress = True
+        dispatched = False
+        try:
+            # Call appropriate command processor
+            mname = 'do_' + self.command
+            if not hasattr(self, mname):
+                self.send_error(501, "Unsupported method (%s)" % self.command)
+            else:
+                method = getattr(self, mname)
+                method()
+            dispatched = True
+        finally:
+            if not dispatched:
+                self.close()
 
         # Get the response going
         # Check that the method has flagged all the headers finished and
@@ -1255,6 +1451,8 @@ class wsgiHTTPRequestShim:
         """
         self.ready_to_iterate = True
 
+        # The response body is sent while WSGI iterates
+        self.timer.start(PHASE_SEND)
         start_response(self.response_status, self.response_headers)
         return iter(self)
 
@@ -1264,7 +1462,8 @@ class wsgiHTTPRequestShim:
         @brief This class can be treated as an iterator.
 
         It has a 'next' method that will deliver the contents of the
-        response_body in chunks when set up.
+        response_body in chunks when set up, and a 'close' method that
+        WSGI calls when it has finished with the response.
         """
         return self
     
@@ -1293,27 +1492,13 @@ class wsgiHTTPRequestShim:
         while True:
             if ((not self.ready_to_iterate) or
                 (self.resp_curr_index >= len(self.response_body))):
-
-                # Calculate time taken for request
-                etime = time.time()
-                duration = etime - self.stime
-
-                self.loginfo("end,req,%s,path,%s,from,%s,dur,%10.10f,msgid,%s,size,%d" %
-                             (self.command,
-                              self.path,
-                              self.client_address,
-                              duration * 1000,
-                              self.msgid,
-                              self.req_size))
-
-                # This probably does nothing for SysLogHandler
-                self.log_handler.flush()
-                
+                self.close()
                 raise StopIteration
 
             segment = self.response_body[self.resp_curr_index]
             if type(segment) == types.StringType:
                 self.resp_curr_index += 1
+                nimetrics.RESPONSE_BYTES.inc(len(segment))
                 return segment
             elif hasattr(segment, "read"):
                 blksize = 16384
@@ -1322,13 +1507,77 @@ class wsgiHTTPRequestShim:
                     segment.close()
                     self.resp_curr_index += 1
                     continue
+                nimetrics.RESPONSE_BYTES.inc(len(buf))
                 return buf
             else:
                 self.logerror("Item in response_body that is not a string or file")
                 self.resp_curr_index += 1
                 continue
         return None
-                
+
+    #--------------------------------------------------------------------------#
+    def close(self):
+        """
+        @brief Finish off the request when WSGI has finished with the response
+        @return (none)
+
+        WSGI calls this when the whole response body has been sent or when
+        sending is abandoned (e.g., the client went away).  It is also
+        called from next when the body has all been delivered and from
+        handle_request if the command processor raises an exception, so
+        only the first call has any effect.
+
+        Any files in the response body that have not been sent are closed,
+        the end of the request is logged and, if the request was counted
+        in REQUESTS_IN_PROGRESS, the request metrics are updated.  The
+        request phase times are logged and aggregated if enabled.
+        """
+        if self.finished:
+            return
+        self.finished = True
+
+        for segment in self.response_body[self.resp_curr_index:]:
+            if hasattr(segment, "close"):
+                try:
+                    segment.close()
+                except Exception, e:
+                    self.logerror("Unable to close response body file: %s" %
+                                  str(e))
+
+        # Calculate time taken for request
+        etime = time.time()
+        duration = etime - self.stime
+
+        self.loginfo("end,req,%s,path,%s,from,%s,dur,%10.10f,msgid,%s,size,%d" %
+                     (self.command,
+                      self.path,
+                      self.client_address,
+                      duration * 1000,
+                      self.msgid,
+                      self.req_size))
+
+        # Update the request metrics
+        if self.in_progress:
+            self.in_progress = False
+            method = nimetrics.method_label(self)
+            nimetrics.REQUESTS_IN_PROGRESS.dec()
+            nimetrics.REQUESTS.inc(labels=(method,))
+            nimetrics.REQUEST_SECONDS.observe(duration, labels=(method,))
+            self.metrics.request_done()
+
+        # Log and aggregate the request phase times
+        self.timer.stop(PHASE_SEND)
+        if self.timer.enabled():
+            self.phase_stats.record(self.timer)
+            self.loginfo("phases,req,%s,path,%s,msgid,%s,%s" %
+                         (self.command, self.path, self.msgid,
+                          self.timer.log_fields()))
+            self.timer = new_timer(None)
+
+        # This probably does nothing for SysLogHandler
+        self.log_handler.flush()
+        return
+
     #--------------------------------------------------------------------------#
     def clear_response(self):
         """
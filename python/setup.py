@@ -84,6 +84,8 @@ setup(name='nilib',
                            'pynipub = nilib.nipub:py_nipub',
                            'pynipubalt = nilib.nipubalt:py_nipubalt',
                            'pynipubdir = nilib.nipubdir:py_nipubdir',
+                           'pynimanifest = nilib.nimanifest:py_nimanifest',
+                           'pyniloadgen = nilib.niloadgen:py_niloadgen',
                            'pynisearch = nilib.nisearch:py_nisearch',
 			   'pyniwgsiserver = nilib.niwsgiserver.py:py_niwsgiserver']
                     },